@@ -15,6 +15,7 @@ parser = argparse.ArgumentParser(
 
 parser.add_argument('--n', dest='number_of_messages',    help='number of messages to publish', type=int, default=100)
 parser.add_argument('--t', dest='time', help='if provided, will publish n messages every t seconds', type=int, default=None)
+parser.add_argument('--batch_size', dest='batch_size', help='number of messages to publish per publish_many call', type=int, default=1000)
 parser.add_argument('--config', type=str, help='path to config file')
 parser.add_argument('-v', '--verbose', dest='verbose', action='store_true')
 args = parser.parse_args()
@@ -56,12 +57,18 @@ def create_random_message(payload: str):
 
 def publish():
     Statman.stopwatch(name='publish-sample-messages.timing', autostart=True)
-    for i in tqdm(range(0, args.number_of_messages)):
-        m = create_random_message(payload=f'HellO WorlD {i}')
-        kessel.publish(m)
-        Statman.gauge(name='publish-sample-messages.published-messages').increment()
+    with tqdm(total=args.number_of_messages) as progress:
+        for start in range(0, args.number_of_messages, args.batch_size):
+            end = min(start + args.batch_size, args.number_of_messages)
+            messages = [create_random_message(payload=f'HellO WorlD {i}') for i in range(start, end)]
+            kessel.publish_many(messages)
+            Statman.gauge(name='publish-sample-messages.published-messages').increment(len(messages))
+            progress.update(len(messages))
     Statman.stopwatch(name='publish-sample-messages.timing').stop()
-    
+    elapsed = Statman.stopwatch(name='publish-sample-messages.timing').value
+    if elapsed:
+        logger.success(f'published {args.number_of_messages} message(s) in {elapsed:.3f}s [{args.number_of_messages / elapsed:.1f} messages/s]')
+
 if args.time:
     continue_processing=True
     while continue_processing:
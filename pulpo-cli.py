@@ -69,8 +69,7 @@ class QueueCommands():
                 n=args.number_of_messages
             else:
                 n=1
-            for i in range(1,n+1):
-                QueueCommands.publish(client=client, body=args.payload)
+            QueueCommands.publish(client=client, body=args.payload, number_of_messages=n)
         else:
             raise Exception(f'invalid command [{command_child}]')
 
@@ -103,11 +102,15 @@ class QueueCommands():
         logger.success(f'delete: {message_id=}')
 
     @staticmethod
-    def publish(client: QueueAdapter, body: str):
-        message = Message(payload = body)
-        message.set_header_item("source", "pulpo-cli.py")
-        message = client.enqueue(message)
-        logger.success(f'put: {message.id=}')
+    def publish(client: QueueAdapter, body: str, number_of_messages: int = 1):
+        messages = []
+        for _ in range(0, number_of_messages):
+            message = Message(payload = body)
+            message.set_header_item("source", "pulpo-cli.py")
+            messages.append(message)
+        messages = client.enqueue_batch(messages)
+        for message in messages:
+            logger.success(f'put: {message.id=}')
 
 
 if __name__ == '__main__':
@@ -1,3 +1,4 @@
 from .kessel import Pulpo
+from .async_kessel import AsyncPulpo
 from .message import Message
 from .sample_handlers import EchoHandler, LowerCaseHandler, UpperCaseHandler
@@ -0,0 +1,225 @@
+import asyncio
+import datetime
+import math
+import greenstalk
+from loguru import logger
+from pulpo_messaging import greenstalk_protocol, message_codec
+from pulpo_messaging.async_queue_adapter import AsyncQueueAdapter
+from pulpo_messaging.beanstalkd_queue_adapter import BeanstalkdQueueAdapterConfig
+from pulpo_messaging.message import Message
+
+
+class AsyncBeanstalkdQueueAdapter(AsyncQueueAdapter):
+    '''
+    Speaks the beanstalkd protocol on asyncio streams, using greenstalk only for response parsing.
+    Commands are serialized on a single connection (beanstalkd requires a reserved job to be deleted / released on the connection that reserved it),
+    so a reserve with a reserve_timeout holds the connection for up to that timeout.  dequeue does not block with the default reserve_timeout of 0:
+    AsyncPulpo blocks in wait_for_message instead, only while no message is in flight, so the wait holds up enqueues only.
+    The watch_tubes are consumed (default_tube when not set), without the weights and tube_concurrency_limits applied by BeanstalkdQueueAdapter.
+    '''
+
+    _config = None
+    _reader = None
+    _writer = None
+    _lock = None
+    _connect_lock = None
+    _enqueue_lock = None
+    _used_tube = None
+    _waited_jobs = None
+
+    def __init__(self, options: dict):
+        super().__init__()
+        logger.trace('AsyncBeanstalkdQueueAdapter init')
+        self._config = BeanstalkdQueueAdapterConfig(options)
+        self._lock = asyncio.Lock()
+        self._connect_lock = asyncio.Lock()
+        self._enqueue_lock = asyncio.Lock()
+        self._waited_jobs = []
+
+    @property
+    def config(self) -> BeanstalkdQueueAdapterConfig:
+        return self._config
+
+    async def connect(self):
+        async with self._connect_lock:
+            if self._writer:
+                return
+            logger.debug(f'connecting to beanstalkd [{self.config.host}:{self.config.port}]')
+            self._reader, self._writer = await asyncio.open_connection(self.config.host, self.config.port)
+            tube = self.config.default_tube.encode('ascii')
+            await self._command(b'use %b' % tube, b'USING')
+            self._used_tube = self.config.default_tube
+            watch_tubes = list(self.config.watch_tubes or [self.config.default_tube])
+            for watch_tube in watch_tubes:
+                await self._command(b'watch %b' % watch_tube.encode('ascii'), b'WATCHING')
+            if greenstalk.DEFAULT_TUBE not in watch_tubes:
+                await self._command(b'ignore %b' % greenstalk.DEFAULT_TUBE.encode('ascii'), b'WATCHING')
+
+    async def close(self):
+        if self._writer:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+            self._reader = None
+
+    async def _command(self, command: bytes, expected: bytes, body: bytes = None) -> list:
+        '''Sends a command and returns the response values; for responses carrying a body (RESERVED / FOUND / OK), the last value is the body.'''
+        if not self._writer:
+            await self.connect()
+        async with self._lock:
+            if body is None:
+                self._writer.write(command + b'\r\n')
+            else:
+                self._writer.write(b'%b\r\n%b\r\n' % (command, body))
+            await self._writer.drain()
+
+            values = greenstalk_protocol.parse_response(await self._reader.readline(), expected)
+            if expected in {b'RESERVED', b'FOUND', b'OK'}:
+                size = int(values[-1])
+                values.append(greenstalk_protocol.parse_chunk(await self._reader.readexactly(size + 2), size))
+            return values
+
+    async def enqueue(self, message: Message) -> Message:
+        if self.config.attempts_tracking == 'message' and message.get('header.attempts') is None:
+            # see BeanstalkdQueueAdapter._track_attempts
+            message.attempts = 0
+        serialized_message = message_codec.encode_message(message, self.config.message_format)
+        command = b'put %d %d %d %d' % (message.priority, message.delayInSeconds, greenstalk.DEFAULT_TTR, len(serialized_message))
+        # tube_routes, as for BeanstalkdQueueAdapter; use and put are made under one lock so that concurrent enqueues do not interleave
+        tube = self.config.tube_routes.get(message.request_type, self.config.default_tube)
+        async with self._enqueue_lock:
+            if not self._writer:
+                await self.connect()
+            if tube != self._used_tube:
+                await self._command(b'use %b' % tube.encode('ascii'), b'USING')
+                self._used_tube = tube
+            (job_id, ) = await self._command(command, b'INSERTED', body=serialized_message)
+        message.id = int(job_id)
+        logger.debug(f'enqueued message {message.id=}')
+        return message
+
+    async def wait_for_message(self, timeout: float) -> bool:
+        '''See BeanstalkdQueueAdapter.wait_for_message: a job reserved by the wait is held (still reserved) and returned by the next dequeue.'''
+        if self._waited_jobs:
+            return True
+        try:
+            self._waited_jobs.append(await self._reserve(timeout=math.ceil(timeout)))
+        except greenstalk.TimedOutError:
+            return False
+        return True
+
+    async def _reserve(self, timeout: int) -> tuple:
+        if self._waited_jobs:
+            return self._waited_jobs.pop(0)
+        (job_id, _, body) = await self._command(b'reserve-with-timeout %d' % timeout, b'RESERVED')
+        return (int(job_id), body)
+
+    async def dequeue(self) -> Message:
+        m = None
+        try:
+            while not m:
+                (job_id, body) = await self._reserve(timeout=self.config.reserve_timeout)
+                m = await self._accept_reserved_job(job_id, body)
+        except greenstalk.TimedOutError:
+            logger.trace('AsyncBeanstalkdQueueAdapter dequeue reserve timeout')
+            m = None
+
+        if m:
+            logger.debug(f'dequeued message: {m.id=}')
+        return m
+
+    async def _accept_reserved_job(self, job_id: int, body: bytes) -> Message:
+        m = self._load_message(job_id, body)
+
+        if self.config.max_number_of_attempts:
+            await self._get_message_attempts(m)
+            if m.attempts >= self.config.max_number_of_attempts:
+                logger.warning(f'message exceed max attempts {m.id=} {self.config.max_number_of_attempts=} {m.attempts=}')
+                await self.commit(message=m, is_success=False)
+                return None
+        if m.expiration and m.expiration < datetime.datetime.now():
+            logger.warning(f'message expired {m.expiration=}')
+            await self.commit(message=m, is_success=False)
+            return None
+        return m
+
+    async def _get_message_attempts(self, message: Message):
+        '''See BeanstalkdQueueAdapter._get_message_attempts.'''
+        if self.config.attempts_tracking == 'message' and message.get('header.attempts') is not None:
+            return
+        job_stats = await self._stats_job(int(message.id))
+        message.attempts = (message.get('header.attempts') or 0) + job_stats.get('releases')
+
+    def _load_message(self, job_id: int, body: bytes) -> Message:
+        m = message_codec.decode_message(body)
+        m.id = job_id
+        return m
+
+    async def _stats_job(self, job_id: int) -> dict:
+        (_, body) = await self._command(b'stats-job %d' % job_id, b'OK')
+        return greenstalk_protocol.parse_stats(body)
+
+    async def peek(self, message_id: str) -> Message:
+        logger.debug(f'peek {message_id=}')
+        (job_id, _, body) = await self._command(b'peek %d' % int(message_id), b'FOUND')
+        return self._load_message(int(job_id), body)
+
+    async def delete(self, message_id: str):
+        logger.trace(f'delete {message_id=}')
+        await self._command(b'delete %d' % int(message_id), b'DELETED')
+
+    async def commit(self, message: Message, is_success: bool = True) -> Message:
+        logger.trace(f'commit (delete) {message.id=}')
+        await self._command(b'delete %d' % int(message.id), b'DELETED')
+
+    async def rollback(self, message: Message, delay: float = None) -> Message:
+        priority = message.priority
+        if self.config.priority_aging_interval:
+            # see BeanstalkdQueueAdapter._get_release_priority
+            job_stats = await self._stats_job(int(message.id))
+            priority = message.get_aged_priority(waited_seconds=job_stats.get('age'), priority_aging_interval=self.config.priority_aging_interval)
+        if self.config.attempts_tracking == 'message':
+            message.attempts = message.attempts + 1
+            await self._reput(message, priority, delay)
+            return
+        delay_seconds = math.ceil(delay) if delay else 0
+        logger.trace(f'rollback (release) {message.id=} {priority=} {delay_seconds=}')
+        await self._command(b'release %d %d %d' % (int(message.id), priority, delay_seconds), b'RELEASED')
+
+    async def defer(self, message: Message, delay: float = None):
+        '''See BeanstalkdQueueAdapter.defer.'''
+        if not self.config.max_number_of_attempts:
+            # the attempts were not read when the job was reserved
+            await self._get_message_attempts(message)
+        # set in the header, which carries the attempts to the new job
+        message.attempts = message.attempts
+        await self._reput(message, message.priority, delay)
+
+    async def _reput(self, message: Message, priority: int, delay: float = None):
+        '''See BeanstalkdQueueAdapter._reput; the attempts are set by the caller.'''
+        job_id = int(message.id)
+        message.priority = priority
+        if delay:
+            message.delay = datetime.timedelta(seconds=delay)
+        await self.enqueue(message)
+        logger.trace(f'rollback (re-put) {job_id=} {message.id=} {message.attempts=}')
+        await self._command(b'delete %d' % job_id, b'DELETED')
+
+    @property
+    def is_pause_shared(self) -> bool:
+        '''See BeanstalkdQueueAdapter.is_pause_shared.'''
+        return True
+
+    async def pause_request_type(self, request_type: str, duration: float) -> bool:
+        '''See BeanstalkdQueueAdapter.pause_request_type.'''
+        tube = self.config.tube_routes.get(request_type)
+        if not tube:
+            return False
+        await self._command(b'pause-tube %b %d' % (tube.encode('ascii'), math.ceil(duration)), b'PAUSED')
+        return True
+
+    async def beanstalk_stat(self, tube: str = None) -> dict:
+        if not tube:
+            tube = self.config.default_tube
+        (_, body) = await self._command(b'stats-tube %b' % tube.encode('ascii'), b'OK')
+        return greenstalk_protocol.parse_stats(body)
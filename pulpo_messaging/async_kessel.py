@@ -0,0 +1,279 @@
+import asyncio
+import signal
+import time
+from statman import Statman
+from loguru import logger
+from .async_beanstalkd_queue_adapter import AsyncBeanstalkdQueueAdapter
+from .async_queue_adapter import AsyncFileQueueAdapter, AsyncQueueAdapter
+from .circuit_breaker import CircuitBreakers
+from .kessel import HandlerRegistry, PulpoConfig
+from .message import Message
+from .payload_handler import AsyncPayloadHandler, PayloadHandler, RequestResult
+from .rate_limiter import RequestTypeLimiter
+from .retry_policy import RetryPolicies
+
+
+class AsyncPulpoConfig(PulpoConfig):
+
+    @property
+    def concurrency_limit(self) -> int:
+        return self.getAsInt('concurrency_limit', 100)
+
+
+class AsyncPulpo():
+    '''
+    asyncio runtime: messages are dequeued on the event loop and each is handled on its own task, with at most concurrency_limit handlers running at once.
+    AsyncPayloadHandler coroutines are awaited on the loop; (blocking) PayloadHandler instances are run on the loop's default executor.
+    '''
+
+    _queue_adapter = None
+    _config = None
+    _handler_registry = None
+    _shutdown_requested = False
+    _retry_policies = None
+    _circuit_breakers = None
+    _throttled_count = 0
+    # taken by each message handled by start, and given back by a message while throttle_message holds it
+    _concurrency_limit = None
+    # set, and replaced, whenever a message counted by the limits of its request type completes
+    _limits_released = None
+
+    def __init__(self, options: dict = None, queue_adapter: AsyncQueueAdapter = None):
+        self._config = AsyncPulpoConfig(options)
+        self._retry_policies = RetryPolicies(policies=self.config.retry_policies, default_policy=self.config.default_retry_policy)
+        self._circuit_breakers = CircuitBreakers(breakers=self.config.circuit_breakers, default_breaker=self.config.default_circuit_breaker)
+        self._queue_adapter = queue_adapter
+        self._handler_registry = HandlerRegistry(rate_limit_directory=self.config.rate_limit_directory)
+        self._shutdown_requested = False
+        self._throttled_count = 0
+
+    def initialize_queue_adapter(self) -> AsyncQueueAdapter:
+        logger.debug('init async queue adapter')
+        if self._queue_adapter:
+            pass  #queue adapter already initialized
+        elif self.config.queue_adapter_type in {'FileQueueAdapter', 'file_queue_adapter'}:
+            self._queue_adapter = AsyncFileQueueAdapter(self.config.get('file_queue_adapter'))
+        elif self.config.queue_adapter_type in {'BeanstalkdQueueAdapter', 'beanstalkd_queue_adapter'}:
+            self._queue_adapter = AsyncBeanstalkdQueueAdapter(self.config.get('beanstalkd_queue_adapter'))
+        else:
+            raise Exception(f'invalid queue adapter type {self.config.queue_adapter_type}')
+        return self._queue_adapter
+
+    @property
+    def config(self) -> AsyncPulpoConfig:
+        return self._config
+
+    @property
+    def queue_adapter(self) -> AsyncQueueAdapter:
+        return self._queue_adapter
+
+    @property
+    def handler_registry(self) -> HandlerRegistry:
+        return self._handler_registry
+
+    async def publish(self, message: Message) -> Message:
+        self.initialize_queue_adapter()
+        logger.info(f'publish message [{message.request_type}]')
+        return await self.queue_adapter.enqueue(message)
+
+    async def start(self):
+        self.initialize_queue_adapter()
+        self._add_signal_handlers()
+
+        concurrency_limit = self._concurrency_limit = asyncio.Semaphore(self.config.concurrency_limit)
+        in_flight = set()
+        # wait on the queue adapter made while messages are in flight, kept until it completes (an adapter may not be left in the middle of a wait)
+        waiting = None
+        iterations_with_no_messages = 0
+        while not self._shutdown_requested:
+            await concurrency_limit.acquire()
+            Statman.gauge('kessel.dequeue-attempts').increment()
+            message = await self.queue_adapter.dequeue()
+            if message:
+                iterations_with_no_messages = 0
+                task = asyncio.create_task(self._handle_message_and_release(message, concurrency_limit))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+                continue
+
+            concurrency_limit.release()
+            if in_flight or waiting:
+                logger.trace('no message available, wait for messages and in-flight messages')
+                if waiting is None:
+                    waiting = asyncio.ensure_future(self.queue_adapter.wait_for_message(timeout=self.config.wait_interval))
+                await asyncio.wait(in_flight | {waiting}, return_when=asyncio.FIRST_COMPLETED)
+                if waiting.done():
+                    waiting.result()
+                    waiting = None
+                continue
+
+            iterations_with_no_messages += 1
+            logger.trace(f'no message available [iteration with no messages = {iterations_with_no_messages}][max = {self.config.shutdown_after_number_of_empty_iterations}]')
+            if iterations_with_no_messages >= self.config.shutdown_after_number_of_empty_iterations:
+                logger.info('no message available, shutdown')
+                break
+            logger.debug('no message available, wait')
+            await self.wait_for_messages(self.config.sleep_duration)
+
+        if waiting:
+            await waiting
+        if in_flight:
+            logger.info(f'draining in-flight messages [in-flight={len(in_flight)}]')
+            await asyncio.gather(*in_flight)
+        self._concurrency_limit = None
+        await self.queue_adapter.close()
+        self._remove_signal_handlers()
+        logger.info('pulpo-messaging shutdown')
+
+    async def wait_for_messages(self, duration: float) -> bool:
+        '''See Pulpo.wait_for_messages: the wait is made in slices of at most wait_interval seconds, so that request_shutdown ends it within one slice.'''
+        deadline = time.monotonic() + duration
+        while not self._shutdown_requested:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if await self.queue_adapter.wait_for_message(timeout=min(remaining, self.config.wait_interval)):
+                logger.trace('wait complete, message may be available')
+                return True
+        return False
+
+    async def _handle_message_and_release(self, message: Message, concurrency_limit: asyncio.Semaphore):
+        try:
+            await self.handle_message(message)
+        finally:
+            concurrency_limit.release()
+
+    async def handle_message(self, message: Message) -> RequestResult:
+        Statman.gauge('kessel.dequeue').increment()
+        limiter = self.handler_registry.get_limiter(message.request_type)
+        if limiter and not await self.throttle_message(message, limiter):
+            return None
+        if await self.hold_back_message(message):
+            if limiter:
+                # see Pulpo._refund_message_limits
+                limiter.refund()
+            return None
+        if limiter is None:
+            return await self._handle_message(message)
+        try:
+            return await self._handle_message(message)
+        finally:
+            limiter.release()
+            if self._limits_released:
+                self._limits_released.set()
+                self._limits_released = None
+
+    async def throttle_message(self, message: Message, limiter: RequestTypeLimiter) -> bool:
+        '''
+        Waits on the task of the message until the rate limit and concurrency cap of its request type let it through, and returns True.
+        While it waits, the message gives back its slot of concurrency_limit (taken back before the message is handled), so that the messages of other request types are
+        dequeued and handled meanwhile; the queue adapter may be asked to hold back the request type (see Pulpo._pause_throttled_request_type).
+        Once max_throttled_messages are waiting, the message is deferred with a delay instead (which does not count as an attempt), and False is returned.
+        '''
+        wait = limiter.acquire()
+        if not wait:
+            return True
+        if self._throttled_count >= self.config.max_throttled_messages:
+            logger.debug(f'message throttled, deferred [id={message.id}][type={message.request_type}][{wait=}]')
+            await self._pause_throttled_request_type(message.request_type, limiter, wait)
+            await self.queue_adapter.defer(message=message, delay=wait)
+            Statman.gauge('kessel.messages.throttled').increment()
+            return False
+
+        self._throttled_count += 1
+        if self._concurrency_limit:
+            self._concurrency_limit.release()
+        try:
+            while wait:
+                logger.debug(f'message throttled [id={message.id}][type={message.request_type}][{wait=}]')
+                await self._pause_throttled_request_type(message.request_type, limiter, wait)
+                Statman.gauge('kessel.messages.throttled').increment()
+                if self._limits_released is None:
+                    self._limits_released = asyncio.Event()
+                try:
+                    # a message of the request type that completes may free its concurrency cap
+                    await asyncio.wait_for(self._limits_released.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                wait = limiter.acquire()
+        finally:
+            self._throttled_count -= 1
+            if self._concurrency_limit:
+                await self._concurrency_limit.acquire()
+        return True
+
+    async def _pause_throttled_request_type(self, request_type: str, limiter: RequestTypeLimiter, wait: float):
+        '''See Pulpo._pause_throttled_request_type.'''
+        if limiter.is_at_concurrency_cap or self.queue_adapter.is_pause_shared:
+            return
+        await self.queue_adapter.pause_request_type(request_type=request_type, duration=wait)
+
+    async def hold_back_message(self, message: Message) -> bool:
+        '''See Pulpo.hold_back_message.'''
+        hold_duration = self._circuit_breakers.get_hold_duration(message.request_type)
+        if hold_duration is None:
+            return False
+        logger.info(f'circuit breaker open, message held back [id={message.id}][type={message.request_type}][{hold_duration=}]')
+        await self.queue_adapter.pause_request_type(request_type=message.request_type, duration=hold_duration)
+        await self.queue_adapter.defer(message=message, delay=hold_duration)
+        Statman.gauge('kessel.messages.held-back').increment()
+        return True
+
+    async def _handle_message(self, message: Message) -> RequestResult:
+        logger.info(f'processing message [id={message.id}][type={message.request_type}]')
+        handler = self.handler_registry.get(message.request_type)
+        logger.trace(f'handler: {handler}')
+        try:
+            if isinstance(handler, AsyncPayloadHandler):
+                result = await handler.handle(payload=message.payload)
+            elif isinstance(handler, PayloadHandler):
+                result = await asyncio.get_running_loop().run_in_executor(None, handler.handle, message.payload)
+            else:
+                logger.warning(f'WARNING no valid handler for message type {message.request_type} {handler}')
+                result = RequestResult.fatal_factory(f'WARNING no valid handler for message type {message.request_type}')
+        except Exception as e:
+            logger.warning(f'handler raised exception [id={message.id}][type={message.request_type}][{e=}]')
+            result = RequestResult.transient_factory(error=str(e))
+        logger.trace(f'processing complete: {result=}')
+        open_duration = self._circuit_breakers.record(message.request_type, result)
+        if open_duration is not None:
+            logger.warning(f'circuit breaker opened [type={message.request_type}][{open_duration=}]')
+            Statman.gauge('kessel.circuit-breaker.opened').increment()
+            await self.queue_adapter.pause_request_type(request_type=message.request_type, duration=open_duration)
+
+        if result.isSuccess:
+            logger.info(f'message successfully processed [id={message.id}][type={message.request_type}]')
+            await self.queue_adapter.commit(message=message, is_success=True)
+            Statman.gauge('kessel.messages.success').increment()
+        elif result.isTransient:
+            delay = self._retry_policies.get_delay(request_type=message.request_type, attempts=message.attempts, retry_after=result.retry_after)
+            logger.warning(f'message failed due to transient condition [id={message.id}][type={message.request_type}][{delay=}]')
+            await self.queue_adapter.rollback(message=message, delay=delay)
+            Statman.gauge('kessel.messages.transient').increment()
+        elif result.isFatal:
+            logger.warning(f'message failed due to fatal exception [id={message.id}][type={message.request_type}]')
+            await self.queue_adapter.commit(message=message, is_success=False)
+            Statman.gauge('kessel.messages.fatal').increment()
+
+        Statman.gauge('kessel.messages_processed').increment()
+        return result
+
+    def _add_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.request_shutdown)
+            except RuntimeError:
+                logger.debug(f'unable to install signal handler [{signum=}]')
+
+    def _remove_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.remove_signal_handler(signum)
+            except RuntimeError:
+                pass
+
+    def request_shutdown(self):
+        logger.info('shutdown requested')
+        self._shutdown_requested = True
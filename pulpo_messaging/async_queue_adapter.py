@@ -0,0 +1,129 @@
+import asyncio
+import concurrent.futures
+import time
+from .file_queue_adapter import FileQueueAdapter
+from .message import Message
+from .queue_adapter import QueueAdapter
+
+
+class AsyncQueueAdapter():
+    '''asyncio counterpart of QueueAdapter, used by AsyncPulpo.'''
+
+    async def enqueue(self, message: Message) -> Message:
+        pass
+
+    async def dequeue(self) -> Message:
+        pass
+
+    async def wait_for_message(self, timeout: float) -> bool:
+        '''See QueueAdapter.wait_for_message.  This default implementation sleeps for the timeout.'''
+        await asyncio.sleep(timeout)
+        return False
+
+    async def commit(self, message: Message, is_success: bool = True) -> Message:
+        pass
+
+    async def rollback(self, message: Message, delay: float = None) -> Message:
+        pass
+
+    async def defer(self, message: Message, delay: float = None):
+        '''See QueueAdapter.defer.  This default implementation rolls back, counting an attempt.'''
+        await self.rollback(message=message, delay=delay)
+
+    async def pause_request_type(self, request_type: str, duration: float) -> bool:  # pylint: disable=unused-argument
+        '''See QueueAdapter.pause_request_type.'''
+        return False
+
+    @property
+    def is_pause_shared(self) -> bool:
+        '''See QueueAdapter.is_pause_shared.'''
+        return False
+
+    async def peek(self, message_id: str) -> Message:
+        pass
+
+    async def delete(self, message_id: str):
+        pass
+
+    async def close(self):
+        pass
+
+
+class ExecutorQueueAdapter(AsyncQueueAdapter):
+    '''
+    Runs a (blocking) QueueAdapter on a thread pool executor, so that its I/O does not block the event loop.
+    With max_workers above 1, calls run concurrently on the threads of the executor: the queue adapter must then be thread safe.
+    '''
+
+    _queue_adapter = None
+    _executor = None
+
+    def __init__(self, queue_adapter: QueueAdapter, max_workers: int = None):
+        self._queue_adapter = queue_adapter
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pulpo-queue-adapter')
+
+    @property
+    def queue_adapter(self) -> QueueAdapter:
+        return self._queue_adapter
+
+    @property
+    def is_pause_shared(self) -> bool:
+        return self.queue_adapter.is_pause_shared
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def enqueue(self, message: Message) -> Message:
+        return await self._run(self.queue_adapter.enqueue, message)
+
+    async def dequeue(self) -> Message:
+        return await self._run(self.queue_adapter.dequeue)
+
+    async def wait_for_message(self, timeout: float) -> bool:
+        return await self._run(self.queue_adapter.wait_for_message, timeout)
+
+    async def commit(self, message: Message, is_success: bool = True) -> Message:
+        return await self._run(self.queue_adapter.commit, message, is_success)
+
+    async def rollback(self, message: Message, delay: float = None) -> Message:
+        return await self._run(self.queue_adapter.rollback, message, delay)
+
+    async def defer(self, message: Message, delay: float = None):
+        return await self._run(self.queue_adapter.defer, message, delay)
+
+    async def pause_request_type(self, request_type: str, duration: float) -> bool:
+        return await self._run(self.queue_adapter.pause_request_type, request_type, duration)
+
+    async def peek(self, message_id: str) -> Message:
+        return await self._run(self.queue_adapter.peek, message_id)
+
+    async def delete(self, message_id: str):
+        return await self._run(self.queue_adapter.delete, message_id)
+
+    async def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class AsyncFileQueueAdapter(ExecutorQueueAdapter):
+    '''
+    Runs a FileQueueAdapter on a single thread: FileQueueAdapter is not thread safe (ready index refresh, change feed and inotify reads, cached lookups),
+    so its calls are serialized, in the order they are made, while the event loop goes on with the handlers.
+    wait_for_message runs on that thread too, in slices of wait_poll_interval seconds, so that the other calls wait for at most one slice.
+    '''
+
+    def __init__(self, options: dict):
+        super().__init__(queue_adapter=FileQueueAdapter(options), max_workers=1)
+
+    @property
+    def queue_adapter(self) -> FileQueueAdapter:
+        return self._queue_adapter
+
+    async def wait_for_message(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            # inotify events arriving between slices are kept by the watch, and read by the next slice
+            if await self._run(self.queue_adapter.wait_for_message, min(remaining, self.queue_adapter.config.wait_poll_interval)):
+                return True
@@ -0,0 +1,177 @@
+import contextlib
+import threading
+import time
+from greenstalk import Address
+from greenstalk import Client as BeanstalkClient
+from loguru import logger
+from statman import Statman
+
+
+class BeanstalkdConnection():
+    '''A greenstalk client, with the tubes it uses and watches.  A connection is used by one thread at a time (see BeanstalkdConnectionPool).'''
+
+    _address = None
+    _default_tube = None
+    client = None
+    used_tube = None
+    watched_tubes = None
+    last_used_at = None
+
+    def __init__(self, address: Address, default_tube: str):
+        self._address = address
+        self._default_tube = default_tube
+        self.last_used_at = time.monotonic()
+
+    @property
+    def is_connected(self) -> bool:
+        return self.client is not None
+
+    def connect(self):
+        # job bodies are handled as bytes, as produced by the message_format codec
+        self.client = BeanstalkClient(address=self._address, encoding=None, watch=self._default_tube, use=self._default_tube)
+        self.used_tube = self._default_tube
+        self.watched_tubes = [self._default_tube]
+
+    def is_healthy(self) -> bool:
+        try:
+            self.client.using()
+            return True
+        except OSError:
+            return False
+
+    def close(self):
+        if self.client:
+            try:
+                self.client.close()
+            except OSError:
+                pass
+        self.client = None
+
+
+class BeanstalkdConnectionPool():
+    '''
+    Thread safe pool of beanstalkd connections.
+    A connection is lent to one thread at a time (`with pool.connection() as connection:`), and is created (up to max_size) when no connection is idle.
+    beanstalkd requires a reserved job to be deleted / released on the connection that reserved it, so reserved jobs are bound to their connection (bind_job)
+    and `pool.connection(job_id)` waits for that connection.
+    A connection that fails with a socket error is closed, losing its reserved jobs (beanstalkd releases them); it reconnects, with exponential backoff, when next lent.
+    Idle connections are health checked before being lent.
+    '''
+
+    _address = None
+    _default_tube = None
+    _max_size = None
+    _health_check_interval = None
+    _reconnect_initial_delay = None
+    _reconnect_max_delay = None
+    _reconnect_max_attempts = None
+    _connections = None
+    _idle = None
+    _job_connections = None
+    _condition = None
+
+    def __init__(self,
+                 address: Address,
+                 default_tube: str,
+                 max_size: int = 4,
+                 health_check_interval: float = 30,
+                 reconnect_initial_delay: float = 0.1,
+                 reconnect_max_delay: float = 5,
+                 reconnect_max_attempts: int = 10):
+        self._address = address
+        self._default_tube = default_tube
+        self._max_size = max(max_size, 1)
+        self._health_check_interval = health_check_interval
+        self._reconnect_initial_delay = reconnect_initial_delay
+        self._reconnect_max_delay = reconnect_max_delay
+        self._reconnect_max_attempts = reconnect_max_attempts
+        self._connections = []
+        self._idle = []
+        self._job_connections = {}
+        self._condition = threading.Condition()
+
+    @property
+    def size(self) -> int:
+        with self._condition:
+            return len(self._connections)
+
+    @contextlib.contextmanager
+    def connection(self, job_id: int = None):
+        '''Lends a connection: the connection holding job_id reserved when it is bound, otherwise any connection.'''
+        connection = self._acquire(job_id)
+        try:
+            self._prepare(connection)
+            yield connection
+        except OSError:
+            self._disconnect(connection)
+            raise
+        finally:
+            connection.last_used_at = time.monotonic()
+            with self._condition:
+                self._idle.append(connection)
+                self._condition.notify_all()
+
+    def _acquire(self, job_id: int) -> BeanstalkdConnection:
+        with self._condition:
+            while True:
+                bound_connection = self._job_connections.get(job_id) if job_id is not None else None
+                if bound_connection:
+                    if bound_connection in self._idle:
+                        self._idle.remove(bound_connection)
+                        return bound_connection
+                elif self._idle:
+                    # most recently used first, so that a single threaded user keeps using one connection
+                    return self._idle.pop()
+                elif len(self._connections) < self._max_size:
+                    connection = BeanstalkdConnection(address=self._address, default_tube=self._default_tube)
+                    self._connections.append(connection)
+                    logger.debug(f'beanstalkd connection pool grown [size={len(self._connections)}]')
+                    return connection
+                self._condition.wait()
+
+    def _prepare(self, connection: BeanstalkdConnection):
+        if connection.is_connected and time.monotonic() - connection.last_used_at >= self._health_check_interval and not connection.is_healthy():
+            logger.warning('beanstalkd connection failed health check, reconnect')
+            self._disconnect(connection)
+        if not connection.is_connected:
+            self._connect(connection)
+
+    def _connect(self, connection: BeanstalkdConnection):
+        delay = self._reconnect_initial_delay
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                connection.connect()
+                return
+            except OSError as ex:
+                if self._reconnect_max_attempts and attempt >= self._reconnect_max_attempts:
+                    logger.error(f'beanstalkd connect failed, giving up [{attempt=}][{ex=}]')
+                    raise
+                logger.warning(f'beanstalkd connect failed, retry [{attempt=}][{delay=}][{ex=}]')
+                Statman.gauge('bqa.reconnect').increment()
+                time.sleep(delay)
+                delay = min(delay * 2, self._reconnect_max_delay)
+
+    def _disconnect(self, connection: BeanstalkdConnection):
+        connection.close()
+        with self._condition:
+            lost_job_ids = [job_id for job_id, bound_connection in self._job_connections.items() if bound_connection is connection]
+            for job_id in lost_job_ids:
+                del self._job_connections[job_id]
+        if lost_job_ids:
+            logger.warning(f'beanstalkd connection lost with reserved jobs, beanstalkd releases them [{lost_job_ids=}]')
+
+    def bind_job(self, job_id: int, connection: BeanstalkdConnection):
+        with self._condition:
+            self._job_connections[job_id] = connection
+
+    def unbind_job(self, job_id: int):
+        with self._condition:
+            self._job_connections.pop(job_id, None)
+
+    def close(self):
+        with self._condition:
+            for connection in self._connections:
+                connection.close()
+            self._job_connections.clear()
@@ -1,12 +1,19 @@
 import datetime
-import json
+import functools
+import math
+import time
+import typing
+from collections.abc import Callable
 import greenstalk
 from statman import Statman
 from greenstalk import Client as BeanstalkClient
 from loguru import logger
 from pulpo_config import Config
+from pulpo_messaging import greenstalk_protocol, message_codec
+from pulpo_messaging.beanstalkd_connection_pool import BeanstalkdConnection, BeanstalkdConnectionPool
 from pulpo_messaging.message import Message
 from pulpo_messaging.queue_adapter import QueueAdapter
+from pulpo_messaging.tube_scheduler import DeficitRoundRobin
 
 # from greenstalk import (
 #     DEFAULT_PRIORITY,
@@ -60,6 +67,10 @@ class BeanstalkdQueueAdapterConfig(Config):
     def encoding(self: Config) -> str:
         return self.get('encoding', "utf-8")
 
+    @property
+    def message_format(self: Config) -> str:
+        return self.get('message_format', 'json')
+
     @property
     def reserve_timeout(self: Config) -> int:
         return self.getAsInt('reserve_timeout', 0)
@@ -68,19 +79,90 @@ class BeanstalkdQueueAdapterConfig(Config):
     def max_number_of_attempts(self: Config) -> bool:
         return self.getAsInt('max_number_of_attempts', 0)
 
+    @property
+    def attempts_tracking(self: Config) -> str:
+        '''stats_job: attempts are beanstalkd's release count for the job (a stats-job per reserve).  message: attempts are carried in the message header, and a rollback re-puts the message.'''
+        return self.get('attempts_tracking', 'stats_job')
+
+    @property
+    def priority_aging_interval(self: Config) -> float:
+        return float(self.get('priority_aging_interval', 0))
+
+    @property
+    def tube_routes(self: Config) -> dict:
+        return self.get('tube_routes', None) or {}
+
+    @property
+    def watch_tubes(self: Config) -> dict:
+        '''Tubes to consume from, with their deficit round robin weights.  A list of tubes is weighted equally.'''
+        watch_tubes = self.get('watch_tubes', None)
+        if isinstance(watch_tubes, (list, tuple)):
+            return {tube: 1 for tube in watch_tubes}
+        return watch_tubes
+
+    @property
+    def tube_concurrency_limits(self: Config) -> dict:
+        return self.get('tube_concurrency_limits', None) or {}
+
+    @property
+    def enqueue_batch_chunk_size(self: Config) -> int:
+        return self.getAsInt('enqueue_batch_chunk_size', 1000)
+
+    @property
+    def connection_pool_size(self: Config) -> int:
+        return self.getAsInt('connection_pool_size', 4)
+
+    @property
+    def health_check_interval(self: Config) -> float:
+        return float(self.get('health_check_interval', 30))
+
+    @property
+    def reconnect_initial_delay(self: Config) -> float:
+        return float(self.get('reconnect_initial_delay', 0.1))
+
+    @property
+    def reconnect_max_delay(self: Config) -> float:
+        return float(self.get('reconnect_max_delay', 5))
+
+    @property
+    def reconnect_max_attempts(self: Config) -> int:
+        return self.getAsInt('reconnect_max_attempts', 10)
+
 
 class BeanstalkdQueueAdapter(QueueAdapter):
+    '''
+    Queue adapter over beanstalkd.  Commands run on connections lent by a BeanstalkdConnectionPool, so the adapter may be shared across threads (e.g. producers calling Pulpo.publish).
+    A command that fails with a connection error is retried once, on a reconnected connection.  A put may therefore be repeated (at least once delivery).
+    '''
 
     _config = None
-    _client = None
+    _pool = None
+    _waited_jobs = None
+    _scheduler = None
+    _reserved_tubes = None
+    _tube_in_flight = None
 
     def __init__(self, options: dict):
         super().__init__()
         logger.trace('BeanstalkdQueueAdapter init')
+        self._waited_jobs = []
 
         self._config = BeanstalkdQueueAdapterConfig(options)
-        address = (self.config.host, self.config.port)
-        self._client = BeanstalkClient(address=address, encoding=self.config.encoding, watch=self.config.default_tube, use=self.config.default_tube)
+        self._pool = BeanstalkdConnectionPool(address=(self.config.host, self.config.port),
+                                              default_tube=self.config.default_tube,
+                                              max_size=self.config.connection_pool_size,
+                                              health_check_interval=self.config.health_check_interval,
+                                              reconnect_initial_delay=self.config.reconnect_initial_delay,
+                                              reconnect_max_delay=self.config.reconnect_max_delay,
+                                              reconnect_max_attempts=self.config.reconnect_max_attempts)
+        # connect up front, so that a misconfigured address fails at startup
+        with self._pool.connection():
+            pass
+
+        if self.config.watch_tubes:
+            self._scheduler = DeficitRoundRobin(self.config.watch_tubes)
+            self._reserved_tubes = {}
+            self._tube_in_flight = {tube: 0 for tube in self._scheduler.tubes}
 
         Statman.external_source('beanstalk', self.beanstalk_stat)
 
@@ -88,38 +170,143 @@ class BeanstalkdQueueAdapter(QueueAdapter):
     def config(self) -> BeanstalkdQueueAdapterConfig:
         return self._config
 
+    @property
+    def pool(self) -> BeanstalkdConnectionPool:
+        return self._pool
+
     @property
     def client(self) -> BeanstalkClient:
-        return self._client
+        '''A client from the pool, for diagnostics; not safe to use while other threads use the adapter.'''
+        with self._pool.connection() as connection:
+            return connection.client
+
+    def _execute(self, command: Callable[[BeanstalkdConnection], typing.Any], job_id: int = None) -> typing.Any:
+        '''Runs command on a pooled connection (the connection holding job_id, when bound).  On a connection error the command is retried once, after reconnecting.'''
+        try:
+            with self._pool.connection(job_id=job_id) as connection:
+                return command(connection)
+        except OSError as ex:
+            logger.warning(f'beanstalkd connection error, retry on a new connection [{ex=}]')
+            Statman.gauge('bqa.connection-error').increment()
+        with self._pool.connection(job_id=job_id) as connection:
+            return command(connection)
 
     def enqueue(self, message: Message) -> Message:
-        serialized_message = json.dumps(message._components, indent=2, default=str)
-        # self.client.use( self.config.default_tube )
-        put_job_id = self.client.put(body=serialized_message, delay=message.delayInSeconds)
-        message.id = put_job_id
+        self._track_attempts(message)
+        serialized_message = message_codec.encode_message(message, self.config.message_format)
+        tube = self._get_tube(message)
+
+        def put(connection: BeanstalkdConnection) -> int:
+            self._use(connection, tube)
+            return connection.client.put(body=serialized_message, priority=message.priority, delay=message.delayInSeconds)
+
+        message.id = self._execute(put)
         logger.debug(f'enqueued message {message.id=}')
         return message
 
+    def enqueue_batch(self, messages: list) -> list:
+        '''
+        Pipelines the puts: the put commands for a chunk of messages are sent in a single write, then the responses are read.
+        greenstalk has no pipelining support, so this uses its connection directly.
+        '''
+        chunk_size = self.config.enqueue_batch_chunk_size
+        for message in messages:
+            self._track_attempts(message)
+        for start in range(0, len(messages), chunk_size):
+            # runs of messages routed to the same tube are pipelined together
+            run = []
+            for message in messages[start:start + chunk_size]:
+                if run and self._get_tube(message) != self._get_tube(run[0]):
+                    self._execute(functools.partial(self._pipeline_put, messages=run))
+                    run = []
+                run.append(message)
+            self._execute(functools.partial(self._pipeline_put, messages=run))
+        logger.debug(f'enqueued messages {len(messages)=}')
+        return messages
+
+    def _track_attempts(self, message: Message):
+        '''With attempts_tracking message, a message is put with its attempts header set, marking that the header (not stats-job) holds its attempts.'''
+        if self.config.attempts_tracking == 'message' and message.get('header.attempts') is None:
+            message.attempts = 0
+
+    def _get_tube(self, message: Message) -> str:
+        '''Tube a message is put on: tube_routes maps request types to tubes, other messages go to default_tube.'''
+        return self.config.tube_routes.get(message.request_type, self.config.default_tube)
+
+    def _use(self, connection: BeanstalkdConnection, tube: str):
+        if tube != connection.used_tube:
+            connection.client.use(tube)
+            connection.used_tube = tube
+
+    def _watch_only(self, connection: BeanstalkdConnection, tubes: list):
+        '''Watches exactly the given tubes.  The watch / ignore commands are pipelined, costing a single round trip.'''
+        if tubes == connection.watched_tubes:
+            return
+        commands = [b'watch %b\r\n' % tube.encode('ascii') for tube in tubes if tube not in connection.watched_tubes]
+        commands += [b'ignore %b\r\n' % tube.encode('ascii') for tube in connection.watched_tubes if tube not in tubes]
+        greenstalk_protocol.send(connection.client, b''.join(commands))
+        for _ in commands:
+            greenstalk_protocol.read_response(connection.client, b'WATCHING')
+        connection.watched_tubes = list(tubes)
+
+    def _pipeline_put(self, connection: BeanstalkdConnection, messages: list):
+        self._use(connection, self._get_tube(messages[0]))
+        client = connection.client
+        commands = []
+        for message in messages:
+            body = message_codec.encode_message(message, self.config.message_format)
+            commands.append(b'put %d %d %d %d\r\n%b\r\n' % (message.priority, message.delayInSeconds, greenstalk.DEFAULT_TTR, len(body), body))
+        greenstalk_protocol.send(client, b''.join(commands))
+
+        # read every response before raising, so that the connection is left in a consistent state
+        error = None
+        for message in messages:
+            try:
+                (job_id, ) = greenstalk_protocol.read_response(client, b'INSERTED')
+                message.id = int(job_id)
+            except greenstalk.Error as ex:
+                error = error or ex
+        if error:
+            raise error
+
+    def _reserve_on(self, connection: BeanstalkdConnection, tubes: list, timeout: int) -> greenstalk.Job:
+        '''Reserves on connection from the given tubes, binding the job to the connection.'''
+        self._watch_only(connection, tubes)
+        job = connection.client.reserve(timeout=timeout)
+        self._pool.bind_job(job.id, connection)
+        return job
+
+    def wait_for_message(self, timeout: float) -> bool:
+        '''Blocks in reserve for up to timeout seconds.  A job reserved by the wait is held (still reserved), with the tubes it was reserved from, and returned by the next dequeue.'''
+        if self._waited_jobs:
+            return True
+        tubes = self._get_tubes_under_concurrency_limit() if self._scheduler else [self.config.default_tube]
+        if not tubes:
+            time.sleep(timeout)
+            return False
+        try:
+            logger.trace(f'BeanstalkdQueueAdapter wait begin reserve {timeout=}')
+            self._waited_jobs.append((self._execute(functools.partial(self._reserve_on, tubes=tubes, timeout=math.ceil(timeout))), tubes))
+        except greenstalk.TimedOutError:
+            return False
+        return True
+
+    def _reserve(self, timeout: int) -> greenstalk.Job:
+        if self._waited_jobs:
+            return self._waited_jobs.pop(0)[0]
+        return self._execute(functools.partial(self._reserve_on, tubes=[self.config.default_tube], timeout=timeout))
+
     def dequeue(self) -> Message:
-        self.client.watch(self.config.default_tube)
+        if self._scheduler:
+            return self._dequeue_from_scheduled_tube(timeout=self.config.reserve_timeout)
+
         m = None
         try:
             while not m:
                 logger.trace(f'BeanstalkdQueueAdapter dequeue begin reserve {self.config.reserve_timeout=}')
-                job = self.client.reserve(timeout=self.config.reserve_timeout)
+                job = self._reserve(timeout=self.config.reserve_timeout)
                 logger.trace(f'BeanstalkdQueueAdapter dequeue reserve complete {job.id=}')
-                m = self._load_message_from_job(job)
-
-                if m and self.config.max_number_of_attempts:
-                    self._get_message_attempts(m)
-                    if m.attempts >= self.config.max_number_of_attempts:
-                        logger.warning(f'message exceed max attempts {m.id=} {self.config.max_number_of_attempts=} {m.attempts=}')
-                        self.commit(message=m, is_success=False)
-                        m = None
-                if m and m.expiration and m.expiration < datetime.datetime.now():
-                    logger.warning(f'message expired {m.expiration=}')
-                    self.commit(message=m, is_success=False)
-                    m = None
+                m = self._accept_reserved_job(job)
 
         except greenstalk.TimedOutError:
             logger.trace('BeanstalkdQueueAdapter dequeue reserve timeout')
@@ -131,36 +318,268 @@ class BeanstalkdQueueAdapter(QueueAdapter):
 
         return m
 
+    def dequeue_batch(self, max_messages: int = 1, timeout: float = None) -> list:
+        '''
+        Reserves up to max_messages jobs.  The first reserve waits up to timeout seconds (reserve_timeout when not provided);
+        the remaining reserves are pipelined on the socket with a zero timeout, costing a single round trip.
+        '''
+        if timeout is None:
+            timeout = self.config.reserve_timeout
+
+        if self._scheduler:
+            messages = []
+            m = self._dequeue_from_scheduled_tube(timeout=int(timeout))
+            while m:
+                messages.append(m)
+                m = self._dequeue_from_scheduled_tube(timeout=0) if len(messages) < max_messages else None
+            return messages
+
+        messages = []
+        try:
+            logger.trace(f'BeanstalkdQueueAdapter dequeue batch begin reserve {timeout=}')
+            jobs = [self._reserve(timeout=int(timeout))]
+        except greenstalk.TimedOutError:
+            logger.trace('BeanstalkdQueueAdapter dequeue batch reserve timeout')
+            return messages
+
+        if max_messages > 1:
+            jobs += self._execute(functools.partial(self._pipeline_reserve, count=max_messages - 1))
+
+        for job in jobs:
+            m = self._accept_reserved_job(job)
+            if m:
+                messages.append(m)
+
+        logger.debug(f'dequeued messages: {len(messages)=}')
+        return messages
+
+    def _pipeline_reserve(self, connection: BeanstalkdConnection, count: int) -> list:
+        '''Sends count reserve-with-timeout 0 commands in a single write, then reads the responses.  greenstalk has no pipelining support, so this uses its connection directly.'''
+        self._watch_only(connection, [self.config.default_tube])
+        client = connection.client
+        greenstalk_protocol.send(client, b'reserve-with-timeout 0\r\n' * count)
+        jobs = []
+        for _ in range(count):
+            try:
+                (job_id, size) = (int(n) for n in greenstalk_protocol.read_response(client, b'RESERVED'))
+            except greenstalk.TimedOutError:
+                continue
+            jobs.append(greenstalk_protocol.read_job(client, job_id, size))
+            self._pool.bind_job(job_id, connection)
+        return jobs
+
+    def _dequeue_from_scheduled_tube(self, timeout: int) -> Message:
+        '''
+        Dequeues from the watch_tubes, choosing the tube by deficit round robin.  Only tubes with ready jobs (per beanstalk_stat) and under their concurrency limit are chosen.
+        When no tube has a ready job, blocks in reserve for up to timeout seconds on every tube under its concurrency limit.
+        '''
+        if self._waited_jobs:
+            (job, tubes) = self._waited_jobs.pop(0)
+            m = self._accept_scheduled_job(job, tubes=tubes)
+            if m:
+                return m
+
+        m = self._reserve_from_scheduled_tube()
+        if m:
+            return m
+
+        tubes = self._get_tubes_under_concurrency_limit()
+        if timeout <= 0 or not tubes:
+            return None
+        try:
+            return self._accept_scheduled_job(self._execute(functools.partial(self._reserve_on, tubes=tubes, timeout=timeout)), tubes=tubes)
+        except greenstalk.TimedOutError:
+            logger.trace('BeanstalkdQueueAdapter dequeue reserve timeout')
+            return None
+
+    def _reserve_from_scheduled_tube(self) -> Message:
+        '''Reserves, without waiting, from the tube chosen by the scheduler among tubes with ready jobs.  Returns None when no tube has a ready job.'''
+        timed_out_tubes = set()
+        while True:
+            tube = self._scheduler.select(lambda tube: tube not in timed_out_tubes and self._is_tube_ready(tube))
+            if tube is None:
+                return None
+            try:
+                job = self._execute(functools.partial(self._reserve_on, tubes=[tube], timeout=0))
+            except greenstalk.TimedOutError:
+                # reserved by another consumer since the stats were read
+                timed_out_tubes.add(tube)
+                continue
+            m = self._accept_scheduled_job(job, tubes=[tube])
+            if m:
+                return m
+
+    def _is_tube_ready(self, tube: str) -> bool:
+        limit = self.config.tube_concurrency_limits.get(tube)
+        if limit and self._tube_in_flight[tube] >= limit:
+            return False
+        try:
+            return self.beanstalk_stat(tube).get('current-jobs-ready', 0) > 0
+        except greenstalk.NotFoundError:
+            # the tube does not exist until a job is put on it
+            return False
+
+    def _get_tubes_under_concurrency_limit(self) -> list:
+        limits = self.config.tube_concurrency_limits
+        return [tube for tube in self._scheduler.tubes if not limits.get(tube) or self._tube_in_flight[tube] < limits.get(tube)]
+
+    def _accept_scheduled_job(self, job: greenstalk.Job, tubes: list) -> Message:
+        '''
+        Accepts a job reserved from tubes (of the watch_tubes), counting it against its tube's concurrency limit until it is committed or rolled back.
+        A job reserved from several tubes is taken to be on the tube its request type is routed to (tube_routes, as producers route it), when that tube is one of them;
+        otherwise its tube is read with a stats-job round trip.
+        '''
+        m = self._accept_reserved_job(job)
+        tube = tubes[0]
+        if m and len(tubes) > 1 and self.config.tube_concurrency_limits:
+            tube = self._get_tube(m)
+            if tube not in tubes:
+                tube = self._stats_job(job.id).get('tube')
+        if m and tube in self._tube_in_flight:
+            self._reserved_tubes[m.id] = tube
+            self._tube_in_flight[tube] += 1
+        if m:
+            logger.debug(f'dequeued message: {m.id=} {tube=}')
+        return m
+
+    def _release_job(self, message_id: str):
+        '''Called once a job is deleted or released: unbinds it from its connection and from its tube's concurrency limit.'''
+        self._pool.unbind_job(int(message_id))
+        if self._scheduler:
+            tube = self._reserved_tubes.pop(str(message_id), None)
+            if tube:
+                self._tube_in_flight[tube] -= 1
+
+    def _accept_reserved_job(self, job: greenstalk.Job) -> Message:
+        '''Loads a reserved job, failing (deleting) it if it has exceeded max attempts or has expired.  Returns None for a failed job.'''
+        m = self._load_message_from_job(job)
+
+        if m and self.config.max_number_of_attempts:
+            self._get_message_attempts(m)
+            if m.attempts >= self.config.max_number_of_attempts:
+                logger.warning(f'message exceed max attempts {m.id=} {self.config.max_number_of_attempts=} {m.attempts=}')
+                self.commit(message=m, is_success=False)
+                m = None
+        if m and m.expiration and m.expiration < datetime.datetime.now():
+            logger.warning(f'message expired {m.expiration=}')
+            self.commit(message=m, is_success=False)
+            m = None
+
+        return m
+
     def _load_message_from_job(self, job):
-        message_components = json.loads(job.body)
-        m = Message(components=message_components)
+        m = message_codec.decode_message(job.body)
         m.id = job.id
         return m
 
+    def _stats_job(self, job_id: int) -> dict:
+        return self._execute(lambda connection: connection.client.stats_job(job_id))
+
     def peek(self, message_id: str) -> Message:
         logger.debug(f'peek {message_id=}')
-        job = self.client.peek(id=int(message_id))
+        job = self._execute(lambda connection: connection.client.peek(id=int(message_id)))
         message = self._load_message_from_job(job)
         return message
 
     def _get_message_attempts(self, message: Message) -> Message:
-        job_stats = self.client.stats_job(int(message.id))
-        message.attempts = job_stats.get('releases')
+        if self.config.attempts_tracking == 'message' and message.get('header.attempts') is not None:
+            return message
+        # stats_job tracking, or a message put without the attempts header (by an adapter using stats_job tracking);
+        # a message put again (by defer) carries the attempts made before in its header
+        job_stats = self._stats_job(int(message.id))
+        message.attempts = (message.get('header.attempts') or 0) + job_stats.get('releases')
         return message
 
     def delete(self, message_id: str, is_success: bool = True) -> Message:  # pylint: disable=unused-argument
         logger.trace(f'delete {message_id=}')
-        self.client.delete(job=greenstalk.Job(id=int(message_id), body=''))
+        self._delete_job(message_id)
 
     def commit(self, message: Message, is_success: bool = True) -> Message:
         logger.trace(f'commit (delete) {message.id=}')
-        self.client.delete(job=greenstalk.Job(int(message.id), message.body))
+        self._delete_job(message.id)
 
-    def rollback(self, message: Message) -> Message:
-        logger.trace(f'rollback (release) {message.id=}')
-        self.client.release(job=greenstalk.Job(int(message.id), message.body))
+    def _delete_job(self, message_id: str):
+        try:
+            self._execute(lambda connection: connection.client.delete(job=int(message_id)), job_id=int(message_id))
+        except greenstalk.NotFoundError:
+            # the connection that reserved the job was lost: beanstalkd has released the job, and another consumer may have reserved it
+            logger.warning(f'delete of a job no longer reserved by this adapter, it may be delivered again {message_id=}')
+        self._release_job(message_id)
+
+    def rollback(self, message: Message, delay: float = None) -> Message:
+        priority = self._get_release_priority(message)
+        if self.config.attempts_tracking == 'message':
+            self._reput(message, priority, delay)
+            return
+        # beanstalkd delays are whole seconds
+        delay_seconds = math.ceil(delay) if delay else 0
+        logger.trace(f'rollback (release) {message.id=} {priority=} {delay_seconds=}')
+        try:
+            self._execute(lambda connection: connection.client.release(job=greenstalk.Job(int(message.id), b''), priority=priority, delay=delay_seconds), job_id=int(message.id))
+        except greenstalk.NotFoundError:
+            # the connection that reserved the job was lost, and beanstalkd has already released the job
+            logger.warning(f'rollback of a job no longer reserved by this adapter {message.id=}')
+        self._release_job(message.id)
+
+    def defer(self, message: Message, delay: float = None):
+        '''
+        Puts the message again, with its attempts and priority unchanged, then deletes the reserved job (see _reput): a release would count as an attempt in the job's stats.
+        The attempts are carried in the message header, which stats_job tracking adds to the releases of the new job.
+        '''
+        if not self.config.max_number_of_attempts:
+            # the attempts were not read when the job was reserved
+            self._get_message_attempts(message)
+        self._reput(message, priority=message.priority, delay=delay, count_attempt=False)
+
+    @property
+    def is_pause_shared(self) -> bool:
+        '''A paused tube is paused for every consumer of the server.'''
+        return True
+
+    def pause_request_type(self, request_type: str, duration: float) -> bool:
+        '''
+        Pauses the tube of request_type (beanstalkd `pause-tube`, in whole seconds rounded up), if it has its own tube in tube_routes.
+        The pause applies to every consumer of the tube.  A request type on the default tube cannot be held back without holding back the others.
+        '''
+        tube = self.config.tube_routes.get(request_type)
+        if not tube:
+            return False
+        logger.info(f'pause tube [{tube=}][{request_type=}][{duration=}]')
+        self._execute(lambda connection: connection.client.pause_tube(tube, math.ceil(duration)))
+        return True
+
+    def _reput(self, message: Message, priority: int, delay: float = None, count_attempt: bool = True):
+        '''
+        Rolls back by putting the message again, with its attempts incremented (if count_attempt), then deleting the reserved job.  The message gets the id of the new job.
+        beanstalkd cannot change the body of a job, so a release cannot carry the attempts.  If the delete fails the message is delivered twice (at least once delivery).
+        '''
+        job_id = int(message.id)
+        message.attempts = message.attempts + 1 if count_attempt else message.attempts
+        message.priority = priority
+        if delay:
+            message.delay = datetime.timedelta(seconds=delay)
+        self.enqueue(message)
+        logger.trace(f'rollback (re-put) {job_id=} {message.id=} {message.attempts=}')
+        try:
+            self._execute(lambda connection: connection.client.delete(job=job_id), job_id=job_id)
+        except greenstalk.NotFoundError:
+            logger.warning(f'rollback of a job no longer reserved by this adapter, it will be delivered again {job_id=}')
+        self._release_job(str(job_id))
+
+    def _get_release_priority(self, message: Message) -> int:
+        '''
+        The message priority, aged by the time since the job was put when priority_aging_interval is set.
+        beanstalkd cannot change the priority of a ready job, so aging is applied when a job is released.
+        '''
+        if not self.config.priority_aging_interval:
+            return message.priority
+        job_stats = self._stats_job(int(message.id))
+        return message.get_aged_priority(waited_seconds=job_stats.get('age'), priority_aging_interval=self.config.priority_aging_interval)
 
     def beanstalk_stat(self, tube: str = None) -> Message:
         if not tube:
             tube = self.config.default_tube
-        return self.client.stats_tube(tube)
+        return self._execute(lambda connection: connection.client.stats_tube(tube))
+
+    def close(self):
+        self._pool.close()
@@ -0,0 +1,108 @@
+import os
+import threading
+import time
+from loguru import logger
+from statman import Statman
+from pulpo_messaging import inotify
+from pulpo_messaging.message_file_name import MessageFileName
+
+LOCK_FILE_SUFFIX = '.message.lock'
+
+
+class ChangeFeed():
+    '''
+    In-memory view of the message files in the queue directories and the lock directories (one of each, or one per shard), kept current from inotify events.
+    Events are applied when the feed is polled (a non-blocking read), so a caller that polls before reading the view sees every completed file operation.
+    A full scan is still needed to seed the view, after an inotify queue overflow, and every resync_interval seconds as a safety net.
+    '''
+
+    _watch = None
+    _base_path = None
+    _lock_path = None
+    _queue_paths = None
+    _lock_paths = None
+    _resync_interval = None
+    _queued = None
+    _locked = None
+    _resync_requested = None
+    _resynced_at = None
+    _lock = None
+
+    def __init__(self, base_path: str, lock_path: str, resync_interval: float, shard_names: list = None):
+        '''With shard_names, the shard subdirectories of base_path and lock_path are watched (see FileQueueLayout).'''
+        self._base_path = base_path
+        self._lock_path = lock_path
+        self._queue_paths = {os.path.join(base_path, shard_name) for shard_name in shard_names} if shard_names else {base_path}
+        self._lock_paths = {os.path.join(lock_path, shard_name) for shard_name in shard_names} if shard_names else {lock_path}
+        mask = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM | inotify.IN_DELETE
+        self._watch = inotify.InotifyWatch(paths=sorted(self._queue_paths) + sorted(self._lock_paths), mask=mask)
+        self._resync_interval = resync_interval
+        self._queued = {}
+        self._locked = set()
+        self._resync_requested = True
+        self._resynced_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def is_resync_due(self) -> bool:
+        return self._resync_requested or time.monotonic() - self._resynced_at >= self._resync_interval
+
+    def discard_pending(self):
+        '''Drops pending events; called before a full scan, which reflects them.'''
+        with self._lock:
+            self._watch.read()
+
+    def resync(self, queued_file_names: list, locked_file_names: list):
+        '''Replaces the view with the result of a full scan (started after discard_pending).  Events raised during the scan are applied by the next poll.'''
+        with self._lock:
+            self._queued = {MessageFileName.parse(file_name).message_id: file_name for file_name in queued_file_names}
+            self._locked = {file_name[:-len(LOCK_FILE_SUFFIX)] for file_name in locked_file_names if file_name.endswith(LOCK_FILE_SUFFIX)}
+            self._resync_requested = False
+            self._resynced_at = time.monotonic()
+        logger.trace(f'change feed resync [queued={len(self._queued)}][locked={len(self._locked)}]')
+        Statman.gauge('fqa.change-feed.resync').increment()
+
+    def poll(self) -> list:
+        '''Applies pending events; returns the queue directory changes as a list of (file_name, is_added), in event order.'''
+        changes = []
+        with self._lock:
+            for event in self._watch.read():
+                if event.is_overflow:
+                    logger.warning('change feed event queue overflow, resync requested')
+                    self._resync_requested = True
+                elif event.path in self._queue_paths:
+                    self._apply_queue_event(event, changes)
+                elif event.path in self._lock_paths:
+                    self._apply_lock_event(event)
+        return changes
+
+    def _apply_queue_event(self, event: inotify.InotifyEvent, changes: list):
+        if not event.name.endswith('.message'):
+            return
+        message_id = MessageFileName.parse(event.name).message_id
+        if event.mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO):
+            self._queued[message_id] = event.name
+            changes.append((event.name, True))
+        elif self._queued.get(message_id) == event.name:
+            del self._queued[message_id]
+            changes.append((event.name, False))
+
+    def _apply_lock_event(self, event: inotify.InotifyEvent):
+        if not event.name.endswith(LOCK_FILE_SUFFIX):
+            return
+        message_id = event.name[:-len(LOCK_FILE_SUFFIX)]
+        if event.mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO):
+            self._locked.add(message_id)
+        else:
+            self._locked.discard(message_id)
+
+    def get_queued_file_name(self, message_id: str) -> str:
+        with self._lock:
+            return self._queued.get(message_id)
+
+    def is_locked(self, message_id: str) -> bool:
+        with self._lock:
+            return message_id in self._locked
+
+    def close(self):
+        self._watch.close()
@@ -0,0 +1,147 @@
+import collections
+import time
+from pulpo_config import Config
+from .payload_handler import RequestResult
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+
+class CircuitBreakerConfig(Config):
+
+    def __init__(self, options: dict = None, json_file_path: str = None):
+        super().__init__(options=options, json_file_path=json_file_path)
+
+    @property
+    def window_size(self: Config) -> int:
+        return self.getAsInt('window_size', 20)
+
+    @property
+    def minimum_calls(self: Config) -> int:
+        return self.getAsInt('minimum_calls', 10)
+
+    @property
+    def failure_rate_threshold(self: Config) -> float:
+        return float(self.get('failure_rate_threshold', 0.5))
+
+    @property
+    def open_duration(self: Config) -> float:
+        return float(self.get('open_duration', 30))
+
+    @property
+    def half_open_max_calls(self: Config) -> int:
+        return self.getAsInt('half_open_max_calls', 1)
+
+
+class CircuitBreaker():
+    '''
+    Circuit breaker of one request type.  Closed, the outcome of the last window_size messages is kept, and the breaker opens once at least minimum_calls
+    have completed and the rate of transient failures reaches failure_rate_threshold.  Open, no message is handled for open_duration seconds; the breaker then
+    half-opens, and lets half_open_max_calls messages through as probes: it closes when they all succeed, and opens again on the first that fails.
+    Fatal failures are not counted: they are a fault of the message, not of a dependency.
+    '''
+
+    # while the probes of a half-open breaker are in flight, seconds for which further messages are held back
+    HALF_OPEN_HOLD_DURATION = 1
+
+    config = None
+    request_type = None
+    _state = None
+    _outcomes = None
+    _opened_at = None
+    _probes_started = None
+    _probes_succeeded = None
+
+    def __init__(self, request_type: str, options: dict = None):
+        self.config = CircuitBreakerConfig(options)
+        self.request_type = request_type
+        self._close()
+
+    @property
+    def state(self) -> str:
+        if self._state == STATE_OPEN and time.monotonic() >= self._opened_at + self.config.open_duration:
+            self._state = STATE_HALF_OPEN
+            self._probes_started = 0
+            self._probes_succeeded = 0
+        return self._state
+
+    def allow_request(self) -> bool:
+        '''Returns True if a message may be handled; in the half-open state, the message is counted as a probe.'''
+        state = self.state
+        if state == STATE_CLOSED:
+            return True
+        if state == STATE_HALF_OPEN and self._probes_started < self.config.half_open_max_calls:
+            self._probes_started += 1
+            return True
+        return False
+
+    def get_hold_duration(self) -> float:
+        '''Seconds for which a message that is not allowed should be held back: until the breaker half-opens, or while its probes are in flight.'''
+        if self.state == STATE_OPEN:
+            return max(self._opened_at + self.config.open_duration - time.monotonic(), 0)
+        return self.HALF_OPEN_HOLD_DURATION
+
+    def record(self, is_failure: bool) -> bool:
+        '''Records the outcome of a handled message.  Returns True if the breaker opened.'''
+        state = self.state
+        if state == STATE_HALF_OPEN:
+            if is_failure:
+                self._open()
+                return True
+            self._probes_succeeded += 1
+            if self._probes_succeeded >= self.config.half_open_max_calls:
+                self._close()
+        elif state == STATE_CLOSED:
+            self._outcomes.append(is_failure)
+            if len(self._outcomes) >= self.config.minimum_calls and sum(self._outcomes) / len(self._outcomes) >= self.config.failure_rate_threshold:
+                self._open()
+                return True
+        # outcomes of messages handled before the breaker opened are ignored
+        return False
+
+    def _open(self):
+        self._state = STATE_OPEN
+        self._opened_at = time.monotonic()
+
+    def _close(self):
+        self._state = STATE_CLOSED
+        self._outcomes = collections.deque(maxlen=self.config.window_size)
+
+
+class CircuitBreakers():
+    '''The circuit breaker of each request type: configured per request type, or else from the default options.  Without options, a request type has no breaker.'''
+
+    _options = None
+    _default_options = None
+    _breakers = None
+
+    def __init__(self, breakers: dict = None, default_breaker: dict = None):
+        self._options = breakers or {}
+        self._default_options = default_breaker
+        self._breakers = {}
+
+    def get(self, request_type: str) -> CircuitBreaker:
+        breaker = self._breakers.get(request_type)
+        if breaker is None:
+            options = self._options.get(request_type, self._default_options)
+            if options is None:
+                return None
+            breaker = self._breakers[request_type] = CircuitBreaker(request_type=request_type, options=options)
+        return breaker
+
+    def get_hold_duration(self, request_type: str) -> float:
+        '''Seconds for which a dequeued message of request_type should be held back, or None if its breaker lets it through.'''
+        breaker = self.get(request_type)
+        if breaker is None or breaker.allow_request():
+            return None
+        return breaker.get_hold_duration()
+
+    def record(self, request_type: str, result: RequestResult) -> float:
+        '''Records the result of a handled message.  Returns the open duration if the breaker of request_type opened, else None.'''
+        breaker = self.get(request_type)
+        if breaker is None or result.isFatal:
+            return None
+        if breaker.record(is_failure=result.isTransient):
+            return breaker.config.open_duration
+        return None
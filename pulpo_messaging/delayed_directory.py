@@ -0,0 +1,122 @@
+import os
+import glob
+import time
+import threading
+from collections.abc import Callable
+from loguru import logger
+from pulpo_messaging import message_codec
+from pulpo_messaging.message_file_name import MessageFileName
+
+
+class DelayedDirectory():
+    '''
+    Messages delayed into the future, held out of the queue directories until they are due (enable_delayed_directory).
+    They are bucketed by available time into subdirectories of path, named by the start (epoch seconds) of their bucket_seconds range,
+    so that only the buckets that have started are listed to promote due messages or to find the next one.
+    '''
+
+    _path = None
+    _bucket_seconds = None
+    # when promote last ran (monotonic), 0 if never
+    promoted_at = None
+    _promoter_thread = None
+    _promoter_stop = None
+
+    def __init__(self, path: str, bucket_seconds: int):
+        self._path = path
+        self._bucket_seconds = bucket_seconds
+        self.promoted_at = 0
+
+    def get_bucket_path(self, available_at: float) -> str:
+        bucket_start = int(available_at // self._bucket_seconds) * self._bucket_seconds
+        return os.path.join(self._path, f'{bucket_start:012d}')
+
+    def get_first_bucket_available_at(self) -> list:
+        '''Available times of the messages of the first bucket, or its start if it has not started yet.'''
+        buckets = sorted(os.listdir(self._path))
+        if not buckets:
+            return []
+        if int(buckets[0]) > time.time():
+            return [int(buckets[0])]
+        try:
+            return [self.get_available_at(file) for file in self._get_message_files(os.path.join(self._path, buckets[0]))]
+        except FileNotFoundError:
+            # bucket promoted and removed by another consumer
+            return []
+
+    def promote(self, now: float, queue_file: Callable[[os.DirEntry], bool]) -> int:
+        '''
+        Calls queue_file for each message due at now, and removes the buckets that have ended.
+        queue_file moves the file into the queue, returning False if it was promoted by another consumer.
+        '''
+        self.promoted_at = time.monotonic()
+        promoted = 0
+        for bucket in sorted(os.listdir(self._path)):
+            bucket_start = int(bucket)
+            if bucket_start > now:
+                break
+
+            bucket_path = os.path.join(self._path, bucket)
+            promoted += self._promote_bucket(bucket_path=bucket_path, now=now, queue_file=queue_file)
+
+            if bucket_start + self._bucket_seconds <= now:
+                try:
+                    os.rmdir(bucket_path)
+                except OSError:
+                    # bucket not empty (message written late) or removed by another consumer
+                    pass
+        return promoted
+
+    def start_promoter(self, interval: float, promote: Callable[[], int]):
+        '''Starts a background thread that calls promote (the adapter's promotion of due messages) every interval seconds.'''
+        if self._promoter_thread:
+            return
+        self._promoter_stop = threading.Event()
+        self._promoter_thread = threading.Thread(target=self._run_promoter, args=(interval, promote), name='fqa-delayed-promoter', daemon=True)
+        self._promoter_thread.start()
+
+    def stop_promoter(self):
+        if not self._promoter_thread:
+            return
+        self._promoter_stop.set()
+        self._promoter_thread.join()
+        self._promoter_thread = None
+
+    def _run_promoter(self, interval: float, promote: Callable[[], int]):
+        while not self._promoter_stop.is_set():
+            try:
+                promote()
+            except OSError as ex:
+                logger.warning(f'failed to promote delayed messages {ex=}')
+            self._promoter_stop.wait(interval)
+
+    def _promote_bucket(self, bucket_path: str, now: float, queue_file: Callable[[os.DirEntry], bool]) -> int:
+        try:
+            files = self._get_message_files(bucket_path)
+        except FileNotFoundError:
+            # bucket emptied and removed by another consumer
+            return 0
+        return sum(1 for file in files if self.get_available_at(file) <= now and queue_file(file))
+
+    def find(self, message_id: str) -> str:
+        '''Path of a delayed message file, under either the legacy or the encoded file name; its bucket is not known from the id, so every bucket is searched.'''
+        escaped_id = glob.escape(message_id)
+        for file_name in (f'*-{escaped_id}.message', f'{escaped_id}.message'):
+            matches = glob.glob(os.path.join(glob.escape(self._path), '*', file_name))
+            if matches:
+                return matches[0]
+        return None
+
+    @staticmethod
+    def get_available_at(file: os.DirEntry) -> float:
+        file_name = MessageFileName.parse(file.name)
+        if file_name.is_encoded:
+            return file_name.available_at_ms / 1000
+        with open(file=file.path, mode='rb') as f:
+            m = message_codec.read_message_header(f)
+        return m.delay.timestamp() if m.delay else 0
+
+    @staticmethod
+    def _get_message_files(directory: str) -> list:
+        with os.scandir(directory) as entries:
+            return [entry for entry in entries if entry.name.endswith('.message') and entry.is_file()]
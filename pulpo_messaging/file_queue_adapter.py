@@ -1,17 +1,26 @@
 import os
+import glob
+import itertools
 import uuid
 import time
-import json
 import random
 import datetime
 from loguru import logger
 from statman import Statman
 from pulpo_config import Config
+from pulpo_messaging import inotify
+from pulpo_messaging import message_codec
+from pulpo_messaging.change_feed import ChangeFeed
+from pulpo_messaging.delayed_directory import DelayedDirectory
+from pulpo_messaging.file_queue_layout import FileQueueLayout
+from pulpo_messaging.partition_lease import PartitionLeases
 from pulpo_messaging.message import Message
 from pulpo_messaging.queue_adapter import QueueAdapter
+from pulpo_messaging.message_file_name import MessageFileName
+from pulpo_messaging.ready_index import ReadyIndex, ReadyIndexEntry
 
 
-class FileQueueAdapterConfig(Config):
+class FileQueueAdapterConfig(Config):  # pylint: disable=too-many-public-methods
 
     def __init__(self, options: dict = None, json_file_path: str = None):
         super().__init__(options=options, json_file_path=json_file_path)
@@ -24,6 +33,14 @@ class FileQueueAdapterConfig(Config):
     def lock_path(self: Config) -> str:
         return os.path.join(self.base_path, 'lock')
 
+    @property
+    def delayed_path(self: Config) -> str:
+        return os.path.join(self.base_path, 'delayed')
+
+    @property
+    def lease_path(self: Config) -> str:
+        return os.path.join(self.base_path, 'lease')
+
     @property
     def archive_success_path(self: Config) -> str:
         return os.path.join(self.base_path, 'archive', 'success')
@@ -32,10 +49,35 @@ class FileQueueAdapterConfig(Config):
     def archive_failure_path(self: Config) -> str:
         return os.path.join(self.base_path, 'archive', 'failure')
 
+    @property
+    def shard_count(self: Config) -> int:
+        return self.getAsInt('shard_count', 0)
+
+    @property
+    def migrate_layout_on_start(self: Config) -> bool:
+        return self.getAsBool('migrate_layout_on_start', False)
+
+    @property
+    def enable_partition_leases(self: Config) -> bool:
+        return self.getAsBool('enable_partition_leases', False)
+
+    @property
+    def partition_lease_duration(self: Config) -> float:
+        return float(self.get('partition_lease_duration', 30))
+
+    @property
+    def disable_work_stealing(self: Config) -> bool:
+        # a disable flag: a false value is read as missing, so an enable flag defaulting to true could not be turned off
+        return self.getAsBool('disable_work_stealing', False)
+
     @property
     def message_format(self: Config) -> str:
         return self.get('message_format', 'json')
 
+    @property
+    def file_name_format(self: Config) -> str:
+        return self.get('file_name_format', 'encoded')
+
     @property
     def skip_random_messages_range(self: Config) -> int:
         return self.getAsInt('skip_random_messages_range', 0)
@@ -48,23 +90,106 @@ class FileQueueAdapterConfig(Config):
     def max_number_of_attempts(self: Config) -> bool:
         return self.getAsInt('max_number_of_attempts', 0)
 
+    @property
+    def priority_aging_interval(self: Config) -> float:
+        return float(self.get('priority_aging_interval', 0))
+
+    @property
+    def enable_fsync(self: Config) -> bool:
+        return self.getAsBool('enable_fsync', False)
+
+    @property
+    def enable_ready_index(self: Config) -> bool:
+        return self.getAsBool('enable_ready_index', False)
+
+    @property
+    def ready_index_refresh_interval(self: Config) -> float:
+        return float(self.get('ready_index_refresh_interval', 1))
+
+    @property
+    def enable_change_feed(self: Config) -> bool:
+        return self.getAsBool('enable_change_feed', "False")
+
+    @property
+    def change_feed_resync_interval(self: Config) -> float:
+        return float(self.get('change_feed_resync_interval', 60))
+
+    @property
+    def enable_delayed_directory(self: Config) -> bool:
+        return self.getAsBool('enable_delayed_directory', False)
+
+    @property
+    def delayed_bucket_seconds(self: Config) -> int:
+        return self.getAsInt('delayed_bucket_seconds', 60)
+
+    @property
+    def delayed_promotion_mode(self: Config) -> str:
+        return self.get('delayed_promotion_mode', 'inline')
+
+    @property
+    def wait_mode(self: Config) -> str:
+        return self.get('wait_mode', 'inotify')
+
+    @property
+    def wait_poll_interval(self: Config) -> float:
+        return float(self.get('wait_poll_interval', 0.1))
+
+    @property
+    def delayed_promotion_interval(self: Config) -> float:
+        return float(self.get('delayed_promotion_interval', 1))
+
 
 class FileQueueAdapter(QueueAdapter):
     MODE_READ_WRITE = 0o770
     MODE_READ_WRITE_EXECUTE = 0o777
 
     _config = None
+    _layout = None
+    _shard_cursor = None
+    _partition_leases = None
+    _ready_index = None
+    _ready_index_refreshed_at = None
+    _delayed_directory = None
+    _inotify_watch = None
+    _change_feed = None
+    _next_delayed_at = None
 
     def __init__(self, options: dict):
         super().__init__()
         logger.trace('FileQueueAdapter init')
 
         self._config = FileQueueAdapterConfig(options)
+        self._layout = FileQueueLayout(base_path=self.config.base_path, lock_path=self.config.lock_path, shard_count=self.config.shard_count)
+        # consumers start scanning at different shards
+        self._shard_cursor = random.randrange(len(self._layout.queue_directories))
         self._create_message_directories()
+        if self.config.migrate_layout_on_start:
+            self.migrate_layout()
+        if self.config.enable_partition_leases:
+            if not self._layout.is_sharded:
+                raise Exception('partition leases require a sharded layout (shard_count)')
+            self._partition_leases = PartitionLeases(lease_path=self.config.lease_path, partitions=self._layout.shard_names, lease_duration=self.config.partition_lease_duration)
+
+        if self.config.enable_change_feed:
+            self._start_change_feed()
+
+        if self.config.enable_ready_index or self._change_feed:
+            self._ready_index = ReadyIndex(priority_aging_interval=self.config.priority_aging_interval)
+            self._refresh_ready_index()
+
+        # the next delayed available time, and when it is to be looked up again (monotonic)
+        self._next_delayed_at = (None, 0)
+        if self.config.enable_delayed_directory:
+            self._delayed_directory = DelayedDirectory(path=self.config.delayed_path, bucket_seconds=self.config.delayed_bucket_seconds)
+        if self.config.enable_delayed_directory and self.config.delayed_promotion_mode == 'thread':
+            self.start_delayed_promoter()
 
     def _create_message_directories(self):
         os.makedirs(name=self.config.base_path, mode=self.MODE_READ_WRITE, exist_ok=True)
         os.makedirs(name=self.config.lock_path, mode=self.MODE_READ_WRITE, exist_ok=True)
+        self._layout.create_directories(mode=self.MODE_READ_WRITE)
+        if self.config.enable_delayed_directory:
+            os.makedirs(name=self.config.delayed_path, mode=self.MODE_READ_WRITE, exist_ok=True)
         os.makedirs(name=self.config.archive_success_path, mode=self.MODE_READ_WRITE, exist_ok=True)
         os.makedirs(name=self.config.archive_failure_path, mode=self.MODE_READ_WRITE, exist_ok=True)
 
@@ -72,78 +197,222 @@ class FileQueueAdapter(QueueAdapter):
     def config(self) -> FileQueueAdapterConfig:
         return self._config
 
+    def migrate_layout(self) -> int:
+        '''Moves message files queued or locked under another layout (flat, or another shard_count) into this adapter's layout.  See FileQueueLayout.migrate.'''
+        moved = self._layout.migrate()
+        if self._ready_index is not None:
+            self._refresh_ready_index()
+        return moved
+
     def enqueue(self, message: Message) -> Message:
         message.id = self._create_message_id()
-        message_file_path = self._get_message_file_path(message_id=message.id)
-        self._save_message_to_file(message=message, file_path=message_file_path)
+        message_file_path = self._get_queue_file_path(message=message)
+        self._save_message_to_file(message=message, file_path=message_file_path, fsync=self.config.enable_fsync)
+        self._expire_next_delayed_at(message)
+        if self.config.enable_fsync:
+            self._fsync_directory(os.path.dirname(message_file_path))
+        self._add_to_ready_index(file_path=message_file_path, message=message)
         logger.debug(f'fqa.enqueue [id={message.id}][file_path={message_file_path}]')
         Statman.gauge('fqa.enqueue').increment()
         return message
 
+    def enqueue_batch(self, messages: list) -> list:
+        '''Writes each message file, then syncs each directory written to once for the whole batch (when enable_fsync is set).'''
+        directories = set()
+        for message in messages:
+            message.id = self._create_message_id()
+            message_file_path = self._get_queue_file_path(message=message)
+            self._save_message_to_file(message=message, file_path=message_file_path, fsync=self.config.enable_fsync)
+            self._add_to_ready_index(file_path=message_file_path, message=message)
+            self._expire_next_delayed_at(message)
+            directories.add(os.path.dirname(message_file_path))
+
+        if self.config.enable_fsync:
+            for directory in directories:
+                self._fsync_directory(directory)
+
+        logger.debug(f'fqa.enqueue_batch [{len(messages)=}][{len(directories)=}]')
+        Statman.gauge('fqa.enqueue').increment(len(messages))
+        return messages
+
     def dequeue(self) -> Message:
         # if there is a message ready for dequeue, return it
         # if no message, return Nothing
 
         logger.trace('begin dequeue')
 
-        lock_file_path = None
-        entries = self._get_message_file_list(self.config.base_path)
+        if self.config.enable_delayed_directory and self.config.delayed_promotion_mode == 'inline':
+            self._promote_delayed_messages_if_due()
+
+        if self._ready_index is not None:
+            return next(iter(self._dequeue_batch_from_ready_index(max_messages=1)), None)
+        return self._dequeue_from_directory_scan()
+
+    def dequeue_batch(self, max_messages: int = 1, timeout: float = None) -> list:
+        '''Locks up to max_messages messages from a single directory scan (or ready index pass), waiting up to timeout seconds for the first.'''
+        logger.trace(f'begin dequeue batch [{max_messages=}][{timeout=}]')
+        deadline = time.monotonic() + (timeout or 0)
+
+        while True:
+            if self.config.enable_delayed_directory and self.config.delayed_promotion_mode == 'inline':
+                self._promote_delayed_messages_if_due()
+
+            if self._ready_index is not None:
+                messages = self._dequeue_batch_from_ready_index(max_messages=max_messages)
+            else:
+                messages = self._dequeue_batch_from_directory_scan(max_messages=max_messages)
+
+            remaining = deadline - time.monotonic()
+            if messages or remaining <= 0:
+                return messages
+            time.sleep(min(self.DEQUEUE_BATCH_POLL_INTERVAL, remaining))
+
+    def wait_for_message(self, timeout: float) -> bool:
+        '''
+        Waits for a message file to be written (or moved) into the queue directory: with inotify when available (wait_mode `inotify`), polling the directory otherwise.
+        Delayed messages generate no event when they become due, so the wait is also cut short at the next delayed message's available time (and returns True, as the message is then due).
+        '''
+        deadline = time.monotonic() + timeout
+        is_delayed_due = False
+        next_delayed_at = self._get_next_delayed_available_at()
+        if next_delayed_at is not None:
+            wake_at = time.monotonic() + max(next_delayed_at - time.time(), 0)
+            if self.config.enable_delayed_directory:
+                # inline promotion runs at most every delayed_promotion_interval
+                wake_at = max(wake_at, self._delayed_directory.promoted_at + self.config.delayed_promotion_interval)
+            is_delayed_due = wake_at <= deadline
+            deadline = min(deadline, wake_at)
+
+        watch = self._get_inotify_watch()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return is_delayed_due
+            if watch:
+                events = watch.wait(timeout=remaining)
+                is_queue_changed = any(event.is_overflow or event.name.endswith('.message') for event in events)
+            else:
+                time.sleep(min(self.config.wait_poll_interval, remaining))
+                is_queue_changed = self._has_ready_message_file()
+            if is_queue_changed:
+                # the change may be a delayed message of another producer
+                self._next_delayed_at = (None, 0)
+                return True
+
+    def _get_inotify_watch(self) -> inotify.InotifyWatch:
+        '''Creates the inotify watch on first use; returns None (polling) if disabled or not available on this platform.'''
+        if self._inotify_watch is None and self.config.wait_mode == 'inotify':
+            try:
+                self._inotify_watch = inotify.InotifyWatch(paths=self._layout.queue_directories, mask=inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO)
+            except OSError as ex:
+                logger.warning(f'inotify not available, falling back to polling [{ex=}]')
+                self.config.set('wait_mode', 'poll')
+        return self._inotify_watch
+
+    def _has_ready_message_file(self) -> bool:
+        now_ms = time.time() * 1000
+        for file in self._get_queued_file_list():
+            file_name = MessageFileName.parse(file.name)
+            if not file_name.is_encoded or file_name.available_at_ms <= now_ms:
+                return True
+        return False
+
+    def _get_next_delayed_available_at(self) -> float:
+        '''
+        Earliest available time (epoch seconds) of a delayed message, taken from encoded file names in the queue directory and, for inline promotion, the first delayed bucket.
+        Returns None if there is no delayed message.
+        The result is kept until it is due, a wait sees the queue change, this adapter queues a delayed message, or ready_index_refresh_interval passes
+        (for the delayed messages of other producers that no wait sees), rather than listing the directories on every wait.
+        '''
+        now = time.time()
+        (next_delayed_at, expires_at) = self._next_delayed_at
+        if time.monotonic() < expires_at and (next_delayed_at is None or next_delayed_at > now):
+            return next_delayed_at
+
+        available_at = [MessageFileName.parse(file.name).available_at_ms / 1000 for file in self._get_queued_file_list()]
+        available_at = [t for t in available_at if t > now]
+        if self.config.enable_delayed_directory and self.config.delayed_promotion_mode == 'inline':
+            # with the promoter thread, promotion is a rename into the queue directory, which is seen by the wait
+            available_at.extend(self._delayed_directory.get_first_bucket_available_at())
+        next_delayed_at = min(available_at, default=None)
+        self._next_delayed_at = (next_delayed_at, time.monotonic() + self.config.ready_index_refresh_interval)
+        return next_delayed_at
+
+    def _expire_next_delayed_at(self, message: Message):
+        if message.delay:
+            self._next_delayed_at = (None, 0)
+
+    def _get_queued_file_list(self) -> list:
+        '''The queued message files, from every queue directory, unsorted.'''
+        return itertools.chain.from_iterable(self._get_message_file_list(directory, sort=False) for directory in self._layout.queue_directories)
+
+    def _get_scan_directories(self) -> list:
+        '''
+        The queue directories in scan order.  With the sharded layout, each scan starts at the shard after the last scan's first shard, rotating through the shards.
+        With partition leases, only the shards leased by this consumer are scanned.
+        '''
+        directories = self._layout.queue_directories
+        if self._partition_leases:
+            self._partition_leases.rebalance_if_due()
+            directories = [self._layout.get_shard_queue_directory(shard_name) for shard_name in self._partition_leases.owned]
+            if not directories:
+                return []
+        start = self._shard_cursor % len(directories)
+        self._shard_cursor = start + 1
+        return directories[start:] + directories[:start]
+
+    def _get_steal_directories(self) -> list:
+        '''With partition leases and work stealing, the queue directories of the shards leased by other consumers, from a random shard.'''
+        if not self._partition_leases or self.config.disable_work_stealing:
+            return []
+        owned = set(self._partition_leases.owned)
+        directories = [self._layout.get_shard_queue_directory(shard_name) for shard_name in self._layout.shard_names if shard_name not in owned]
+        start = random.randrange(len(directories)) if directories else 0
+        return directories[start:] + directories[:start]
+
+    @property
+    def partition_leases(self) -> PartitionLeases:
+        '''The partition leases (None unless enable_partition_leases).  Call release_all on shutdown, so that other consumers take the partitions over without waiting for the leases to expire.'''
+        return self._partition_leases
+
+    def _dequeue_from_directory_scan(self) -> Message:
+        for directory in self._get_scan_directories():
+            m = self._dequeue_from_directory(directory)
+            if m:
+                return m
+        for directory in self._get_steal_directories():
+            m = self._dequeue_from_directory(directory)
+            if m:
+                Statman.gauge('fqa.partition.stolen').increment()
+                return m
+        return None
+
+    def _dequeue_from_directory(self, directory: str) -> Message:
+        entries = self._get_message_file_list(directory)
 
         skip_messages = random.randint(0, self.config.skip_random_messages_range)
         i = 0
         last_file = None
+        m = None
 
         for file in entries:
-            # logger.trace(f'checking file name: {file.name}')
-            # # in future, this is where I would test for delay and maybe TTL
-            # logger.trace('file meets criteria')
-            # message_path_file = os.path.join(self.config.base_path, file)
-
             if (i >= skip_messages):
                 last_file = None
-
-                m = self._load_message_from_file(file_path=file)
-                logger.trace(f'loaded message [{m.id=}][{m.delay=}][{m.attempts=}][{file.path=}][{m.expiration=}]')
-
-                now = datetime.datetime.now()
-
-                if m.delay and m.delay > now:
-                    logger.trace('message delayed, do not process yet')
-                    # todo: should move this out of queue
-                elif self.config.max_number_of_attempts and m.attempts >= self.config.max_number_of_attempts:
-                    logger.trace(f'message exceed max attempts {self.config.max_number_of_attempts=} {m.attempts=}')
-                    self._archive_message(message_id=m.id, source='queue', destination='failure')
-                elif m.expiration and m.expiration < now:
-                    logger.trace(f'message expired {m.expiration=}')
-                    self._archive_message(message_id=m.id, source='queue', destination='failure')
-                else:
-                    logger.trace(f'attempt to lock message: {file.path}')
-                    lock_file_path = self._lock_file(file.path)
-                    if lock_file_path:  # pylint: disable=no-else-break
-                        logger.trace('locked message')
+                if self._is_message_file_ready(file):
+                    m = self._lock_and_load_message(file.path)
+                    if m:
                         break
-                    else:
-                        logger.trace('failed to lock message')
             else:
                 # logger.trace(f'skip message [i={i}][skip={skip_messages}]')
                 last_file = file
 
             i += 1
 
-        if last_file and not lock_file_path:
-            file = last_file
+        if last_file and not m:
             logger.trace('skipped all messages, trying last message from loop')
-            logger.trace(f'attempt to lock message: {file.path}')
-            lock_file_path = self._lock_file(file.path)
-            if lock_file_path:
-                logger.trace('locked message')
-            else:
-                logger.trace('failed to lock message')
+            m = self._lock_and_load_message(last_file.path)
 
-        m = None
-        if lock_file_path:
-            logger.trace(f'load message (dq): {lock_file_path}')
-            m = self._load_message_from_file(file_path=lock_file_path)
+        if m:
             logger.debug(f'dequeued message: {m.id=}')
             Statman.gauge('fqa.dequeue').increment()
         else:
@@ -151,13 +420,247 @@ class FileQueueAdapter(QueueAdapter):
 
         return m
 
+    def _is_message_file_ready(self, file: os.DirEntry) -> bool:
+        '''
+        Determines if a queued message file is a candidate for dequeue.
+        Encoded file names are checked on the name alone; legacy file names require loading the message.
+        Expired (and, for legacy files, exhausted) messages are archived as failures.
+        '''
+        file_name = MessageFileName.parse(file.name)
+
+        if file_name.is_encoded:
+            now_ms = int(time.time() * 1000)
+            if file_name.available_at_ms > now_ms:
+                logger.trace('message delayed, do not process yet')
+                return False
+            if file_name.expires_at_ms and file_name.expires_at_ms < now_ms:
+                logger.trace(f'message expired {file_name.expires_at_ms=}')
+                self._archive_message(message_id=file_name.message_id, source='queue', destination='failure', source_file_path=file.path)
+                return False
+            return True
+
+        try:
+            m = self._load_message_from_file(file_path=file.path, header_only=True)
+        except FileNotFoundError:
+            logger.trace('message locked by another consumer')
+            return False
+        logger.trace(f'loaded message [{m.id=}][{m.delay=}][{m.attempts=}][{file.path=}][{m.expiration=}]')
+
+        now = datetime.datetime.now()
+        if m.delay and m.delay > now:
+            # legacy file, or enable_delayed_directory is off; otherwise delayed messages are held out of the queue
+            logger.trace('message delayed, do not process yet')
+            return False
+        if self.config.max_number_of_attempts and m.attempts >= self.config.max_number_of_attempts:
+            logger.trace(f'message exceed max attempts {self.config.max_number_of_attempts=} {m.attempts=}')
+            self._archive_message(message_id=m.id, source='queue', destination='failure', source_file_path=file.path)
+            return False
+        if m.expiration and m.expiration < now:
+            logger.trace(f'message expired {m.expiration=}')
+            self._archive_message(message_id=m.id, source='queue', destination='failure', source_file_path=file.path)
+            return False
+        return True
+
+    def _lock_and_load_message(self, message_file_path: str) -> Message:
+        '''Locks the message file and loads it.  Returns None if the lock failed, or if the locked message turned out to be exhausted or expired.'''
+        logger.trace(f'attempt to lock message: {message_file_path}')
+        lock_file_path = self._lock_file(message_file_path)
+        if not lock_file_path:
+            logger.trace('failed to lock message')
+            return None
+        logger.trace('locked message')
+
+        logger.trace(f'load message (dq): {lock_file_path}')
+        m = self._load_message_from_file(file_path=lock_file_path)
+        if self.config.max_number_of_attempts and m.attempts >= self.config.max_number_of_attempts:
+            logger.trace(f'message exceed max attempts {self.config.max_number_of_attempts=} {m.attempts=}')
+            self._archive_message(message_id=m.id, source='lock', destination='failure')
+            return None
+        if m.expiration and m.expiration < datetime.datetime.now():
+            logger.trace(f'message expired {m.expiration=}')
+            self._archive_message(message_id=m.id, source='lock', destination='failure')
+            return None
+        return m
+
+    def _dequeue_batch_from_directory_scan(self, max_messages: int) -> list:
+        messages = []
+        for directory in self._get_scan_directories():
+            self._dequeue_batch_from_directory(directory=directory, max_messages=max_messages, messages=messages)
+        if not messages:
+            for directory in self._get_steal_directories():
+                self._dequeue_batch_from_directory(directory=directory, max_messages=max_messages, messages=messages)
+            if messages:
+                Statman.gauge('fqa.partition.stolen').increment(len(messages))
+
+        logger.debug(f'dequeued messages: {len(messages)=}')
+        Statman.gauge('fqa.dequeue').increment(len(messages))
+        return messages
+
+    def _dequeue_batch_from_directory(self, directory: str, max_messages: int, messages: list):
+        '''Appends messages locked from directory to messages, up to max_messages in total.'''
+        if len(messages) >= max_messages:
+            return
+        entries = list(self._get_message_file_list(directory))
+
+        # rather than skipping messages, consumers sharing a directory start the scan at a random offset and wrap around
+        skip_messages = min(random.randint(0, self.config.skip_random_messages_range), len(entries))
+        entries = entries[skip_messages:] + entries[:skip_messages]
+
+        for file in entries:
+            if len(messages) >= max_messages:
+                break
+            if self._is_message_file_ready(file):
+                m = self._lock_and_load_message(file.path)
+                if m:
+                    messages.append(m)
+
+    def _dequeue_batch_from_ready_index(self, max_messages: int) -> list:
+        self._refresh_ready_index_if_due()
+
+        messages = []
+        while len(messages) < max_messages:
+            entry = self._ready_index.pop(now=time.time())
+            if not entry:
+                logger.trace('no message found in ready index')
+                break
+            if self._ready_index.has_paused_request_types and self._ready_index.hold_back(entry, request_type=self._get_queued_request_type(entry), now=time.time()):
+                Statman.gauge('fqa.ready-index.held-back').increment()
+                continue
+
+            m = self._lock_and_load_message(self._get_queued_file_path(entry.file_name))
+            if m:
+                logger.debug(f'dequeued message: {m.id=}')
+                messages.append(m)
+            else:
+                Statman.gauge('fqa.ready-index.skipped').increment()
+
+        Statman.gauge('fqa.dequeue').increment(len(messages))
+        return messages
+
+    def pause_request_type(self, request_type: str, duration: float) -> bool:
+        '''Held back through the ready index only: without it, the request type of a message is not known before the message is locked.'''
+        if self._ready_index is not None:
+            self._ready_index.pause(request_type, until=time.time() + duration)
+        return self._ready_index is not None
+
+    def _get_queued_request_type(self, entry: ReadyIndexEntry) -> str:
+        try:
+            return self._load_message_from_file(file_path=self._get_queued_file_path(entry.file_name), header_only=True).request_type
+        except FileNotFoundError:
+            # locked by another consumer: the lock attempt fails in turn
+            return None
+
+    def _add_to_ready_index(self, file_path: str, message: Message = None):
+        (directory, file_name) = os.path.split(file_path)
+        if self._ready_index is None or not self._layout.is_queue_directory(directory):
+            return
+        parsed_file_name = MessageFileName.parse(file_name)
+        if parsed_file_name.is_encoded:
+            entry = ReadyIndexEntry(priority=parsed_file_name.priority, available_at=parsed_file_name.available_at_ms / 1000, message_id=parsed_file_name.message_id, file_name=file_name)
+        else:
+            if not message:
+                message = self._load_message_from_file(file_path=file_path, header_only=True)
+            # a legacy file name encodes no available at: without a delay, the index ranks the entry from when it is indexed
+            available_at = message.delay.timestamp() if message.delay else None
+            entry = ReadyIndexEntry(priority=message.priority, available_at=available_at, message_id=message.id, file_name=file_name)
+        self._ready_index.push(entry=entry, now=time.time())
+
+    def _refresh_ready_index_if_due(self):
+        if self._change_feed:
+            self._poll_change_feed()
+            return
+
+        elapsed = time.monotonic() - self._ready_index_refreshed_at
+        if elapsed >= self.config.ready_index_refresh_interval:
+            self._refresh_ready_index()
+
+    def _start_change_feed(self):
+        try:
+            self._change_feed = ChangeFeed(base_path=self.config.base_path,
+                                           lock_path=self.config.lock_path,
+                                           resync_interval=self.config.change_feed_resync_interval,
+                                           shard_names=self._layout.shard_names)
+        except OSError as ex:
+            logger.warning(f'change feed not available, falling back to directory scans [{ex=}]')
+
+    def _poll_change_feed(self):
+        '''Applies queue directory changes seen by the change feed to the ready index, or rescans when a resync is due.'''
+        if self._change_feed.is_resync_due:
+            self._refresh_ready_index()
+            return
+
+        for (file_name, is_added) in self._change_feed.poll():
+            if not is_added:
+                self._ready_index.discard(file_name)
+            elif not self._ready_index.is_known(file_name):
+                try:
+                    self._add_to_ready_index(file_path=self._get_queued_file_path(file_name))
+                except FileNotFoundError:
+                    # locked by another consumer since the event
+                    continue
+                Statman.gauge('fqa.change-feed.added').increment()
+
+    def _refresh_ready_index(self):
+        '''
+        Picks up messages written by other producers (or rolled back by other consumers).
+        Only files not already known to the index are considered, and only legacy file names need to be read.
+        '''
+        logger.trace('refresh ready index')
+        if self._change_feed:
+            self._change_feed.discard_pending()
+        file_names = set()
+        for file in self._get_queued_file_list():
+            file_names.add(file.name)
+            if not self._ready_index.is_known(file.name):
+                try:
+                    self._add_to_ready_index(file_path=file.path)
+                except FileNotFoundError:
+                    # locked by another consumer since the directory was scanned
+                    continue
+                Statman.gauge('fqa.ready-index.refresh.added').increment()
+        self._ready_index.retain(file_names)
+        self._ready_index_refreshed_at = time.monotonic()
+        if self._change_feed:
+            locked_file_names = [file_name for directory in self._layout.lock_directories for file_name in os.listdir(directory)]
+            self._change_feed.resync(queued_file_names=file_names, locked_file_names=locked_file_names)
+
+    def start_delayed_promoter(self):
+        '''Starts a background thread that promotes due delayed messages every delayed_promotion_interval seconds.'''
+        self._delayed_directory.start_promoter(interval=self.config.delayed_promotion_interval, promote=self._promote_delayed_messages)
+
+    def stop_delayed_promoter(self):
+        self._delayed_directory.stop_promoter()
+
+    def _promote_delayed_messages_if_due(self):
+        if time.monotonic() - self._delayed_directory.promoted_at >= self.config.delayed_promotion_interval:
+            self._promote_delayed_messages()
+
+    def _promote_delayed_messages(self) -> int:
+        '''Moves due messages from the delayed directory into the queue.'''
+        promoted = self._delayed_directory.promote(now=time.time(), queue_file=self._queue_delayed_file)
+        if promoted:
+            logger.debug(f'promoted delayed messages [{promoted=}]')
+            Statman.gauge('fqa.delayed.promoted').increment(promoted)
+        return promoted
+
+    def _queue_delayed_file(self, file: os.DirEntry) -> bool:
+        message_file_path = self._get_queued_file_path(file.name)
+        logger.trace(f'promote delayed message [{file.path}]=>[{message_file_path}]')
+        try:
+            os.rename(src=file.path, dst=message_file_path)
+        except FileNotFoundError:
+            # promoted by another consumer
+            return False
+        self._add_to_ready_index(file_path=message_file_path)
+        return True
+
     def peek(self, message_id: str) -> Message:
         logger.debug(f'peek {message_id=}')
         status = self.lookup_message_state(message_id=message_id)
         logger.debug(f'peek {message_id=} {status=}')
         # unknown, queue, lock, complete.success, complete.fail
         if status == 'queue':
-            return self._load_message_from_file(self._get_message_file_path(message_id))
+            return self._load_message_from_file(self._find_message_file_path(message_id))
         if status == 'lock':
             return self._load_message_from_file(self._get_lock_file_path(message_id))
         return None
@@ -166,15 +669,15 @@ class FileQueueAdapter(QueueAdapter):
         status = self.lookup_message_state(message_id=message_id)
         self._archive_message(message_id=message_id, source=status, destination='failure')
 
-    def _load_message_from_file(self, file_path) -> Message:
-        logger.trace(f'load message from file [{file_path=}][format={self.config.message_format}]')
-        message = None
-        with open(file=file_path, encoding="utf-8", mode='r') as f:
-            if self.config.message_format == 'json':
-                message_components = json.load(f)
-                message = Message(components=message_components)
+    def _load_message_from_file(self, file_path, header_only: bool = False) -> Message:
+        '''Loads a message.  header_only reads only the header section (for formats that are header-first), for checks that do not need the body.'''
+        logger.trace(f'load message from file [{file_path=}][{header_only=}]')
+        with open(file=file_path, mode='rb') as f:
+            # the format is read from the file, so files written with different message_format settings can share a queue
+            if header_only:
+                message = message_codec.read_message_header(f)
             else:
-                raise Exception(f'invalid message format config setting {self.config.message_format}')
+                message = message_codec.decode_message(f.read())
 
         logger.trace(f'loaded message from file [{file_path=}][{message.id=}')
         return message
@@ -184,27 +687,29 @@ class FileQueueAdapter(QueueAdapter):
         return self._get_message_id_from_file_name(message_file_name)
 
     def _get_message_id_from_file_name(self, message_file_name):
-        # todo: pretty weak approach, might try to get better way
-        # like message id in message
-        buffer = message_file_name
-        buffer = buffer.replace('.message', '')
-        buffer = buffer.replace('.lock', '')
-        return buffer
-
-    # https://docs.python.org/3/tutorial/inputoutput.html#saving-structured-data-with-json
-    def _save_message_to_file(self, message: Message, file_path: str):
+        return MessageFileName.parse(message_file_name).message_id
+
+    def _save_message_to_file(self, message: Message, file_path: str, fsync: bool = False):
         logger.trace(f'save message [id={message.id}][path={file_path}][format={self.config.message_format}]')
-        if self.config.message_format == 'json':
-            serialized_message = json.dumps(message._components, indent=2, default=str)
-        else:
-            raise Exception(f'invalid message format config setting {self.config.message_format}')
-        with open(file=file_path, encoding="utf-8", mode='w') as f:
+        serialized_message = message_codec.encode_message(message, self.config.message_format)
+        with open(file=file_path, mode='wb') as f:
             f.write(serialized_message)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
         logger.trace(f'saved message [{file_path=}][id={message.id}]')
 
+    def _fsync_directory(self, directory: str):
+        logger.trace(f'fsync directory {directory}')
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
     def _lock_file(self, message_file_path) -> str:
         (message_path, message_file_name) = os.path.split(message_file_path)
-        lock_file_path = os.path.join(self.config.lock_path, message_file_name + '.lock')
+        lock_file_path = self._get_lock_file_path(message_id=MessageFileName.parse(message_file_name).message_id)
         logger.trace(f'_lock_file [message_path={message_path}][message_file_name={message_file_name}][lock_file_path={lock_file_path}]')
 
         try:
@@ -224,10 +729,13 @@ class FileQueueAdapter(QueueAdapter):
     def _create_message_id(self):
         return f"{time.time()}-{uuid.uuid4()}"
 
-    def _get_message_file_list(self, directory) -> os.DirEntry:
+    def _get_message_file_list(self, directory, sort: bool = True) -> os.DirEntry:
         logger.trace(f'scanning directory {directory}')
         with os.scandir(directory) as entries:
-            sorted_entries = sorted(entries, key=lambda entry: entry.name)
+            if sort:
+                sorted_entries = sorted(entries, key=lambda entry: MessageFileName.parse(entry.name).get_aged_sort_key(self.config.priority_aging_interval))
+            else:
+                sorted_entries = list(entries)
 
         filtered_entries = filter(lambda entry: entry.name.endswith('.message'), sorted_entries)
         filtered_entries = filter(lambda entry: entry.is_file(), filtered_entries)
@@ -237,10 +745,59 @@ class FileQueueAdapter(QueueAdapter):
 
     def _get_message_file_path(self, message_id) -> str:
         file_name = f'{message_id}.message'
-        path = os.path.join(self.config.base_path, file_name)
+        path = os.path.join(self._layout.get_queue_directory(message_id), file_name)
         logger.trace(f'_get_message_file_path [id:{message_id}]=>[file_name:{file_name}]=>[path:{path}]')
         return path
 
+    def _get_queued_file_path(self, file_name: str) -> str:
+        '''Path of a queued message file (in the queue directory of the message id in its name).'''
+        return os.path.join(self._layout.get_queue_directory(MessageFileName.parse(file_name).message_id), file_name)
+
+    def _get_queue_file_path(self, message: Message) -> str:
+        '''Path at which a message is queued; with enable_delayed_directory, messages delayed into the future are queued in a delayed bucket (created if needed).'''
+        if self.config.file_name_format == 'encoded':
+            file_name = str(MessageFileName.from_message(message))
+        elif self.config.file_name_format == 'id':
+            file_name = f'{message.id}.message'
+        else:
+            raise Exception(f'invalid file name format config setting {self.config.file_name_format}')
+
+        directory = self._layout.get_queue_directory(message.id)
+        if self.config.enable_delayed_directory and message.delay and message.delay.timestamp() > time.time():
+            directory = self._delayed_directory.get_bucket_path(available_at=message.delay.timestamp())
+            os.makedirs(name=directory, mode=self.MODE_READ_WRITE, exist_ok=True)
+
+        path = os.path.join(directory, file_name)
+        logger.trace(f'_get_queue_file_path [id:{message.id}]=>[file_name:{file_name}]=>[path:{path}]')
+        return path
+
+    def _find_message_file_path(self, message_id) -> str:
+        '''
+        Locates a queued (or delayed) message file by id, under either the legacy or the encoded file name.  Returns None if not queued.
+        The encoded file name is taken from the change feed or the ready index when they know the message; otherwise its directory is searched.
+        '''
+        path = self._get_message_file_path(message_id=message_id)
+        if os.path.exists(path):
+            return path
+
+        if self._change_feed:
+            self._poll_change_feed()
+            # the change feed knows every queued file: only the delayed directory is left to search
+            file_name = self._change_feed.get_queued_file_name(message_id)
+            if file_name:
+                return self._get_queued_file_path(file_name)
+        else:
+            file_name = self._ready_index.get_file_name(message_id) if self._ready_index is not None else None
+            if file_name and os.path.exists(self._get_queued_file_path(file_name)):
+                return self._get_queued_file_path(file_name)
+            # not indexed yet, or renamed since by another consumer
+            matches = glob.glob(os.path.join(glob.escape(self._layout.get_queue_directory(message_id)), f'*-{glob.escape(message_id)}.message'))
+            if matches:
+                return matches[0]
+        if self._delayed_directory:
+            return self._delayed_directory.find(message_id)
+        return None
+
     def _does_archive_success_message_exist(self, message_id) -> bool:
         return os.path.exists(self._get_archive_success_file_path(message_id=message_id))
 
@@ -261,7 +818,7 @@ class FileQueueAdapter(QueueAdapter):
 
     def _get_lock_file_path(self, message_id) -> str:
         file_name = f'{message_id}.message.lock'
-        path = os.path.join(self.config.lock_path, file_name)
+        path = os.path.join(self._layout.get_lock_directory(message_id), file_name)
         logger.trace(f'_get_lock_file_path [id:{message_id}]=>[file_name:{file_name}]=>[path:{path}]')
         return path
 
@@ -287,7 +844,7 @@ class FileQueueAdapter(QueueAdapter):
         logger.trace(f'commit complete {message_id}')
         Statman.gauge('fqa.commit').increment()
 
-    def rollback(self, message: Message):
+    def rollback(self, message: Message, delay: float = None):
         message_id = None
         if isinstance(message, Message):
             message_id = message.id
@@ -297,24 +854,39 @@ class FileQueueAdapter(QueueAdapter):
             raise Exception('rollback expects message object')
 
         logger.trace(f'rollback [id={message_id}]')
-        self._increment_failed_attempts(message_id=message_id)
-        self._rollback_lock(message_id=message_id)
+        self._return_lock_to_queue(message_id=message_id, delay=delay, count_attempt=True)
         logger.trace(f'rollback complete [id={message_id}]')
         Statman.gauge('fqa.rollback').increment()
 
-    def _increment_failed_attempts(self, message_id: str):
-        '''Increments the attempts counter in the message.  This method assumes the message is in the lock directory.'''
+    def defer(self, message: Message, delay: float = None):
+        logger.trace(f'defer [id={message.id}]')
+        self._return_lock_to_queue(message_id=message.id, delay=delay, count_attempt=False)
+        Statman.gauge('fqa.defer').increment()
+
+    def _return_lock_to_queue(self, message_id: str, delay: float, count_attempt: bool):
+        m = self._update_locked_message(message_id=message_id, delay=delay, count_attempt=count_attempt)
+        message_file_path = self._rollback_lock(message=m)
+        self._add_to_ready_index(file_path=message_file_path, message=m)
+        self._expire_next_delayed_at(m)
+
+    def _update_locked_message(self, message_id: str, delay: float = None, count_attempt: bool = True) -> Message:
+        '''Increments the attempts counter in the message (if count_attempt), and delays it by delay seconds if given.  This method assumes the message is in the lock directory.'''
         lock_file_path = self._get_lock_file_path(message_id=message_id)
         m = self._load_message_from_file(file_path=lock_file_path)
-        m.attempts += 1
+        if count_attempt:
+            m.attempts += 1
+        if delay:
+            m.delay = datetime.timedelta(seconds=delay)
         self._save_message_to_file(message=m, file_path=lock_file_path)
+        return m
 
-    def _rollback_lock(self, message_id: str):
-        logger.trace(f'rollback lock [id={message_id}]')
-        lock_file_path = self._get_lock_file_path(message_id=message_id)
-        message_file_path = self._get_message_file_path(message_id=message_id)
+    def _rollback_lock(self, message: Message) -> str:
+        logger.trace(f'rollback lock [id={message.id}]')
+        lock_file_path = self._get_lock_file_path(message_id=message.id)
+        message_file_path = self._get_queue_file_path(message=message)
         logger.trace(f'move file [{lock_file_path}]=>[{message_file_path}]')
         os.rename(src=lock_file_path, dst=message_file_path)
+        return message_file_path
 
     def _delete_lock(self, message_id: str):
         logger.trace(f'remove lock {message_id}')
@@ -322,19 +894,20 @@ class FileQueueAdapter(QueueAdapter):
         logger.trace(f'delete file {lock_file_path}')
         os.remove(lock_file_path)
 
-    def _archive_message(self, message_id: str, source: str, destination: str):
+    def _archive_message(self, message_id: str, source: str, destination: str, source_file_path: str = None):
         '''
         Move message to history.
         Source: queue | lock
         Destination: success | failure
+        For source queue, source_file_path may be provided when the caller already knows the queued file, avoiding a lookup.
         '''
 
         logger.trace(f'archive message [{message_id=}][{source=}][{destination=}]')
-        source_file_path = None
         destination_file_path = None
 
         if source == 'queue':
-            source_file_path = self._get_message_file_path(message_id=message_id)
+            if not source_file_path:
+                source_file_path = self._find_message_file_path(message_id=message_id)
         elif source == 'lock':
             source_file_path = self._get_lock_file_path(message_id=message_id)
         else:
@@ -352,14 +925,17 @@ class FileQueueAdapter(QueueAdapter):
 
     def _delete_message(self, message_id: str):
         logger.trace(f'remove message {message_id}')
-        lock_file_path = self._get_message_file_path(message_id=message_id)
-        os.remove(lock_file_path)
+        message_file_path = self._find_message_file_path(message_id=message_id)
+        os.remove(message_file_path)
 
     def _does_lock_exist(self, message_id) -> bool:
+        if self._change_feed:
+            self._poll_change_feed()
+            return self._change_feed.is_locked(message_id)
         return os.path.exists(self._get_lock_file_path(message_id=message_id))
 
     def _does_message_exist(self, message_id) -> bool:
-        return os.path.exists(self._get_message_file_path(message_id=message_id))
+        return self._find_message_file_path(message_id=message_id) is not None
 
     def lookup_message_state(self, message_id):
         '''
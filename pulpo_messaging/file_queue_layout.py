@@ -0,0 +1,124 @@
+import os
+import re
+import zlib
+from loguru import logger
+from statman import Statman
+from pulpo_messaging.change_feed import LOCK_FILE_SUFFIX
+from pulpo_messaging.message_file_name import MessageFileName
+
+
+class FileQueueLayout():
+    '''
+    Directories holding queued and locked message files.
+    The flat layout (shard_count 0) holds queued messages in base_path and locked messages in lock_path.
+    The sharded layout spreads them over shard_count subdirectories of each (base_path/007, lock_path/007), chosen by a hash of the message id,
+    so that each directory stays small and consumers scanning different shards do not contend for the same files.
+    The hash (crc32) is stable across processes, so every producer and consumer with the same shard_count agrees on a message's shard.
+    '''
+
+    MAX_SHARD_COUNT = 1000
+    SHARD_NAME_PATTERN = re.compile(r'\d{3}')
+
+    _base_path = None
+    _lock_path = None
+    _shard_count = None
+
+    def __init__(self, base_path: str, lock_path: str, shard_count: int = 0):
+        if shard_count < 0 or shard_count > self.MAX_SHARD_COUNT:
+            raise Exception(f'invalid shard count [{shard_count=}]')
+        self._base_path = base_path
+        self._lock_path = lock_path
+        self._shard_count = shard_count
+
+    @property
+    def is_sharded(self) -> bool:
+        return self._shard_count > 0
+
+    @property
+    def shard_names(self) -> list:
+        return [f'{shard:03d}' for shard in range(self._shard_count)]
+
+    @property
+    def queue_directories(self) -> list:
+        if not self.is_sharded:
+            return [self._base_path]
+        return [self.get_shard_queue_directory(shard_name) for shard_name in self.shard_names]
+
+    @property
+    def lock_directories(self) -> list:
+        if not self.is_sharded:
+            return [self._lock_path]
+        return [os.path.join(self._lock_path, shard_name) for shard_name in self.shard_names]
+
+    def get_shard_queue_directory(self, shard_name: str) -> str:
+        return os.path.join(self._base_path, shard_name)
+
+    def get_shard_name(self, message_id: str) -> str:
+        return f'{zlib.crc32(str(message_id).encode("utf-8")) % self._shard_count:03d}'
+
+    def get_queue_directory(self, message_id: str) -> str:
+        if not self.is_sharded:
+            return self._base_path
+        return self.get_shard_queue_directory(self.get_shard_name(message_id))
+
+    def get_lock_directory(self, message_id: str) -> str:
+        if not self.is_sharded:
+            return self._lock_path
+        return os.path.join(self._lock_path, self.get_shard_name(message_id))
+
+    def is_queue_directory(self, directory: str) -> bool:
+        if not self.is_sharded:
+            return directory == self._base_path
+        (parent, shard_name) = os.path.split(directory)
+        return parent == self._base_path and shard_name in self.shard_names
+
+    def create_directories(self, mode: int):
+        for directory in self.queue_directories + self.lock_directories:
+            os.makedirs(name=directory, mode=mode, exist_ok=True)
+
+    def migrate(self) -> int:
+        '''
+        Moves queued and locked message files written under another layout (flat, or another shard_count) to their place in this layout, and removes emptied shard directories.
+        A message locked by a running consumer would be lost to its commit, so consumers using the old layout should be stopped first.
+        Returns the number of files moved.
+        '''
+        moved = self._migrate_files(root=self._base_path, suffix='.message', get_directory=self.get_queue_directory)
+        moved += self._migrate_files(root=self._lock_path, suffix=LOCK_FILE_SUFFIX, get_directory=self.get_lock_directory)
+        if moved:
+            logger.info(f'migrated message files to layout [{self._shard_count=}][{moved=}]')
+            Statman.gauge('fqa.layout.migrated').increment(moved)
+        return moved
+
+    def _migrate_files(self, root: str, suffix: str, get_directory) -> int:
+        moved = 0
+        shard_names = [name for name in sorted(os.listdir(root)) if self.SHARD_NAME_PATTERN.fullmatch(name) and os.path.isdir(os.path.join(root, name))]
+        for directory in [root] + [os.path.join(root, shard_name) for shard_name in shard_names]:
+            for file_name in os.listdir(directory):
+                if not file_name.endswith(suffix):
+                    continue
+                destination = get_directory(self._get_message_id(file_name))
+                if destination == directory:
+                    continue
+                try:
+                    os.rename(src=os.path.join(directory, file_name), dst=os.path.join(destination, file_name))
+                except FileNotFoundError:
+                    # locked (or archived) by a consumer since the directory was listed
+                    continue
+                moved += 1
+
+        for shard_name in shard_names:
+            if shard_name not in self.shard_names:
+                self._remove_shard_directory(os.path.join(root, shard_name))
+        return moved
+
+    def _get_message_id(self, file_name: str) -> str:
+        if file_name.endswith(LOCK_FILE_SUFFIX):
+            return file_name[:-len(LOCK_FILE_SUFFIX)]
+        return MessageFileName.parse(file_name).message_id
+
+    def _remove_shard_directory(self, directory: str):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            # not empty: written to by a producer still using the old layout
+            logger.warning(f'shard directory not empty after migration [{directory=}]')
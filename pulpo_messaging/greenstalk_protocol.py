@@ -0,0 +1,33 @@
+'''
+greenstalk supports neither pipelining nor asyncio, so the beanstalkd adapters use its socket and response parsing directly, through this module only.
+These are greenstalk internals: they are written against the greenstalk version pinned in requirements.txt.
+'''
+import greenstalk
+
+
+def send(client: greenstalk.Client, data: bytes):
+    '''Writes data (one or more commands) to the connection of client, without reading the responses.'''
+    client._sock.sendall(data)
+
+
+def read_response(client: greenstalk.Client, expected: bytes) -> list:
+    '''Reads the next response line from the connection of client, returning its values; raises the greenstalk error of an unexpected response.'''
+    return parse_response(client._reader.readline(), expected)
+
+
+def read_job(client: greenstalk.Client, job_id: int, size: int) -> greenstalk.Job:
+    '''Reads the body of a RESERVED response from the connection of client.'''
+    return greenstalk.Job(job_id, client._read_chunk(size))
+
+
+def parse_response(line: bytes, expected: bytes) -> list:
+    return greenstalk._parse_response(line, expected)
+
+
+def parse_chunk(data: bytes, size: int) -> bytes:
+    '''Strips the trailing \\r\\n of a body of size bytes.'''
+    return greenstalk._parse_chunk(data, size)
+
+
+def parse_stats(body: bytes) -> dict:
+    return greenstalk._parse_stats(body)
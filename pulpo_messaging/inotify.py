@@ -0,0 +1,136 @@
+import os
+import ctypes
+import ctypes.util
+import select
+import struct
+from loguru import logger
+
+# see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT_HEADER = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+_libc = None
+
+
+def _load_libc():
+    global _libc  # pylint: disable=global-statement
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc = libc
+    return _libc
+
+
+def is_available() -> bool:
+    try:
+        return hasattr(_load_libc(), 'inotify_init1')
+    except (OSError, AttributeError):
+        return False
+
+
+class InotifyEvent():
+    _mask = None
+    _name = None
+    _path = None
+
+    def __init__(self, mask: int, name: str, path: str = None):
+        self._mask = mask
+        self._name = name
+        self._path = path
+
+    def __repr__(self):
+        return f'InotifyEvent(mask={self.mask:#x}, name={self.name!r}, path={self.path!r})'
+
+    @property
+    def mask(self) -> int:
+        return self._mask
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def path(self) -> str:
+        '''The watched directory the event occurred in.'''
+        return self._path
+
+    @property
+    def is_overflow(self) -> bool:
+        return bool(self.mask & IN_Q_OVERFLOW)
+
+
+class InotifyWatch():
+    '''
+    Minimal ctypes wrapper over Linux inotify: watches one or more directories and waits (select) for events.
+    Raises OSError when inotify is not available; callers are expected to fall back to polling.
+    '''
+
+    _fd = None
+    _watch_descriptors = None
+
+    def __init__(self, paths: list, mask: int):
+        if not is_available():
+            raise OSError('inotify is not available')
+        libc = _load_libc()
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._fd = fd
+        self._watch_descriptors = {}
+        for path in paths:
+            wd = libc.inotify_add_watch(fd, os.fsencode(path), mask)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                self.close()
+                raise OSError(errno, os.strerror(errno), path)
+            self._watch_descriptors[wd] = path
+        logger.trace(f'inotify watch [{fd=}][{paths=}][{mask=:#x}]')
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def wait(self, timeout: float = None) -> list:
+        '''Waits up to timeout seconds for events, returning the (possibly empty) list of events read.'''
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        return self.read()
+
+    def read(self) -> list:
+        '''Reads all pending events without blocking.'''
+        events = []
+        while True:
+            try:
+                buffer = os.read(self._fd, _READ_SIZE)
+            except BlockingIOError:
+                break
+            events.extend(self._parse(buffer))
+        return events
+
+    def _parse(self, buffer: bytes) -> list:
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buffer):
+            (wd, mask, _, name_length) = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + name_length].rstrip(b'\0')
+            offset += name_length
+            events.append(InotifyEvent(mask=mask, name=os.fsdecode(name), path=self._watch_descriptors.get(wd)))
+        return events
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
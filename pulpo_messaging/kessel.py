@@ -1,3 +1,4 @@
+import os
 import signal
 import time
 from statman import Statman
@@ -6,24 +7,46 @@ from art import text2art
 from loguru import logger
 from .file_queue_adapter import FileQueueAdapter
 from .beanstalkd_queue_adapter import BeanstalkdQueueAdapter
+from .circuit_breaker import CircuitBreakers
+from .segment_log_queue_adapter import SegmentLogQueueAdapter
+from .sqlite_queue_adapter import SqliteQueueAdapter
+from .memory_queue_adapter import MemoryQueueAdapter
 from .message import Message
 from .payload_handler import PayloadHandler, RequestResult
 from .queue_adapter import QueueAdapter
+from .rate_limiter import RequestTypeLimiter
+from .retry_policy import RetryPolicies
 from .sample_handlers import AlwaysFailHandler, AlwaysSucceedHandler, EchoHandler, FiftyFiftyHandler, LowerCaseHandler, UpperCaseHandler
+from .worker_pool import WorkerPool
 
 
 class HandlerRegistry():
     _registry = None
+    _limiters = None
+    _rate_limit_directory = None
 
-    def __init__(self):
+    def __init__(self, rate_limit_directory: str = None):
         self._registry = {}
-
-    def register(self, request_type: str, handler: PayloadHandler):
+        self._limiters = {}
+        self._rate_limit_directory = rate_limit_directory
+
+    def register(self, request_type: str, handler: PayloadHandler, rate_limit: float = None, burst: float = None, max_concurrency: int = None):
+        '''
+        Registers the handler of request_type.  rate_limit caps the messages of request_type handled per second (a token bucket of burst tokens), and
+        max_concurrency the messages of request_type handled at once; the dispatcher holds back a message over a limit, and goes on with the other request types.
+        '''
         self._registry[request_type] = handler
+        if rate_limit or max_concurrency:
+            self._limiters[request_type] = RequestTypeLimiter(request_type=request_type, rate_limit=rate_limit, burst=burst, max_concurrency=max_concurrency, directory=self._rate_limit_directory)
+        else:
+            self._limiters.pop(request_type, None)
 
     def get(self, message_type: str) -> PayloadHandler:
         return self._registry.get(message_type)
 
+    def get_limiter(self, message_type: str) -> RequestTypeLimiter:
+        return self._limiters.get(message_type)
+
 
 class PulpoConfig(Config):
 
@@ -42,6 +65,26 @@ class PulpoConfig(Config):
     def sleep_duration(self) -> int:
         return self.getAsInt('sleep_duration', 5)
 
+    @property
+    def wait_interval(self) -> float:
+        return float(self.get('wait_interval', 1))
+
+    @property
+    def batch_size(self) -> int:
+        return self.getAsInt('batch_size', 1)
+
+    @property
+    def worker_pool_mode(self) -> str:
+        return self.get('worker_pool.mode', None)
+
+    @property
+    def worker_pool_size(self) -> int:
+        return self.getAsInt('worker_pool.size', os.cpu_count())
+
+    @property
+    def worker_pool_prefetch(self) -> int:
+        return self.getAsInt('worker_pool.prefetch', 0)
+
     @property
     def enable_output_buffering(self) -> bool:
         return self.getAsBool(key='enable_output_buffering', default_value=False)
@@ -62,20 +105,52 @@ class PulpoConfig(Config):
     def enable_statman_reporting(self: Config) -> bool:
         return self.getAsBool('enable_statman_reporting', False)
 
+    @property
+    def retry_policies(self: Config) -> dict:
+        return self.get('retry_policies', {})
+
+    @property
+    def default_retry_policy(self: Config) -> dict:
+        return self.get('default_retry_policy', None)
+
+    @property
+    def circuit_breakers(self: Config) -> dict:
+        return self.get('circuit_breakers', {})
+
+    @property
+    def default_circuit_breaker(self: Config) -> dict:
+        return self.get('default_circuit_breaker', None)
+
+    @property
+    def rate_limit_directory(self: Config) -> str:
+        return self.get('rate_limit.directory', None)
+
+    @property
+    def max_throttled_messages(self: Config) -> int:
+        return self.getAsInt('rate_limit.max_throttled_messages', 100)
+
 
 class Pulpo():
     _queue_adapter = None
     _config = None
     _handler_registry = None
     _shutdown_requested = False
+    _worker_pool = None
+    _retry_policies = None
+    _circuit_breakers = None
+    # messages held back by the limits of their request type, as (time at which to try again (monotonic), message)
+    _throttled = None
 
     def __init__(self, options: dict = None, queue_adapter=None):
         self._config = PulpoConfig(options)
+        self._retry_policies = RetryPolicies(policies=self.config.retry_policies, default_policy=self.config.default_retry_policy)
+        self._circuit_breakers = CircuitBreakers(breakers=self.config.circuit_breakers, default_breaker=self.config.default_circuit_breaker)
 
         if queue_adapter:
             self._queue_adapter = queue_adapter
 
-        self._handler_registry = HandlerRegistry()
+        self._throttled = []
+        self._handler_registry = HandlerRegistry(rate_limit_directory=self.config.rate_limit_directory)
         self.handler_registry.register('echo', EchoHandler(self.config.get('echo_handler')))
         self.handler_registry.register('lower', LowerCaseHandler(self.config.get('lower_handler')))
         self.handler_registry.register('upper', UpperCaseHandler(self.config.get('upper_handler')))
@@ -101,6 +176,12 @@ class Pulpo():
             self._queue_adapter = FileQueueAdapter(self.config.get('file_queue_adapter'))
         elif self.config.queue_adapter_type in {'BeanstalkdQueueAdapter', 'beanstalkd_queue_adapter'}:
             self._queue_adapter = BeanstalkdQueueAdapter(self.config.get('beanstalkd_queue_adapter'))
+        elif self.config.queue_adapter_type in {'SegmentLogQueueAdapter', 'segment_log_queue_adapter'}:
+            self._queue_adapter = SegmentLogQueueAdapter(self.config.get('segment_log_queue_adapter'))
+        elif self.config.queue_adapter_type in {'SqliteQueueAdapter', 'sqlite_queue_adapter'}:
+            self._queue_adapter = SqliteQueueAdapter(self.config.get('sqlite_queue_adapter'))
+        elif self.config.queue_adapter_type in {'MemoryQueueAdapter', 'memory_queue_adapter'}:
+            self._queue_adapter = MemoryQueueAdapter(self.config.get('memory_queue_adapter'))
         else:
             raise Exception(f'invalid queue adapter type {self.config.queue_adapter_type}')
         return self._queue_adapter
@@ -124,9 +205,18 @@ class Pulpo():
         logger.info(f'publish message [{message.request_type}]')
         return self.queue_adapter.enqueue(message)
 
+    def publish_many(self, messages: list) -> list:
+        if not self._queue_adapter:
+            self.initialize_queue_adapter()
+
+        logger.info(f'publish messages [{len(messages)}]')
+        return self.queue_adapter.enqueue_batch(messages)
+
     def start(self) -> Message:
         self.print_banner()
         self.initialize_queue_adapter()
+        if self.config.worker_pool_mode:
+            self._worker_pool = WorkerPool(mode=self.config.worker_pool_mode, size=self.config.worker_pool_size, prefetch=self.config.worker_pool_prefetch)
         continue_processing = True
         iterations_with_no_messages = 0
 
@@ -134,12 +224,19 @@ class Pulpo():
         Statman.calculation(
             'kessel.message_streak_messages_per_s').calculation_function = lambda: Statman.gauge('kessel.message_streak_cnt').value / Statman.stopwatch('kessel.message_streak_tm').value
         while continue_processing and not self._shutdown_requested:
+            if self._worker_pool:
+                self.complete_worker_pool_messages()
+            self.process_throttled_messages()
+
             Statman.gauge('kessel.dequeue-attempts').increment()
-            message = self.queue_adapter.dequeue()
+            messages = self.dequeue_messages()
 
-            if message:
+            if messages:
                 iterations_with_no_messages = 0
-                self.handle_message(message)
+                for message in messages:
+                    self.process_message(message)
+            elif (self._worker_pool and self._worker_pool.in_flight_count) or self._throttled:
+                self.wait_for_pending_messages()
             else:
                 iterations_with_no_messages += 1
                 logger.trace(f'no message available [iteration with no messages = {iterations_with_no_messages}][max = {self.config.shutdown_after_number_of_empty_iterations}]')
@@ -152,29 +249,223 @@ class Pulpo():
                     logger.info('no message available, shutdown')
                     continue_processing = False
                 else:
-                    logger.debug('no message available, sleep')
-                    time.sleep(self.config.sleep_duration)
+                    logger.debug('no message available, wait')
+                    self.wait_for_messages(self.config.sleep_duration)
                     Statman.stopwatch('kessel.message_streak_tm').start()
                     Statman.gauge('kessel.message_streak_cnt').value = 0
 
+        if self._worker_pool:
+            self.shutdown_worker_pool()
+        self.rollback_throttled_messages()
+
         logger.info('pulpo-messaging shutdown')
 
+    def wait_for_pending_messages(self):
+        '''
+        Waits while messages are in flight or kept aside by throttle_message, for at most wait_interval seconds (so that a shutdown ends the wait within one slice),
+        cut short when the first message kept aside may be tried again.  While a worker is free, the wait is on the queue adapter, so that a message published meanwhile
+        is dispatched at once rather than behind the messages in flight; those completed meanwhile are committed on the next iteration.  Otherwise the wait is for an
+        in-flight message to complete.
+        '''
+        if self._worker_pool and self._worker_pool.in_flight_count:
+            timeout = self.config.wait_interval
+            throttled_wait = self._get_throttled_wait()
+            if throttled_wait is not None:
+                timeout = min(timeout, throttled_wait)
+            if self._worker_pool.available_capacity:
+                logger.trace('no message available, wait for messages while in-flight messages complete')
+                self.queue_adapter.wait_for_message(timeout=timeout)
+            else:
+                logger.trace('no message available, wait for in-flight messages')
+                self.complete_worker_pool_messages(wait=True, timeout=timeout)
+        else:
+            logger.trace('no message available, wait for throttled messages')
+            self.wait_for_messages(min(self.config.sleep_duration, self._get_throttled_wait()))
+
+    def wait_for_messages(self, duration: float) -> bool:
+        '''
+        Blocks on the queue adapter for up to duration seconds until a message may be available.
+        The wait is made in slices of at most wait_interval seconds, so that a shutdown requested by signal_handler ends it within one slice.
+        '''
+        deadline = time.monotonic() + duration
+        while not self._shutdown_requested:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.queue_adapter.wait_for_message(timeout=min(remaining, self.config.wait_interval)):
+                logger.trace('wait complete, message may be available')
+                return True
+        return False
+
+    def dequeue_messages(self) -> list:
+        batch_size = self.config.batch_size
+        if self._worker_pool:
+            batch_size = min(batch_size, self._worker_pool.available_capacity)
+            if batch_size < 1:
+                return []
+
+        if batch_size > 1:
+            return self.queue_adapter.dequeue_batch(max_messages=batch_size)
+
+        message = self.queue_adapter.dequeue()
+        if message:
+            return [message]
+        return []
+
+    def process_message(self, message: Message):
+        if self.throttle_message(message):
+            return
+        if self.hold_back_message(message):
+            self._refund_message_limits(message)
+            return
+        if self._worker_pool:
+            self.dispatch_message(message)
+        else:
+            self.handle_message(message)
+
+    def throttle_message(self, message: Message) -> bool:
+        '''
+        If the rate limit or concurrency cap of the message's request type does not let it through, keeps the message aside until it may be tried again, and returns True.
+        The dispatcher goes on with the messages of other request types; while the rate limit holds, the queue adapter is asked to hold back the request type (see _pause_throttled_request_type).
+        A message kept aside stays dequeued; once max_throttled_messages are kept aside, it is deferred (returned to the queue with a delay) instead.  Neither counts as an attempt.
+        '''
+        limiter = self.handler_registry.get_limiter(message.request_type)
+        if limiter is None:
+            return False
+        wait = limiter.acquire()
+        if not wait:
+            return False
+        logger.debug(f'message throttled [id={message.id}][type={message.request_type}][{wait=}]')
+        self._pause_throttled_request_type(message.request_type, limiter, wait)
+        if len(self._throttled) < self.config.max_throttled_messages:
+            self._throttled.append((time.monotonic() + wait, message))
+        else:
+            self.queue_adapter.defer(message=message, delay=wait)
+        Statman.gauge('kessel.messages.throttled').increment()
+        return True
+
+    def _pause_throttled_request_type(self, request_type: str, limiter: RequestTypeLimiter, wait: float):
+        '''
+        Asks the queue adapter to hold back a request type held by its rate limit for wait seconds.  The limits are kept by this process (or host, for a shared token bucket),
+        so a pause that applies to every consumer of the queue (beanstalkd pause-tube) is not used, and neither is a pause for the concurrency cap, which frees as soon as
+        a message of the request type completes: the messages then dequeued are kept aside, or deferred.
+        '''
+        if limiter.is_at_concurrency_cap or self.queue_adapter.is_pause_shared:
+            return
+        self.queue_adapter.pause_request_type(request_type=request_type, duration=wait)
+
+    def process_throttled_messages(self):
+        '''Tries again the messages kept aside by throttle_message whose wait is over, in the order they were dequeued.'''
+        now = time.monotonic()
+        throttled = self._throttled
+        self._throttled = [(retry_at, message) for (retry_at, message) in throttled if retry_at > now]
+        for (retry_at, message) in throttled:
+            if retry_at <= now:
+                self.process_message(message)
+
+    def rollback_throttled_messages(self):
+        '''Returns the messages kept aside by throttle_message to the queue, on shutdown, without counting an attempt.'''
+        for (_, message) in self._throttled:
+            self.queue_adapter.defer(message=message)
+        self._throttled = []
+
+    def _get_throttled_wait(self) -> float:
+        '''Seconds until the first message kept aside by throttle_message may be tried again, or None if there is none.'''
+        if not self._throttled:
+            return None
+        return max(min(retry_at for (retry_at, _) in self._throttled) - time.monotonic(), 0)
+
+    def _release_message_limits(self, message: Message):
+        limiter = self.handler_registry.get_limiter(message.request_type)
+        if limiter:
+            limiter.release()
+            if limiter.max_concurrency and self._throttled:
+                # the messages of the request type held back by its concurrency cap may go now
+                self._throttled = [(0 if throttled.request_type == message.request_type else retry_at, throttled) for (retry_at, throttled) in self._throttled]
+
+    def _refund_message_limits(self, message: Message):
+        '''Undoes the acquire of throttle_message for a message held back by its circuit breaker; the messages kept aside are not woken, as the breaker holds back their request type too.'''
+        limiter = self.handler_registry.get_limiter(message.request_type)
+        if limiter:
+            limiter.refund()
+
+    def dispatch_message(self, message: Message):
+        '''Hands the message to the worker pool; it is committed / rolled back by complete_worker_pool_messages once the handler completes.'''
+        handler = self.begin_message(message)
+        if handler:
+            self._worker_pool.submit(message, handler)
+        else:
+            self.complete_message(message, self.invalid_handler_result(message))
+
+    def complete_worker_pool_messages(self, wait: bool = False, timeout: float = None):
+        '''Commits / rolls back every completed in-flight message; blocks for at least one completion (for up to timeout seconds) if wait is set or the pool is saturated.'''
+        if not wait and self._worker_pool.available_capacity:
+            timeout = 0
+        for message, result in self._worker_pool.wait_for_completed(timeout=timeout):
+            self.complete_message(message, result)
+
+    def shutdown_worker_pool(self):
+        logger.info(f'draining worker pool [in-flight={self._worker_pool.in_flight_count}]')
+        for message, result in self._worker_pool.drain():
+            self.complete_message(message, result)
+        self._worker_pool.shutdown()
+        self._worker_pool = None
+
     def handle_message(self, message) -> RequestResult:
+        handler = self.begin_message(message)
+        if handler:
+            result = handler.handle(payload=message.payload)
+        else:
+            result = self.invalid_handler_result(message)
+        return self.complete_message(message, result)
+
+    def begin_message(self, message: Message) -> PayloadHandler:
+        '''Returns the handler for the message, or None if there is no valid handler.'''
         Statman.gauge('kessel.dequeue').increment()
         Statman.gauge('kessel.message_streak_cnt').increment()
 
         logger.info(f'processing message [id={message.id}][type={message.request_type}]')
         handler = self.handler_registry.get(message.request_type)
         logger.trace(f'handler: {handler}')
+        if isinstance(handler, PayloadHandler):
+            return handler
+        return None
+
+    def invalid_handler_result(self, message: Message) -> RequestResult:
+        handler = self.handler_registry.get(message.request_type)
         if handler is None:
             logger.warning(f'WARNING no handler for message type {message.request_type}')
-            result = RequestResult.fatal_factory(f'WARNING no handler for message type {message.request_type}')
-        elif isinstance(handler, PayloadHandler):
-            result = handler.handle(payload=message.payload)
-        else:
-            logger.warning(f'WARNING unexpected handler {message.request_type} {handler}')
-            result = RequestResult.fatal_factory(f'WARNING unexpected handler {message.request_type} {handler}')
+            return RequestResult.fatal_factory(f'WARNING no handler for message type {message.request_type}')
+        logger.warning(f'WARNING unexpected handler {message.request_type} {handler}')
+        return RequestResult.fatal_factory(f'WARNING unexpected handler {message.request_type} {handler}')
+
+    def hold_back_message(self, message: Message) -> bool:
+        '''
+        If the circuit breaker of the message's request type does not let it through, returns the message to the queue until the breaker half-opens, and returns True.
+        The queue adapter is asked to hold back the request type, so that its other messages stay in the queue; this message is deferred with a delay,
+        so that it does not count as an attempt however long the breaker stays open.
+        '''
+        duration = self._circuit_breakers.get_hold_duration(message.request_type)
+        if duration is None:
+            return False
+        logger.info(f'circuit breaker open, message held back [id={message.id}][type={message.request_type}][{duration=}]')
+        self.queue_adapter.pause_request_type(request_type=message.request_type, duration=duration)
+        self.queue_adapter.defer(message=message, delay=duration)
+        Statman.gauge('kessel.messages.held-back').increment()
+        return True
+
+    def record_circuit_breaker_result(self, message: Message, result: RequestResult):
+        '''Counts a transient failure, or a success, in the circuit breaker of the message's request type; when the breaker opens, the queue adapter holds back the request type.'''
+        open_duration = self._circuit_breakers.record(message.request_type, result)
+        if open_duration is not None:
+            logger.warning(f'circuit breaker opened [type={message.request_type}][{open_duration=}]')
+            Statman.gauge('kessel.circuit-breaker.opened').increment()
+            self.queue_adapter.pause_request_type(request_type=message.request_type, duration=open_duration)
+
+    def complete_message(self, message: Message, result: RequestResult) -> RequestResult:
         logger.trace(f'processing complete: {result=}')
+        self._release_message_limits(message)
+        self.record_circuit_breaker_result(message, result)
 
         if result.isSuccess:
             logger.info(f'message successfully processed [id={message.id}][type={message.request_type}]')
@@ -183,8 +474,9 @@ class Pulpo():
             Statman.gauge('kessel.commit').increment()
             logger.debug('commit complete')
         elif result.isTransient:
-            logger.warning(f'message failed due to transient condition [id={message.id}][type={message.request_type}]')
-            self.queue_adapter.rollback(message=message)
+            delay = self._retry_policies.get_delay(request_type=message.request_type, attempts=message.attempts, retry_after=result.retry_after)
+            logger.warning(f'message failed due to transient condition [id={message.id}][type={message.request_type}][{delay=}]')
+            self.queue_adapter.rollback(message=message, delay=delay)
             Statman.gauge('kessel.messages.transient').increment()
             Statman.gauge('kessel.rollback').increment()
             logger.debug('rollback complete')
@@ -199,7 +491,7 @@ class Pulpo():
 
         Statman.gauge('kessel.messages_processed').increment()
 
-        return RequestResult
+        return result
 
     def print_banner(self):
         if self.config.enable_banner:
@@ -0,0 +1,166 @@
+import datetime
+import heapq
+import time
+from loguru import logger
+from statman import Statman
+from pulpo_config import Config
+from pulpo_messaging.message import Message
+from pulpo_messaging.ready_heap import ReadyHeapQueueAdapter
+
+
+class MemoryQueueAdapterConfig(Config):
+
+    def __init__(self, options: dict = None, json_file_path: str = None):
+        super().__init__(options=options, json_file_path=json_file_path)
+
+    @property
+    def max_number_of_attempts(self: Config) -> int:
+        return self.getAsInt('max_number_of_attempts', 0)
+
+    @property
+    def ttr(self: Config) -> float:
+        return float(self.get('ttr', 120))
+
+
+class MemoryQueueAdapter(ReadyHeapQueueAdapter):
+    '''
+    Queue held in process memory: for tests, for benchmarks (a baseline without I/O for the cost of the dispatcher), and for offloading jobs within a process.
+    Messages are lost when the process exits.  Messages are held, not copied: a message should not be changed once enqueued.
+    Ready messages are kept in a priority heap, and delayed messages in a timing wheel by available time (see ReadyHeap).
+    A dequeued message is reserved for ttr seconds, as with beanstalkd: a reservation neither committed nor rolled back in time expires,
+    and the message is dequeued again, counted as a failed attempt.
+    '''
+
+    GAUGE_PREFIX = 'mqa'
+
+    config = None
+    _next_seq = None
+    _messages = None
+    _attempts = None
+    _reserved = None
+    _reservation_deadlines = None
+
+    def __init__(self, options: dict = None):
+        super().__init__()
+        self.config = MemoryQueueAdapterConfig(options)
+        self._next_seq = 1
+        self._messages = {}
+        self._attempts = {}
+        # seq => reservation deadline (monotonic)
+        self._reserved = {}
+        self._reservation_deadlines = []
+
+    def enqueue(self, message: Message) -> Message:
+        return self.enqueue_batch([message])[0]
+
+    def enqueue_batch(self, messages: list) -> list:
+        now = time.time()
+        with self._condition:
+            for message in messages:
+                seq = self._next_seq
+                self._next_seq += 1
+                message.id = str(seq)
+                self._messages[seq] = message
+                self._ready.push(seq, message.priority, message.delay.timestamp() if message.delay else 0, now)
+            self._condition.notify_all()
+        Statman.gauge('mqa.enqueue').increment(len(messages))
+        return messages
+
+    def _lock_next(self) -> Message:
+        '''Reserves the first ready message in priority order.  Exhausted and expired messages are removed on the way.'''
+        self._promote()
+        while (seq := self._ready.pop()) is not None:
+            message = self._messages.get(seq)
+            if message is None or seq in self._reserved:
+                # deleted since it was pushed
+                continue
+            attempts = self._attempts.get(seq, 0)
+            if self.config.max_number_of_attempts and attempts >= self.config.max_number_of_attempts:
+                logger.trace(f'message exceed max attempts {self.config.max_number_of_attempts=} {attempts=}')
+                self._remove(seq)
+                continue
+            if message.expiration and message.expiration < datetime.datetime.now():
+                logger.trace(f'message expired {message.expiration=}')
+                self._remove(seq)
+                continue
+            if self._hold_back(seq, message.priority, message):
+                continue
+
+            message.attempts = attempts
+            self._reserved[seq] = time.monotonic() + self.config.ttr
+            heapq.heappush(self._reservation_deadlines, (self._reserved[seq], seq))
+            return message
+        return None
+
+    def _expire_reservations(self):
+        now = time.monotonic()
+        while self._reservation_deadlines and self._reservation_deadlines[0][0] <= now:
+            (deadline, seq) = heapq.heappop(self._reservation_deadlines)
+            if self._reserved.get(seq) == deadline:
+                logger.warning(f'message reservation expired, message returned to the queue [{seq=}]')
+                Statman.gauge('mqa.reservation-expired').increment()
+                self._release(seq)
+
+    def _release(self, seq: int, delay: float = None, count_attempt: bool = True):
+        del self._reserved[seq]
+        if count_attempt:
+            self._attempts[seq] = self._attempts.get(seq, 0) + 1
+        now = time.time()
+        self._ready.push(seq, self._messages[seq].priority, now + delay if delay else 0, now)
+        self._condition.notify_all()
+
+    def _remove(self, seq: int):
+        self._messages.pop(seq, None)
+        self._attempts.pop(seq, None)
+        self._reserved.pop(seq, None)
+
+    def _promote(self):
+        self._expire_reservations()
+        super()._promote()
+
+    def _get_wait_timeout(self, remaining: float) -> float:
+        '''Cut short also at the next reservation deadline.'''
+        timeout = super()._get_wait_timeout(remaining)
+        if self._reservation_deadlines:
+            timeout = min(timeout, max(self._reservation_deadlines[0][0] - time.monotonic(), 0))
+        return timeout
+
+    def _check_reserved(self, seq: int):
+        self._expire_reservations()
+        if seq not in self._reserved:
+            raise Exception(f'message is not reserved, or its reservation expired [{seq=}]')
+
+    def commit(self, message: Message, is_success: bool = True):
+        seq = self._get_seq(message)
+        with self._condition:
+            self._check_reserved(seq)
+            self._remove(seq)
+        logger.trace(f'commit complete [{seq=}][{is_success=}]')
+        Statman.gauge('mqa.commit').increment()
+
+    def rollback(self, message: Message, delay: float = None):
+        seq = self._get_seq(message)
+        with self._condition:
+            self._check_reserved(seq)
+            self._release(seq, delay)
+        Statman.gauge('mqa.rollback').increment()
+
+    def defer(self, message: Message, delay: float = None):
+        seq = self._get_seq(message)
+        with self._condition:
+            self._check_reserved(seq)
+            self._release(seq, delay, count_attempt=False)
+        Statman.gauge('mqa.defer').increment()
+
+    def peek(self, message_id: str) -> Message:
+        seq = self._get_seq(message_id)
+        with self._condition:
+            message = self._messages.get(seq)
+            if message:
+                message.attempts = self._attempts.get(seq, 0)
+            return message
+
+    def delete(self, message_id: str):
+        seq = self._get_seq(message_id)
+        with self._condition:
+            self._remove(seq)
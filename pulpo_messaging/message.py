@@ -1,5 +1,6 @@
 from datetime import timedelta
 import datetime
+import math
 import typing
 
 
@@ -8,14 +9,46 @@ class Message():
     # - delay
     # - ttr
     # - payload
-
-    _components = None
-
-    def __init__(self, message_id=None, body: dict = None, payload=None, header: dict = None, request_type=None, delay=None, expiration: datetime.datetime = None, components: dict = None):
-        self._components = {}
+    '''
+    The header items read by the adapters and the dispatch loop (request_type, priority, delay, expiration, attempts) and the id are held in typed slots,
+    converted once when set (including when a message is decoded), so reading them needs no dict walk or date parsing.
+    Other header items, the body and any other components are held as dicts.  The nested components form is rebuilt on demand (`_components`), for serialization.
+    A message decoded from a header-first format holds its body as raw bytes, decoded by the codec on first access to the body.
+    '''
+
+    DEFAULT_PRIORITY = 2**16
+    # beanstalkd priorities are unsigned 32 bit
+    MAX_PRIORITY = 2**32 - 1
+
+    # header items held in slots
+    TYPED_HEADER_KEYS = ('request_type', 'priority', 'delay', 'expiration', 'attempts')
+
+    __slots__ = ('_id', '_request_type', '_priority', '_delay', '_expiration', '_attempts', '_header', '_body', '_other', '_raw_body', '_body_codec')
+
+    def __init__(self,
+                 message_id=None,
+                 body: dict = None,
+                 payload=None,
+                 header: dict = None,
+                 request_type=None,
+                 delay=None,
+                 expiration: datetime.datetime = None,
+                 components: dict = None,
+                 priority: int = None):
+        self._id = None
+        self._request_type = None
+        self._priority = None
+        self._delay = None
+        self._expiration = None
+        self._attempts = None
+        self._header = None
+        self._body = None
+        self._other = None
+        self._raw_body = None
+        self._body_codec = None
 
         if components:
-            self._components = components
+            self.__store_components(components)
         if message_id:
             self.id = message_id
         if body:
@@ -30,10 +63,16 @@ class Message():
             self.delay = delay
         if expiration:
             self.expiration = expiration
+        if priority is not None:
+            self.priority = priority
 
     def __str__(self):
         return str(self._components)
 
+    def __store_components(self, components: dict):
+        for key, value in components.items():
+            self.set(key, value)
+
     def __store_header(self, header):
         if isinstance(header, dict):
             for key in header:
@@ -46,10 +85,66 @@ class Message():
         for key in body:
             self.set_body_item(key=key, value=body[key])
 
+    @property
+    def _components(self) -> dict:
+        '''The nested components form (id, header, body, ...), as serialized by the message codecs.'''
+        components = self._header_components
+        body = self.__get_body()
+        if body is not None:
+            components['body'] = body
+        return components
+
+    @property
+    def _header_components(self) -> dict:
+        '''The components other than the body.'''
+        components = {}
+        if self._id is not None:
+            components['id'] = self._id
+        header = self.header
+        if header is not None:
+            components['header'] = header
+        if self._other:
+            components.update(self._other)
+        return components
+
+    def _set_raw_body(self, raw_body: bytes, codec):
+        '''Holds the encoded body, to be decoded by codec.decode_body on first access.'''
+        self._body = None
+        self._raw_body = raw_body
+        self._body_codec = codec
+
+    def _get_raw_body(self, codec) -> bytes:
+        '''Returns the encoded body if it has not been decoded and was encoded by codec (so it can be written as is), otherwise None.'''
+        if self._raw_body is not None and self._body_codec is codec:
+            return self._raw_body
+        return None
+
+    def __get_body(self):
+        if self._raw_body is not None:
+            self._body = self._body_codec.decode_body(self._raw_body)
+            self._raw_body = None
+            self._body_codec = None
+        return self._body
+
     def get(self, key: str):
         keys = key.split('.')
 
-        value = self._components
+        if keys[0] == 'id':
+            value = self._id
+            keys = keys[1:]
+        elif keys[0] == 'header':
+            if len(keys) > 1 and keys[1] in self.TYPED_HEADER_KEYS:
+                value = getattr(self, f'_{keys[1]}')
+                keys = keys[2:]
+            else:
+                value = self.header
+                keys = keys[1:]
+        elif keys[0] == 'body':
+            value = self.__get_body()
+            keys = keys[1:]
+        else:
+            value = self._other
+
         for subkey in keys:
             if value:
                 if subkey in value:
@@ -70,7 +165,22 @@ class Message():
     def set(self, key: str, value: typing.Any):
         keys = key.split('.')
 
-        parent = self._components
+        if keys == ['id']:
+            self._id = value
+            return
+        if keys == ['header']:
+            self.__set_header(value)
+            return
+        if len(keys) == 2 and keys[0] == 'header' and keys[1] in self.TYPED_HEADER_KEYS:
+            self.__set_typed_header_item(keys[1], value)
+            return
+
+        if keys == ['body']:
+            self._raw_body = None
+            self._body = value
+            return
+
+        (parent, keys) = self.__get_container(keys)
         for key_number in range(0, len(keys) - 1):
             key = keys[key_number]
             if not key in parent:
@@ -80,17 +190,55 @@ class Message():
         last_key = keys[len(keys) - 1]
         parent[last_key] = value
 
+    def __get_container(self, keys: list) -> tuple:
+        '''Returns the dict holding the (untyped) item named by keys, and the keys relative to it.'''
+        if keys[0] == 'header':
+            if self._header is None:
+                self._header = {}
+            return (self._header, keys[1:])
+        if keys[0] == 'body':
+            if self.__get_body() is None:
+                self._body = {}
+            return (self._body, keys[1:])
+        if self._other is None:
+            self._other = {}
+        return (self._other, keys)
+
+    def __set_header(self, header):
+        for key in self.TYPED_HEADER_KEYS:
+            setattr(self, f'_{key}', None)
+        self._header = None
+        if isinstance(header, dict):
+            for key, value in header.items():
+                self.set_header_item(key=key, value=value)
+        elif header is not None:
+            # not a dict (not written by this class); kept as is
+            self._header = header
+
+    def __set_typed_header_item(self, key: str, value):
+        if key in {'priority', 'attempts'}:
+            value = None if value is None else int(value)
+        elif key in {'delay', 'expiration'} and isinstance(value, str):
+            # datetimes are serialized by str(), e.g. '2024-01-02 03:04:05.678000' (or without the fraction)
+            value = datetime.datetime.fromisoformat(value)
+        setattr(self, f'_{key}', value)
+
     @property
     def id(self):
-        return str(self.get("id"))
+        return str(self._id)
 
     @id.setter
     def id(self, value):
-        self.set("id", value)
+        self._id = value
 
     @property
     def header(self) -> dict:
-        return self.get('header')
+        if self._header is not None and not isinstance(self._header, dict):
+            return self._header
+        typed_header = {key: getattr(self, f'_{key}') for key in self.TYPED_HEADER_KEYS if getattr(self, f'_{key}') is not None}
+        if self._header is None and not typed_header:
+            return None
+        return {**(self._header or {}), **typed_header}
 
     def get_header_item(self, key: str) -> str:
         fqk = f'header.{key}'
@@ -102,8 +250,7 @@ class Message():
 
     @property
     def delay(self):
-        fqk = 'header.delay'
-        return self.getAsDate(fqk)
+        return self._delay
 
     @property
     def delayInSeconds(self):
@@ -115,7 +262,8 @@ class Message():
         delay_delta = delay_dt - now
         value = delay_delta.total_seconds()
         value = max(value, 0)
-        value = round(value)
+        # beanstalkd delays are whole seconds: round up, so that the message is never delivered early
+        value = math.ceil(value)
         return value
 
     @delay.setter
@@ -127,43 +275,49 @@ class Message():
             delta_dt = datetime.datetime.now() + delta
         else:
             delta_dt = value
-        fqk = 'header.delay'
-        self.set(fqk, delta_dt)
+        self.__set_typed_header_item('delay', delta_dt)
+
+    @property
+    def priority(self) -> int:
+        if self._priority is None:
+            return self.DEFAULT_PRIORITY
+        return min(max(self._priority, 0), self.MAX_PRIORITY)
+
+    def get_aged_priority(self, waited_seconds: float, priority_aging_interval: float) -> int:
+        '''Priority raised (lowered in value) by one for every priority_aging_interval seconds waited, so that low priority messages are not starved.'''
+        if not priority_aging_interval or waited_seconds <= 0:
+            return self.priority
+        return max(self.priority - int(waited_seconds // priority_aging_interval), 0)
+
+    @priority.setter
+    def priority(self, value: int):
+        self.__set_typed_header_item('priority', value)
 
     @property
     def request_type(self):
-        return self.get_header_item('request_type')
+        return self._request_type
 
     @request_type.setter
     def request_type(self, value):
-        self.set_header_item('request_type', value)
+        self._request_type = value
 
     @property
     def expiration(self) -> datetime.datetime:
-        value = self.get_header_item('expiration')
-        if isinstance(value, str):
-            value = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')  # pylint: disable=redefined-variable-type
-        return value
+        return self._expiration
 
     @expiration.setter
     def expiration(self, value):
-        #%Y-%m-%d %H:%M:%S
-        if isinstance(value, str):
-            value = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
-        self.set_header_item('expiration', value)
+        self.__set_typed_header_item('expiration', value)
 
     @property
     def attempts(self) -> int:
-        header_item = self.get_header_item('attempts')
-        if header_item is None:
-            value = 0
-        else:
-            value = int(header_item)
-        return value
+        if self._attempts is None:
+            return 0
+        return self._attempts
 
     @attempts.setter
     def attempts(self, value: int):
-        self.set_header_item('attempts', value)
+        self.__set_typed_header_item('attempts', value)
 
     def get_body_item(self, key: str):
         fqk = f'body.{key}'
@@ -175,8 +329,11 @@ class Message():
 
     @property
     def body(self) -> dict:
-        return self.get('body')
+        return self.__get_body()
 
     @property
     def payload(self):
-        return self.get_body_item('payload')
+        body = self.__get_body()
+        if not isinstance(body, dict):
+            return None
+        return body.get('payload')
@@ -0,0 +1,289 @@
+import datetime
+import json
+import struct
+import typing
+from pulpo_messaging.message import Message
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+# encoded messages other than the (legacy) pretty printed json start with FORMAT_TAG_MARKER followed by the codec's one byte format tag,
+# followed by the header-first layout (see HeaderFirstCodec).
+# json always starts with '{', so untagged data is json, and files / jobs written in different formats can share a queue.
+FORMAT_TAG_MARKER = b'\x00'
+
+# header items carried as epoch timestamps (rather than strings) by the compact codecs
+TIMESTAMP_HEADER_KEYS = ('delay', 'expiration')
+
+
+class MessageCodec():
+    '''Serializes a message to bytes and back.  format_tag is None only for the untagged json format.'''
+    name = None
+    format_tag = None
+
+    def encode(self, message: Message) -> bytes:
+        pass
+
+    def decode(self, data: bytes, header_only: bool = False) -> Message:
+        pass
+
+
+class HeaderFirstCodec(MessageCodec):
+    '''
+    Codec with a header-first layout: the length of the header section, the header section (every component except the body), then the body section.
+    Decoding parses the header section only; the body section is held as raw bytes and decoded on first access to the message body (see Message._set_raw_body),
+    so messages skipped on their header (delayed, expired, exhausted) never pay for their payload.  All tagged codecs are header-first.
+    '''
+
+    HEADER_LENGTH = struct.Struct('!I')
+
+    def encode_header(self, components: dict) -> bytes:
+        pass
+
+    def decode_header(self, data: bytes) -> dict:
+        pass
+
+    def encode_body(self, body) -> bytes:
+        pass
+
+    def decode_body(self, data: bytes):
+        pass
+
+    def encode(self, message: Message) -> bytes:
+        header = self.encode_header(_to_wire(message._header_components))  # pylint: disable=assignment-from-no-return
+        body = message._get_raw_body(self)
+        if body is None:
+            body = self.encode_body(message.body) if message.body is not None else b''
+        return b''.join((self.HEADER_LENGTH.pack(len(header)), header, body))
+
+    def decode(self, data: bytes, header_only: bool = False) -> Message:
+        data = memoryview(data)
+        (header_length, ) = self.HEADER_LENGTH.unpack_from(data)
+        offset = self.HEADER_LENGTH.size
+        message = self.decode_header_section(data[offset:offset + header_length])
+        body = data[offset + header_length:]
+        if body and not header_only:
+            message._set_raw_body(body, self)
+        return message
+
+    def decode_header_section(self, data: bytes) -> Message:
+        return Message(components=_from_wire(self.decode_header(data)))
+
+
+class JsonCodec(MessageCodec):
+    '''The original pretty printed json format; datetimes are written as strings.  Not header-first: the whole document is parsed on decode.'''
+    name = 'json'
+
+    def encode(self, message: Message) -> bytes:
+        return json.dumps(message._components, indent=2, default=str).encode('utf-8')
+
+    def decode(self, data: bytes, header_only: bool = False) -> Message:
+        return Message(components=json.loads(data))
+
+
+class CompactJsonCodec(HeaderFirstCodec):
+    '''json without whitespace, with delay / expiration as epoch timestamps, so that decoded messages carry datetimes and need no strptime.'''
+    name = 'json-compact'
+    format_tag = b'j'
+
+    def encode_header(self, components: dict) -> bytes:
+        return _compact_json(components)
+
+    def decode_header(self, data: bytes) -> dict:
+        return json.loads(bytes(data))
+
+    def encode_body(self, body) -> bytes:
+        return _compact_json(body)
+
+    def decode_body(self, data: bytes):
+        return json.loads(bytes(data))
+
+
+class MsgpackCodec(HeaderFirstCodec):
+    '''msgpack, with delay / expiration as epoch timestamps.  Requires the optional msgpack package.'''
+    name = 'msgpack'
+    format_tag = b'm'
+
+    def encode_header(self, components: dict) -> bytes:
+        return _require_msgpack().packb(components, default=str)
+
+    def decode_header(self, data: bytes) -> dict:
+        return _require_msgpack().unpackb(data)
+
+    def encode_body(self, body) -> bytes:
+        return _require_msgpack().packb(body, default=str)
+
+    def decode_body(self, data: bytes):
+        return _require_msgpack().unpackb(data)
+
+
+class StructCodec(HeaderFirstCodec):
+    '''
+    Fixed struct packed header (priority, delay, expiration, attempts, request type), with any other components (id, additional header items) as compact json.
+    A body holding only a string payload is carried as raw utf-8; any other body as compact json.
+    '''
+    name = 'struct'
+    format_tag = b's'
+
+    # flags, priority, delay, expiration, attempts, request type length
+    HEADER = struct.Struct('!BqddqH')
+
+    FLAG_PRIORITY = 0x01
+    FLAG_DELAY = 0x02
+    FLAG_EXPIRATION = 0x04
+    FLAG_ATTEMPTS = 0x08
+    FLAG_REQUEST_TYPE = 0x10
+
+    # header item, flag, packed types
+    FIELDS = (
+        ('priority', FLAG_PRIORITY, int),
+        ('delay', FLAG_DELAY, (int, float)),
+        ('expiration', FLAG_EXPIRATION, (int, float)),
+        ('attempts', FLAG_ATTEMPTS, int),
+        ('request_type', FLAG_REQUEST_TYPE, str),
+    )
+
+    # first byte of the body section
+    BODY_RAW_PAYLOAD = b'r'
+    BODY_JSON = b'j'
+
+    def encode_header(self, components: dict) -> bytes:
+        header = components.get('header')
+        header = dict(header) if isinstance(header, dict) else header
+
+        # header items that do not fit the packed header (e.g. a delay held as a string) stay in the json extra
+        flags = 0
+        values = {}
+        for (key, flag, types) in self.FIELDS if isinstance(header, dict) else ():
+            if isinstance(header.get(key), types) and not isinstance(header.get(key), bool):
+                flags |= flag
+                values[key] = header.pop(key)
+        request_type = values.get('request_type', '').encode('utf-8')
+
+        extra = {key: value for key, value in components.items() if key != 'header'}
+        if header:
+            extra['header'] = header
+        extra = _compact_json(extra) if extra else b''
+
+        packed_header = self.HEADER.pack(flags, values.get('priority', 0), values.get('delay', 0), values.get('expiration', 0), values.get('attempts', 0), len(request_type))
+        return b''.join((packed_header, request_type, extra))
+
+    def decode_header(self, data: bytes) -> dict:
+        (flags, priority, delay, expiration, attempts, request_type_length) = self.HEADER.unpack_from(data)
+        offset = self.HEADER.size
+        request_type = bytes(data[offset:offset + request_type_length]).decode('utf-8')
+        offset += request_type_length
+        components = json.loads(bytes(data[offset:])) if len(data) > offset else {}
+
+        header = components.get('header', {})
+        packed_values = {'priority': priority, 'delay': delay, 'expiration': expiration, 'attempts': attempts, 'request_type': request_type}
+        for (key, flag, _) in self.FIELDS:
+            if flags & flag:
+                header[key] = packed_values[key]
+        if header:
+            components['header'] = header
+        return components
+
+    def encode_body(self, body) -> bytes:
+        if isinstance(body, dict) and list(body) == ['payload'] and isinstance(body['payload'], str):
+            return self.BODY_RAW_PAYLOAD + body['payload'].encode('utf-8')
+        return self.BODY_JSON + _compact_json(body)
+
+    def decode_body(self, data: bytes):
+        if data[:1] == self.BODY_RAW_PAYLOAD:
+            return {'payload': bytes(data[1:]).decode('utf-8')}
+        return json.loads(bytes(data[1:]))
+
+
+_codecs_by_name = {}
+_codecs_by_tag = {}
+
+
+def register_codec(codec: MessageCodec):
+    '''Registers a codec for use as a message_format; codecs are looked up by name to encode, and by format tag to decode.'''
+    if codec.format_tag is not None and (len(codec.format_tag) != 1 or not isinstance(codec, HeaderFirstCodec)):
+        raise Exception(f'invalid format tag, tagged codecs must be one byte and header-first [{codec.name=}][{codec.format_tag=}]')
+    _codecs_by_name[codec.name] = codec
+    if codec.format_tag is not None:
+        _codecs_by_tag[codec.format_tag] = codec
+
+
+def get_codec(name: str) -> MessageCodec:
+    codec = _codecs_by_name.get(name)
+    if codec is None:
+        raise Exception(f'invalid message format config setting {name}')
+    return codec
+
+
+def encode_message(message: Message, message_format: str) -> bytes:
+    codec = get_codec(message_format)
+    if codec.format_tag is None:
+        return codec.encode(message)
+    return FORMAT_TAG_MARKER + codec.format_tag + codec.encode(message)
+
+
+def decode_message(data: bytes, header_only: bool = False) -> Message:
+    '''
+    Decodes a message written in any registered format, using its format tag.
+    With header_only, the body of a header-first format is not kept (the message has no body); use it to filter messages on their header.
+    '''
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if data[:1] != FORMAT_TAG_MARKER:
+        return _codecs_by_name[JsonCodec.name].decode(data)
+
+    codec = _codecs_by_tag.get(bytes(data[1:2]))
+    if codec is None:
+        raise Exception(f'unknown message format tag {bytes(data[1:2])}')
+    return codec.decode(memoryview(data)[2:], header_only=header_only)
+
+
+def read_message_header(f: typing.BinaryIO) -> Message:
+    '''Reads only the header section of a message from a (binary) file; the whole file is read only for the (untagged) json format.'''
+    prefix = f.read(2)
+    if prefix[:1] != FORMAT_TAG_MARKER:
+        return decode_message(prefix + f.read())
+
+    codec = _codecs_by_tag.get(prefix[1:2])
+    if codec is None:
+        raise Exception(f'unknown message format tag {prefix[1:2]}')
+    (header_length, ) = HeaderFirstCodec.HEADER_LENGTH.unpack(f.read(HeaderFirstCodec.HEADER_LENGTH.size))
+    return codec.decode_header_section(f.read(header_length))
+
+
+def _require_msgpack():
+    if msgpack is None:
+        raise Exception('message format msgpack requires the msgpack package')
+    return msgpack
+
+
+def _compact_json(value) -> bytes:
+    return json.dumps(value, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def _to_wire(components: dict) -> dict:
+    header = components.get('header')
+    if not header or not any(isinstance(header.get(key), datetime.datetime) for key in TIMESTAMP_HEADER_KEYS):
+        return components
+    header = dict(header)
+    for key in TIMESTAMP_HEADER_KEYS:
+        if isinstance(header.get(key), datetime.datetime):
+            header[key] = header[key].timestamp()
+    return {**components, 'header': header}
+
+
+def _from_wire(components: dict) -> dict:
+    header = components.get('header')
+    if header:
+        for key in TIMESTAMP_HEADER_KEYS:
+            if isinstance(header.get(key), (int, float)):
+                header[key] = datetime.datetime.fromtimestamp(header[key])
+    return components
+
+
+register_codec(JsonCodec())
+register_codec(CompactJsonCodec())
+register_codec(MsgpackCodec())
+register_codec(StructCodec())
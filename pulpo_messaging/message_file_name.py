@@ -0,0 +1,56 @@
+import re
+import time
+from typing import NamedTuple
+from pulpo_messaging.message import Message
+
+
+class MessageFileName(NamedTuple):
+    '''
+    Name of a queued message file.
+    Encoded file names carry the fields needed to filter and order messages without opening the file:
+    <priority>-<available_at_ms>-<expires_at_ms>-<message_id>.message
+    Fields are zero padded, so lexical order of encoded names matches (priority, available_at) order.
+    Legacy file names (<message_id>.message) are still supported; is_encoded is False for these.
+    '''
+    priority: int
+    available_at_ms: int
+    expires_at_ms: int
+    message_id: str
+    is_encoded: bool = True
+
+    ENCODED_PATTERN = re.compile(r'^(\d{10})-(\d{15})-(\d{15})-(.+)\.message$')
+
+    def __str__(self):
+        if not self.is_encoded:
+            return f'{self.message_id}.message'
+        return f'{self.priority:010d}-{self.available_at_ms:015d}-{self.expires_at_ms:015d}-{self.message_id}.message'
+
+    @property
+    def sort_key(self):
+        return (self.priority, self.available_at_ms, self.message_id)
+
+    def get_aged_sort_key(self, priority_aging_interval: float):
+        '''Sort key with priority aging (see ReadyIndex): one priority level per priority_aging_interval seconds since the message became available.'''
+        if not priority_aging_interval:
+            return self.sort_key
+        return (self.priority * priority_aging_interval * 1000 + self.available_at_ms, self.message_id)
+
+    @staticmethod
+    def from_message(message: Message) -> 'MessageFileName':
+        available_at = message.delay.timestamp() if message.delay else time.time()
+        expires_at = message.expiration.timestamp() if message.expiration else 0
+        return MessageFileName(priority=message.priority, available_at_ms=int(available_at * 1000), expires_at_ms=int(expires_at * 1000), message_id=message.id)
+
+    @staticmethod
+    def parse(file_name: str) -> 'MessageFileName':
+        match = MessageFileName.ENCODED_PATTERN.match(file_name)
+        if match:
+            return MessageFileName(priority=int(match.group(1)), available_at_ms=int(match.group(2)), expires_at_ms=int(match.group(3)), message_id=match.group(4))
+
+        # legacy file name, only the message id is known.  ids created by this adapter start with the enqueue time
+        message_id = file_name.replace('.message', '').replace('.lock', '')
+        try:
+            available_at_ms = int(float(message_id.split('-', 1)[0]) * 1000)
+        except ValueError:
+            available_at_ms = 0
+        return MessageFileName(priority=Message.DEFAULT_PRIORITY, available_at_ms=available_at_ms, expires_at_ms=0, message_id=message_id, is_encoded=False)
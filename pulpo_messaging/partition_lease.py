@@ -0,0 +1,180 @@
+import os
+import json
+import math
+import time
+import uuid
+import socket
+import zlib
+from loguru import logger
+from statman import Statman
+
+LEASE_FILE_SUFFIX = '.lease'
+CONSUMER_FILE_SUFFIX = '.consumer'
+
+
+class PartitionLeases():
+    '''
+    Leases on partitions (the shards of a FileQueueLayout), held as lease files naming the owning consumer and the lease expiry.
+    Each live consumer holds a fair share (partitions / live consumers, rounded up): rebalance renews its leases, claims free or expired partitions up to its share
+    and releases partitions above it, so partitions move to new consumers and are taken over from consumers that died (stopped renewing).
+    Live consumers are counted from heartbeat files, touched on each rebalance.
+    A free lease is claimed by hard linking a prepared lease file into place, and an expired lease is taken over by renaming it away first, so two consumers cannot both claim a partition.
+    Leases only reduce contention: a message is still locked by renaming its file, so a consumer scanning a partition it does not hold is safe.
+    '''
+
+    _lease_path = None
+    _partitions = None
+    _consumer_id = None
+    _lease_duration = None
+    _owned = None
+    _rebalanced_at = None
+
+    def __init__(self, lease_path: str, partitions: list, lease_duration: float, consumer_id: str = None):
+        self._lease_path = lease_path
+        self._partitions = list(partitions)
+        self._lease_duration = lease_duration
+        self._consumer_id = consumer_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self._owned = []
+        self._rebalanced_at = 0
+        os.makedirs(name=lease_path, exist_ok=True)
+
+    @property
+    def consumer_id(self) -> str:
+        return self._consumer_id
+
+    @property
+    def owned(self) -> list:
+        return list(self._owned)
+
+    def rebalance_if_due(self):
+        '''Rebalances every third of the lease duration, so that leases are renewed well before they expire.'''
+        if time.monotonic() - self._rebalanced_at >= self._lease_duration / 3:
+            self.rebalance()
+
+    def rebalance(self):
+        self._rebalanced_at = time.monotonic()
+        now = time.time()
+        self._touch_heartbeat()
+        share = math.ceil(len(self._partitions) / max(self._count_live_consumers(now), 1))
+
+        leases = {partition: self._read_lease(partition) for partition in self._partitions}
+        owned = [partition for partition, lease in leases.items() if lease and lease['owner'] == self._consumer_id and lease['expires_at'] > now]
+        for partition in owned[share:]:
+            self._release(partition)
+        owned = owned[:share]
+        for partition in owned:
+            self._write_lease(partition, now)
+
+        # consumers start looking for free partitions at different offsets, so they rarely race for the same one
+        start = zlib.crc32(self._consumer_id.encode('utf-8')) % len(self._partitions)
+        for partition in self._partitions[start:] + self._partitions[:start]:
+            if len(owned) >= share:
+                break
+            lease = leases[partition]
+            if lease and lease['owner'] != self._consumer_id and lease['expires_at'] > now:
+                continue
+            if self._claim(partition, lease, now):
+                owned.append(partition)
+
+        if set(owned) != set(self._owned):
+            logger.debug(f'partition leases rebalanced [{self._consumer_id=}][{share=}][{owned=}]')
+        self._owned = sorted(owned)
+
+    def release_all(self):
+        for partition in self._owned:
+            self._release(partition)
+        self._owned = []
+        try:
+            os.remove(self._get_heartbeat_file_path())
+        except FileNotFoundError:
+            pass
+
+    def _get_lease_file_path(self, partition: str) -> str:
+        return os.path.join(self._lease_path, f'{partition}{LEASE_FILE_SUFFIX}')
+
+    def _get_heartbeat_file_path(self) -> str:
+        return os.path.join(self._lease_path, f'{self._consumer_id}{CONSUMER_FILE_SUFFIX}')
+
+    def _touch_heartbeat(self):
+        with open(file=self._get_heartbeat_file_path(), mode='a', encoding='utf-8'):
+            pass
+        os.utime(self._get_heartbeat_file_path())
+
+    def _count_live_consumers(self, now: float) -> int:
+        live = 0
+        for entry in os.scandir(self._lease_path):
+            if not entry.name.endswith(CONSUMER_FILE_SUFFIX):
+                continue
+            try:
+                modified_at = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if modified_at > now - self._lease_duration:
+                live += 1
+            elif modified_at < now - 10 * self._lease_duration:
+                # long dead consumer
+                self._remove_quietly(entry.path)
+        return live
+
+    def _read_lease(self, partition: str) -> dict:
+        return self._read_lease_file(self._get_lease_file_path(partition))
+
+    def _read_lease_file(self, file_path: str) -> dict:
+        try:
+            with open(file=file_path, mode='r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            # free, or being written
+            return None
+
+    def _write_lease_file(self, file_path: str, now: float):
+        with open(file=file_path, mode='w', encoding='utf-8') as f:
+            json.dump({'owner': self._consumer_id, 'expires_at': now + self._lease_duration}, f)
+
+    def _write_lease(self, partition: str, now: float):
+        '''Renews a lease held by this consumer (written aside, then replaced, so readers never see a partial lease).'''
+        temporary_file_path = os.path.join(self._lease_path, f'.{partition}.{self._consumer_id}.tmp')
+        self._write_lease_file(temporary_file_path, now)
+        os.replace(temporary_file_path, self._get_lease_file_path(partition))
+
+    def _claim(self, partition: str, lease: dict, now: float) -> bool:
+        lease_file_path = self._get_lease_file_path(partition)
+        if lease:
+            # expired: only one consumer succeeds in renaming it away
+            expired_file_path = os.path.join(self._lease_path, f'.{partition}.{self._consumer_id}.expired')
+            try:
+                os.rename(lease_file_path, expired_file_path)
+            except FileNotFoundError:
+                return False
+            if self._read_lease_file(expired_file_path) != lease:
+                # taken over by another consumer since it was read: put its lease back
+                try:
+                    os.link(expired_file_path, lease_file_path)
+                except FileExistsError:
+                    pass
+                self._remove_quietly(expired_file_path)
+                return False
+            self._remove_quietly(expired_file_path)
+            Statman.gauge('fqa.partition.taken-over').increment()
+
+        temporary_file_path = os.path.join(self._lease_path, f'.{partition}.{self._consumer_id}.tmp')
+        self._write_lease_file(temporary_file_path, now)
+        try:
+            os.link(temporary_file_path, lease_file_path)
+        except FileExistsError:
+            return False
+        finally:
+            self._remove_quietly(temporary_file_path)
+        Statman.gauge('fqa.partition.claimed').increment()
+        return True
+
+    def _release(self, partition: str):
+        lease = self._read_lease(partition)
+        if lease and lease['owner'] == self._consumer_id:
+            self._remove_quietly(self._get_lease_file_path(partition))
+
+    def _remove_quietly(self, file_path: str):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
@@ -5,24 +5,28 @@ class RequestResult():
     _result = None
     _response_message_list = None
     _error = None
+    _retry_after = None
 
     RESULT_SUCCESS = 'success'
     RESULT_FAIL_FATAL = 'fatal'
     RESULT_FAIL_TRANSIENT = 'transient'
 
-    def __init__(self, result: str, response_message_list=None, error=None):
+    def __init__(self, result: str, response_message_list=None, error=None, retry_after: float = None):
         self._result = result
         self._response_message_list = []
         if response_message_list:
             for response_message in response_message_list:
                 self._response_message_list.append(response_message)
         self._error = error
+        self._retry_after = retry_after
 
     def __str__(self):
         values = {}
         values['result'] = self.result
         if self.error:
             values['error'] = self.error
+        if self.retry_after is not None:
+            values['retry_after'] = self.retry_after
         if self.response_messages:
             values['response_messages_cnt'] = len(self.response_messages)
         return str(values)
@@ -39,6 +43,11 @@ class RequestResult():
     def error(self):
         return self._error
 
+    @property
+    def retry_after(self) -> float:
+        '''Seconds before a message that failed on a transient condition should be retried, as given by the handler (e.g. from a Retry-After response header).'''
+        return self._retry_after
+
     @property
     def isSuccess(self):
         return self.result == self.RESULT_SUCCESS
@@ -60,8 +69,8 @@ class RequestResult():
         return RequestResult(result=RequestResult.RESULT_FAIL_FATAL, error=error, response_message_list=response_message_list)
 
     @staticmethod
-    def transient_factory(error=None, response_message_list=None) -> "RequestResult":
-        return RequestResult(result=RequestResult.RESULT_FAIL_TRANSIENT, error=error, response_message_list=response_message_list)
+    def transient_factory(error=None, response_message_list=None, retry_after: float = None) -> "RequestResult":
+        return RequestResult(result=RequestResult.RESULT_FAIL_TRANSIENT, error=error, response_message_list=response_message_list, retry_after=retry_after)
 
 
 class PayloadHandler():
@@ -76,3 +85,18 @@ class PayloadHandler():
     @property
     def config(self) -> Config:
         return self._config
+
+
+class AsyncPayloadHandler():
+    '''Handler for AsyncPulpo: handle is a coroutine, awaited on the event loop, so it must not block (use async I/O clients).'''
+    _config = None
+
+    def __init__(self, options: dict = None):
+        self._config = Config(options=options)
+
+    async def handle(self, payload: str) -> RequestResult:
+        pass
+
+    @property
+    def config(self) -> Config:
+        return self._config
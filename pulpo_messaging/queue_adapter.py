@@ -1,22 +1,97 @@
+import time
 from .message import Message
 
 
 class QueueAdapter():
+    DEQUEUE_BATCH_POLL_INTERVAL = 0.1
 
     def enqueue(self, message: Message) -> Message:
         pass
 
+    def enqueue_batch(self, messages: list) -> list:
+        '''Enqueues each message.  This default implementation enqueues one message at a time; adapters override it to amortize I/O across the batch.'''
+        return [self.enqueue(message) for message in messages]
+
     def dequeue(self) -> Message:
         pass
 
+    def dequeue_batch(self, max_messages: int = 1, timeout: float = None) -> list:
+        '''
+        Dequeues up to max_messages messages.  Waits up to timeout seconds for the first message, then returns what is immediately available.
+        This default implementation dequeues one message at a time; adapters override it to dequeue several messages in one pass.
+        '''
+        messages = []
+        deadline = time.monotonic() + (timeout or 0)
+        while len(messages) < max_messages:
+            message = self.dequeue()  # pylint: disable=assignment-from-no-return
+            if message:
+                messages.append(message)
+                continue
+
+            remaining = deadline - time.monotonic()
+            if messages or remaining <= 0:
+                break
+            time.sleep(min(self.DEQUEUE_BATCH_POLL_INTERVAL, remaining))
+        return messages
+
+    def wait_for_message(self, timeout: float) -> bool:
+        '''
+        Blocks for up to timeout seconds until a message may be available to dequeue, returning True if woken early (spurious wake ups are allowed) and False on timeout.
+        This default implementation sleeps for the timeout; adapters override it with a blocking wait on the queue.
+        '''
+        time.sleep(timeout)
+        return False
+
     def commit(self, message: Message, is_success: bool = True) -> Message:
         pass
 
-    def rollback(self, message: Message) -> Message:
-        pass
+    def rollback(self, message: Message, delay: float = None) -> Message:
+        '''Returns a dequeued message to the queue, counted as a failed attempt.  With delay, the message is not dequeued again for delay seconds.'''
+
+    def defer(self, message: Message, delay: float = None):
+        '''
+        Returns a dequeued message that was not handled to the queue, without counting an attempt (used by Pulpo for messages held back by a circuit breaker or rate limit).
+        With delay, the message is not dequeued again for delay seconds.  This default implementation rolls back, counting an attempt; adapters override it.
+        '''
+        self.rollback(message=message, delay=delay)
+
+    def pause_request_type(self, request_type: str, duration: float) -> bool:  # pylint: disable=unused-argument
+        '''
+        Holds back the messages of request_type for duration seconds: they stay in the queue, and are not dequeued (used by the circuit breakers and rate limits of Pulpo).
+        Returns False if the adapter cannot hold back the request type; this default implementation cannot.
+        '''
+        return False
+
+    @property
+    def is_pause_shared(self) -> bool:
+        '''True if pause_request_type holds back the request type for every consumer of the queue, rather than for this adapter only.'''
+        return False
 
     def peek(self, message_id: str) -> Message:
         pass
 
     def delete(self, message_id: str):
         pass
+
+
+class PausedRequestTypes():
+    '''Request types whose messages a queue adapter holds back, each until a time (epoch seconds).'''
+
+    _paused_until = None
+
+    def __init__(self):
+        self._paused_until = {}
+
+    def __bool__(self):
+        return bool(self._paused_until)
+
+    def pause(self, request_type: str, until: float):
+        self._paused_until[request_type] = max(until, self._paused_until.get(request_type, 0))
+
+    def get_paused_until(self, request_type: str, now: float) -> float:
+        '''The end of the pause of request_type, or None if it is not paused.'''
+        paused_until = self._paused_until.get(request_type)
+        if paused_until is not None and paused_until <= now:
+            self._paused_until.pop(request_type, None)
+            return None
+        return paused_until
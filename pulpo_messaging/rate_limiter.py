@@ -0,0 +1,129 @@
+import fcntl
+import os
+import struct
+import time
+import urllib.parse
+from collections.abc import Callable
+
+# state of a token bucket kept in a file: the tokens, and the time (epoch seconds) at which they were counted
+BUCKET_STATE = struct.Struct('<dd')
+
+
+class TokenBucket():
+    '''
+    Token bucket refilled with rate tokens per second, holding at most burst tokens (by default rate, and at least 1); it starts full.
+    With path, the state of the bucket is kept in that file and updated under an exclusive flock, so that the processes of a host using the file share one bucket.
+    '''
+
+    rate = None
+    burst = None
+    _tokens = None
+    _updated_at = None
+    _fd = None
+
+    def __init__(self, rate: float, burst: float = None, path: str = None):
+        self.rate = float(rate)
+        self.burst = float(burst) if burst else max(self.rate, 1)
+        if self.rate <= 0 or self.burst < 1:
+            raise Exception(f'invalid rate limit [{rate=}][{burst=}]')
+        self._tokens = self.burst
+        self._updated_at = time.time()
+        if path:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def try_acquire(self) -> float:
+        '''Takes a token and returns 0 if one is available, else returns the seconds until one is.'''
+        return self._update(self._take)
+
+    def refund(self):
+        '''Puts back a token taken by try_acquire, for a message that was not handled after all.'''
+        self._update(self._put_back)
+
+    def _update(self, update: Callable[[float], float]) -> float:
+        if self._fd is None:
+            return update(time.time())
+
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            state = os.pread(self._fd, BUCKET_STATE.size, 0)
+            if len(state) == BUCKET_STATE.size:
+                (self._tokens, self._updated_at) = BUCKET_STATE.unpack(state)
+            wait = update(time.time())
+            os.pwrite(self._fd, BUCKET_STATE.pack(self._tokens, self._updated_at), 0)
+            return wait
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _refill(self, now: float):
+        # a clock that went back adds no tokens
+        self._tokens = min(self._tokens + max(now - self._updated_at, 0) * self.rate, self.burst)
+        self._updated_at = now
+
+    def _take(self, now: float) -> float:
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def _put_back(self, now: float) -> float:
+        self._refill(now)
+        self._tokens = min(self._tokens + 1, self.burst)
+        return 0
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class RequestTypeLimiter():
+    '''
+    Rate limit and concurrency cap of the messages of one request type, enforced by the dispatcher (see HandlerRegistry.register).
+    The rate limit is a TokenBucket, kept in a file of directory when given, so that it is shared by the processes of the host.
+    The concurrency cap counts the messages of the request type being handled by this process only.
+    '''
+
+    # seconds after which a message held back by the concurrency cap is tried again, unless a message of its request type completes first
+    CONCURRENCY_HOLD_DURATION = 0.1
+
+    request_type = None
+    bucket = None
+    max_concurrency = None
+    in_flight = None
+
+    def __init__(self, request_type: str, rate_limit: float = None, burst: float = None, max_concurrency: int = None, directory: str = None):
+        self.request_type = request_type
+        if rate_limit:
+            path = None
+            if directory:
+                os.makedirs(name=directory, exist_ok=True)
+                path = os.path.join(directory, urllib.parse.quote(request_type, safe='') + '.bucket')
+            self.bucket = TokenBucket(rate=rate_limit, burst=burst, path=path)
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+
+    @property
+    def is_at_concurrency_cap(self) -> bool:
+        return bool(self.max_concurrency) and self.in_flight >= self.max_concurrency
+
+    def acquire(self) -> float:
+        '''Counts a message in flight and returns 0 if the limits let it through, else returns the seconds after which it may be tried again.'''
+        if self.is_at_concurrency_cap:
+            return self.CONCURRENCY_HOLD_DURATION
+        if self.bucket:
+            wait = self.bucket.try_acquire()
+            if wait:
+                return wait
+        self.in_flight += 1
+        return 0
+
+    def release(self):
+        '''Called once a message counted by acquire is committed or rolled back.'''
+        self.in_flight = max(self.in_flight - 1, 0)
+
+    def refund(self):
+        '''Undoes acquire, for a message let through but then not handled (held back by its circuit breaker): it is no longer counted in flight, and its token is put back.'''
+        self.release()
+        if self.bucket:
+            self.bucket.refund()
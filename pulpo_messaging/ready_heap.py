@@ -0,0 +1,134 @@
+import heapq
+import threading
+import time
+from loguru import logger
+from statman import Statman
+from pulpo_messaging.message import Message
+from pulpo_messaging.queue_adapter import PausedRequestTypes, QueueAdapter
+from pulpo_messaging.timing_wheel import TimingWheel
+
+
+class ReadyHeap():
+    '''Sequence numbers of the messages ready to dequeue, in priority then sequence order, and of the delayed messages, in a timing wheel by available at (epoch seconds).'''
+
+    _ready = None
+    _delayed = None
+
+    def __init__(self):
+        self._ready = []
+        self._delayed = TimingWheel()
+
+    @property
+    def ready_count(self) -> int:
+        return len(self._ready)
+
+    @property
+    def delayed_count(self) -> int:
+        return len(self._delayed)
+
+    @property
+    def next_available_at(self) -> float:
+        return self._delayed.next_deadline
+
+    def push(self, seq: int, priority: int, available_at: float, now: float):
+        if available_at > now:
+            self._delayed.add((priority, seq), available_at, now)
+        else:
+            heapq.heappush(self._ready, (priority, seq))
+
+    def promote(self, now: float):
+        '''Moves the delayed messages available by now to the ready heap.'''
+        for item in self._delayed.advance(now):
+            heapq.heappush(self._ready, item)
+
+    def pop(self) -> int:
+        return heapq.heappop(self._ready)[1] if self._ready else None
+
+
+class ReadyHeapQueueAdapter(QueueAdapter):
+    '''
+    Base of the queue adapters holding their ready messages in a ReadyHeap, guarded by a condition that is notified on enqueue and rollback.
+    dequeue_batch and wait_for_message wait on the condition, cut short when the next delayed message is due.
+    Subclasses implement _lock_next, called with the condition held, and hold back messages of paused request types with _hold_back.
+    '''
+
+    GAUGE_PREFIX = None
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._ready = ReadyHeap()
+        self._paused = PausedRequestTypes()
+
+    @staticmethod
+    def _get_seq(message) -> int:
+        '''Message ids are sequence numbers.'''
+        if isinstance(message, Message):
+            return int(message.id)
+        if isinstance(message, str):
+            return int(message)
+        raise Exception('expects message object')
+
+    def _lock_next(self) -> Message:
+        '''Locks the first ready message in priority order, or returns None.  Implemented by the subclasses.'''
+
+    def pause_request_type(self, request_type: str, duration: float) -> bool:
+        with self._condition:
+            self._paused.pause(request_type, time.time() + duration)
+        return True
+
+    def _hold_back(self, seq: int, priority: int, message: Message) -> bool:
+        '''If the request type of the message is paused, moves the message to the delayed messages until the pause ends, and returns True.'''
+        if not self._paused:
+            return False
+        now = time.time()
+        paused_until = self._paused.get_paused_until(message.request_type, now)
+        if paused_until is None:
+            return False
+        self._ready.push(seq, priority, paused_until, now)
+        return True
+
+    def _promote(self):
+        self._ready.promote(time.time())
+
+    def _get_wait_timeout(self, remaining: float) -> float:
+        next_available_at = self._ready.next_available_at
+        if next_available_at is not None:
+            return min(remaining, max(next_available_at - time.time(), 0))
+        return remaining
+
+    def dequeue(self) -> Message:
+        with self._condition:
+            message = self._lock_next()  # pylint: disable=assignment-from-no-return
+        if message:
+            logger.debug(f'dequeued message: {message.id=}')
+            Statman.gauge(f'{self.GAUGE_PREFIX}.dequeue').increment()
+        return message
+
+    def dequeue_batch(self, max_messages: int = 1, timeout: float = None) -> list:
+        messages = []
+        deadline = time.monotonic() + (timeout or 0)
+        with self._condition:
+            while len(messages) < max_messages:
+                message = self._lock_next()  # pylint: disable=assignment-from-no-return
+                if message:
+                    messages.append(message)
+                    continue
+                remaining = deadline - time.monotonic()
+                if messages or remaining <= 0:
+                    break
+                self._condition.wait(self._get_wait_timeout(remaining))
+        Statman.gauge(f'{self.GAUGE_PREFIX}.dequeue').increment(len(messages))
+        return messages
+
+    def wait_for_message(self, timeout: float) -> bool:
+        '''Waits for an enqueue or rollback, cut short when the next delayed message is due.'''
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                self._promote()
+                if self._ready.ready_count:
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(self._get_wait_timeout(remaining))
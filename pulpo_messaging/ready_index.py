@@ -0,0 +1,120 @@
+import heapq
+import threading
+from typing import NamedTuple
+from pulpo_messaging.queue_adapter import PausedRequestTypes
+from pulpo_messaging.timing_wheel import TimingWheel
+
+
+class ReadyIndexEntry(NamedTuple):
+    priority: int
+    # epoch seconds; None when not known, the entry is then available from when it is pushed
+    available_at: float
+    message_id: str
+    file_name: str
+
+
+class ReadyIndex():
+    '''
+    In-process index of messages available for dequeue.
+    Entries are held in a ready heap ordered by (priority, available_at, message_id), and delayed entries in a timing wheel by available_at.
+    Delayed entries are promoted to the ready heap once they are due.
+    With priority aging, the ready heap is ordered by priority * priority_aging_interval + available_at instead: an entry that has waited
+    priority_aging_interval seconds ranks with an entry one priority level higher that has just become available.  The rank does not change as time passes, so the heap stays valid.
+    Entries are removed lazily: a stale entry (message locked or removed by another consumer) is simply dropped when the lock attempt fails.
+    Entries of a paused request type are moved back to the delayed entries, until the pause ends, by hold_back.
+    The file name of each known message is kept by id, so that a message can be located by id without searching its directory (get_file_name).
+    '''
+
+    _ready = None
+    _delayed = None
+    _known_file_names = None
+    _file_names_by_id = None
+    _lock = None
+    _priority_aging_interval = None
+    _paused = None
+
+    def __init__(self, priority_aging_interval: float = 0):
+        self._priority_aging_interval = priority_aging_interval
+        self._ready = []
+        self._delayed = TimingWheel()
+        self._known_file_names = set()
+        self._file_names_by_id = {}
+        self._lock = threading.Lock()
+        self._paused = PausedRequestTypes()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._ready) + len(self._delayed)
+
+    def push(self, entry: ReadyIndexEntry, now: float):
+        with self._lock:
+            self._known_file_names.add(entry.file_name)
+            self._file_names_by_id[entry.message_id] = entry.file_name
+            if entry.available_at is None:
+                # rather than available since the epoch, which priority aging would rank ahead of every other entry
+                entry = entry._replace(available_at=now)
+            if entry.available_at > now:
+                self._delayed.add(entry, entry.available_at, now)
+            else:
+                heapq.heappush(self._ready, (self._rank(entry), entry))
+
+    def pop(self, now: float) -> ReadyIndexEntry:
+        '''Removes and returns the highest priority entry that is available at `now`, or None.'''
+        with self._lock:
+            self._promote(now)
+            if not self._ready:
+                return None
+            _, entry = heapq.heappop(self._ready)
+            self._known_file_names.discard(entry.file_name)
+            # unless the message was pushed again since, under another file name
+            if self._file_names_by_id.get(entry.message_id) == entry.file_name:
+                del self._file_names_by_id[entry.message_id]
+            return entry
+
+    @property
+    def has_paused_request_types(self) -> bool:
+        return bool(self._paused)
+
+    def pause(self, request_type: str, until: float):
+        with self._lock:
+            self._paused.pause(request_type, until)
+
+    def hold_back(self, entry: ReadyIndexEntry, request_type: str, now: float) -> bool:
+        '''If request_type is paused, moves the (popped) entry to the delayed entries until the pause ends, and returns True.'''
+        with self._lock:
+            paused_until = self._paused.get_paused_until(request_type, now)
+            if paused_until is None:
+                return False
+            self._known_file_names.add(entry.file_name)
+            self._file_names_by_id[entry.message_id] = entry.file_name
+            self._delayed.add(entry, paused_until, now)
+            return True
+
+    def _promote(self, now: float):
+        for entry in self._delayed.advance(now):
+            heapq.heappush(self._ready, (self._rank(entry), entry))
+
+    def _rank(self, entry: ReadyIndexEntry) -> tuple:
+        if self._priority_aging_interval:
+            return (entry.priority * self._priority_aging_interval + entry.available_at, entry.message_id)
+        return (entry.priority, entry.available_at, entry.message_id)
+
+    def discard(self, file_name: str):
+        with self._lock:
+            self._known_file_names.discard(file_name)
+
+    def is_known(self, file_name: str) -> bool:
+        with self._lock:
+            return file_name in self._known_file_names
+
+    def get_file_name(self, message_id: str) -> str:
+        '''File name of a known message, or None.'''
+        with self._lock:
+            file_name = self._file_names_by_id.get(message_id)
+            return file_name if file_name in self._known_file_names else None
+
+    def retain(self, file_names: set):
+        '''Forget file names that are no longer present; matching heap entries are dropped lazily on dequeue.'''
+        with self._lock:
+            self._known_file_names.intersection_update(file_names)
+            self._file_names_by_id = {message_id: file_name for (message_id, file_name) in self._file_names_by_id.items() if file_name in self._known_file_names}
@@ -0,0 +1,73 @@
+import random
+from pulpo_config import Config
+
+JITTER_FULL = 'full'
+JITTER_EQUAL = 'equal'
+JITTER_NONE = 'none'
+
+
+class RetryPolicyConfig(Config):
+
+    def __init__(self, options: dict = None, json_file_path: str = None):
+        super().__init__(options=options, json_file_path=json_file_path)
+
+    @property
+    def initial_delay(self: Config) -> float:
+        return float(self.get('initial_delay', 1))
+
+    @property
+    def multiplier(self: Config) -> float:
+        return float(self.get('multiplier', 2))
+
+    @property
+    def max_delay(self: Config) -> float:
+        return float(self.get('max_delay', 300))
+
+    @property
+    def jitter(self: Config) -> str:
+        return self.get('jitter', JITTER_FULL)
+
+
+class RetryPolicy():
+    '''
+    Exponential backoff for a message rolled back on a transient failure: initial_delay seconds after the first failed attempt, multiplied by multiplier
+    for each further failed attempt, capped at max_delay.  Jitter spreads the retries of messages that failed together (e.g. on one outage of a dependency):
+    `full` draws the delay between 0 and the backoff, `equal` between half the backoff and the backoff, and `none` uses the backoff as is.
+    '''
+
+    config = None
+
+    def __init__(self, options: dict = None):
+        self.config = RetryPolicyConfig(options)
+        if self.config.jitter not in {JITTER_FULL, JITTER_EQUAL, JITTER_NONE}:
+            raise Exception(f'invalid retry policy jitter [{self.config.jitter}]')
+
+    def get_delay(self, attempts: int) -> float:
+        '''Seconds before the next attempt, given the number of attempts that failed before the one that just failed.'''
+        # the exponent is bounded so that the backoff does not overflow before it is capped
+        backoff = min(self.config.initial_delay * self.config.multiplier**min(attempts, 64), self.config.max_delay)
+        if self.config.jitter == JITTER_FULL:
+            return random.uniform(0, backoff)
+        if self.config.jitter == JITTER_EQUAL:
+            return backoff / 2 + random.uniform(0, backoff / 2)
+        return backoff
+
+
+class RetryPolicies():
+    '''The retry policy of each request type, and a default policy for the other request types.  Without a policy, a message is redelivered at once.'''
+
+    _policies = None
+    _default_policy = None
+
+    def __init__(self, policies: dict = None, default_policy: dict = None):
+        self._policies = {request_type: RetryPolicy(options) for (request_type, options) in (policies or {}).items()}
+        self._default_policy = RetryPolicy(default_policy) if default_policy else None
+
+    def get_delay(self, request_type: str, attempts: int, retry_after: float = None) -> float:
+        '''Seconds before a message that failed on a transient condition is delivered again: the retry after given by the handler, or else the delay of the policy.'''
+        if retry_after is not None:
+            return max(retry_after, 0)
+        policy = self._policies.get(request_type, self._default_policy)
+        if policy is None:
+            return None
+        return policy.get_delay(attempts=attempts)
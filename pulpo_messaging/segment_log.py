@@ -0,0 +1,297 @@
+import os
+import mmap
+import struct
+import typing
+import zlib
+
+# segment record: payload length, crc32 of the payload, sequence number; followed by the payload (an encoded message)
+RECORD_HEADER = struct.Struct('!IIQ')
+# offset index entry: sequence number, offset of the record in the segment, priority, available at, expires at (epoch seconds, 0 when not set)
+INDEX_ENTRY = struct.Struct('!QQIdd')
+# state log record: operation, sequence number, attempts
+STATE_RECORD = struct.Struct('!BQI')
+
+SEGMENT_FILE_SUFFIX = '.log'
+INDEX_FILE_SUFFIX = '.index'
+COMPACT_FILE_SUFFIX = '.compact'
+
+
+class SegmentIndexEntry(typing.NamedTuple):
+    seq: int
+    offset: int
+    priority: int
+    available_at: float
+    expires_at: float
+
+
+class Segment():
+    '''
+    An append-only segment file of message records, and its offset index (one fixed size entry per record, in sequence order).
+    A segment is named after the first sequence number it may hold, so the segment holding a sequence number is found by bisecting the segment names,
+    and the record within it by a binary search of its memory-mapped index; the index also holds what dequeue needs (priority, delay, expiration),
+    so the queue is recovered at startup without reading the records.
+    The active (last) segment is appended to, and keeps its index entries in memory; a sealed segment is only read, or rewritten by compact.
+    '''
+
+    _directory = None
+    _fd = None
+    _index_fd = None
+    _index_map = None
+    _active_entries = None
+    number = None
+    size = None
+    is_sealed = None
+
+    def __init__(self, directory: str, number: int):
+        self._directory = directory
+        self.number = number
+        self.is_sealed = False
+        self._active_entries = {}
+        self._open()
+
+    @property
+    def log_path(self) -> str:
+        return os.path.join(self._directory, f'{self.number:020d}{SEGMENT_FILE_SUFFIX}')
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self._directory, f'{self.number:020d}{INDEX_FILE_SUFFIX}')
+
+    @property
+    def entry_count(self) -> int:
+        return os.fstat(self._index_fd).st_size // INDEX_ENTRY.size
+
+    def _open(self):
+        self._fd = os.open(self.log_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self._fd).st_size
+
+    def append(self, records: list) -> list:
+        '''Appends (seq, payload, priority, available_at, expires_at) records, in one write to the segment and one to the index.  Returns the index entries.'''
+        data = bytearray()
+        index_data = bytearray()
+        entries = []
+        for (seq, payload, priority, available_at, expires_at) in records:
+            entry = SegmentIndexEntry(seq, self.size + len(data), priority, available_at, expires_at)
+            data += RECORD_HEADER.pack(len(payload), zlib.crc32(payload), seq)
+            data += payload
+            index_data += INDEX_ENTRY.pack(*entry)
+            entries.append(entry)
+        # the record is written before its index entry: a crash in between leaves records past the index, re-indexed by recover
+        os.write(self._fd, data)
+        os.write(self._index_fd, index_data)
+        self.size += len(data)
+        for entry in entries:
+            self._active_entries[entry.seq] = entry
+        return entries
+
+    def read(self, entry: SegmentIndexEntry) -> bytes:
+        header = os.pread(self._fd, RECORD_HEADER.size, entry.offset)
+        (length, crc, seq) = RECORD_HEADER.unpack(header)
+        payload = os.pread(self._fd, length, entry.offset + RECORD_HEADER.size)
+        if seq != entry.seq or zlib.crc32(payload) != crc:
+            raise Exception(f'corrupt segment record [{self.log_path=}][{entry=}]')
+        return payload
+
+    def find(self, seq: int) -> SegmentIndexEntry:
+        if not self.is_sealed:
+            return self._active_entries.get(seq)
+        index_map = self._get_index_map()
+        (low, high) = (0, len(index_map) // INDEX_ENTRY.size)
+        while low < high:
+            middle = (low + high) // 2
+            (middle_seq, ) = struct.unpack_from('!Q', index_map, middle * INDEX_ENTRY.size)
+            if middle_seq < seq:
+                low = middle + 1
+            elif middle_seq > seq:
+                high = middle
+            else:
+                return SegmentIndexEntry(*INDEX_ENTRY.unpack_from(index_map, middle * INDEX_ENTRY.size))
+        return None
+
+    def entries(self):
+        if not self.is_sealed:
+            yield from list(self._active_entries.values())
+            return
+        for values in INDEX_ENTRY.iter_unpack(self._get_index_map()):
+            yield SegmentIndexEntry(*values)
+
+    def _get_index_map(self):
+        if self._index_map is None:
+            if self.entry_count == 0:
+                return b''
+            self._index_map = mmap.mmap(self._index_fd, self.entry_count * INDEX_ENTRY.size, access=mmap.ACCESS_READ)
+        return self._index_map
+
+    def _read_index(self) -> list:
+        with open(self.index_path, 'rb') as f:
+            data = f.read()
+        return [SegmentIndexEntry(*values) for values in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size])]
+
+    def recover(self, describe) -> int:
+        '''
+        Loads the index of a segment found at startup, and repairs a crash during append: a torn index entry is dropped, records written past the index are indexed
+        (describe returns the priority, available at and expires at of a payload), and a torn record at the end of the segment is truncated.
+        Returns the number of records re-indexed.
+        '''
+        entries = self._read_index()
+        if os.fstat(self._index_fd).st_size != len(entries) * INDEX_ENTRY.size:
+            os.ftruncate(self._index_fd, len(entries) * INDEX_ENTRY.size)
+        self._active_entries = {entry.seq: entry for entry in entries}
+
+        offset = 0
+        if entries:
+            (length, _, _) = RECORD_HEADER.unpack(os.pread(self._fd, RECORD_HEADER.size, entries[-1].offset))
+            offset = entries[-1].offset + RECORD_HEADER.size + length
+        recovered = []
+        while offset + RECORD_HEADER.size <= self.size:
+            (length, crc, seq) = RECORD_HEADER.unpack(os.pread(self._fd, RECORD_HEADER.size, offset))
+            payload = os.pread(self._fd, length, offset + RECORD_HEADER.size)
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            recovered.append(SegmentIndexEntry(seq, offset, *describe(payload)))
+            offset += RECORD_HEADER.size + length
+        if offset != self.size:
+            os.ftruncate(self._fd, offset)
+            self.size = offset
+        if recovered:
+            os.write(self._index_fd, b''.join(INDEX_ENTRY.pack(*entry) for entry in recovered))
+            self._active_entries.update({entry.seq: entry for entry in recovered})
+        return len(recovered)
+
+    def seal(self):
+        self.is_sealed = True
+        self._active_entries = {}
+
+    def fsync(self):
+        os.fsync(self._fd)
+        os.fsync(self._index_fd)
+
+    def compact(self, live_seqs: set) -> int:
+        '''
+        Rewrites a sealed segment with the records of live_seqs only.  The new segment and index are written aside and fsynced, then renamed into place:
+        the segment first, then the index, so that finish_compactions can complete (or discard) a compaction interrupted by a crash.
+        Returns the number of bytes reclaimed.
+        '''
+        compact_log_path = self.log_path + COMPACT_FILE_SUFFIX
+        compact_index_path = self.index_path + COMPACT_FILE_SUFFIX
+        data = bytearray()
+        index_data = bytearray()
+        for entry in self.entries():
+            if entry.seq not in live_seqs:
+                continue
+            payload = self.read(entry)
+            index_data += INDEX_ENTRY.pack(entry.seq, len(data), entry.priority, entry.available_at, entry.expires_at)
+            data += RECORD_HEADER.pack(len(payload), zlib.crc32(payload), entry.seq)
+            data += payload
+        for (path, content) in ((compact_log_path, data), (compact_index_path, index_data)):
+            with open(path, 'wb') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+
+        reclaimed = self.size - len(data)
+        self.close()
+        os.replace(compact_log_path, self.log_path)
+        os.replace(compact_index_path, self.index_path)
+        self._open()
+        self.seal()
+        return reclaimed
+
+    @staticmethod
+    def finish_compactions(directory: str):
+        '''Completes a compaction interrupted after its segment was renamed into place, and discards one interrupted before.'''
+        for file_name in os.listdir(directory):
+            if not file_name.endswith(INDEX_FILE_SUFFIX + COMPACT_FILE_SUFFIX):
+                continue
+            compact_index_path = os.path.join(directory, file_name)
+            compact_log_path = compact_index_path.replace(INDEX_FILE_SUFFIX + COMPACT_FILE_SUFFIX, SEGMENT_FILE_SUFFIX + COMPACT_FILE_SUFFIX)
+            if os.path.exists(compact_log_path):
+                os.remove(compact_log_path)
+                os.remove(compact_index_path)
+            else:
+                os.replace(compact_index_path, compact_index_path[:-len(COMPACT_FILE_SUFFIX)])
+        for file_name in os.listdir(directory):
+            # written aside, but interrupted before its index was
+            if file_name.endswith(SEGMENT_FILE_SUFFIX + COMPACT_FILE_SUFFIX):
+                os.remove(os.path.join(directory, file_name))
+
+    def close(self):
+        if self._index_map is not None:
+            self._index_map.close()
+            self._index_map = None
+        os.close(self._fd)
+        os.close(self._index_fd)
+
+    def delete(self):
+        self.close()
+        os.remove(self.log_path)
+        os.remove(self.index_path)
+
+
+class StateLog():
+    '''
+    Append-only log of the state changes of messages (lock, commit, rollback), kept apart from the segments so that the segments are never rewritten on the hot path.
+    Replay returns the current state: the messages done (committed, failed or deleted), the attempts of rolled back messages, and the messages still locked.
+    '''
+
+    LOCK = 1
+    COMMIT = 2
+    FAIL = 3
+    ROLLBACK = 4
+
+    _path = None
+    _fd = None
+    record_count = None
+
+    def __init__(self, path: str):
+        self._path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.record_count = os.fstat(self._fd).st_size // STATE_RECORD.size
+
+    def append(self, records: list):
+        '''Appends (operation, seq, attempts) records in one write.'''
+        os.write(self._fd, b''.join(STATE_RECORD.pack(*record) for record in records))
+        self.record_count += len(records)
+
+    def replay(self) -> tuple:
+        with open(self._path, 'rb') as f:
+            data = f.read()
+        torn = len(data) % STATE_RECORD.size
+        if torn:
+            os.ftruncate(self._fd, len(data) - torn)
+            data = data[:len(data) - torn]
+
+        done = set()
+        attempts = {}
+        locked = set()
+        for (operation, seq, seq_attempts) in STATE_RECORD.iter_unpack(data):
+            if operation == self.LOCK:
+                locked.add(seq)
+            elif operation == self.ROLLBACK:
+                attempts[seq] = seq_attempts
+                locked.discard(seq)
+            else:
+                done.add(seq)
+                attempts.pop(seq, None)
+                locked.discard(seq)
+        self.record_count = len(data) // STATE_RECORD.size
+        return (done, attempts, locked)
+
+    def rewrite(self, records: list):
+        '''Replaces the log with the given (operation, seq, attempts) records: written aside, fsynced, then renamed into place.'''
+        compact_path = self._path + COMPACT_FILE_SUFFIX
+        with open(compact_path, 'wb') as f:
+            f.write(b''.join(STATE_RECORD.pack(*record) for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.close(self._fd)
+        os.replace(compact_path, self._path)
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.record_count = len(records)
+
+    def fsync(self):
+        os.fsync(self._fd)
+
+    def close(self):
+        os.close(self._fd)
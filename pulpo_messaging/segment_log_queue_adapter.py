@@ -0,0 +1,381 @@
+import os
+import bisect
+import fcntl
+import threading
+import time
+from loguru import logger
+from statman import Statman
+from pulpo_config import Config
+from pulpo_messaging import message_codec
+from pulpo_messaging.message import Message
+from pulpo_messaging.ready_heap import ReadyHeapQueueAdapter
+from pulpo_messaging.segment_log import RECORD_HEADER, SEGMENT_FILE_SUFFIX, Segment, StateLog
+
+
+class SegmentLogQueueAdapterConfig(Config):
+
+    def __init__(self, options: dict = None, json_file_path: str = None):
+        super().__init__(options=options, json_file_path=json_file_path)
+
+    @property
+    def base_path(self: Config) -> str:
+        return self.get('base_path', '/tmp/kessel/segment-log')
+
+    @property
+    def segments_path(self: Config) -> str:
+        return os.path.join(self.base_path, 'segments')
+
+    @property
+    def state_log_path(self: Config) -> str:
+        return os.path.join(self.base_path, 'state.log')
+
+    @property
+    def owner_lock_path(self: Config) -> str:
+        return os.path.join(self.base_path, 'owner.lock')
+
+    @property
+    def message_format(self: Config) -> str:
+        return self.get('message_format', 'json')
+
+    @property
+    def max_number_of_attempts(self: Config) -> int:
+        return self.getAsInt('max_number_of_attempts', 0)
+
+    @property
+    def segment_max_bytes(self: Config) -> int:
+        return self.getAsInt('segment_max_bytes', 64 * 1024 * 1024)
+
+    @property
+    def fsync_policy(self: Config) -> str:
+        return self.get('fsync_policy', 'never')
+
+    @property
+    def fsync_interval(self: Config) -> float:
+        return float(self.get('fsync_interval', 1))
+
+    @property
+    def compaction_interval(self: Config) -> float:
+        return float(self.get('compaction_interval', 60))
+
+    @property
+    def disable_compaction(self: Config) -> bool:
+        # a disable flag: a compaction_interval of 0 is read as missing, so it cannot turn compaction off
+        return self.getAsBool('disable_compaction', False)
+
+    @property
+    def compaction_min_live_ratio(self: Config) -> float:
+        return float(self.get('compaction_min_live_ratio', 0.5))
+
+
+class SegmentLogQueueAdapter(ReadyHeapQueueAdapter):
+    '''
+    Queue held in append-only segment files (see Segment), with the lock, commit and rollback of each message appended to a separate state log (see StateLog).
+    Message ids are sequence numbers.  Ready and delayed messages are held in memory in priority then sequence order, rebuilt at startup from the segment indexes and the state log;
+    a message still locked when the process stopped is redelivered, counted as a failed attempt.
+    compact deletes segments whose messages are all done and rewrites segments that are mostly done; it runs in the background every compaction_interval, unless disable_compaction is set.
+    The log is owned by one process (an exclusive lock on owner.lock); threads of that process may share the adapter.
+    '''
+
+    GAUGE_PREFIX = 'slqa'
+    FSYNC_POLICIES = ('always', 'interval', 'never')
+    # the state log is rewritten when it holds this many more records than needed
+    STATE_LOG_COMPACTION_SLACK = 1000
+
+    config = None
+    _owner_lock_fd = None
+    _state_log = None
+    _segments = None
+    # the number of each segment of _segments, in the same order, to find the segment of a sequence number
+    _segment_numbers = None
+    _next_seq = None
+    _live = None
+    _locked = None
+    _attempts = None
+    _maintenance_thread = None
+    _maintenance_stop = None
+
+    def __init__(self, options: dict = None):
+        super().__init__()
+        self.config = SegmentLogQueueAdapterConfig(options)
+        if self.config.fsync_policy not in self.FSYNC_POLICIES:
+            raise Exception(f'invalid fsync policy [{self.config.fsync_policy=}]')
+        os.makedirs(name=self.config.segments_path, exist_ok=True)
+        self._acquire_owner_lock()
+
+        self._state_log = StateLog(self.config.state_log_path)
+        self._load()
+
+        self._maintenance_stop = threading.Event()
+        if not self.config.disable_compaction or self.config.fsync_policy == 'interval':
+            self._maintenance_thread = threading.Thread(target=self._maintain, name='segment-log-maintenance', daemon=True)
+            self._maintenance_thread.start()
+
+    def _acquire_owner_lock(self):
+        self._owner_lock_fd = os.open(self.config.owner_lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._owner_lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError as ex:
+            os.close(self._owner_lock_fd)
+            raise Exception(f'segment log is in use by another adapter [{self.config.base_path=}]') from ex
+
+    def _load(self):
+        Segment.finish_compactions(self.config.segments_path)
+        numbers = sorted(int(file_name[:-len(SEGMENT_FILE_SUFFIX)]) for file_name in os.listdir(self.config.segments_path) if file_name.endswith(SEGMENT_FILE_SUFFIX))
+        self._segments = [Segment(self.config.segments_path, number) for number in numbers]
+        for segment in self._segments:
+            recovered = segment.recover(self._describe_payload)
+            if recovered:
+                logger.warning(f'records past the segment index recovered [{segment.log_path=}][{recovered=}]')
+        for segment in self._segments[:-1]:
+            segment.seal()
+        if not self._segments:
+            self._segments = [Segment(self.config.segments_path, 1)]
+        self._segment_numbers = [segment.number for segment in self._segments]
+
+        (done, self._attempts, locked) = self._state_log.replay()
+        self._live = {}
+        self._locked = set()
+        self._next_seq = self._segments[-1].number
+        now = time.time()
+        for segment in self._segments:
+            live = set()
+            for entry in segment.entries():
+                self._next_seq = max(self._next_seq, entry.seq + 1)
+                if entry.seq not in done:
+                    live.add(entry.seq)
+                    self._ready.push(entry.seq, entry.priority, entry.available_at, now)
+            self._live[segment.number] = live
+
+        # locked when the process stopped: the handler may have failed on it, so count an attempt
+        interrupted = sorted(seq for seq in locked if self._is_live(seq))
+        for seq in interrupted:
+            self._attempts[seq] = self._attempts.get(seq, 0) + 1
+        self._state_log.append([(StateLog.ROLLBACK, seq, self._attempts[seq]) for seq in interrupted])
+        logger.info(f'segment log loaded [segments={len(self._segments)}][ready={self._ready.ready_count}][delayed={self._ready.delayed_count}][{interrupted=}]')
+
+    @staticmethod
+    def _describe(message: Message) -> tuple:
+        '''The index fields of a message: priority, available at and expires at (epoch seconds, 0 when not set).'''
+        return (message.priority, message.delay.timestamp() if message.delay else 0, message.expiration.timestamp() if message.expiration else 0)
+
+    def _describe_payload(self, payload: bytes) -> tuple:
+        return self._describe(message_codec.decode_message(payload, header_only=True))
+
+    def _get_segment(self, seq: int) -> Segment:
+        i = bisect.bisect_right(self._segment_numbers, seq) - 1
+        return self._segments[i] if i >= 0 else None
+
+    def _is_live(self, seq: int) -> bool:
+        '''A message is live from enqueue until it is done (committed, failed or deleted).'''
+        segment = self._get_segment(seq)
+        return segment is not None and seq in self._live[segment.number]
+
+    def enqueue(self, message: Message) -> Message:
+        return self.enqueue_batch([message])[0]
+
+    def enqueue_batch(self, messages: list) -> list:
+        '''Appends the messages to the active segment, with one write (and with fsync_policy always, one fsync) per segment written.'''
+        with self._condition:
+            pending = []
+            pending_size = 0
+            for message in messages:
+                seq = self._next_seq
+                self._next_seq += 1
+                message.id = str(seq)
+                payload = message_codec.encode_message(message, self.config.message_format)
+                record_size = RECORD_HEADER.size + len(payload)
+                if self._segments[-1].size + pending_size + record_size > self.config.segment_max_bytes and (self._segments[-1].size or pending):
+                    self._write(pending)
+                    (pending, pending_size) = ([], 0)
+                    self._roll(seq)
+                pending.append((seq, payload, *self._describe(message)))
+                pending_size += record_size
+            self._write(pending)
+            if self.config.fsync_policy == 'always':
+                self._segments[-1].fsync()
+            self._condition.notify_all()
+        Statman.gauge('slqa.enqueue').increment(len(messages))
+        return messages
+
+    def _write(self, records: list):
+        if not records:
+            return
+        segment = self._segments[-1]
+        now = time.time()
+        for entry in segment.append(records):
+            self._live[segment.number].add(entry.seq)
+            self._ready.push(entry.seq, entry.priority, entry.available_at, now)
+
+    def _roll(self, number: int):
+        '''Seals the active segment and starts a new one, named after the next sequence number.'''
+        if self.config.fsync_policy != 'never':
+            self._segments[-1].fsync()
+        self._segments[-1].seal()
+        self._segments.append(Segment(self.config.segments_path, number))
+        self._segment_numbers.append(number)
+        self._live[number] = set()
+        logger.debug(f'segment rolled [{number=}]')
+
+    def _append_state(self, records: list):
+        self._state_log.append(records)
+        if self.config.fsync_policy == 'always':
+            self._state_log.fsync()
+
+    def _finish(self, seq: int, operation: int):
+        self._append_state([(operation, seq, 0)])
+        self._locked.discard(seq)
+        self._attempts.pop(seq, None)
+        self._live[self._get_segment(seq).number].discard(seq)
+
+    def _lock_next(self) -> Message:
+        '''Locks the first ready message in priority order.  Exhausted and expired messages are failed on the way.'''
+        now = time.time()
+        self._ready.promote(now)
+        while (seq := self._ready.pop()) is not None:
+            if not self._is_live(seq) or seq in self._locked:
+                # deleted since it was pushed
+                continue
+            segment = self._get_segment(seq)
+            entry = segment.find(seq)
+            attempts = self._attempts.get(seq, 0)
+            if self.config.max_number_of_attempts and attempts >= self.config.max_number_of_attempts:
+                logger.trace(f'message exceed max attempts {self.config.max_number_of_attempts=} {attempts=}')
+                self._finish(seq, StateLog.FAIL)
+                continue
+            if entry.expires_at and entry.expires_at < now:
+                logger.trace(f'message expired {entry.expires_at=}')
+                self._finish(seq, StateLog.FAIL)
+                continue
+
+            message = message_codec.decode_message(segment.read(entry))
+            if self._hold_back(seq, entry.priority, message):
+                continue
+            message.id = str(seq)
+            message.attempts = attempts
+            self._locked.add(seq)
+            self._append_state([(StateLog.LOCK, seq, attempts)])
+            return message
+        return None
+
+    def commit(self, message: Message, is_success: bool = True):
+        seq = self._get_seq(message)
+        with self._condition:
+            if seq not in self._locked:
+                raise Exception(f'message is not locked [{seq=}]')
+            self._finish(seq, StateLog.COMMIT if is_success else StateLog.FAIL)
+        logger.trace(f'commit complete {seq}')
+        Statman.gauge('slqa.commit').increment()
+
+    def rollback(self, message: Message, delay: float = None):
+        '''A rollback delay is held in memory only: after a restart the message is available at once.'''
+        self._unlock(message, delay=delay, attempts_increment=1)
+        Statman.gauge('slqa.rollback').increment()
+
+    def defer(self, message: Message, delay: float = None):
+        '''As for rollback, the delay is held in memory only.'''
+        self._unlock(message, delay=delay, attempts_increment=0)
+        Statman.gauge('slqa.defer').increment()
+
+    def _unlock(self, message: Message, delay: float, attempts_increment: int):
+        seq = self._get_seq(message)
+        with self._condition:
+            if seq not in self._locked:
+                raise Exception(f'message is not locked [{seq=}]')
+            attempts = self._attempts.get(seq, 0) + attempts_increment
+            self._append_state([(StateLog.ROLLBACK, seq, attempts)])
+            self._attempts[seq] = attempts
+            self._locked.discard(seq)
+            entry = self._get_segment(seq).find(seq)
+            now = time.time()
+            self._ready.push(seq, entry.priority, max(entry.available_at, now + delay) if delay else entry.available_at, now)
+            self._condition.notify_all()
+        logger.trace(f'unlock complete [{seq=}][{attempts=}]')
+
+    def peek(self, message_id: str) -> Message:
+        seq = self._get_seq(message_id)
+        with self._condition:
+            if not self._is_live(seq):
+                return None
+            segment = self._get_segment(seq)
+            message = message_codec.decode_message(segment.read(segment.find(seq)))
+            message.id = str(seq)
+            message.attempts = self._attempts.get(seq, 0)
+            return message
+
+    def delete(self, message_id: str):
+        seq = self._get_seq(message_id)
+        with self._condition:
+            if self._is_live(seq):
+                self._finish(seq, StateLog.FAIL)
+
+    def compact(self) -> int:
+        '''
+        Deletes sealed segments whose messages are all done, rewrites sealed segments with fewer than compaction_min_live_ratio of their messages live,
+        and rewrites the state log once most of its records are no longer needed.  Enqueue and dequeue wait while a segment is rewritten.
+        Returns the number of segments deleted or rewritten.
+        '''
+        compacted = 0
+        reclaimed = 0
+        with self._condition:
+            for segment in list(self._segments[:-1]):
+                live = self._live[segment.number]
+                if not live:
+                    reclaimed += segment.size
+                    segment.delete()
+                    self._segments.remove(segment)
+                    self._segment_numbers.remove(segment.number)
+                    del self._live[segment.number]
+                    compacted += 1
+                elif len(live) < segment.entry_count * self.config.compaction_min_live_ratio:
+                    reclaimed += segment.compact(live)
+                    compacted += 1
+            self._compact_state_log()
+        if compacted:
+            logger.info(f'segment log compacted [segments={compacted}][{reclaimed=}]')
+            Statman.gauge('slqa.compaction.segments').increment(compacted)
+            Statman.gauge('slqa.compaction.reclaimed-bytes').increment(reclaimed)
+        return compacted
+
+    def _compact_state_log(self):
+        # a done message needs its record for as long as it is in a segment
+        done = [(StateLog.COMMIT, entry.seq, 0) for segment in self._segments for entry in segment.entries() if entry.seq not in self._live[segment.number]]
+        records = done + [(StateLog.ROLLBACK, seq, attempts) for seq, attempts in self._attempts.items()] + [(StateLog.LOCK, seq, 0) for seq in self._locked]
+        if self._state_log.record_count > 2 * len(records) + self.STATE_LOG_COMPACTION_SLACK:
+            logger.info(f'state log compacted [before={self._state_log.record_count}][after={len(records)}]')
+            self._state_log.rewrite(records)
+
+    def fsync(self):
+        '''Flushes the active segment and the state log to disk (sealed segments are flushed when sealed, unless fsync_policy is never).'''
+        with self._condition:
+            self._segments[-1].fsync()
+            self._state_log.fsync()
+
+    def _maintain(self):
+        intervals = []
+        if not self.config.disable_compaction:
+            intervals.append(self.config.compaction_interval)
+        if self.config.fsync_policy == 'interval':
+            intervals.append(self.config.fsync_interval)
+        compacted_at = time.monotonic()
+        while not self._maintenance_stop.wait(min(intervals)):
+            try:
+                if self.config.fsync_policy == 'interval':
+                    self.fsync()
+                if not self.config.disable_compaction and time.monotonic() - compacted_at >= self.config.compaction_interval:
+                    compacted_at = time.monotonic()
+                    self.compact()
+            except OSError as ex:
+                logger.error(f'segment log maintenance failed [{ex=}]')
+
+    def close(self):
+        self._maintenance_stop.set()
+        if self._maintenance_thread:
+            self._maintenance_thread.join()
+        with self._condition:
+            if self.config.fsync_policy != 'never':
+                self._segments[-1].fsync()
+                self._state_log.fsync()
+            for segment in self._segments:
+                segment.close()
+            self._state_log.close()
+        os.close(self._owner_lock_fd)
@@ -0,0 +1,317 @@
+import os
+import contextlib
+import datetime
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from loguru import logger
+from statman import Statman
+from pulpo_config import Config
+from pulpo_messaging import message_codec
+from pulpo_messaging.message import Message
+from pulpo_messaging.queue_adapter import QueueAdapter
+
+ARCHIVE_TABLE_PREFIX = 'archive_'
+ARCHIVE_PARTITION_FORMATS = {'day': '%Y%m%d', 'month': '%Y%m'}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS message (
+    id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    available_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    lease_owner TEXT,
+    lease_expires_at REAL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS message_dequeue ON message (state, priority, available_at);
+'''
+
+
+class SqliteQueueAdapterConfig(Config):
+
+    def __init__(self, options: dict = None, json_file_path: str = None):
+        super().__init__(options=options, json_file_path=json_file_path)
+
+    @property
+    def base_path(self: Config) -> str:
+        return self.get('base_path', '/tmp/kessel/sqlite')
+
+    @property
+    def database_path(self: Config) -> str:
+        return os.path.join(self.base_path, 'queue.db')
+
+    @property
+    def message_format(self: Config) -> str:
+        return self.get('message_format', 'json')
+
+    @property
+    def max_number_of_attempts(self: Config) -> int:
+        return self.getAsInt('max_number_of_attempts', 0)
+
+    @property
+    def lease_duration(self: Config) -> float:
+        return float(self.get('lease_duration', 300))
+
+    @property
+    def enable_archive(self: Config) -> bool:
+        return self.getAsBool('enable_archive', False)
+
+    @property
+    def archive_partition(self: Config) -> str:
+        return self.get('archive_partition', 'day')
+
+    @property
+    def synchronous(self: Config) -> str:
+        return self.get('synchronous', 'NORMAL')
+
+    @property
+    def busy_timeout(self: Config) -> float:
+        return float(self.get('busy_timeout', 5))
+
+    @property
+    def wait_poll_interval(self: Config) -> float:
+        return float(self.get('wait_poll_interval', 0.1))
+
+
+class SqliteQueueAdapter(QueueAdapter):
+    '''
+    Queue held in one SQLite database (in WAL mode, so readers do not block the writer), shared by the producers and consumers of a host.
+    Dequeue claims the first ready messages, in priority then available time order through the (state, priority, available_at) index, in one immediate transaction:
+    a claim is a lease held by this adapter for lease_duration seconds, and a message whose lease expired (its consumer died) is claimed again, counted as a failed attempt.
+    Committed and failed messages are deleted, or with enable_archive moved to an archive table per day (or month), which is dropped as a whole once no longer needed.
+    '''
+
+    SELECT_READY = "SELECT id, attempts, expires_at, data FROM message WHERE state = 'queue' AND available_at <= ? ORDER BY priority, available_at, rowid LIMIT ?"
+
+    config = None
+    _consumer_id = None
+    _local = None
+    _connections = None
+    _connections_lock = None
+
+    def __init__(self, options: dict = None):
+        self.config = SqliteQueueAdapterConfig(options)
+        if self.config.archive_partition not in ARCHIVE_PARTITION_FORMATS:
+            raise Exception(f'invalid archive partition [{self.config.archive_partition=}]')
+        os.makedirs(name=self.config.base_path, exist_ok=True)
+        self._consumer_id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        connection = self._get_connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(SCHEMA)
+
+    @property
+    def consumer_id(self) -> str:
+        return self._consumer_id
+
+    def _get_connection(self) -> sqlite3.Connection:
+        '''A connection per thread, in autocommit mode: transactions are begun explicitly.'''
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.config.database_path, timeout=self.config.busy_timeout, isolation_level=None, check_same_thread=False)
+            connection.execute(f'PRAGMA synchronous={self.config.synchronous}')
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        '''An immediate transaction: the write lock is taken at begin, so a claim cannot be raced by another consumer between its select and its update.'''
+        connection = self._get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def _create_message_id(self):
+        return f"{time.time()}-{uuid.uuid4()}"
+
+    def _get_row(self, message: Message, now: float) -> tuple:
+        message.id = self._create_message_id()
+        available_at = message.delay.timestamp() if message.delay else now
+        expires_at = message.expiration.timestamp() if message.expiration else 0
+        return (message.id, message.priority, available_at, expires_at, message.attempts, message_codec.encode_message(message, self.config.message_format))
+
+    def enqueue(self, message: Message) -> Message:
+        return self.enqueue_batch([message])[0]
+
+    def enqueue_batch(self, messages: list) -> list:
+        '''Inserts the messages in one transaction.'''
+        now = time.time()
+        rows = [self._get_row(message, now) for message in messages]
+        with self._transaction() as connection:
+            connection.executemany("INSERT INTO message (id, state, priority, available_at, expires_at, attempts, data) VALUES (?, 'queue', ?, ?, ?, ?, ?)", rows)
+        Statman.gauge('sqliteqa.enqueue').increment(len(messages))
+        return messages
+
+    def dequeue(self) -> Message:
+        messages = self._claim(max_messages=1)
+        return messages[0] if messages else None
+
+    def dequeue_batch(self, max_messages: int = 1, timeout: float = None) -> list:
+        deadline = time.monotonic() + (timeout or 0)
+        while True:
+            messages = self._claim(max_messages=max_messages)
+            remaining = deadline - time.monotonic()
+            if messages or remaining <= 0:
+                return messages
+            time.sleep(min(self.config.wait_poll_interval, remaining))
+
+    def _claim(self, max_messages: int) -> list:
+        '''Claims up to max_messages ready messages.  Exhausted and expired messages are failed on the way.'''
+        now = time.time()
+        messages = []
+        with self._transaction() as connection:
+            self._reclaim_expired_leases(connection, now)
+            while len(messages) < max_messages:
+                rows = connection.execute(self.SELECT_READY, (now, max_messages - len(messages))).fetchall()
+                if not rows:
+                    break
+                claimed = []
+                for (message_id, attempts, expires_at, data) in rows:
+                    if self.config.max_number_of_attempts and attempts >= self.config.max_number_of_attempts:
+                        logger.trace(f'message exceed max attempts {self.config.max_number_of_attempts=} {attempts=}')
+                        self._finish(connection, message_id, 'failure', now)
+                        continue
+                    if expires_at and expires_at < now:
+                        logger.trace(f'message expired {expires_at=}')
+                        self._finish(connection, message_id, 'failure', now)
+                        continue
+                    message = message_codec.decode_message(data)
+                    message.id = message_id
+                    message.attempts = attempts
+                    messages.append(message)
+                    claimed.append((self._consumer_id, now + self.config.lease_duration, message_id))
+                connection.executemany("UPDATE message SET state = 'lock', lease_owner = ?, lease_expires_at = ? WHERE id = ?", claimed)
+        if messages:
+            logger.debug(f'dequeued messages [{len(messages)=}]')
+            Statman.gauge('sqliteqa.dequeue').increment(len(messages))
+        return messages
+
+    def _reclaim_expired_leases(self, connection: sqlite3.Connection, now: float):
+        # the locked messages are few, and found through the state prefix of the dequeue index
+        cursor = connection.execute("UPDATE message SET state = 'queue', attempts = attempts + 1, lease_owner = NULL, lease_expires_at = NULL WHERE state = 'lock' AND lease_expires_at < ?", (now, ))
+        if cursor.rowcount:
+            logger.warning(f'message leases expired, messages returned to the queue [count={cursor.rowcount}]')
+            Statman.gauge('sqliteqa.lease-expired').increment(cursor.rowcount)
+
+    def wait_for_message(self, timeout: float) -> bool:
+        '''Polls the dequeue index every wait_poll_interval seconds.'''
+        deadline = time.monotonic() + timeout
+        while True:
+            if self._get_connection().execute("SELECT 1 FROM message WHERE state = 'queue' AND available_at <= ? LIMIT 1", (time.time(), )).fetchone():
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.config.wait_poll_interval, remaining))
+
+    def _get_message_id(self, message) -> str:
+        if isinstance(message, Message):
+            return message.id
+        if isinstance(message, str):
+            return message
+        raise Exception('expects message object')
+
+    def _get_archive_table(self, connection: sqlite3.Connection, now: float) -> str:
+        table = ARCHIVE_TABLE_PREFIX + time.strftime(ARCHIVE_PARTITION_FORMATS[self.config.archive_partition], time.localtime(now))
+        connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (id TEXT PRIMARY KEY, state TEXT NOT NULL, attempts INTEGER NOT NULL, archived_at REAL NOT NULL, data BLOB NOT NULL)')
+        return table
+
+    def _finish(self, connection: sqlite3.Connection, message_id: str, destination: str, now: float, condition: str = '', parameters: tuple = ()) -> bool:
+        '''Deletes the message, archiving it first when enabled.  Returns False if no message matched.'''
+        if self.config.enable_archive:
+            table = self._get_archive_table(connection, now)
+            connection.execute(f'INSERT OR REPLACE INTO {table} SELECT id, ?, attempts, ?, data FROM message WHERE id = ?{condition}', (destination, now, message_id) + parameters)
+        return connection.execute(f'DELETE FROM message WHERE id = ?{condition}', (message_id, ) + parameters).rowcount > 0
+
+    def commit(self, message: Message, is_success: bool = True):
+        message_id = self._get_message_id(message)
+        with self._transaction() as connection:
+            if not self._finish(connection, message_id, 'success' if is_success else 'failure', time.time(), " AND state = 'lock' AND lease_owner = ?", (self._consumer_id, )):
+                raise Exception(f'message is not locked by this consumer, or its lease expired [{message_id=}]')
+        logger.trace(f'commit complete {message_id}')
+        Statman.gauge('sqliteqa.commit').increment()
+
+    def rollback(self, message: Message, delay: float = None):
+        message_id = self._get_message_id(message)
+        self._unlock(message_id, delay=delay, attempts_increment=1)
+        logger.trace(f'rollback complete [{message_id=}]')
+        Statman.gauge('sqliteqa.rollback').increment()
+
+    def defer(self, message: Message, delay: float = None):
+        message_id = self._get_message_id(message)
+        self._unlock(message_id, delay=delay, attempts_increment=0)
+        logger.trace(f'defer complete [{message_id=}]')
+        Statman.gauge('sqliteqa.defer').increment()
+
+    def _unlock(self, message_id: str, delay: float, attempts_increment: int):
+        available_at = time.time() + delay if delay else 0
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE message SET state = 'queue', attempts = attempts + ?, available_at = MAX(available_at, ?), lease_owner = NULL, lease_expires_at = NULL WHERE id = ? AND state = 'lock' AND lease_owner = ?",
+                (attempts_increment, available_at, message_id, self._consumer_id))
+            if not cursor.rowcount:
+                raise Exception(f'message is not locked by this consumer, or its lease expired [{message_id=}]')
+
+    def peek(self, message_id: str) -> Message:
+        row = self._get_connection().execute('SELECT attempts, data FROM message WHERE id = ?', (message_id, )).fetchone()
+        if not row:
+            return None
+        message = message_codec.decode_message(row[1])
+        message.id = message_id
+        message.attempts = row[0]
+        return message
+
+    def delete(self, message_id: str):
+        with self._transaction() as connection:
+            self._finish(connection, message_id, 'failure', time.time())
+
+    def lookup_message_state(self, message_id: str) -> str:
+        '''
+        Determines the state of a message by primary key lookups: in the message table, then in each archive table (newest first).
+        Valid states: unknown, queue, lock, complete.success, complete.fail
+        '''
+        connection = self._get_connection()
+        row = connection.execute('SELECT state FROM message WHERE id = ?', (message_id, )).fetchone()
+        if row:
+            return row[0]
+        for table in self._get_archive_tables(connection):
+            row = connection.execute(f'SELECT state FROM {table} WHERE id = ?', (message_id, )).fetchone()
+            if row:
+                return 'complete.success' if row[0] == 'success' else 'complete.fail'
+        return 'unknown'
+
+    def _get_archive_tables(self, connection: sqlite3.Connection) -> list:
+        rows = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ? ORDER BY name DESC", (ARCHIVE_TABLE_PREFIX + '%', )).fetchall()
+        return [row[0] for row in rows]
+
+    def drop_archive_partitions(self, older_than: datetime.datetime) -> int:
+        '''Drops the archive tables of the days (or months) before the one holding older_than.  Returns the number of tables dropped.'''
+        cutoff = ARCHIVE_TABLE_PREFIX + older_than.strftime(ARCHIVE_PARTITION_FORMATS[self.config.archive_partition])
+        connection = self._get_connection()
+        dropped = [table for table in self._get_archive_tables(connection) if table < cutoff]
+        for table in dropped:
+            connection.execute(f'DROP TABLE IF EXISTS {table}')
+        if dropped:
+            logger.info(f'archive partitions dropped [{dropped=}]')
+        return len(dropped)
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
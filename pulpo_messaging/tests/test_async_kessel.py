@@ -0,0 +1,410 @@
+import os
+import asyncio
+import datetime
+import subprocess
+import threading
+import time
+import unittest
+from unittest.mock import AsyncMock, patch
+from pulpo_messaging.async_beanstalkd_queue_adapter import AsyncBeanstalkdQueueAdapter
+from pulpo_messaging.async_kessel import AsyncPulpo
+from pulpo_messaging.async_queue_adapter import AsyncFileQueueAdapter, AsyncQueueAdapter
+from pulpo_messaging.kessel import Message
+from pulpo_messaging.payload_handler import AsyncPayloadHandler, RequestResult
+from pulpo_messaging.sample_handlers import AlwaysSucceedHandler
+from .unittest_helper import get_unique_base_path
+
+BEANSTALKD_PATH = os.getenv("BEANSTALKD_PATH", "beanstalkd")
+ASYNC_INET_ADDRESS = ("127.0.0.1", 4445)
+
+
+class AsyncSleepHandler(AsyncPayloadHandler):
+    running = 0
+    max_running = 0
+
+    async def handle(self, payload: str):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(float(payload))
+        self.running -= 1
+        return RequestResult.success_factory()
+
+
+class AsyncTimedHandler(AsyncPayloadHandler):
+    '''Records when each message is handled.'''
+
+    def __init__(self):
+        super().__init__()
+        self.handled_at = []
+
+    async def handle(self, payload: str):
+        self.handled_at.append(time.monotonic())
+        return RequestResult.success_factory()
+
+
+class AsyncRaiseHandler(AsyncPayloadHandler):
+
+    async def handle(self, payload: str):
+        raise Exception('handler failure')
+
+
+def async_file_queue_adapter_factory() -> AsyncFileQueueAdapter:
+    return AsyncFileQueueAdapter(options={'base_path': get_unique_base_path('async-fqa')})
+
+
+class TestAsyncFileQueueAdapter(unittest.IsolatedAsyncioTestCase):
+
+    async def test_concurrent_dequeue(self):
+        qa = AsyncFileQueueAdapter(options={'base_path': get_unique_base_path('async-fqa'), 'enable_ready_index': True, 'ready_index_refresh_interval': 0.001})
+        messages = [await qa.enqueue(Message(payload=f'message {i}')) for i in range(20)]
+
+        dequeued = await asyncio.gather(*[qa.dequeue() for _ in range(40)])
+        dequeued = [m.id for m in dequeued if m]
+        self.assertEqual(sorted(dequeued), sorted(m.id for m in messages))
+        await asyncio.gather(*[qa.commit(m) for m in dequeued])
+        self.assertIsNone(await qa.dequeue())
+        await qa.close()
+
+    async def test_wait_wakes_on_enqueue(self):
+        qa = async_file_queue_adapter_factory()
+        asyncio.get_running_loop().call_later(0.2, asyncio.ensure_future, qa.enqueue(Message(payload='hello world')))
+
+        start = time.monotonic()
+        self.assertTrue(await qa.wait_for_message(timeout=5))
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertIsNotNone(await qa.dequeue())
+        await qa.close()
+
+    async def test_wait_runs_in_slices_on_adapter_thread(self):
+        qa = async_file_queue_adapter_factory()
+        thread_names = set()
+        wait_for_message = qa.queue_adapter.wait_for_message
+
+        def record_thread(timeout):
+            thread_names.add(threading.current_thread().name)
+            return wait_for_message(timeout)
+
+        with patch.object(qa.queue_adapter, 'wait_for_message', side_effect=record_thread):
+            waiting = asyncio.ensure_future(qa.wait_for_message(timeout=5))
+            await asyncio.sleep(0.05)
+            # served between two slices of the wait
+            start = time.monotonic()
+            self.assertIsNone(await qa.dequeue())
+            self.assertLess(time.monotonic() - start, 0.5)
+
+            await qa.enqueue(Message(payload='hello world'))
+            self.assertTrue(await waiting)
+        self.assertTrue(all(name.startswith('pulpo-queue-adapter') for name in thread_names))
+        await qa.close()
+
+
+class TestAsyncPulpo(unittest.IsolatedAsyncioTestCase):
+
+    async def test_handles_messages_concurrently(self):
+        qa = async_file_queue_adapter_factory()
+        pulpo = AsyncPulpo(options={'shutdown_after_number_of_empty_iterations': 1, 'sleep_duration': 0.001}, queue_adapter=qa)
+        handler = AsyncSleepHandler()
+        pulpo.handler_registry.register('sleep', handler)
+        for _ in range(5):
+            await pulpo.publish(Message(payload='0.3', request_type='sleep'))
+
+        start = time.monotonic()
+        await pulpo.start()
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(handler.max_running, 5)
+        self.assertLess(elapsed, 1.2)
+        self.assertIsNone(qa.queue_adapter.dequeue())
+
+    async def test_concurrency_limit(self):
+        qa = async_file_queue_adapter_factory()
+        pulpo = AsyncPulpo(options={'concurrency_limit': 2, 'shutdown_after_number_of_empty_iterations': 1, 'sleep_duration': 0.001}, queue_adapter=qa)
+        handler = AsyncSleepHandler()
+        pulpo.handler_registry.register('sleep', handler)
+        for _ in range(6):
+            await pulpo.publish(Message(payload='0.05', request_type='sleep'))
+
+        await pulpo.start()
+
+        self.assertEqual(handler.max_running, 2)
+        self.assertIsNone(qa.queue_adapter.dequeue())
+
+    async def test_sync_handler_runs_on_executor(self):
+        qa = async_file_queue_adapter_factory()
+        pulpo = AsyncPulpo(options={'shutdown_after_number_of_empty_iterations': 1, 'sleep_duration': 0.001}, queue_adapter=qa)
+        pulpo.handler_registry.register('success', AlwaysSucceedHandler())
+        m = await pulpo.publish(Message(payload='hello world', request_type='success'))
+
+        result = await pulpo.handle_message(await qa.dequeue())
+
+        self.assertTrue(result.isSuccess)
+        self.assertEqual(qa.queue_adapter.lookup_message_state(m.id), 'complete.success')
+
+    async def test_handler_exception_rolls_back(self):
+        qa = AsyncMock(AsyncQueueAdapter)
+        pulpo = AsyncPulpo(queue_adapter=qa)
+        pulpo.handler_registry.register('raise', AsyncRaiseHandler())
+
+        result = await pulpo.handle_message(Message(message_id=1, payload='hello world', request_type='raise'))
+
+        self.assertTrue(result.isTransient)
+        self.assertTrue(qa.rollback.called)
+        self.assertFalse(qa.commit.called)
+
+    async def test_circuit_breaker_holds_back_request_type(self):
+        qa = AsyncMock(AsyncQueueAdapter)
+        pulpo = AsyncPulpo(options={'circuit_breakers': {'raise': {'minimum_calls': 1, 'open_duration': 60}}}, queue_adapter=qa)
+        pulpo.handler_registry.register('raise', AsyncRaiseHandler())
+
+        await pulpo.handle_message(Message(message_id=1, payload='hello world', request_type='raise'))
+        qa.pause_request_type.assert_called_once()
+
+        # held back without being handled
+        self.assertIsNone(await pulpo.handle_message(Message(message_id=2, payload='hello world', request_type='raise')))
+        self.assertGreater(qa.defer.call_args.kwargs['delay'], 59)
+        qa.rollback.assert_called_once()
+
+    async def test_max_concurrency_per_request_type(self):
+        qa = AsyncMock(AsyncQueueAdapter)
+        pulpo = AsyncPulpo(queue_adapter=qa)
+        handler = AsyncSleepHandler()
+        pulpo.handler_registry.register('sleep', handler, max_concurrency=2)
+        pulpo.handler_registry.register('success', AlwaysSucceedHandler())
+
+        results = await asyncio.gather(*[pulpo.handle_message(Message(message_id=i, payload='0.05', request_type='sleep')) for i in range(1, 6)],
+                                       pulpo.handle_message(Message(message_id=6, payload='hello world', request_type='success')))
+
+        self.assertTrue(all(result.isSuccess for result in results))
+        self.assertEqual(handler.max_running, 2)
+        # the cap is counted by this process, and frees as soon as a message completes
+        self.assertFalse(qa.pause_request_type.called)
+        self.assertFalse(qa.rollback.called)
+
+    async def test_throttled_messages_do_not_hold_concurrency_limit(self):
+        qa = async_file_queue_adapter_factory()
+        pulpo = AsyncPulpo(options={'concurrency_limit': 4, 'shutdown_after_number_of_empty_iterations': 1, 'sleep_duration': 0.001}, queue_adapter=qa)
+        pulpo.handler_registry.register('slow', AlwaysSucceedHandler(), rate_limit=5, burst=1)
+        handler = AsyncTimedHandler()
+        pulpo.handler_registry.register('fast', handler)
+        for _ in range(10):
+            await pulpo.publish(Message(payload='hello world', request_type='slow'))
+        await pulpo.publish(Message(payload='hello world', request_type='fast'))
+
+        start = time.monotonic()
+        await pulpo.start()
+
+        # dequeued behind the throttled messages, and handled while they wait
+        self.assertEqual(len(handler.handled_at), 1)
+        self.assertLess(handler.handled_at[0] - start, 0.5)
+        self.assertGreater(time.monotonic() - start, 1.5)
+        self.assertIsNone(qa.queue_adapter.dequeue())
+
+    async def test_rate_limit_over_max_throttled_messages_defers(self):
+        qa = AsyncMock(AsyncQueueAdapter)
+        pulpo = AsyncPulpo(options={'rate_limit': {'max_throttled_messages': 1}}, queue_adapter=qa)
+        pulpo.handler_registry.register('success', AlwaysSucceedHandler(), rate_limit=0.001, burst=1)
+
+        self.assertTrue((await pulpo.handle_message(Message(message_id=1, payload='hello world', request_type='success'))).isSuccess)
+        throttled = asyncio.create_task(pulpo.handle_message(Message(message_id=2, payload='hello world', request_type='success')))
+        await asyncio.sleep(0.01)
+        self.assertFalse(throttled.done())
+
+        self.assertIsNone(await pulpo.handle_message(Message(message_id=3, payload='hello world', request_type='success')))
+        qa.defer.assert_called_once()
+        self.assertGreater(qa.defer.call_args.kwargs['delay'], 1)
+        self.assertFalse(qa.rollback.called)
+        throttled.cancel()
+
+    async def test_message_held_back_by_circuit_breaker_refunds_rate_limit(self):
+        qa = AsyncMock(AsyncQueueAdapter)
+        pulpo = AsyncPulpo(options={'circuit_breakers': {'raise': {'minimum_calls': 1, 'open_duration': 60}}}, queue_adapter=qa)
+        pulpo.handler_registry.register('raise', AsyncRaiseHandler(), rate_limit=0.001, burst=2, max_concurrency=1)
+        limiter = pulpo.handler_registry.get_limiter('raise')
+
+        await pulpo.handle_message(Message(message_id=1, payload='hello world', request_type='raise'))
+        self.assertIsNone(await pulpo.handle_message(Message(message_id=2, payload='hello world', request_type='raise')))
+        qa.defer.assert_called_once()
+
+        # the held back message did not use up the token nor the concurrency of the request type
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(limiter.acquire(), 0)
+
+    async def test_shutdown_ends_idle_wait(self):
+        qa = async_file_queue_adapter_factory()
+        pulpo = AsyncPulpo(options={'shutdown_after_number_of_empty_iterations': 100, 'sleep_duration': 30, 'wait_interval': 0.1}, queue_adapter=qa)
+        asyncio.get_running_loop().call_later(0.2, pulpo.request_shutdown)
+
+        start = time.monotonic()
+        await pulpo.start()
+        self.assertLess(time.monotonic() - start, 2)
+
+    async def test_message_published_while_idle_is_handled(self):
+        qa = async_file_queue_adapter_factory()
+        pulpo = AsyncPulpo(options={'shutdown_after_number_of_empty_iterations': 2, 'sleep_duration': 1, 'wait_interval': 0.1}, queue_adapter=qa)
+        pulpo.handler_registry.register('echo', AlwaysSucceedHandler())
+        asyncio.get_running_loop().call_later(0.2, asyncio.ensure_future, pulpo.publish(Message(payload='hello world', request_type='echo')))
+
+        await pulpo.start()
+        self.assertIsNone(qa.queue_adapter.dequeue())
+
+    async def test_message_published_while_in_flight_is_handled(self):
+        qa = async_file_queue_adapter_factory()
+        pulpo = AsyncPulpo(options={'shutdown_after_number_of_empty_iterations': 1, 'sleep_duration': 5, 'wait_interval': 0.1}, queue_adapter=qa)
+        pulpo.handler_registry.register('sleep', AsyncSleepHandler())
+        handler = AsyncTimedHandler()
+        pulpo.handler_registry.register('timed', handler)
+        await pulpo.publish(Message(payload='2', request_type='sleep'))
+        asyncio.get_running_loop().call_later(0.3, asyncio.ensure_future, pulpo.publish(Message(payload='hello world', request_type='timed')))
+
+        start = time.monotonic()
+        await pulpo.start()
+
+        # not held behind the message in flight, nor polled every sleep_duration
+        self.assertEqual(len(handler.handled_at), 1)
+        self.assertLess(handler.handled_at[0] - start, 1)
+
+    async def test_missing_handler_is_fatal(self):
+        qa = AsyncMock(AsyncQueueAdapter)
+        pulpo = AsyncPulpo(queue_adapter=qa)
+
+        result = await pulpo.handle_message(Message(message_id=1, payload='hello world', request_type='unknown'))
+
+        self.assertTrue(result.isFatal)
+        qa.commit.assert_called_once()
+
+    async def test_shutdown_drains_in_flight_messages(self):
+        qa = async_file_queue_adapter_factory()
+        pulpo = AsyncPulpo(options={'shutdown_after_number_of_empty_iterations': 10, 'sleep_duration': 1}, queue_adapter=qa)
+        handler = AsyncSleepHandler()
+        pulpo.handler_registry.register('sleep', handler)
+        for _ in range(3):
+            await pulpo.publish(Message(payload='0.2', request_type='sleep'))
+
+        asyncio.get_running_loop().call_later(0.1, pulpo.request_shutdown)
+        await pulpo.start()
+
+        self.assertEqual(handler.running, 0)
+        self.assertIsNone(qa.queue_adapter.dequeue())
+
+
+class TestAsyncBeanstalkdQueueAdapter(unittest.IsolatedAsyncioTestCase):
+    beanstalkd = None
+    qa = None
+
+    async def asyncSetUp(self):
+        host, port = ASYNC_INET_ADDRESS
+        self.beanstalkd = subprocess.Popen([BEANSTALKD_PATH, "-l", host, "-p", str(port)])
+        time.sleep(0.1)
+        self.qa = AsyncBeanstalkdQueueAdapter(options={'host': host, 'port': port, 'max_number_of_attempts': 3})
+
+    async def asyncTearDown(self):
+        await self.qa.close()
+        self.beanstalkd.terminate()
+        self.beanstalkd.wait()
+
+    async def test_enqueue_dequeue_commit(self):
+        m1 = await self.qa.enqueue(Message(payload='hello world'))
+        self.assertIsNotNone(m1.id)
+
+        dq = await self.qa.dequeue()
+        self.assertEqual(dq.id, m1.id)
+        self.assertEqual(dq.payload, 'hello world')
+        await self.qa.commit(dq)
+
+        self.assertIsNone(await self.qa.dequeue())
+
+    async def test_rollback(self):
+        m1 = await self.qa.enqueue(Message(payload='hello world'))
+        await self.qa.rollback(await self.qa.dequeue())
+
+        dq = await self.qa.dequeue()
+        self.assertEqual(dq.id, m1.id)
+        self.assertEqual(dq.attempts, 1)
+
+    async def test_tube_routes(self):
+        self.qa.config.set('tube_routes', {'bulk': 'bulk-tube'})
+        await asyncio.gather(*[self.qa.enqueue(Message(payload=f'hello {i}', request_type='bulk' if i % 2 else 'echo')) for i in range(6)])
+
+        self.assertEqual((await self.qa.beanstalk_stat('bulk-tube'))['current-jobs-ready'], 3)
+        self.assertEqual((await self.qa.beanstalk_stat())['current-jobs-ready'], 3)
+
+    async def test_watch_tubes(self):
+        self.qa.config.set('tube_routes', {'bulk': 'bulk-tube'})
+        self.qa.config.set('watch_tubes', ['bulk-tube', self.qa.config.default_tube])
+        messages = await asyncio.gather(*[self.qa.enqueue(Message(payload=f'hello {i}', request_type='bulk' if i % 2 else 'echo')) for i in range(4)])
+
+        dequeued = [await self.qa.dequeue() for _ in range(4)]
+        self.assertEqual(sorted(m.id for m in dequeued), sorted(m.id for m in messages))
+
+    async def test_wait_holds_reserved_job_for_dequeue(self):
+        self.assertFalse(await self.qa.wait_for_message(timeout=0))
+        # the wait holds the connection of the adapter: the message is put by another producer
+        host, port = ASYNC_INET_ADDRESS
+        producer = AsyncBeanstalkdQueueAdapter(options={'host': host, 'port': port})
+        asyncio.get_running_loop().call_later(0.2, asyncio.ensure_future, producer.enqueue(Message(payload='hello world')))
+
+        self.assertTrue(await self.qa.wait_for_message(timeout=5))
+        dq = await self.qa.dequeue()
+        self.assertEqual(dq.payload, 'hello world')
+        await self.qa.commit(dq)
+        await producer.close()
+
+    async def test_peek(self):
+        m1 = await self.qa.enqueue(Message(payload='hello world'))
+        peeked = await self.qa.peek(m1.id)
+        self.assertEqual(peeked.payload, 'hello world')
+
+    async def test_expired_message_is_not_dequeued(self):
+        expiration_date_in_past = datetime.datetime.strptime("2000-01-01 12:00:00", "%Y-%m-%d %H:%M:%S")
+        await self.qa.enqueue(Message(payload='hello world', expiration=expiration_date_in_past))
+        self.assertIsNone(await self.qa.dequeue())
+
+    async def test_max_attempts(self):
+        await self.qa.enqueue(Message(payload='hello world'))
+        for _ in range(3):
+            await self.qa.rollback(await self.qa.dequeue())
+        self.assertIsNone(await self.qa.dequeue())
+
+    async def test_max_attempts_tracked_in_message(self):
+        self.qa.config.set('attempts_tracking', 'message')
+        await self.qa.enqueue(Message(payload='hello world'))
+        for attempts in range(3):
+            dq = await self.qa.dequeue()
+            self.assertEqual(dq.attempts, attempts)
+            await self.qa.rollback(dq)
+        self.assertIsNone(await self.qa.dequeue())
+        self.assertEqual((await self.qa.beanstalk_stat())['current-jobs-ready'], 0)
+
+    async def test_defer_does_not_count_attempt(self):
+        for attempts_tracking in ('stats_job', 'message'):
+            self.qa.config.set('attempts_tracking', attempts_tracking)
+            await self.qa.enqueue(Message(payload='hello world'))
+            await self.qa.rollback(await self.qa.dequeue())
+            for _ in range(3):
+                await self.qa.defer(await self.qa.dequeue())
+
+            dq = await self.qa.dequeue()
+            self.assertEqual(dq.attempts, 1)
+            await self.qa.commit(dq)
+
+    async def test_concurrent_commands(self):
+        messages = await asyncio.gather(*[self.qa.enqueue(Message(payload=f'hello world {i}')) for i in range(20)])
+        dequeued = await asyncio.gather(*[self.qa.dequeue() for _ in range(20)])
+        self.assertEqual(sorted(m.id for m in dequeued), sorted(m.id for m in messages))
+        await asyncio.gather(*[self.qa.commit(m) for m in dequeued])
+
+        stats = await self.qa.beanstalk_stat()
+        self.assertEqual(stats['cmd-delete'], 20)
+
+    async def test_pulpo(self):
+        pulpo = AsyncPulpo(options={'shutdown_after_number_of_empty_iterations': 1, 'sleep_duration': 0.001}, queue_adapter=self.qa)
+        handler = AsyncSleepHandler()
+        pulpo.handler_registry.register('sleep', handler)
+        for _ in range(10):
+            await pulpo.publish(Message(payload='0.2', request_type='sleep'))
+
+        await pulpo.start()
+
+        self.assertEqual(handler.max_running, 10)
+        stats = await self.qa.beanstalk_stat()
+        self.assertEqual(stats['cmd-delete'], 10)
@@ -1,7 +1,9 @@
 import os
 import time
 import subprocess
+import threading
 import unittest
+import unittest.mock
 import datetime
 from typing import Callable
 from greenstalk import (DEFAULT_TUBE, Address, Client)
@@ -223,6 +225,34 @@ class TestBeanstalkQueueAdapterDelay(unittest.TestCase):
         assert dq_2
         assert dq_2.id == m1.id
 
+    @with_beanstalkd(reserve_timeout=None)
+    def test_rollback_with_delay(self, qa: BeanstalkdQueueAdapter):
+        m1 = qa.enqueue(Message(payload='hello world'))
+        # rounded up to whole seconds
+        qa.rollback(qa.dequeue(), delay=0.5)
+
+        assert not qa.dequeue()
+        time.sleep(1)
+
+        dq = qa.dequeue()
+        assert dq
+        assert dq.id == m1.id
+
+    @with_beanstalkd(reserve_timeout=None, max_number_of_attempts=2)
+    def test_rollback_with_delay_attempts_tracked_in_message(self, qa: BeanstalkdQueueAdapter):
+        qa.config.set('attempts_tracking', 'message')
+        qa.enqueue(Message(payload='hello world'))
+        dq_1 = qa.dequeue()
+        qa.rollback(dq_1, delay=1)
+
+        assert not qa.dequeue()
+        time.sleep(1)
+
+        dq_2 = qa.dequeue()
+        assert dq_2
+        assert dq_2.id == dq_1.id
+        assert dq_2.attempts == 1
+
     @with_beanstalkd(reserve_timeout=None)
     def test_reserve_with_delay_access_another_message(self, qa: BeanstalkdQueueAdapter):
         delay = 1
@@ -359,6 +389,62 @@ class TestBqaMaxAttempts(unittest.TestCase):
         self.assertIsNotNone(dq_3)
         self.assertEqual(dq_3.id, m2.id)
 
+    @with_beanstalkd(reserve_timeout=None, max_number_of_attempts=2)
+    def test_attempts_tracked_in_message(self, qa: BeanstalkdQueueAdapter):
+        qa.config.set('attempts_tracking', 'message')
+        m1 = qa.enqueue(Message(payload='hello world', priority=5))
+
+        dq_1 = qa.dequeue()
+        self.assertEqual(dq_1.id, m1.id)
+        self.assertEqual(dq_1.attempts, 0)
+        qa.rollback(dq_1)
+        self.assertNotEqual(dq_1.id, m1.id)
+
+        dq_2 = qa.dequeue()
+        self.assertEqual(dq_2.id, dq_1.id)
+        self.assertEqual(dq_2.attempts, 1)
+        self.assertEqual(dq_2.priority, 5)
+        self.assertEqual(dq_2.payload, 'hello world')
+        qa.rollback(dq_2)
+
+        self.assertIsNone(qa.dequeue())
+        self.assertEqual(qa.beanstalk_stat()['current-jobs-ready'], 0)
+        self.assertNotIn('cmd-stats-job', qa.client.stats())
+
+    @with_beanstalkd(reserve_timeout=None, max_number_of_attempts=2)
+    def test_attempts_tracked_in_message_fall_back_to_stats_job(self, qa: BeanstalkdQueueAdapter):
+        # put, and released, by an adapter tracking attempts with stats-job
+        m1 = qa.enqueue(Message(payload='hello world'))
+        qa.rollback(qa.dequeue())
+
+        qa.config.set('attempts_tracking', 'message')
+        dq_1 = qa.dequeue()
+        self.assertEqual(dq_1.id, m1.id)
+        self.assertEqual(dq_1.attempts, 1)
+
+    @with_beanstalkd(reserve_timeout=None, max_number_of_attempts=2)
+    def test_defer_does_not_count_attempt(self, qa: BeanstalkdQueueAdapter):
+        qa.enqueue(Message(payload='hello world'))
+        qa.rollback(qa.dequeue())
+        for _ in range(3):
+            qa.defer(qa.dequeue())
+
+        dq = qa.dequeue()
+        self.assertIsNotNone(dq)
+        self.assertEqual(dq.attempts, 1)
+
+    @with_beanstalkd(reserve_timeout=None, max_number_of_attempts=2)
+    def test_defer_does_not_count_attempt_tracked_in_message(self, qa: BeanstalkdQueueAdapter):
+        qa.config.set('attempts_tracking', 'message')
+        qa.enqueue(Message(payload='hello world'))
+        qa.rollback(qa.dequeue())
+        for _ in range(3):
+            qa.defer(qa.dequeue())
+
+        dq = qa.dequeue()
+        self.assertIsNotNone(dq)
+        self.assertEqual(dq.attempts, 1)
+
 
 class TestBeanstalkQueueAdapterStats():
 
@@ -441,4 +527,317 @@ class TestBeanstalkQueueAdapterStats():
         assert stats['total-jobs'] == 4
 
 
+class TestBeanstalkQueueAdapterDequeueBatch(unittest.TestCase):
+
+    @with_beanstalkd()
+    def test_dequeue_batch(self, qa: BeanstalkdQueueAdapter):
+        enqueued = [qa.enqueue(Message(payload=f'hello world {i}')).id for i in range(5)]
+
+        batch_1 = qa.dequeue_batch(max_messages=3)
+        self.assertEqual([m.id for m in batch_1], enqueued[:3])
+
+        batch_2 = qa.dequeue_batch(max_messages=3)
+        self.assertEqual([m.id for m in batch_2], enqueued[3:])
+        self.assertEqual(batch_2[1].payload, 'hello world 4')
+
+        self.assertEqual(qa.dequeue_batch(max_messages=3), [])
+
+        stats = qa.beanstalk_stat()
+        assert stats['current-jobs-reserved'] == 5
+
+    @with_beanstalkd()
+    def test_dequeue_batch_commit_and_rollback(self, qa: BeanstalkdQueueAdapter):
+        qa.enqueue(Message(payload='hello world 1'))
+        qa.enqueue(Message(payload='hello world 2'))
+
+        (dq_1, dq_2) = qa.dequeue_batch(max_messages=2)
+        qa.commit(dq_1)
+        qa.rollback(dq_2)
+
+        batch = qa.dequeue_batch(max_messages=2)
+        self.assertEqual([m.id for m in batch], [dq_2.id])
+
+    @with_beanstalkd(reserve_timeout=None)
+    def test_dequeue_batch_skips_expired(self, qa: BeanstalkdQueueAdapter):
+        expiration_date_in_past = datetime.datetime.strptime("2000-01-01 12:00:00", "%Y-%m-%d %H:%M:%S")
+        qa.enqueue(Message(payload='hello world', expiration=expiration_date_in_past))
+        m2 = qa.enqueue(Message(payload='hello world'))
+
+        batch = qa.dequeue_batch(max_messages=2)
+        self.assertEqual([m.id for m in batch], [m2.id])
+
+
+class TestBeanstalkQueueAdapterWaitForMessage(unittest.TestCase):
+
+    @with_beanstalkd()
+    def test_wait_timeout(self, qa: BeanstalkdQueueAdapter):
+        start = time.monotonic()
+        self.assertFalse(qa.wait_for_message(timeout=1))
+        self.assertAlmostEqual(time.monotonic() - start, 1, delta=0.5)
+
+    @with_beanstalkd()
+    def test_wait_holds_reserved_job_for_dequeue(self, qa: BeanstalkdQueueAdapter):
+        m1 = qa.enqueue(Message(payload='hello world'))
+
+        self.assertTrue(qa.wait_for_message(timeout=1))
+        stats = qa.beanstalk_stat()
+        assert stats['current-jobs-reserved'] == 1
+
+        dq = qa.dequeue()
+        self.assertEqual(dq.id, m1.id)
+        qa.commit(dq)
+        self.assertIsNone(qa.dequeue())
+
+    @with_beanstalkd()
+    def test_wait_then_dequeue_batch(self, qa: BeanstalkdQueueAdapter):
+        enqueued = [qa.enqueue(Message(payload=f'hello world {i}')).id for i in range(3)]
+
+        self.assertTrue(qa.wait_for_message(timeout=1))
+        batch = qa.dequeue_batch(max_messages=3)
+        self.assertEqual([m.id for m in batch], enqueued)
+
+
+class TestBeanstalkQueueAdapterEnqueueBatch(unittest.TestCase):
+
+    @with_beanstalkd()
+    def test_enqueue_batch(self, qa: BeanstalkdQueueAdapter):
+        messages = qa.enqueue_batch([Message(payload=f'hello world {i}') for i in range(5)])
+        self.assertEqual(len(messages), 5)
+        self.assertEqual(len(set(m.id for m in messages)), 5)
+
+        batch = qa.dequeue_batch(max_messages=5)
+        self.assertEqual([m.id for m in batch], [m.id for m in messages])
+        self.assertEqual(batch[4].payload, 'hello world 4')
+
+    @with_beanstalkd()
+    def test_enqueue_batch_in_chunks(self, qa: BeanstalkdQueueAdapter):
+        qa.config.set('enqueue_batch_chunk_size', 2)
+        messages = qa.enqueue_batch([Message(payload=f'hello world {i}') for i in range(5)])
+        self.assertEqual(len(messages), 5)
+
+        stats = qa.beanstalk_stat()
+        assert stats['total-jobs'] == 5
+
+    @with_beanstalkd()
+    def test_enqueue_batch_with_delay(self, qa: BeanstalkdQueueAdapter):
+        qa.enqueue_batch([Message(payload='later', delay=datetime.timedelta(seconds=60)), Message(payload='now')])
+
+        batch = qa.dequeue_batch(max_messages=2)
+        self.assertEqual([m.payload for m in batch], ['now'])
+
+
+class TestBeanstalkQueueAdapterPriority(unittest.TestCase):
+
+    @with_beanstalkd()
+    def test_dequeue_in_priority_order(self, qa: BeanstalkdQueueAdapter):
+        low = qa.enqueue(Message(payload='low', priority=100))
+        qa.enqueue_batch([Message(payload='batch', priority=50)])
+        high = qa.enqueue(Message(payload='high', priority=1))
+
+        self.assertEqual(qa.dequeue().id, high.id)
+        self.assertEqual(qa.dequeue().payload, 'batch')
+        self.assertEqual(qa.dequeue().id, low.id)
+
+    @with_beanstalkd()
+    def test_rollback_keeps_priority(self, qa: BeanstalkdQueueAdapter):
+        m1 = qa.enqueue(Message(payload='hello world', priority=3))
+        qa.rollback(qa.dequeue())
+
+        self.assertEqual(qa._stats_job(int(m1.id))['pri'], 3)
+
+    @with_beanstalkd()
+    def test_rollback_ages_priority(self, qa: BeanstalkdQueueAdapter):
+        qa.config.set('priority_aging_interval', 0.001)
+        m1 = qa.enqueue(Message(payload='hello world', priority=3))
+        time.sleep(1)
+        qa.rollback(qa.dequeue())
+
+        self.assertEqual(qa._stats_job(int(m1.id))['pri'], 0)
+
+
+class TestBeanstalkQueueAdapterTubes(unittest.TestCase):
+
+    @staticmethod
+    def consumer_factory(qa: BeanstalkdQueueAdapter, additional_options: dict) -> BeanstalkdQueueAdapter:
+        options = {'host': qa.config.host, 'port': qa.config.port, **additional_options}
+        return BeanstalkdQueueAdapter(options=options)
+
+    @with_beanstalkd()
+    def test_route_by_request_type(self, qa: BeanstalkdQueueAdapter):
+        qa.config.set('tube_routes', {'bulk': 'bulk-tube'})
+        qa.enqueue(Message(payload='bulk', request_type='bulk'))
+        qa.enqueue(Message(payload='other', request_type='echo'))
+        qa.enqueue_batch([Message(payload='bulk', request_type='bulk'), Message(payload='other', request_type='echo'), Message(payload='bulk', request_type='bulk')])
+
+        self.assertEqual(qa.beanstalk_stat('bulk-tube')['current-jobs-ready'], 3)
+        self.assertEqual(qa.beanstalk_stat()['current-jobs-ready'], 2)
+
+    @with_beanstalkd()
+    def test_weighted_consumption(self, qa: BeanstalkdQueueAdapter):
+        qa.config.set('tube_routes', {'bulk': 'bulk-tube', 'interactive': 'interactive-tube'})
+        qa.enqueue_batch([Message(payload=f'bulk {i}', request_type='bulk') for i in range(8)])
+        qa.enqueue_batch([Message(payload=f'interactive {i}', request_type='interactive') for i in range(8)])
+
+        consumer = TestBeanstalkQueueAdapterTubes.consumer_factory(qa, {'watch_tubes': {'bulk-tube': 1, 'interactive-tube': 3}})
+        request_types = [m.request_type for m in consumer.dequeue_batch(max_messages=8)]
+        self.assertEqual(request_types.count('interactive'), 6)
+        self.assertEqual(request_types.count('bulk'), 2)
+
+    @with_beanstalkd()
+    def test_tube_concurrency_limit(self, qa: BeanstalkdQueueAdapter):
+        qa.config.set('tube_routes', {'bulk': 'bulk-tube'})
+        qa.enqueue_batch([Message(payload=f'bulk {i}', request_type='bulk') for i in range(2)])
+        other = qa.enqueue(Message(payload='other', request_type='echo'))
+
+        consumer = TestBeanstalkQueueAdapterTubes.consumer_factory(qa, {'watch_tubes': ['bulk-tube', qa.config.default_tube], 'tube_concurrency_limits': {'bulk-tube': 1}})
+        m1 = consumer.dequeue()
+        m2 = consumer.dequeue()
+        self.assertEqual({m1.request_type, m2.request_type}, {'bulk', 'echo'})
+        self.assertIsNone(consumer.dequeue())
+
+        consumer.commit(m1 if m1.request_type == 'bulk' else m2)
+        self.assertEqual(consumer.dequeue().request_type, 'bulk')
+        self.assertEqual(qa.peek(other.id).payload, 'other')
+
+    @with_beanstalkd()
+    def test_pause_request_type(self, qa: BeanstalkdQueueAdapter):
+        qa.config.set('tube_routes', {'bulk': 'bulk-tube'})
+        qa.enqueue(Message(payload='bulk', request_type='bulk'))
+        other = qa.enqueue(Message(payload='other', request_type='echo'))
+        consumer = TestBeanstalkQueueAdapterTubes.consumer_factory(qa, {'watch_tubes': ['bulk-tube', qa.config.default_tube], 'tube_routes': {'bulk': 'bulk-tube'}})
+
+        self.assertTrue(consumer.pause_request_type('bulk', duration=0.5))
+        # a request type on the default tube cannot be held back alone
+        self.assertFalse(consumer.pause_request_type('echo', duration=0.5))
+        self.assertEqual(consumer.dequeue().id, other.id)
+        self.assertIsNone(consumer.dequeue())
+
+        time.sleep(1)
+        self.assertEqual(consumer.dequeue().request_type, 'bulk')
+
+    @with_beanstalkd()
+    def test_wait_on_watch_tubes(self, qa: BeanstalkdQueueAdapter):
+        qa.config.set('tube_routes', {'bulk': 'bulk-tube'})
+        consumer = TestBeanstalkQueueAdapterTubes.consumer_factory(qa, {'watch_tubes': ['bulk-tube', 'interactive-tube']})
+        self.assertFalse(consumer.wait_for_message(timeout=1))
+
+        m1 = qa.enqueue(Message(payload='bulk', request_type='bulk'))
+        self.assertTrue(consumer.wait_for_message(timeout=1))
+        self.assertEqual(consumer.dequeue().id, m1.id)
+
+    @with_beanstalkd()
+    def test_tube_of_waited_job_from_tube_routes(self, qa: BeanstalkdQueueAdapter):
+        qa.config.set('tube_routes', {'bulk': 'bulk-tube'})
+        options = {'watch_tubes': ['bulk-tube', qa.config.default_tube], 'tube_routes': {'bulk': 'bulk-tube'}, 'tube_concurrency_limits': {'bulk-tube': 1}}
+        consumer = TestBeanstalkQueueAdapterTubes.consumer_factory(qa, options)
+        qa.enqueue_batch([Message(payload=f'bulk {i}', request_type='bulk') for i in range(2)])
+
+        with unittest.mock.patch.object(consumer, '_stats_job', side_effect=AssertionError('stats-job')):
+            self.assertTrue(consumer.wait_for_message(timeout=1))
+            m1 = consumer.dequeue()
+        self.assertEqual(m1.request_type, 'bulk')
+        # counted against the limit of bulk-tube
+        self.assertIsNone(consumer.dequeue())
+
+
+class TestBeanstalkQueueAdapterMessageFormat(unittest.TestCase):
+
+    @with_beanstalkd()
+    def test_mixed_message_formats(self, qa: BeanstalkdQueueAdapter):
+        enqueued = []
+        for message_format in ('json', 'json-compact', 'struct'):
+            qa.config.set('message_format', message_format)
+            enqueued.append(qa.enqueue(Message(payload=f'hello {message_format}', request_type='echo')))
+        qa.enqueue_batch([Message(payload='hello batch')])
+
+        batch = qa.dequeue_batch(max_messages=4)
+        self.assertEqual([m.payload for m in batch], ['hello json', 'hello json-compact', 'hello struct', 'hello batch'])
+        self.assertEqual([m.request_type for m in batch[:3]], ['echo'] * 3)
+        self.assertEqual(qa.peek(enqueued[2].id).payload, 'hello struct')
+
+
+class TestBeanstalkQueueAdapterConnectionPool(unittest.TestCase):
+
+    @with_beanstalkd()
+    def test_concurrent_enqueue(self, qa: BeanstalkdQueueAdapter):
+        barrier = threading.Barrier(4)
+
+        def publish(thread_number: int):
+            barrier.wait()
+            for i in range(10):
+                qa.enqueue(Message(payload=f'hello {thread_number} {i}'))
+
+        threads = [threading.Thread(target=publish, args=(thread_number, )) for thread_number in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertGreater(qa.pool.size, 1)
+        self.assertLessEqual(qa.pool.size, qa.config.connection_pool_size)
+        self.assertEqual(qa.beanstalk_stat()['current-jobs-ready'], 40)
+
+    @with_beanstalkd()
+    def test_commit_on_reserving_connection(self, qa: BeanstalkdQueueAdapter):
+        qa.enqueue(Message(payload='hello world'))
+        # hold the idle connection, so that the reserve runs on a second connection
+        with qa.pool.connection():
+            m1 = qa.dequeue()
+        self.assertEqual(qa.pool.size, 2)
+
+        qa.commit(m1)
+        self.assertEqual(qa.beanstalk_stat()['current-jobs-reserved'], 0)
+        self.assertEqual(qa.beanstalk_stat()['cmd-delete'], 1)
+
+    @with_beanstalkd()
+    def test_commit_after_connection_lost(self, qa: BeanstalkdQueueAdapter):
+        qa.enqueue(Message(payload='hello world'))
+        m1 = qa.dequeue()
+        # the connection holding the job is lost: beanstalkd releases the job, and another consumer reserves it
+        with qa.pool.connection(job_id=int(m1.id)) as connection:
+            qa.pool._disconnect(connection)
+        consumer = TestBeanstalkQueueAdapterTubes.consumer_factory(qa, {'default_tube': qa.config.default_tube})
+        self.assertEqual(consumer.dequeue().id, m1.id)
+
+        qa.commit(m1)
+        qa.delete(m1.id)
+        self.assertEqual(qa.beanstalk_stat()['current-jobs-reserved'], 1)
+
+    @with_beanstalkd()
+    def test_rollback_from_other_thread(self, qa: BeanstalkdQueueAdapter):
+        m1 = qa.enqueue(Message(payload='hello world'))
+        dequeued = qa.dequeue()
+
+        thread = threading.Thread(target=qa.rollback, args=(dequeued, ))
+        thread.start()
+        thread.join()
+        self.assertEqual(qa._stats_job(int(m1.id))['releases'], 1)
+
+    def test_reconnect_after_restart(self):
+        address = ('127.0.0.1', 4445)
+        cmd = [BEANSTALKD_PATH, '-l', address[0], '-p', str(address[1])]
+        with subprocess.Popen(cmd) as beanstalkd:
+            time.sleep(0.1)
+            qa = BeanstalkdQueueAdapter(options={'host': address[0], 'port': address[1], 'reserve_timeout': 1, 'health_check_interval': 0})
+            qa.enqueue(Message(payload='before restart'))
+            beanstalkd.terminate()
+            beanstalkd.wait()
+
+        with subprocess.Popen(cmd) as beanstalkd:
+            time.sleep(0.1)
+            try:
+                m1 = qa.enqueue(Message(payload='after restart'))
+                m2 = qa.dequeue()
+                self.assertEqual(m2.id, m1.id)
+                qa.commit(m2)
+            finally:
+                qa.close()
+                beanstalkd.terminate()
+
+    def test_connect_gives_up(self):
+        options = {'host': '127.0.0.1', 'port': 4446, 'reconnect_initial_delay': 0.01, 'reconnect_max_attempts': 3}
+        with self.assertRaises(ConnectionError):
+            BeanstalkdQueueAdapter(options=options)
+
+
 # pylint: enable=duplicate-code
@@ -0,0 +1,63 @@
+import os
+import unittest
+from pulpo_messaging import inotify
+from pulpo_messaging.change_feed import ChangeFeed
+from .unittest_helper import get_unique_base_path
+
+
+@unittest.skipUnless(inotify.is_available(), 'inotify not available')
+class TestChangeFeed(unittest.TestCase):
+
+    @staticmethod
+    def change_feed_factory() -> ChangeFeed:
+        base_path = get_unique_base_path('change-feed')
+        os.makedirs(os.path.join(base_path, 'lock'))
+        feed = ChangeFeed(base_path=base_path, lock_path=os.path.join(base_path, 'lock'), resync_interval=60)
+        feed.resync(queued_file_names=[], locked_file_names=[])
+        return feed
+
+    @staticmethod
+    def write(path: str):
+        with open(path, mode='w', encoding='utf-8') as f:
+            f.write('hello world')
+
+    def test_resync_is_due_until_first_resync(self):
+        base_path = get_unique_base_path('change-feed')
+        os.makedirs(os.path.join(base_path, 'lock'))
+        feed = ChangeFeed(base_path=base_path, lock_path=os.path.join(base_path, 'lock'), resync_interval=60)
+        self.assertTrue(feed.is_resync_due)
+        feed.resync(queued_file_names=['a.message'], locked_file_names=['b.message.lock'])
+        self.assertFalse(feed.is_resync_due)
+        self.assertEqual(feed.get_queued_file_name('a'), 'a.message')
+        self.assertTrue(feed.is_locked('b'))
+
+    def test_poll_applies_events_in_order(self):
+        feed = self.change_feed_factory()
+        base_path = feed._base_path
+        file_name = '0000065536-001700000000000-000000000000000-abc.message'
+
+        self.write(os.path.join(base_path, file_name))
+        os.rename(os.path.join(base_path, file_name), os.path.join(base_path, 'lock', 'abc.message.lock'))
+        os.rename(os.path.join(base_path, 'lock', 'abc.message.lock'), os.path.join(base_path, file_name))
+
+        self.assertEqual(feed.poll(), [(file_name, True), (file_name, False), (file_name, True)])
+        self.assertEqual(feed.get_queued_file_name('abc'), file_name)
+        self.assertFalse(feed.is_locked('abc'))
+
+    def test_lock_and_remove(self):
+        feed = self.change_feed_factory()
+        base_path = feed._base_path
+        self.write(os.path.join(base_path, 'abc.message'))
+        os.rename(os.path.join(base_path, 'abc.message'), os.path.join(base_path, 'lock', 'abc.message.lock'))
+        feed.poll()
+        self.assertIsNone(feed.get_queued_file_name('abc'))
+        self.assertTrue(feed.is_locked('abc'))
+
+        os.remove(os.path.join(base_path, 'lock', 'abc.message.lock'))
+        feed.poll()
+        self.assertFalse(feed.is_locked('abc'))
+
+    def test_ignores_other_files(self):
+        feed = self.change_feed_factory()
+        self.write(os.path.join(feed._base_path, 'readme.txt'))
+        self.assertEqual(feed.poll(), [])
@@ -0,0 +1,74 @@
+import time
+import unittest
+from pulpo_messaging.circuit_breaker import STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN, CircuitBreaker, CircuitBreakers
+from pulpo_messaging.payload_handler import RequestResult
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    @staticmethod
+    def circuit_breaker_factory(additional_options: dict = None) -> CircuitBreaker:
+        options = {'window_size': 4, 'minimum_calls': 4, 'failure_rate_threshold': 0.5, 'open_duration': 0.1}
+        options.update(additional_options or {})
+        return CircuitBreaker(request_type='sample', options=options)
+
+    def test_opens_at_failure_rate_threshold(self):
+        breaker = self.circuit_breaker_factory()
+        self.assertFalse(breaker.record(is_failure=True))
+        self.assertFalse(breaker.record(is_failure=False))
+        self.assertFalse(breaker.record(is_failure=False))
+        self.assertEqual(breaker.state, STATE_CLOSED)
+        # 2 failures in the last 4 calls
+        self.assertTrue(breaker.record(is_failure=True))
+        self.assertEqual(breaker.state, STATE_OPEN)
+        self.assertFalse(breaker.allow_request())
+        self.assertGreater(breaker.get_hold_duration(), 0)
+
+    def test_failure_rate_over_window(self):
+        breaker = self.circuit_breaker_factory()
+        for is_failure in (True, False, False, False, False, True):
+            self.assertFalse(breaker.record(is_failure=is_failure))
+        self.assertEqual(breaker.state, STATE_CLOSED)
+
+    def test_half_open_probe_success_closes(self):
+        breaker = self.circuit_breaker_factory({'minimum_calls': 1})
+        breaker.record(is_failure=True)
+        time.sleep(0.1)
+
+        self.assertEqual(breaker.state, STATE_HALF_OPEN)
+        self.assertTrue(breaker.allow_request())
+        # one probe at a time
+        self.assertFalse(breaker.allow_request())
+        self.assertEqual(breaker.get_hold_duration(), CircuitBreaker.HALF_OPEN_HOLD_DURATION)
+
+        breaker.record(is_failure=False)
+        self.assertEqual(breaker.state, STATE_CLOSED)
+        self.assertTrue(breaker.allow_request())
+
+    def test_half_open_probe_failure_reopens(self):
+        breaker = self.circuit_breaker_factory({'minimum_calls': 1})
+        breaker.record(is_failure=True)
+        time.sleep(0.1)
+
+        self.assertTrue(breaker.allow_request())
+        self.assertTrue(breaker.record(is_failure=True))
+        self.assertEqual(breaker.state, STATE_OPEN)
+
+
+class TestCircuitBreakers(unittest.TestCase):
+
+    def test_breaker_of_request_type_then_default(self):
+        breakers = CircuitBreakers(breakers={'email': {'open_duration': 5}}, default_breaker={'open_duration': 60})
+        self.assertEqual(breakers.get('email').config.open_duration, 5)
+        self.assertEqual(breakers.get('print').config.open_duration, 60)
+        self.assertIsNot(breakers.get('print'), breakers.get('label'))
+        self.assertIsNone(CircuitBreakers(breakers={'email': {'open_duration': 5}}).get('print'))
+
+    def test_fatal_results_not_counted(self):
+        breakers = CircuitBreakers(default_breaker={'minimum_calls': 1, 'open_duration': 60})
+        self.assertIsNone(breakers.record('email', RequestResult.fatal_factory(error='bad address')))
+        self.assertIsNone(breakers.get_hold_duration('email'))
+
+        self.assertEqual(breakers.record('email', RequestResult.transient_factory(error='smtp down')), 60)
+        self.assertGreater(breakers.get_hold_duration('email'), 59)
+        self.assertIsNone(breakers.get_hold_duration('print'))
@@ -0,0 +1,151 @@
+import os
+import unittest
+import datetime
+from pulpo_messaging import inotify
+from pulpo_messaging.file_queue_layout import FileQueueLayout
+from pulpo_messaging.kessel import FileQueueAdapter
+from pulpo_messaging.kessel import QueueAdapter
+from pulpo_messaging.kessel import Message
+from . import test_fqa
+from .unittest_helper import get_unique_base_path
+
+
+class TestFileQueueLayout(unittest.TestCase):
+
+    def test_flat(self):
+        layout = FileQueueLayout(base_path='/q', lock_path='/q/lock')
+        self.assertEqual(layout.queue_directories, ['/q'])
+        self.assertEqual(layout.lock_directories, ['/q/lock'])
+        self.assertEqual(layout.get_queue_directory('abc'), '/q')
+        self.assertEqual(layout.get_lock_directory('abc'), '/q/lock')
+        self.assertTrue(layout.is_queue_directory('/q'))
+
+    def test_sharded(self):
+        layout = FileQueueLayout(base_path='/q', lock_path='/q/lock', shard_count=4)
+        self.assertEqual(layout.queue_directories, ['/q/000', '/q/001', '/q/002', '/q/003'])
+        shard_name = layout.get_shard_name('abc')
+        self.assertIn(shard_name, layout.shard_names)
+        self.assertEqual(layout.get_queue_directory('abc'), f'/q/{shard_name}')
+        self.assertEqual(layout.get_lock_directory('abc'), f'/q/lock/{shard_name}')
+        self.assertTrue(layout.is_queue_directory(f'/q/{shard_name}'))
+        self.assertFalse(layout.is_queue_directory('/q'))
+        self.assertFalse(layout.is_queue_directory('/q/lock'))
+
+    def test_shards_are_balanced(self):
+        layout = FileQueueLayout(base_path='/q', lock_path='/q/lock', shard_count=8)
+        shard_names = [layout.get_shard_name(f'1700000000.{i}-id') for i in range(800)]
+        for shard_name in layout.shard_names:
+            self.assertGreater(shard_names.count(shard_name), 50)
+
+    def test_invalid_shard_count(self):
+        with self.assertRaises(Exception):
+            FileQueueLayout(base_path='/q', lock_path='/q/lock', shard_count=-1)
+
+
+class TestFqaShardedCompliance(test_fqa.TestFqaCompliance):
+
+    def queue_adapter_factory(self) -> QueueAdapter:
+        options = {}
+        options['base_path'] = get_unique_base_path('fqa-sharded-compliance')
+        # order is kept within a shard only; the compliance tests expect first in first out
+        options['shard_count'] = 1
+        return FileQueueAdapter(options=options)
+
+
+@unittest.skipUnless(inotify.is_available(), 'inotify not available')
+class TestFqaShardedChangeFeedCompliance(test_fqa.TestFqaCompliance):
+
+    def queue_adapter_factory(self) -> QueueAdapter:
+        options = {}
+        options['base_path'] = get_unique_base_path('fqa-sharded-change-feed-compliance')
+        options['shard_count'] = 1
+        options['enable_change_feed'] = True
+        return FileQueueAdapter(options=options)
+
+
+class TestFqaSharded(unittest.TestCase):
+
+    @staticmethod
+    def sharded_queue_adapter_factory(additional_options=None) -> FileQueueAdapter:
+        options = {'shard_count': 4}
+        options.update(additional_options or {})
+        return test_fqa.TestFqa.file_queue_adapter_factory(tag='fqa-sharded', additional_options=options)
+
+    def test_message_files_are_sharded(self):
+        qa = self.sharded_queue_adapter_factory()
+        m1 = qa.enqueue(Message(payload='hello world'))
+        shard_name = qa._layout.get_shard_name(m1.id)
+        self.assertEqual(len(os.listdir(os.path.join(qa.config.base_path, shard_name))), 1)
+        self.assertEqual(qa.lookup_message_state(m1.id), 'queue')
+        self.assertEqual(qa.peek(m1.id).payload, 'hello world')
+
+        dq = qa.dequeue()
+        self.assertEqual(dq.id, m1.id)
+        self.assertTrue(os.path.exists(os.path.join(qa.config.lock_path, shard_name, f'{m1.id}.message.lock')))
+        self.assertEqual(qa.lookup_message_state(m1.id), 'lock')
+        self.assertEqual(qa.peek(m1.id).payload, 'hello world')
+
+        qa.commit(dq)
+        self.assertEqual(qa.lookup_message_state(m1.id), 'complete.success')
+
+    def test_dequeue_from_every_shard(self):
+        qa = self.sharded_queue_adapter_factory()
+        messages = qa.enqueue_batch([Message(payload=f'hello {i}') for i in range(20)])
+        self.assertGreater(len({qa._layout.get_shard_name(m.id) for m in messages}), 1)
+
+        dequeued = [qa.dequeue() for _ in range(20)]
+        self.assertEqual(sorted(m.id for m in dequeued), sorted(m.id for m in messages))
+        self.assertIsNone(qa.dequeue())
+
+    def test_dequeue_batch_across_shards(self):
+        qa = self.sharded_queue_adapter_factory()
+        messages = qa.enqueue_batch([Message(payload=f'hello {i}') for i in range(10)])
+        batch = qa.dequeue_batch(max_messages=20)
+        self.assertEqual(sorted(m.id for m in batch), sorted(m.id for m in messages))
+
+    def test_scan_starts_at_rotating_shard(self):
+        qa = self.sharded_queue_adapter_factory()
+        first_directories = [qa._get_scan_directories()[0] for _ in range(4)]
+        self.assertEqual(sorted(first_directories), qa._layout.queue_directories)
+
+    def test_rollback(self):
+        qa = self.sharded_queue_adapter_factory(additional_options={'enable_ready_index': True})
+        m1 = qa.enqueue(Message(payload='hello world'))
+        qa.rollback(qa.dequeue())
+
+        dq = qa.dequeue()
+        self.assertEqual(dq.id, m1.id)
+        self.assertEqual(dq.attempts, 1)
+
+    def test_delayed_directory(self):
+        qa = self.sharded_queue_adapter_factory(additional_options={'enable_delayed_directory': True, 'delayed_promotion_interval': 0})
+        m1 = qa.enqueue(Message(payload='hello world', delay=datetime.datetime.now() + datetime.timedelta(seconds=1)))
+        self.assertEqual(qa.lookup_message_state(m1.id), 'queue')
+        self.assertIsNone(qa.dequeue())
+
+        self.assertTrue(qa.wait_for_message(timeout=5))
+        self.assertEqual(qa.dequeue().id, m1.id)
+
+    def test_migrate_from_flat_layout(self):
+        flat_qa = test_fqa.TestFqa.file_queue_adapter_factory(tag='fqa-sharded-migrate')
+        messages = flat_qa.enqueue_batch([Message(payload=f'hello {i}') for i in range(10)])
+        locked = flat_qa.dequeue()
+
+        qa = FileQueueAdapter(options={'base_path': flat_qa.config.base_path, 'shard_count': 4, 'migrate_layout_on_start': True})
+        self.assertEqual(qa.lookup_message_state(locked.id), 'lock')
+        qa.commit(locked)
+
+        dequeued = qa.dequeue_batch(max_messages=20)
+        self.assertEqual(sorted(m.id for m in dequeued + [locked]), sorted(m.id for m in messages))
+        self.assertEqual([name for name in os.listdir(qa.config.base_path) if name.endswith('.message')], [])
+
+    def test_migrate_to_flat_layout(self):
+        qa = self.sharded_queue_adapter_factory()
+        messages = qa.enqueue_batch([Message(payload=f'hello {i}') for i in range(10)])
+
+        flat_qa = FileQueueAdapter(options={'base_path': qa.config.base_path})
+        self.assertEqual(flat_qa.migrate_layout(), 10)
+        self.assertFalse(any(os.path.isdir(os.path.join(qa.config.base_path, shard_name)) for shard_name in qa._layout.shard_names))
+
+        dequeued = flat_qa.dequeue_batch(max_messages=20)
+        self.assertEqual(sorted(m.id for m in dequeued), sorted(m.id for m in messages))
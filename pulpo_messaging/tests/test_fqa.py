@@ -1,11 +1,15 @@
 import os
+import threading
 import unittest
+import unittest.mock
 import time
 import datetime
 from datetime import timedelta
+from pulpo_messaging import inotify
 from pulpo_messaging.kessel import FileQueueAdapter
 from pulpo_messaging.kessel import QueueAdapter
 from pulpo_messaging.kessel import Message
+from pulpo_messaging.message_file_name import MessageFileName
 from .unittest_helper import get_unique_base_path
 
 
@@ -146,6 +150,31 @@ class TestFqaCompliance(unittest.TestCase):
         dq_3 = qa.dequeue()
         self.assertIsNotNone(dq_3)
 
+    def test_rollback_with_delay(self):
+        qa = self.queue_adapter_factory()
+        m1 = qa.enqueue(Message(payload='hello world'))
+        qa.rollback(qa.dequeue(), delay=0.3)
+
+        # because of the rollback delay, the message should not be available yet
+        self.assertIsNone(qa.dequeue())
+
+        dq = qa.dequeue_batch(max_messages=1, timeout=5)
+        self.assertEqual([m.id for m in dq], [m1.id])
+        self.assertEqual(dq[0].attempts, 1)
+
+    def test_defer_does_not_count_attempt(self):
+        qa = self.queue_adapter_factory()
+        m1 = qa.enqueue(Message(payload='hello world'))
+        qa.rollback(qa.dequeue())
+        qa.defer(qa.dequeue(), delay=0.3)
+
+        # because of the defer delay, the message should not be available yet
+        self.assertIsNone(qa.dequeue())
+
+        dq = qa.dequeue_batch(max_messages=1, timeout=5)
+        self.assertEqual([m.id for m in dq], [m1.id])
+        self.assertEqual(dq[0].attempts, 1)
+
 
 class TestFqa(unittest.TestCase):
 
@@ -343,3 +372,588 @@ class TestFqaExpiration(unittest.TestCase):
 
         # ensure that message is locked
         self.assertEqual(qa.lookup_message_state(m1.id), 'lock')
+
+
+class TestFqaReadyIndexCompliance(TestFqaCompliance):
+
+    def queue_adapter_factory(self) -> QueueAdapter:
+        options = {}
+        options['base_path'] = get_unique_base_path('fqa-ready-index-compliance')
+        options['enable_ready_index'] = True
+        return FileQueueAdapter(options=options)
+
+
+class TestFqaReadyIndex(unittest.TestCase):
+
+    def test_dequeue_in_priority_order(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'enable_ready_index': True})
+        low = Message(payload='low')
+        low.priority = 100
+        low = qa.enqueue(low)
+        high = Message(payload='high')
+        high.priority = 1
+        high = qa.enqueue(high)
+
+        self.assertEqual(qa.dequeue().id, high.id)
+        self.assertEqual(qa.dequeue().id, low.id)
+
+    def test_lookup_by_id_without_directory_search(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'enable_ready_index': True})
+        m1 = qa.enqueue(Message(payload='hello world', priority=3))
+
+        with unittest.mock.patch('glob.glob', side_effect=AssertionError('directory searched')):
+            self.assertEqual(qa.lookup_message_state(m1.id), 'queue')
+            self.assertEqual(qa.peek(m1.id).payload, 'hello world')
+            qa.delete(m1.id)
+        self.assertEqual(qa.lookup_message_state(m1.id), 'complete.fail')
+
+    def test_lookup_by_id_of_message_renamed_by_other_consumer(self):
+        qa_1 = TestFqa.file_queue_adapter_factory(additional_options={'enable_ready_index': True})
+        qa_2 = FileQueueAdapter(options={'base_path': qa_1.config.base_path})
+        m1 = qa_1.enqueue(Message(payload='hello world'))
+
+        qa_2.rollback(qa_2.dequeue(), delay=60)
+        self.assertEqual(qa_1.lookup_message_state(m1.id), 'queue')
+        self.assertEqual(qa_1.peek(m1.id).attempts, 1)
+
+    def test_index_loaded_at_startup(self):
+        producer = TestFqa.file_queue_adapter_factory()
+        m1 = producer.enqueue(Message(payload='hello world'))
+
+        consumer = FileQueueAdapter(options={'base_path': producer.config.base_path, 'enable_ready_index': True})
+        dq_1 = consumer.dequeue()
+        self.assertIsNotNone(dq_1)
+        self.assertEqual(dq_1.id, m1.id)
+
+    def test_refresh_picks_up_other_producer(self):
+        consumer = TestFqa.file_queue_adapter_factory(additional_options={'enable_ready_index': True, 'ready_index_refresh_interval': 0.001})
+        producer = FileQueueAdapter(options={'base_path': consumer.config.base_path})
+        self.assertIsNone(consumer.dequeue())
+
+        m1 = producer.enqueue(Message(payload='hello world'))
+        time.sleep(0.01)
+        dq_1 = consumer.dequeue()
+        self.assertIsNotNone(dq_1)
+        self.assertEqual(dq_1.id, m1.id)
+
+    def test_message_locked_by_other_consumer_is_skipped(self):
+        qa_1 = TestFqa.file_queue_adapter_factory(additional_options={'enable_ready_index': True})
+        qa_2 = FileQueueAdapter(options={'base_path': qa_1.config.base_path, 'enable_ready_index': True, 'ready_index_refresh_interval': 0.001})
+        m1 = qa_1.enqueue(Message(payload='hello world'))
+        time.sleep(0.01)
+
+        dq_1 = qa_2.dequeue()
+        self.assertEqual(dq_1.id, m1.id)
+        self.assertIsNone(qa_1.dequeue())
+
+    def test_delay(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'enable_ready_index': True})
+        m1 = qa.enqueue(Message(payload='hello world', delay=timedelta(seconds=1)))
+        self.assertIsNone(qa.dequeue())
+
+        time.sleep(1)
+        dq_1 = qa.dequeue()
+        self.assertIsNotNone(dq_1)
+        self.assertEqual(dq_1.id, m1.id)
+
+    def test_pause_request_type(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'enable_ready_index': True})
+        m1 = qa.enqueue(Message(payload='hello world', request_type='paused', priority=1))
+        m2 = qa.enqueue(Message(payload='hello world', request_type='other', priority=2))
+        self.assertTrue(qa.pause_request_type('paused', duration=0.3))
+
+        self.assertEqual(qa.dequeue().id, m2.id)
+        self.assertIsNone(qa.dequeue())
+        self.assertEqual(qa.lookup_message_state(m1.id), 'queue')
+        time.sleep(0.3)
+        dq_1 = qa.dequeue()
+        self.assertEqual(dq_1.id, m1.id)
+        self.assertEqual(dq_1.attempts, 0)
+
+    def test_pause_request_type_requires_ready_index(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        self.assertFalse(qa.pause_request_type('paused', duration=1))
+
+    def test_skip_expired_message(self):
+        expiration_date_in_past = datetime.datetime.strptime("2000-01-01 12:00:00", "%Y-%m-%d %H:%M:%S")
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'enable_ready_index': True})
+        m1 = qa.enqueue(Message(payload='hello world', expiration=expiration_date_in_past))
+
+        self.assertIsNone(qa.dequeue())
+        self.assertEqual(qa.lookup_message_state(m1.id), 'complete.fail')
+
+    def test_message_exceeds_attempts_unavailable(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'enable_ready_index': True, 'max_number_of_attempts': 2})
+        m1 = qa.enqueue(Message(payload='hello world'))
+
+        qa.rollback(qa.dequeue())
+        qa.rollback(qa.dequeue())
+
+        self.assertIsNone(qa.dequeue())
+        self.assertEqual(qa.lookup_message_state(m1.id), 'complete.fail')
+
+
+class TestFqaFileName(unittest.TestCase):
+
+    def test_encoded_file_name_round_trip(self):
+        file_name = MessageFileName(priority=5, available_at_ms=1700000000123, expires_at_ms=0, message_id='1700000000.123-abc-def')
+        parsed = MessageFileName.parse(str(file_name))
+        self.assertTrue(parsed.is_encoded)
+        self.assertEqual(parsed, file_name)
+
+    def test_parse_legacy_file_name(self):
+        parsed = MessageFileName.parse('1700000000.5-abc-def.message')
+        self.assertFalse(parsed.is_encoded)
+        self.assertEqual(parsed.message_id, '1700000000.5-abc-def')
+        self.assertEqual(parsed.available_at_ms, 1700000000500)
+        self.assertEqual(str(parsed), '1700000000.5-abc-def.message')
+
+    def test_enqueue_writes_encoded_file_name(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        m1 = Message(payload='hello world')
+        m1.priority = 7
+        m1 = qa.enqueue(m1)
+
+        file_names = [name for name in os.listdir(qa.config.base_path) if name.endswith('.message')]
+        self.assertEqual(len(file_names), 1)
+        parsed = MessageFileName.parse(file_names[0])
+        self.assertTrue(parsed.is_encoded)
+        self.assertEqual(parsed.priority, 7)
+        self.assertEqual(parsed.message_id, m1.id)
+
+    def test_legacy_file_is_dequeued(self):
+        legacy_qa = TestFqa.file_queue_adapter_factory(additional_options={'file_name_format': 'id'})
+        m1 = legacy_qa.enqueue(Message(payload='hello world'))
+        self.assertTrue(os.path.exists(os.path.join(legacy_qa.config.base_path, f'{m1.id}.message')))
+
+        qa = FileQueueAdapter(options={'base_path': legacy_qa.config.base_path})
+        self.assertEqual(qa.lookup_message_state(m1.id), 'queue')
+        self.assertEqual(qa.peek(m1.id).payload, 'hello world')
+
+        dq_1 = qa.dequeue()
+        self.assertEqual(dq_1.id, m1.id)
+        qa.rollback(dq_1)
+
+        # rollback rewrites the message using the encoded file name
+        self.assertIsNotNone(qa.peek(m1.id))
+        self.assertFalse(os.path.exists(os.path.join(legacy_qa.config.base_path, f'{m1.id}.message')))
+
+    def test_delayed_message_is_not_opened(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        qa.enqueue(Message(payload='hello world', delay=timedelta(seconds=60)))
+
+        with unittest.mock.patch.object(qa, '_load_message_from_file', wraps=qa._load_message_from_file) as load:
+            self.assertIsNone(qa.dequeue())
+            load.assert_not_called()
+
+    def test_expired_message_is_archived_without_lock(self):
+        expiration_date_in_past = datetime.datetime.strptime("2000-01-01 12:00:00", "%Y-%m-%d %H:%M:%S")
+        qa = TestFqa.file_queue_adapter_factory()
+        m1 = qa.enqueue(Message(payload='hello world', expiration=expiration_date_in_past))
+
+        with unittest.mock.patch.object(qa, '_lock_file', wraps=qa._lock_file) as lock:
+            self.assertIsNone(qa.dequeue())
+            lock.assert_not_called()
+        self.assertEqual(qa.lookup_message_state(m1.id), 'complete.fail')
+
+
+class TestFqaDelayedDirectoryCompliance(TestFqaCompliance):
+
+    def queue_adapter_factory(self) -> QueueAdapter:
+        options = {}
+        options['base_path'] = get_unique_base_path('fqa-delayed-compliance')
+        options['enable_delayed_directory'] = True
+        return FileQueueAdapter(options=options)
+
+
+class TestFqaDelayedDirectory(unittest.TestCase):
+
+    @staticmethod
+    def delayed_queue_adapter_factory(additional_options=None) -> FileQueueAdapter:
+        options = {'enable_delayed_directory': True, 'delayed_promotion_interval': 0.001}
+        if additional_options:
+            options.update(additional_options)
+        return TestFqa.file_queue_adapter_factory(tag='fqa-delayed', additional_options=options)
+
+    def test_delayed_message_held_out_of_queue(self):
+        qa = self.delayed_queue_adapter_factory()
+        m1 = qa.enqueue(Message(payload='hello world', delay=timedelta(seconds=60)))
+
+        queued = [name for name in os.listdir(qa.config.base_path) if name.endswith('.message')]
+        self.assertEqual(queued, [])
+        self.assertEqual(qa.lookup_message_state(m1.id), 'queue')
+        self.assertEqual(qa.peek(m1.id).payload, 'hello world')
+        self.assertIsNone(qa.dequeue())
+
+    def test_delay_promoted_inline(self):
+        qa = self.delayed_queue_adapter_factory()
+        m1 = qa.enqueue(Message(payload='hello world', delay=timedelta(seconds=1)))
+        m2 = qa.enqueue(Message(payload='hello world'))
+
+        self.assertEqual(qa.dequeue().id, m2.id)
+        self.assertIsNone(qa.dequeue())
+
+        time.sleep(1)
+        dq_1 = qa.dequeue()
+        self.assertIsNotNone(dq_1)
+        self.assertEqual(dq_1.id, m1.id)
+
+    def test_delay_promoted_by_thread(self):
+        qa = self.delayed_queue_adapter_factory(additional_options={'delayed_promotion_mode': 'thread', 'delayed_promotion_interval': 0.1})
+        try:
+            m1 = qa.enqueue(Message(payload='hello world', delay=timedelta(seconds=1)))
+            time.sleep(1.5)
+            self.assertTrue(any(name.endswith(f'{m1.id}.message') for name in os.listdir(qa.config.base_path)))
+            self.assertEqual(qa.dequeue().id, m1.id)
+        finally:
+            qa.stop_delayed_promoter()
+
+    def test_delay_with_ready_index(self):
+        qa = self.delayed_queue_adapter_factory(additional_options={'enable_ready_index': True})
+        m1 = qa.enqueue(Message(payload='hello world', delay=timedelta(seconds=1)))
+        self.assertIsNone(qa.dequeue())
+
+        time.sleep(1)
+        self.assertEqual(qa.dequeue().id, m1.id)
+
+    def test_delete_delayed_message(self):
+        qa = self.delayed_queue_adapter_factory()
+        m1 = qa.enqueue(Message(payload='hello world', delay=timedelta(seconds=60)))
+
+        qa.delete(m1.id)
+        self.assertEqual(qa.lookup_message_state(m1.id), 'complete.fail')
+
+    def test_elapsed_bucket_removed(self):
+        qa = self.delayed_queue_adapter_factory(additional_options={'delayed_bucket_seconds': 1})
+        qa.enqueue(Message(payload='hello world', delay=timedelta(seconds=1)))
+        self.assertEqual(len(os.listdir(qa.config.delayed_path)), 1)
+
+        time.sleep(2)
+        self.assertIsNotNone(qa.dequeue())
+        self.assertEqual(os.listdir(qa.config.delayed_path), [])
+
+
+class TestFqaDequeueBatch(unittest.TestCase):
+
+    def test_dequeue_batch_locks_up_to_max_messages(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        enqueued = [qa.enqueue(Message(payload=f'hello world {i}')).id for i in range(5)]
+
+        batch_1 = qa.dequeue_batch(max_messages=3)
+        self.assertEqual([m.id for m in batch_1], enqueued[:3])
+        for m in batch_1:
+            self.assertEqual(qa.lookup_message_state(m.id), 'lock')
+
+        batch_2 = qa.dequeue_batch(max_messages=3)
+        self.assertEqual([m.id for m in batch_2], enqueued[3:])
+
+        self.assertEqual(qa.dequeue_batch(max_messages=3), [])
+
+    def test_dequeue_batch_with_ready_index(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'enable_ready_index': True})
+        enqueued = [qa.enqueue(Message(payload=f'hello world {i}')).id for i in range(3)]
+
+        batch = qa.dequeue_batch(max_messages=5)
+        self.assertEqual([m.id for m in batch], enqueued)
+
+    def test_dequeue_batch_skips_delayed(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        qa.enqueue(Message(payload='later', delay=timedelta(seconds=60)))
+        m2 = qa.enqueue(Message(payload='now'))
+
+        batch = qa.dequeue_batch(max_messages=2)
+        self.assertEqual([m.id for m in batch], [m2.id])
+
+    def test_dequeue_batch_timeout(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        start = time.monotonic()
+        self.assertEqual(qa.dequeue_batch(max_messages=2, timeout=0.5), [])
+        self.assertAlmostEqual(time.monotonic() - start, 0.5, delta=0.2)
+
+    def test_dequeue_batch_waits_for_delayed_message(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        m1 = qa.enqueue(Message(payload='soon', delay=timedelta(seconds=0.5)))
+
+        batch = qa.dequeue_batch(max_messages=2, timeout=2)
+        self.assertEqual([m.id for m in batch], [m1.id])
+
+
+class TestFqaEnqueueBatch(unittest.TestCase):
+
+    def test_enqueue_batch(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        messages = qa.enqueue_batch([Message(payload=f'hello world {i}') for i in range(3)])
+        self.assertEqual(len(messages), 3)
+        for m in messages:
+            self.assertEqual(qa.lookup_message_state(m.id), 'queue')
+
+        batch = qa.dequeue_batch(max_messages=3)
+        self.assertEqual([m.id for m in batch], [m.id for m in messages])
+
+    def test_enqueue_batch_with_fsync(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'enable_fsync': True})
+        with unittest.mock.patch('os.fsync', wraps=os.fsync) as fsync:
+            messages = qa.enqueue_batch([Message(payload=f'hello world {i}') for i in range(3)])
+        # one fsync per message file, plus a single fsync of the queue directory
+        self.assertEqual(fsync.call_count, 4)
+        self.assertEqual(qa.dequeue().id, messages[0].id)
+
+    def test_enqueue_batch_with_ready_index(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'enable_ready_index': True})
+        messages = qa.enqueue_batch([Message(payload=f'hello world {i}') for i in range(3)])
+        self.assertEqual(len(qa._ready_index), 3)
+        self.assertEqual(qa.dequeue().id, messages[0].id)
+
+
+class TestFqaWaitForMessage(unittest.TestCase):
+
+    @staticmethod
+    def enqueue_later(qa: FileQueueAdapter, delay: float):
+        producer = FileQueueAdapter(options={'base_path': qa.config.base_path})
+
+        def enqueue():
+            time.sleep(delay)
+            producer.enqueue(Message(payload='hello world'))
+
+        threading.Thread(target=enqueue).start()
+
+    def test_wait_timeout(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        start = time.monotonic()
+        self.assertFalse(qa.wait_for_message(timeout=0.3))
+        self.assertAlmostEqual(time.monotonic() - start, 0.3, delta=0.2)
+
+    def test_wait_wakes_on_enqueue(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        self.enqueue_later(qa, delay=0.2)
+
+        start = time.monotonic()
+        self.assertTrue(qa.wait_for_message(timeout=5))
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertIsNotNone(qa.dequeue())
+
+    def test_wait_wakes_on_enqueue_with_polling(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'wait_mode': 'poll'})
+        self.enqueue_later(qa, delay=0.2)
+
+        start = time.monotonic()
+        self.assertTrue(qa.wait_for_message(timeout=5))
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertIsNotNone(qa.dequeue())
+
+    def test_wait_wakes_on_rollback(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        qa.enqueue(Message(payload='hello world'))
+        m = qa.dequeue()
+
+        threading.Timer(0.2, qa.rollback, kwargs={'message': m}).start()
+        self.assertTrue(qa.wait_for_message(timeout=5))
+
+    def test_wait_wakes_for_delayed_message(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        qa.enqueue(Message(payload='hello world', delay=timedelta(seconds=0.5)))
+
+        start = time.monotonic()
+        self.assertTrue(qa.wait_for_message(timeout=5))
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertIsNotNone(qa.dequeue())
+
+    def test_wait_wakes_for_delayed_directory_message(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'enable_delayed_directory': True, 'delayed_promotion_interval': 0.001})
+        qa.enqueue(Message(payload='hello world', delay=timedelta(seconds=1)))
+
+        start = time.monotonic()
+        self.assertTrue(qa.wait_for_message(timeout=5))
+        self.assertLess(time.monotonic() - start, 3)
+        self.assertIsNotNone(qa.dequeue())
+
+    def test_wait_times_out_before_delayed_message(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        qa.enqueue(Message(payload='hello world', delay=timedelta(seconds=60)))
+
+        self.assertFalse(qa.wait_for_message(timeout=0.2))
+        self.assertFalse(qa.wait_for_message(timeout=0.2))
+        self.assertIsNone(qa.dequeue())
+
+    def test_wait_sees_delayed_message_queued_after_cached(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'ready_index_refresh_interval': 60})
+        self.assertFalse(qa.wait_for_message(timeout=0.1))
+        qa.enqueue(Message(payload='hello world', delay=timedelta(seconds=0.3)))
+
+        start = time.monotonic()
+        self.assertTrue(qa.wait_for_message(timeout=5))
+        self.assertLess(time.monotonic() - start, 2)
+
+
+class TestFqaPriority(unittest.TestCase):
+
+    def test_dequeue_in_priority_order(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        low = qa.enqueue(Message(payload='low', priority=100))
+        high = qa.enqueue(Message(payload='high', priority=1))
+
+        self.assertEqual(qa.dequeue().id, high.id)
+        self.assertEqual(qa.dequeue().id, low.id)
+
+    def test_rollback_keeps_priority(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        m1 = qa.enqueue(Message(payload='hello world', priority=3))
+        qa.rollback(qa.dequeue())
+
+        self.assertEqual(MessageFileName.parse(os.path.basename(qa._find_message_file_path(m1.id))).priority, 3)
+        dq = qa.dequeue()
+        self.assertEqual(dq.id, m1.id)
+        self.assertEqual(dq.priority, 3)
+
+    def test_priority_aging(self):
+        for additional_options in ({}, {'enable_ready_index': True}):
+            qa = TestFqa.file_queue_adapter_factory(additional_options={'priority_aging_interval': 10, **additional_options})
+            # available for 100 seconds, aged by 10 levels
+            waiting = qa.enqueue(Message(payload='waiting', priority=10, delay=datetime.datetime.now() - timedelta(seconds=100)))
+            new = qa.enqueue(Message(payload='new', priority=5))
+
+            self.assertEqual(qa.dequeue().id, waiting.id)
+            self.assertEqual(qa.dequeue().id, new.id)
+
+    def test_priority_aging_of_legacy_file(self):
+        legacy_qa = TestFqa.file_queue_adapter_factory(additional_options={'file_name_format': 'id'})
+        legacy = legacy_qa.enqueue(Message(payload='legacy', priority=10))
+        qa = FileQueueAdapter(options={'base_path': legacy_qa.config.base_path, 'enable_ready_index': True, 'priority_aging_interval': 10})
+        new = qa.enqueue(Message(payload='new', priority=5))
+
+        # the legacy file ranks as available from when it was indexed, not from the epoch
+        self.assertEqual(qa.dequeue().id, new.id)
+        self.assertEqual(qa.dequeue().id, legacy.id)
+
+    def test_no_priority_aging(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        qa.enqueue(Message(payload='waiting', priority=10, delay=datetime.datetime.now() - timedelta(seconds=100)))
+        new = qa.enqueue(Message(payload='new', priority=5))
+
+        self.assertEqual(qa.dequeue().id, new.id)
+
+
+class TestFqaStructFormatCompliance(TestFqaCompliance):
+
+    def queue_adapter_factory(self) -> QueueAdapter:
+        options = {}
+        options['base_path'] = get_unique_base_path('fqa-struct-compliance')
+        options['message_format'] = 'struct'
+        return FileQueueAdapter(options=options)
+
+
+class TestFqaMessageFormat(unittest.TestCase):
+
+    def test_mixed_message_formats(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        for message_format in ('json', 'json-compact', 'struct'):
+            qa.config.set('message_format', message_format)
+            qa.enqueue(Message(payload=f'hello {message_format}'))
+
+        payloads = set()
+        for _ in range(3):
+            m = qa.dequeue()
+            payloads.add(m.payload)
+            qa.commit(m)
+        self.assertEqual(payloads, {'hello json', 'hello json-compact', 'hello struct'})
+        self.assertIsNone(qa.dequeue())
+
+    def test_struct_rollback_keeps_attempts(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        qa.config.set('message_format', 'struct')
+        m1 = qa.enqueue(Message(payload='hello world'))
+
+        qa.rollback(qa.dequeue())
+        dq = qa.dequeue()
+        self.assertEqual(dq.id, m1.id)
+        self.assertEqual(dq.attempts, 1)
+
+    def test_load_header_only(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        qa.config.set('message_format', 'struct')
+        m1 = qa.enqueue(Message(payload='hello world', request_type='echo'))
+
+        m = qa._load_message_from_file(qa._find_message_file_path(m1.id), header_only=True)
+        self.assertEqual(m.id, m1.id)
+        self.assertEqual(m.request_type, 'echo')
+        self.assertIsNone(m.body)
+
+    def test_legacy_file_name_delayed_struct(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'file_name_format': 'id', 'message_format': 'struct'})
+        qa.enqueue(Message(payload='later', delay=timedelta(seconds=60)))
+        m2 = qa.enqueue(Message(payload='now'))
+
+        dq = qa.dequeue()
+        self.assertEqual(dq.id, m2.id)
+        self.assertEqual(dq.payload, 'now')
+        self.assertIsNone(qa.dequeue())
+
+    def test_invalid_message_format(self):
+        qa = TestFqa.file_queue_adapter_factory()
+        qa.config.set('message_format', 'xml')
+        with self.assertRaises(Exception):
+            qa.enqueue(Message(payload='hello world'))
+
+
+@unittest.skipUnless(inotify.is_available(), 'inotify not available')
+class TestFqaChangeFeedCompliance(TestFqaCompliance):
+
+    def queue_adapter_factory(self) -> QueueAdapter:
+        options = {}
+        options['base_path'] = get_unique_base_path('fqa-change-feed-compliance')
+        options['enable_change_feed'] = True
+        return FileQueueAdapter(options=options)
+
+
+@unittest.skipUnless(inotify.is_available(), 'inotify not available')
+class TestFqaChangeFeed(unittest.TestCase):
+
+    def test_change_feed_enables_ready_index(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'enable_change_feed': True})
+        self.assertIsNotNone(qa._change_feed)
+        self.assertIsNotNone(qa._ready_index)
+
+    def test_dequeue_message_from_other_producer_without_rescan(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'enable_change_feed': True, 'ready_index_refresh_interval': 3600})
+        producer = FileQueueAdapter(options={'base_path': qa.config.base_path})
+        m1 = producer.enqueue(Message(payload='hello world'))
+
+        with unittest.mock.patch.object(qa, '_refresh_ready_index') as refresh:
+            dq = qa.dequeue()
+            self.assertFalse(refresh.called)
+        self.assertEqual(dq.id, m1.id)
+
+    def test_message_locked_by_other_consumer_is_removed_from_view(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'enable_change_feed': True})
+        consumer = FileQueueAdapter(options={'base_path': qa.config.base_path})
+        m1 = qa.enqueue(Message(payload='hello world'))
+
+        self.assertEqual(qa.lookup_message_state(m1.id), 'queue')
+        self.assertEqual(consumer.dequeue().id, m1.id)
+        self.assertEqual(qa.lookup_message_state(m1.id), 'lock')
+        self.assertIsNone(qa.dequeue())
+
+    def test_lookup_message_state_uses_view(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'enable_change_feed': True})
+        m1 = qa.enqueue(Message(payload='hello world'))
+
+        with unittest.mock.patch('glob.glob') as glob_glob:
+            self.assertEqual(qa.lookup_message_state(m1.id), 'queue')
+            dq = qa.dequeue()
+            self.assertEqual(qa.lookup_message_state(m1.id), 'lock')
+            qa.rollback(dq)
+            self.assertEqual(qa.lookup_message_state(m1.id), 'queue')
+            dq = qa.dequeue()
+            qa.commit(dq)
+            self.assertEqual(qa.lookup_message_state(m1.id), 'complete.success')
+            self.assertFalse(glob_glob.called)
+
+    def test_resync_picks_up_missed_changes(self):
+        qa = TestFqa.file_queue_adapter_factory(additional_options={'enable_change_feed': True})
+        producer = FileQueueAdapter(options={'base_path': qa.config.base_path})
+        m1 = producer.enqueue(Message(payload='hello world'))
+        # simulate an event queue overflow: pending events are lost, and a resync is needed
+        qa._change_feed.discard_pending()
+        qa._change_feed._resync_requested = True
+
+        self.assertEqual(qa.dequeue().id, m1.id)
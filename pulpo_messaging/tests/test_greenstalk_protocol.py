@@ -0,0 +1,19 @@
+import unittest
+import greenstalk
+from pulpo_messaging import greenstalk_protocol
+
+
+class TestGreenstalkProtocol(unittest.TestCase):
+
+    def test_parse_response(self):
+        self.assertEqual(greenstalk_protocol.parse_response(b'RESERVED 12 5\r\n', b'RESERVED'), [b'12', b'5'])
+
+    def test_parse_response_error(self):
+        with self.assertRaises(greenstalk.TimedOutError):
+            greenstalk_protocol.parse_response(b'TIMED_OUT\r\n', b'RESERVED')
+
+    def test_parse_chunk(self):
+        self.assertEqual(greenstalk_protocol.parse_chunk(b'hello\r\n', 5), b'hello')
+
+    def test_parse_stats(self):
+        self.assertEqual(greenstalk_protocol.parse_stats(b'---\nname: default\ncurrent-jobs-ready: 3\n')['current-jobs-ready'], 3)
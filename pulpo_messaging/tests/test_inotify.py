@@ -0,0 +1,51 @@
+import os
+import threading
+import time
+import unittest
+from pulpo_messaging import inotify
+from .unittest_helper import get_unique_base_path
+
+
+@unittest.skipUnless(inotify.is_available(), 'inotify not available')
+class TestInotifyWatch(unittest.TestCase):
+
+    def test_wait_timeout(self):
+        path = get_unique_base_path('inotify')
+        os.makedirs(path)
+        watch = inotify.InotifyWatch(paths=[path], mask=inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO)
+        start = time.monotonic()
+        self.assertEqual(watch.wait(timeout=0.2), [])
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        watch.close()
+
+    def test_wait_for_close_write(self):
+        path = get_unique_base_path('inotify')
+        os.makedirs(path)
+        watch = inotify.InotifyWatch(paths=[path], mask=inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO)
+
+        def write_file():
+            time.sleep(0.1)
+            with open(os.path.join(path, 'a.message'), mode='w', encoding='utf-8') as f:
+                f.write('hello world')
+
+        threading.Thread(target=write_file).start()
+        events = watch.wait(timeout=2)
+        self.assertEqual([event.name for event in events], ['a.message'])
+        self.assertTrue(events[0].mask & inotify.IN_CLOSE_WRITE)
+        watch.close()
+
+    def test_moved_to(self):
+        path = get_unique_base_path('inotify')
+        os.makedirs(os.path.join(path, 'other'))
+        with open(os.path.join(path, 'other', 'a.message'), mode='w', encoding='utf-8') as f:
+            f.write('hello world')
+        watch = inotify.InotifyWatch(paths=[path], mask=inotify.IN_MOVED_TO)
+
+        os.rename(os.path.join(path, 'other', 'a.message'), os.path.join(path, 'b.message'))
+        events = watch.wait(timeout=0)
+        self.assertEqual([event.name for event in events], ['b.message'])
+        watch.close()
+
+    def test_missing_directory(self):
+        with self.assertRaises(OSError):
+            inotify.InotifyWatch(paths=[get_unique_base_path('inotify')], mask=inotify.IN_MOVED_TO)
@@ -1,9 +1,17 @@
+import signal
+import threading
+import time
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
+from statman import Statman
 from pulpo_messaging.kessel import Message
 from pulpo_messaging.kessel import Pulpo
+from pulpo_messaging.file_queue_adapter import FileQueueAdapter
+from pulpo_messaging.memory_queue_adapter import MemoryQueueAdapter
+from pulpo_messaging.payload_handler import PayloadHandler, RequestResult
 from pulpo_messaging.queue_adapter import QueueAdapter
 from pulpo_messaging.sample_handlers import AlwaysFailHandler, AlwaysSucceedHandler, AlwaysTransientFailureHandler
+from .unittest_helper import get_unique_base_path
 
 
 class TestKessel_HandleMessage(unittest.TestCase):
@@ -46,3 +54,456 @@ class TestKessel_HandleMessage(unittest.TestCase):
         self.assertTrue(result.isTransient)
         self.assertFalse(mock_queue_adapter.commit.called)
         self.assertTrue(mock_queue_adapter.rollback.called)
+        # without a retry policy, the message is redelivered at once
+        self.assertIsNone(mock_queue_adapter.rollback.call_args.kwargs['delay'])
+
+    def test_transient_failure_delayed_by_retry_policy(self):
+        mock_queue_adapter = MagicMock(QueueAdapter)
+        pulpo = Pulpo(options={'retry_policies': {'sample': {'initial_delay': 2, 'max_delay': 10, 'jitter': 'none'}}}, queue_adapter=mock_queue_adapter)
+        pulpo.handler_registry.register('sample', AlwaysTransientFailureHandler())
+
+        m = Message(message_id=123, payload='hello world', request_type='sample')
+        m.attempts = 2
+        pulpo.handle_message(m)
+
+        self.assertEqual(mock_queue_adapter.rollback.call_args.kwargs['delay'], 8)
+
+    def test_transient_failure_retry_after(self):
+        mock_queue_adapter = MagicMock(QueueAdapter)
+        pulpo = Pulpo(options={'default_retry_policy': {'initial_delay': 2}}, queue_adapter=mock_queue_adapter)
+        handler = MagicMock(PayloadHandler)
+        handler.handle.return_value = RequestResult.transient_factory(error='throttled', retry_after=30)
+        pulpo.handler_registry.register('sample', handler)
+
+        pulpo.handle_message(Message(message_id=123, payload='hello world', request_type='sample'))
+
+        self.assertEqual(mock_queue_adapter.rollback.call_args.kwargs['delay'], 30)
+
+
+class TestKessel_Start(unittest.TestCase):
+
+    def test_batch_mode_handles_each_message(self):
+        mock_queue_adapter = MagicMock(QueueAdapter)
+        m1 = Message(message_id=1, payload='hello world', request_type='sample')
+        m2 = Message(message_id=2, payload='hello world', request_type='sample')
+        mock_queue_adapter.dequeue_batch.side_effect = [[m1, m2], []]
+
+        pulpo = Pulpo(options={'batch_size': 2, 'shutdown_after_number_of_empty_iterations': 1}, queue_adapter=mock_queue_adapter)
+        pulpo.handler_registry.register('sample', AlwaysSucceedHandler())
+        pulpo.start()
+
+        mock_queue_adapter.dequeue_batch.assert_called_with(max_messages=2)
+        self.assertFalse(mock_queue_adapter.dequeue.called)
+        self.assertEqual(mock_queue_adapter.commit.call_count, 2)
+
+    def test_default_mode_dequeues_single_message(self):
+        mock_queue_adapter = MagicMock(QueueAdapter)
+        m1 = Message(message_id=1, payload='hello world', request_type='sample')
+        mock_queue_adapter.dequeue.side_effect = [m1, None]
+
+        pulpo = Pulpo(options={'shutdown_after_number_of_empty_iterations': 1}, queue_adapter=mock_queue_adapter)
+        pulpo.handler_registry.register('sample', AlwaysSucceedHandler())
+        pulpo.start()
+
+        self.assertFalse(mock_queue_adapter.dequeue_batch.called)
+        self.assertEqual(mock_queue_adapter.commit.call_count, 1)
+
+
+class TestKessel_PublishMany(unittest.TestCase):
+
+    def test_publish_many_uses_enqueue_batch(self):
+        mock_queue_adapter = MagicMock(QueueAdapter)
+        messages = [Message(payload='hello world 1'), Message(payload='hello world 2')]
+        mock_queue_adapter.enqueue_batch.return_value = messages
+
+        pulpo = Pulpo(queue_adapter=mock_queue_adapter)
+        result = pulpo.publish_many(messages)
+
+        mock_queue_adapter.enqueue_batch.assert_called_once_with(messages)
+        self.assertFalse(mock_queue_adapter.enqueue.called)
+        self.assertEqual(result, messages)
+
+
+class SleepHandler(PayloadHandler):
+
+    def handle(self, payload: str):
+        time.sleep(float(payload))
+        return RequestResult.success_factory()
+
+
+class RaiseHandler(PayloadHandler):
+
+    def handle(self, payload: str):
+        raise Exception('handler failure')
+
+
+def mock_queue_adapter_factory(messages: list) -> MagicMock:
+    mock_queue_adapter = MagicMock(QueueAdapter)
+    pending = list(messages)
+    mock_queue_adapter.dequeue.side_effect = lambda: pending.pop(0) if pending else None
+    return mock_queue_adapter
+
+
+class TestKessel_WorkerPool(unittest.TestCase):
+
+    def test_thread_pool_handles_messages_concurrently(self):
+        messages = [Message(message_id=i, payload='0.3', request_type='sleep') for i in range(4)]
+        mock_queue_adapter = mock_queue_adapter_factory(messages)
+
+        options = {'worker_pool': {'mode': 'thread', 'size': 4}, 'shutdown_after_number_of_empty_iterations': 1, 'sleep_duration': 1}
+        pulpo = Pulpo(options=options, queue_adapter=mock_queue_adapter)
+        pulpo.handler_registry.register('sleep', SleepHandler())
+
+        start = time.monotonic()
+        pulpo.start()
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(mock_queue_adapter.commit.call_count, 4)
+        # serial processing would take 1.2s (plus the 1s sleep once the queue is empty)
+        self.assertLess(elapsed, 2)
+
+    def test_thread_pool_limits_in_flight_messages(self):
+        messages = [Message(message_id=i, payload='0.1', request_type='sleep') for i in range(6)]
+        mock_queue_adapter = mock_queue_adapter_factory(messages)
+
+        options = {'worker_pool': {'mode': 'thread', 'size': 2, 'prefetch': 1}, 'shutdown_after_number_of_empty_iterations': 1, 'sleep_duration': 0.001}
+        pulpo = Pulpo(options=options, queue_adapter=mock_queue_adapter)
+        handler = SleepHandler()
+        pulpo.handler_registry.register('sleep', handler)
+
+        max_in_flight = []
+        original_dequeue_messages = pulpo.dequeue_messages
+
+        def dequeue_messages():
+            max_in_flight.append(pulpo._worker_pool.in_flight_count)
+            return original_dequeue_messages()
+
+        pulpo.dequeue_messages = dequeue_messages
+        pulpo.start()
+
+        self.assertEqual(mock_queue_adapter.commit.call_count, 6)
+        self.assertLessEqual(max(max_in_flight), 3)
+
+    def test_handler_exception_rolls_back(self):
+        mock_queue_adapter = mock_queue_adapter_factory([Message(message_id=1, payload='hello world', request_type='raise')])
+
+        options = {'worker_pool': {'mode': 'thread', 'size': 2}, 'shutdown_after_number_of_empty_iterations': 1, 'sleep_duration': 0.001}
+        pulpo = Pulpo(options=options, queue_adapter=mock_queue_adapter)
+        pulpo.handler_registry.register('raise', RaiseHandler())
+        pulpo.start()
+
+        self.assertTrue(mock_queue_adapter.rollback.called)
+        self.assertFalse(mock_queue_adapter.commit.called)
+
+    def test_missing_handler_commits_as_fatal(self):
+        mock_queue_adapter = mock_queue_adapter_factory([Message(message_id=1, payload='hello world', request_type='unknown')])
+
+        options = {'worker_pool': {'mode': 'thread', 'size': 2}, 'shutdown_after_number_of_empty_iterations': 1, 'sleep_duration': 0.001}
+        pulpo = Pulpo(options=options, queue_adapter=mock_queue_adapter)
+        pulpo.start()
+
+        mock_queue_adapter.commit.assert_called_once_with(message=mock_queue_adapter.commit.call_args.kwargs['message'], is_success=False)
+
+    def test_shutdown_drains_in_flight_messages(self):
+        messages = [Message(message_id=i, payload='0.3', request_type='sleep') for i in range(3)]
+        mock_queue_adapter = mock_queue_adapter_factory(messages)
+
+        options = {'worker_pool': {'mode': 'thread', 'size': 3}, 'batch_size': 3, 'shutdown_after_number_of_empty_iterations': 10, 'sleep_duration': 1}
+        pulpo = Pulpo(options=options, queue_adapter=mock_queue_adapter)
+        pulpo.handler_registry.register('sleep', SleepHandler())
+
+        def dequeue_batch(max_messages):  # pylint: disable=unused-argument
+            # shutdown is requested while the dequeued messages are still in-flight
+            pulpo.signal_handler(signal.SIGTERM, None)
+            return messages
+
+        mock_queue_adapter.dequeue_batch.side_effect = dequeue_batch
+
+        pulpo.start()
+
+        self.assertEqual(mock_queue_adapter.commit.call_count, 3)
+        self.assertEqual(mock_queue_adapter.dequeue_batch.call_count, 1)
+
+    def test_process_pool(self):
+        messages = [Message(message_id=i, payload='hello world', request_type='success') for i in range(4)]
+        mock_queue_adapter = mock_queue_adapter_factory(messages)
+
+        options = {'worker_pool': {'mode': 'process', 'size': 2}, 'shutdown_after_number_of_empty_iterations': 1, 'sleep_duration': 0.001}
+        pulpo = Pulpo(options=options, queue_adapter=mock_queue_adapter)
+        pulpo.start()
+
+        self.assertEqual(mock_queue_adapter.commit.call_count, 4)
+        for call in mock_queue_adapter.commit.call_args_list:
+            self.assertTrue(call.kwargs['is_success'])
+
+    def test_invalid_mode(self):
+        pulpo = Pulpo(options={'worker_pool': {'mode': 'fibers'}}, queue_adapter=mock_queue_adapter_factory([]))
+        with self.assertRaises(Exception):
+            pulpo.start()
+
+
+class TestKessel_CircuitBreaker(unittest.TestCase):
+
+    def test_open_breaker_holds_back_request_type(self):
+        qa = MemoryQueueAdapter()
+        options = {'circuit_breakers': {'flaky': {'minimum_calls': 2, 'open_duration': 60}}, 'shutdown_after_number_of_empty_iterations': 1, 'sleep_duration': 0.001}
+        pulpo = Pulpo(options=options, queue_adapter=qa)
+        flaky_handler = MagicMock(PayloadHandler)
+        flaky_handler.handle.return_value = RequestResult.transient_factory(error='dependency down')
+        pulpo.handler_registry.register('flaky', flaky_handler)
+        pulpo.handler_registry.register('sample', AlwaysSucceedHandler())
+
+        flaky = qa.enqueue_batch([Message(payload=f'flaky {i}', request_type='flaky') for i in range(5)])
+        qa.enqueue_batch([Message(payload=f'sample {i}', request_type='sample') for i in range(5)])
+        opened = Statman.gauge('kessel.circuit-breaker.opened').value
+        pulpo.start()
+
+        # the breaker opened after 2 failures: the other messages of the type stay in the queue, and the other type is handled
+        self.assertEqual(flaky_handler.handle.call_count, 2)
+        self.assertEqual(Statman.gauge('kessel.circuit-breaker.opened').value, opened + 1)
+        for m in flaky:
+            self.assertIsNotNone(qa.peek(m.id))
+        self.assertEqual(len(qa._messages), len(flaky))
+
+    def test_message_dequeued_while_open_is_deferred_until_half_open(self):
+        mock_queue_adapter = MagicMock(QueueAdapter)
+        pulpo = Pulpo(options={'default_circuit_breaker': {'minimum_calls': 1, 'open_duration': 60}}, queue_adapter=mock_queue_adapter)
+        pulpo.handler_registry.register('sample', AlwaysTransientFailureHandler())
+
+        pulpo.process_message(Message(message_id=1, payload='hello world', request_type='sample'))
+        self.assertTrue(mock_queue_adapter.pause_request_type.called)
+
+        pulpo.process_message(Message(message_id=2, payload='hello world', request_type='sample'))
+        mock_queue_adapter.rollback.assert_called_once()
+        self.assertEqual(mock_queue_adapter.defer.call_args.kwargs['message'].id, '2')
+        self.assertGreater(mock_queue_adapter.defer.call_args.kwargs['delay'], 59)
+
+    def test_long_open_circuit_does_not_fail_messages(self):
+        qa = MemoryQueueAdapter(options={'max_number_of_attempts': 2})
+        # as for a request type without a tube of its own in beanstalkd: the request type is not held back, so its messages are dequeued while the breaker is open
+        qa.pause_request_type = MagicMock(return_value=False)
+        pulpo = Pulpo(options={'default_circuit_breaker': {'minimum_calls': 1, 'open_duration': 0.01}}, queue_adapter=qa)
+        flaky_handler = MagicMock(PayloadHandler)
+        flaky_handler.handle.return_value = RequestResult.transient_factory(error='dependency down')
+        pulpo.handler_registry.register('flaky', flaky_handler)
+        messages = qa.enqueue_batch([Message(payload=f'flaky {i}', request_type='flaky') for i in range(2)])
+
+        # the clock of the breaker is stopped: it stays open however many times the messages are dequeued
+        with patch('pulpo_messaging.circuit_breaker.time') as breaker_time:
+            breaker_time.monotonic.return_value = 0
+            for _ in range(10):
+                pulpo.process_message(qa.dequeue_batch(max_messages=1, timeout=1)[0])
+
+        self.assertEqual(flaky_handler.handle.call_count, 1)
+        self.assertEqual([qa.peek(m.id).attempts for m in messages], [1, 0])
+
+
+class TimedHandler(PayloadHandler):
+    '''Records when each message is handled, and the most messages handled at once.'''
+
+    def __init__(self, duration: float = 0):
+        super().__init__()
+        self.duration = duration
+        self.handled_at = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def handle(self, payload: str):
+        with self._lock:
+            self.handled_at.append(time.monotonic())
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.duration)
+        with self._lock:
+            self.running -= 1
+        return RequestResult.success_factory()
+
+
+class TestKessel_RateLimit(unittest.TestCase):
+
+    def test_rate_limit_does_not_hold_other_request_types(self):
+        qa = MemoryQueueAdapter()
+        pulpo = Pulpo(options={'shutdown_after_number_of_empty_iterations': 3, 'sleep_duration': 1}, queue_adapter=qa)
+        limited_handler = TimedHandler()
+        sample_handler = TimedHandler()
+        pulpo.handler_registry.register('limited', limited_handler, rate_limit=20, burst=1)
+        pulpo.handler_registry.register('sample', sample_handler)
+
+        qa.enqueue_batch([Message(payload=f'limited {i}', request_type='limited') for i in range(5)])
+        qa.enqueue_batch([Message(payload=f'sample {i}', request_type='sample') for i in range(5)])
+        start = time.monotonic()
+        pulpo.start()
+
+        self.assertEqual(len(limited_handler.handled_at), 5)
+        self.assertEqual(len(sample_handler.handled_at), 5)
+        self.assertEqual(len(qa._messages), 0)
+        # 1 message at once, then 1 every 50ms; the other request type is not held behind them
+        self.assertGreaterEqual(limited_handler.handled_at[-1] - limited_handler.handled_at[0], 0.19)
+        self.assertLess(sample_handler.handled_at[-1] - start, 0.1)
+
+    def test_throttled_message_is_kept_aside_without_rollback(self):
+        mock_queue_adapter = MagicMock(QueueAdapter)
+        mock_queue_adapter.is_pause_shared = False
+        pulpo = Pulpo(queue_adapter=mock_queue_adapter)
+        pulpo.handler_registry.register('sample', AlwaysSucceedHandler(), rate_limit=0.001, burst=1)
+
+        pulpo.process_message(Message(message_id=1, payload='hello world', request_type='sample'))
+        pulpo.process_message(Message(message_id=2, payload='hello world', request_type='sample'))
+
+        self.assertEqual(mock_queue_adapter.commit.call_count, 1)
+        self.assertTrue(mock_queue_adapter.pause_request_type.called)
+        self.assertFalse(mock_queue_adapter.rollback.called)
+        self.assertFalse(mock_queue_adapter.defer.called)
+
+        # on shutdown, the message is returned to the queue
+        pulpo.rollback_throttled_messages()
+        self.assertEqual(mock_queue_adapter.defer.call_args.kwargs['message'].id, '2')
+        self.assertFalse(mock_queue_adapter.rollback.called)
+
+    def test_rate_limit_does_not_pause_request_type_for_every_consumer(self):
+        mock_queue_adapter = MagicMock(QueueAdapter)
+        mock_queue_adapter.is_pause_shared = True
+        pulpo = Pulpo(queue_adapter=mock_queue_adapter)
+        pulpo.handler_registry.register('sample', AlwaysSucceedHandler(), rate_limit=0.001, burst=1)
+
+        pulpo.process_message(Message(message_id=1, payload='hello world', request_type='sample'))
+        pulpo.process_message(Message(message_id=2, payload='hello world', request_type='sample'))
+
+        # the token bucket is kept by this process: the message is kept aside, and the other consumers of the queue are not held back
+        self.assertEqual(len(pulpo._throttled), 1)
+        self.assertFalse(mock_queue_adapter.pause_request_type.called)
+
+    def test_concurrency_cap_does_not_pause_request_type(self):
+        mock_queue_adapter = MagicMock(QueueAdapter)
+        mock_queue_adapter.is_pause_shared = False
+        pulpo = Pulpo(queue_adapter=mock_queue_adapter)
+        pulpo.handler_registry.register('sample', AlwaysSucceedHandler(), max_concurrency=1)
+        # a message of the request type in flight
+        pulpo.handler_registry.get_limiter('sample').acquire()
+
+        pulpo.process_message(Message(message_id=1, payload='hello world', request_type='sample'))
+
+        self.assertEqual(len(pulpo._throttled), 1)
+        self.assertFalse(mock_queue_adapter.pause_request_type.called)
+
+    def test_throttled_messages_over_max_are_deferred_with_delay(self):
+        mock_queue_adapter = MagicMock(QueueAdapter)
+        pulpo = Pulpo(options={'rate_limit': {'max_throttled_messages': 1}}, queue_adapter=mock_queue_adapter)
+        pulpo.handler_registry.register('sample', AlwaysSucceedHandler(), rate_limit=0.001, burst=1)
+
+        for message_id in range(1, 4):
+            pulpo.process_message(Message(message_id=message_id, payload='hello world', request_type='sample'))
+
+        mock_queue_adapter.defer.assert_called_once()
+        self.assertEqual(mock_queue_adapter.defer.call_args.kwargs['message'].id, '3')
+        self.assertGreater(mock_queue_adapter.defer.call_args.kwargs['delay'], 1)
+        self.assertFalse(mock_queue_adapter.rollback.called)
+
+    def test_throttled_messages_over_max_keep_attempts(self):
+        qa = MemoryQueueAdapter(options={'max_number_of_attempts': 1})
+        # the request type is not held back, so that the throttled messages are dequeued again and again
+        qa.pause_request_type = MagicMock(return_value=False)
+        pulpo = Pulpo(options={'rate_limit': {'max_throttled_messages': 1}, 'shutdown_after_number_of_empty_iterations': 3, 'sleep_duration': 1}, queue_adapter=qa)
+        handler = TimedHandler()
+        pulpo.handler_registry.register('limited', handler, rate_limit=20, burst=1)
+
+        qa.enqueue_batch([Message(payload=f'limited {i}', request_type='limited') for i in range(5)])
+        deferred = Statman.gauge('mqa.defer').value
+        pulpo.start()
+
+        # a message deferred over max_throttled_messages is not failed, however many times it is deferred
+        self.assertGreater(Statman.gauge('mqa.defer').value, deferred)
+        self.assertEqual(len(handler.handled_at), 5)
+        self.assertEqual(len(qa._messages), 0)
+
+    def test_message_held_back_by_circuit_breaker_refunds_rate_limit(self):
+        mock_queue_adapter = MagicMock(QueueAdapter)
+        pulpo = Pulpo(options={'default_circuit_breaker': {'minimum_calls': 1, 'open_duration': 60}}, queue_adapter=mock_queue_adapter)
+        pulpo.handler_registry.register('sample', AlwaysTransientFailureHandler(), rate_limit=0.001, burst=2, max_concurrency=1)
+        limiter = pulpo.handler_registry.get_limiter('sample')
+
+        # the first message opens the breaker, the second is held back
+        for message_id in range(1, 3):
+            pulpo.process_message(Message(message_id=message_id, payload='hello world', request_type='sample'))
+        mock_queue_adapter.defer.assert_called_once()
+
+        # the held back message did not use up the token nor the concurrency of the request type
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(limiter.acquire(), 0)
+
+    def test_max_concurrency_with_worker_pool(self):
+        qa = MemoryQueueAdapter()
+        options = {'worker_pool': {'mode': 'thread', 'size': 4}, 'shutdown_after_number_of_empty_iterations': 3, 'sleep_duration': 1}
+        pulpo = Pulpo(options=options, queue_adapter=qa)
+        handler = TimedHandler(duration=0.05)
+        pulpo.handler_registry.register('sample', handler, max_concurrency=2)
+
+        qa.enqueue_batch([Message(payload=f'sample {i}', request_type='sample') for i in range(8)])
+        pulpo.start()
+
+        self.assertEqual(len(handler.handled_at), 8)
+        self.assertEqual(handler.max_running, 2)
+        self.assertEqual(len(qa._messages), 0)
+
+
+class TestKessel_Wait(unittest.TestCase):
+
+    def test_wait_returns_when_message_may_be_available(self):
+        mock_queue_adapter = MagicMock(QueueAdapter)
+        mock_queue_adapter.wait_for_message.side_effect = [False, True]
+        pulpo = Pulpo(options={'wait_interval': 0.1}, queue_adapter=mock_queue_adapter)
+
+        self.assertTrue(pulpo.wait_for_messages(duration=5))
+        self.assertEqual(mock_queue_adapter.wait_for_message.call_count, 2)
+
+    def test_wait_is_interrupted_by_shutdown(self):
+        mock_queue_adapter = MagicMock(QueueAdapter)
+        pulpo = Pulpo(options={'wait_interval': 0.1}, queue_adapter=mock_queue_adapter)
+
+        def wait_for_message(timeout):
+            time.sleep(timeout)
+            pulpo.signal_handler(signal.SIGTERM, None)
+            return False
+
+        mock_queue_adapter.wait_for_message.side_effect = wait_for_message
+
+        start = time.monotonic()
+        self.assertFalse(pulpo.wait_for_messages(duration=5))
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_message_published_while_idle_is_handled_without_sleep_duration_delay(self):
+        qa = FileQueueAdapter(options={'base_path': get_unique_base_path('kessel-wait')})
+        pulpo = Pulpo(options={'shutdown_after_number_of_empty_iterations': 2, 'sleep_duration': 2}, queue_adapter=qa)
+        pulpo.handler_registry.register('success', AlwaysSucceedHandler())
+        handled_at = []
+        original_handle_message = pulpo.handle_message
+
+        def handle_message(message):
+            handled_at.append(time.monotonic())
+            return original_handle_message(message)
+
+        pulpo.handle_message = handle_message
+        start = time.monotonic()
+        threading.Timer(0.3, qa.enqueue, args=[Message(payload='hello world', request_type='success')]).start()
+        pulpo.start()
+
+        self.assertEqual(len(handled_at), 1)
+        self.assertLess(handled_at[0] - start, 1.5)
+
+    def test_message_published_while_in_flight_is_dispatched_to_free_worker(self):
+        qa = MemoryQueueAdapter()
+        options = {'worker_pool': {'mode': 'thread', 'size': 4}, 'shutdown_after_number_of_empty_iterations': 1, 'sleep_duration': 0.001, 'wait_interval': 5}
+        pulpo = Pulpo(options=options, queue_adapter=qa)
+        pulpo.handler_registry.register('sleep', SleepHandler())
+        handler = TimedHandler()
+        pulpo.handler_registry.register('timed', handler)
+
+        qa.enqueue(Message(payload='2', request_type='sleep'))
+        start = time.monotonic()
+        threading.Timer(0.3, qa.enqueue, args=[Message(payload='hello world', request_type='timed')]).start()
+        pulpo.start()
+
+        # not held behind the message in flight
+        self.assertEqual(len(handler.handled_at), 1)
+        self.assertLess(handler.handled_at[0] - start, 1)
@@ -0,0 +1,99 @@
+import datetime
+import unittest
+from pulpo_messaging.kessel import Config
+from pulpo_messaging.kessel import Message
+from pulpo_messaging.kessel import Pulpo
+from pulpo_messaging.kessel import QueueAdapter
+from pulpo_messaging.memory_queue_adapter import MemoryQueueAdapter
+from pulpo_messaging.sample_handlers import AlwaysSucceedHandler
+from . import test_fqa
+
+
+class TestMqaCompliance(test_fqa.TestFqaCompliance):
+
+    def queue_adapter_factory(self) -> QueueAdapter:
+        return MemoryQueueAdapter()
+
+
+class TestMqa(unittest.TestCase):
+
+    def test_initialize_from_pulpo_config(self):
+        config = Config()
+        config.set('queue_adapter_type', 'memory_queue_adapter')
+        pulpo = Pulpo(config)
+        self.assertIsInstance(pulpo.initialize_queue_adapter(), MemoryQueueAdapter)
+
+    def test_pulpo_handles_messages(self):
+        qa = MemoryQueueAdapter()
+        pulpo = Pulpo(options={'shutdown_after_number_of_empty_iterations': 1, 'sleep_duration': 0.1, 'batch_size': 10}, queue_adapter=qa)
+        pulpo.handler_registry.register('success', AlwaysSucceedHandler())
+        messages = pulpo.publish_many([Message(payload=f'hello {i}', request_type='success') for i in range(20)])
+        pulpo.start()
+        for m in messages:
+            self.assertIsNone(qa.peek(m.id))
+
+    def test_dequeue_in_priority_order(self):
+        qa = MemoryQueueAdapter()
+        low = qa.enqueue(Message(payload='low', priority=10))
+        high = qa.enqueue(Message(payload='high', priority=1))
+        self.assertEqual([m.id for m in qa.dequeue_batch(max_messages=2)], [high.id, low.id])
+
+    def test_delay(self):
+        qa = MemoryQueueAdapter()
+        m1 = qa.enqueue(Message(payload='hello world', delay=datetime.datetime.now() + datetime.timedelta(seconds=0.3)))
+        self.assertIsNone(qa.dequeue())
+        self.assertEqual([m.id for m in qa.dequeue_batch(max_messages=1, timeout=5)], [m1.id])
+
+    def test_sub_second_delay_delivered_on_time(self):
+        qa = MemoryQueueAdapter()
+        available_at = datetime.datetime.now() + datetime.timedelta(milliseconds=50)
+        m1 = qa.enqueue(Message(payload='hello world', delay=available_at))
+        self.assertEqual([m.id for m in qa.dequeue_batch(max_messages=1, timeout=5)], [m1.id])
+        lateness = (datetime.datetime.now() - available_at).total_seconds()
+        self.assertGreaterEqual(lateness, 0)
+        self.assertLess(lateness, 0.05)
+
+    def test_pause_request_type(self):
+        qa = MemoryQueueAdapter()
+        m1 = qa.enqueue(Message(payload='hello world', request_type='paused', priority=1))
+        m2 = qa.enqueue(Message(payload='hello world', request_type='other', priority=2))
+        self.assertTrue(qa.pause_request_type('paused', duration=0.3))
+
+        self.assertEqual(qa.dequeue().id, m2.id)
+        self.assertIsNone(qa.dequeue())
+        dq = qa.dequeue_batch(max_messages=1, timeout=5)
+        self.assertEqual([m.id for m in dq], [m1.id])
+        self.assertEqual(dq[0].attempts, 0)
+
+    def test_skip_expired_message(self):
+        qa = MemoryQueueAdapter()
+        m1 = qa.enqueue(Message(payload='hello world', expiration=datetime.datetime.now() - datetime.timedelta(seconds=1)))
+        self.assertIsNone(qa.dequeue())
+        self.assertIsNone(qa.peek(m1.id))
+
+    def test_message_exceeds_attempts_unavailable(self):
+        qa = MemoryQueueAdapter(options={'max_number_of_attempts': 1})
+        m1 = qa.enqueue(Message(payload='hello world'))
+        qa.rollback(qa.dequeue())
+        self.assertEqual(qa.peek(m1.id).attempts, 1)
+        self.assertIsNone(qa.dequeue())
+
+    def test_delete(self):
+        qa = MemoryQueueAdapter()
+        m1 = qa.enqueue(Message(payload='hello world'))
+        qa.delete(m1.id)
+        self.assertIsNone(qa.dequeue())
+
+    def test_reservation_expires(self):
+        qa = MemoryQueueAdapter(options={'ttr': 0.2})
+        m1 = qa.enqueue(Message(payload='hello world'))
+        dq_1 = qa.dequeue()
+        self.assertIsNone(qa.dequeue())
+
+        self.assertTrue(qa.wait_for_message(timeout=5))
+        dq_2 = qa.dequeue()
+        self.assertEqual(dq_2.id, m1.id)
+        self.assertEqual(dq_2.attempts, 1)
+        qa.commit(dq_2)
+        with self.assertRaises(Exception):
+            qa.commit(dq_1)
@@ -133,3 +133,69 @@ class TestMessageDelta(unittest.TestCase):
         # dates are almost equal
         print(f'm delay: {m.delay=}')
         assert (m.delayInSeconds - delta_in_seconds) < 1
+
+
+class TestMessageComponents(unittest.TestCase):
+
+    def test_components_parsed_once(self):
+        components = {
+            'id': 'm1',
+            'header': {
+                'request_type': 'echo',
+                'priority': '3',
+                'attempts': '2',
+                'delay': '2030-01-02 03:04:05.678000',
+                'expiration': '2031-01-02 03:04:05',
+                'k1': 'v1'
+            },
+            'body': {
+                'payload': 'hello'
+            }
+        }
+        m = Message(components=components)
+        self.assertEqual(m.id, 'm1')
+        self.assertEqual(m.request_type, 'echo')
+        self.assertEqual(m.priority, 3)
+        self.assertEqual(m.attempts, 2)
+        self.assertEqual(m.delay, datetime.datetime(2030, 1, 2, 3, 4, 5, 678000))
+        self.assertEqual(m.expiration, datetime.datetime(2031, 1, 2, 3, 4, 5))
+        self.assertEqual(m.get('header.delay'), datetime.datetime(2030, 1, 2, 3, 4, 5, 678000))
+        self.assertEqual(m.get('header.k1'), 'v1')
+        self.assertEqual(m.payload, 'hello')
+
+    def test_components_rebuilt(self):
+        m = Message(payload='hello', request_type='echo', header={'k1': 'v1'})
+        m.id = 'm1'
+        m.attempts = 1
+        m.set('trace.parent', 'p1')
+        self.assertEqual(m._components, {'id': 'm1', 'header': {'k1': 'v1', 'request_type': 'echo', 'attempts': 1}, 'body': {'payload': 'hello'}, 'trace': {'parent': 'p1'}})
+        self.assertEqual(m.get('trace.parent'), 'p1')
+
+    def test_set_header_replaces_items(self):
+        m = Message(request_type='echo', header={'k1': 'v1'})
+        m.set('header', {'k2': 'v2', 'priority': 1})
+        self.assertIsNone(m.request_type)
+        self.assertEqual(m.priority, 1)
+        self.assertEqual(m.header, {'k2': 'v2', 'priority': 1})
+
+    def test_empty_header(self):
+        m = Message(payload='hello')
+        self.assertIsNone(m.header)
+        self.assertNotIn('header', m._components)
+
+    def test_priority(self):
+        self.assertEqual(Message().priority, Message.DEFAULT_PRIORITY)
+        self.assertEqual(Message(priority=0).priority, 0)
+        self.assertEqual(Message(priority=-1).priority, 0)
+        self.assertEqual(Message(priority=2**40).priority, Message.MAX_PRIORITY)
+
+    def test_aged_priority(self):
+        m = Message(priority=10)
+        self.assertEqual(m.get_aged_priority(waited_seconds=25, priority_aging_interval=10), 8)
+        self.assertEqual(m.get_aged_priority(waited_seconds=1000, priority_aging_interval=10), 0)
+        self.assertEqual(m.get_aged_priority(waited_seconds=25, priority_aging_interval=0), 10)
+
+    def test_slotted(self):
+        m = Message()
+        with self.assertRaises(AttributeError):
+            setattr(m, 'unknown_attribute', 1)
@@ -0,0 +1,126 @@
+import io
+import unittest
+import datetime
+from pulpo_messaging import message_codec
+from pulpo_messaging.kessel import Message
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class TestMessageCodec(unittest.TestCase):
+
+    @staticmethod
+    def message_factory() -> Message:
+        m = Message(payload='hello world', request_type='echo', delay=datetime.datetime(2030, 1, 2, 3, 4, 5, 678000), expiration=datetime.datetime(2031, 1, 2, 3, 4, 5))
+        m.id = 'id-1'
+        m.priority = 5
+        m.set('header.attempts', 2)
+        m.set('header.custom', 'c1')
+        return m
+
+    def assert_round_trip(self, message_format: str):
+        m = TestMessageCodec.message_factory()
+        data = message_codec.encode_message(m, message_format)
+        self.assertIsInstance(data, bytes)
+
+        m2 = message_codec.decode_message(data)
+        self.assertEqual(m2.id, 'id-1')
+        self.assertEqual(m2.payload, 'hello world')
+        self.assertEqual(m2.request_type, 'echo')
+        self.assertEqual(m2.priority, 5)
+        self.assertEqual(m2.get('header.attempts'), 2)
+        self.assertEqual(m2.get('header.custom'), 'c1')
+        self.assertEqual(m2.delay, datetime.datetime(2030, 1, 2, 3, 4, 5, 678000))
+        self.assertEqual(m2.expiration, datetime.datetime(2031, 1, 2, 3, 4, 5))
+        return data
+
+    def test_json_round_trip(self):
+        data = self.assert_round_trip('json')
+        self.assertTrue(data.startswith(b'{'))
+
+    def test_json_compact_round_trip(self):
+        data = self.assert_round_trip('json-compact')
+        self.assertLess(len(data), len(message_codec.encode_message(TestMessageCodec.message_factory(), 'json')))
+
+    @unittest.skipUnless(msgpack, 'msgpack is not installed')
+    def test_msgpack_round_trip(self):
+        self.assert_round_trip('msgpack')
+
+    def test_struct_round_trip(self):
+        data = self.assert_round_trip('struct')
+        self.assertLess(len(data), len(message_codec.encode_message(TestMessageCodec.message_factory(), 'json-compact')))
+
+    def test_struct_non_string_payload(self):
+        m = Message(payload={'k1': 'v1', 'k2': [1, 2]})
+        m2 = message_codec.decode_message(message_codec.encode_message(m, 'struct'))
+        self.assertEqual(m2.payload, {'k1': 'v1', 'k2': [1, 2]})
+
+    def test_struct_empty_message(self):
+        m2 = message_codec.decode_message(message_codec.encode_message(Message(), 'struct'))
+        self.assertIsNone(m2.payload)
+        self.assertIsNone(m2.request_type)
+
+    def test_decode_str(self):
+        m = TestMessageCodec.message_factory()
+        m2 = message_codec.decode_message(message_codec.encode_message(m, 'json').decode('utf-8'))
+        self.assertEqual(m2.payload, 'hello world')
+
+    def test_decode_mixed_formats(self):
+        formats = ['json', 'json-compact', 'struct']
+        encoded = [message_codec.encode_message(Message(payload=f'payload {message_format}'), message_format) for message_format in formats]
+        payloads = [message_codec.decode_message(data).payload for data in encoded]
+        self.assertEqual(payloads, [f'payload {message_format}' for message_format in formats])
+
+    def test_invalid_message_format(self):
+        with self.assertRaises(Exception) as context:
+            message_codec.encode_message(Message(payload='hello world'), 'xml')
+        self.assertIn('invalid message format', str(context.exception))
+
+    def test_unknown_format_tag(self):
+        with self.assertRaises(Exception) as context:
+            message_codec.decode_message(message_codec.FORMAT_TAG_MARKER + b'?{}')
+        self.assertIn('unknown message format', str(context.exception))
+
+
+class TestMessageCodecLazyBody(unittest.TestCase):
+
+    def test_body_decoded_on_access(self):
+        for message_format in ('json-compact', 'struct'):
+            data = message_codec.encode_message(Message(payload='hello world', request_type='echo'), message_format)
+            m = message_codec.decode_message(data)
+            self.assertEqual(m.request_type, 'echo')
+            self.assertIsNotNone(m._get_raw_body(message_codec.get_codec(message_format)))
+
+            self.assertEqual(m.payload, 'hello world')
+            self.assertIsNone(m._get_raw_body(message_codec.get_codec(message_format)))
+
+    def test_undecoded_body_written_as_is(self):
+        data = message_codec.encode_message(Message(payload={'k1': 'v1'}), 'struct')
+        m = message_codec.decode_message(data)
+        m.attempts = 1
+
+        m2 = message_codec.decode_message(message_codec.encode_message(m, 'struct'))
+        self.assertIsNotNone(m._get_raw_body(message_codec.get_codec('struct')))
+        self.assertEqual(m2.attempts, 1)
+        self.assertEqual(m2.payload, {'k1': 'v1'})
+
+    def test_undecoded_body_other_format(self):
+        m = message_codec.decode_message(message_codec.encode_message(Message(payload='hello world'), 'struct'))
+        m2 = message_codec.decode_message(message_codec.encode_message(m, 'json-compact'))
+        self.assertEqual(m2.payload, 'hello world')
+
+    def test_header_only(self):
+        data = message_codec.encode_message(Message(payload='hello world', request_type='echo'), 'json-compact')
+        m = message_codec.decode_message(data, header_only=True)
+        self.assertEqual(m.request_type, 'echo')
+        self.assertIsNone(m.body)
+
+    def test_read_message_header(self):
+        for message_format in ('json', 'json-compact', 'struct'):
+            data = message_codec.encode_message(Message(payload='hello world', request_type='echo', delay=datetime.datetime(2030, 1, 2, 3, 4, 5, 678000)), message_format)
+            m = message_codec.read_message_header(io.BytesIO(data))
+            self.assertEqual(m.request_type, 'echo')
+            self.assertEqual(m.delay, datetime.datetime(2030, 1, 2, 3, 4, 5, 678000))
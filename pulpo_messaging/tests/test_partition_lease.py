@@ -0,0 +1,128 @@
+import os
+import time
+import unittest
+from statman import Statman
+from pulpo_messaging.kessel import FileQueueAdapter
+from pulpo_messaging.kessel import Message
+from pulpo_messaging.partition_lease import PartitionLeases
+from . import test_fqa
+from .unittest_helper import get_unique_base_path
+
+
+class TestPartitionLeases(unittest.TestCase):
+
+    PARTITIONS = ['000', '001', '002', '003']
+
+    @staticmethod
+    def leases_factory(lease_path: str, consumer_id: str, lease_duration: float = 30) -> PartitionLeases:
+        return PartitionLeases(lease_path=lease_path, partitions=TestPartitionLeases.PARTITIONS, lease_duration=lease_duration, consumer_id=consumer_id)
+
+    def test_single_consumer_holds_every_partition(self):
+        leases = self.leases_factory(get_unique_base_path('lease'), 'c1')
+        leases.rebalance()
+        self.assertEqual(leases.owned, self.PARTITIONS)
+
+    def test_partitions_shared_between_consumers(self):
+        lease_path = get_unique_base_path('lease')
+        leases_1 = self.leases_factory(lease_path, 'c1')
+        leases_1.rebalance()
+        leases_2 = self.leases_factory(lease_path, 'c2')
+        leases_2.rebalance()
+        self.assertEqual(leases_2.owned, [])
+
+        # c1 gives up partitions above its share, which c2 then claims
+        leases_1.rebalance()
+        leases_2.rebalance()
+        self.assertEqual(len(leases_1.owned), 2)
+        self.assertEqual(len(leases_2.owned), 2)
+        self.assertEqual(sorted(leases_1.owned + leases_2.owned), self.PARTITIONS)
+
+    def test_expired_leases_taken_over(self):
+        lease_path = get_unique_base_path('lease')
+        leases_1 = self.leases_factory(lease_path, 'c1', lease_duration=0.2)
+        leases_1.rebalance()
+
+        leases_2 = self.leases_factory(lease_path, 'c2', lease_duration=0.2)
+        time.sleep(0.3)
+        leases_2.rebalance()
+        self.assertEqual(leases_2.owned, self.PARTITIONS)
+
+    def test_release_all(self):
+        lease_path = get_unique_base_path('lease')
+        leases_1 = self.leases_factory(lease_path, 'c1')
+        leases_1.rebalance()
+        leases_1.release_all()
+        self.assertEqual(leases_1.owned, [])
+
+        leases_2 = self.leases_factory(lease_path, 'c2')
+        leases_2.rebalance()
+        self.assertEqual(leases_2.owned, self.PARTITIONS)
+
+
+class TestFqaPartitionLeases(unittest.TestCase):
+
+    @staticmethod
+    def consumer_factory(base_path: str, additional_options: dict = None) -> FileQueueAdapter:
+        options = {'base_path': base_path, 'shard_count': 4, 'enable_partition_leases': True}
+        options.update(additional_options or {})
+        return FileQueueAdapter(options=options)
+
+    def test_requires_sharded_layout(self):
+        with self.assertRaises(Exception):
+            FileQueueAdapter(options={'base_path': get_unique_base_path('fqa-lease'), 'enable_partition_leases': True})
+
+    def test_consumers_scan_own_partitions(self):
+        base_path = get_unique_base_path('fqa-lease')
+        consumer_1 = self.consumer_factory(base_path, {'disable_work_stealing': True})
+        consumer_1.partition_leases.rebalance()
+        consumer_2 = self.consumer_factory(base_path, {'disable_work_stealing': True})
+        consumer_2.partition_leases.rebalance()
+        consumer_1.partition_leases.rebalance()
+        consumer_2.partition_leases.rebalance()
+
+        producer = FileQueueAdapter(options={'base_path': base_path, 'shard_count': 4})
+        messages = producer.enqueue_batch([Message(payload=f'hello {i}') for i in range(40)])
+        lock_failures = Statman.gauge('fqa.lock-check.exists.failed-lock.FileNotFoundError').value
+
+        dequeued_1 = consumer_1.dequeue_batch(max_messages=40)
+        dequeued_2 = consumer_2.dequeue_batch(max_messages=40)
+        self.assertEqual({consumer_1._layout.get_shard_name(m.id) for m in dequeued_1}, set(consumer_1.partition_leases.owned))
+        self.assertEqual({consumer_2._layout.get_shard_name(m.id) for m in dequeued_2}, set(consumer_2.partition_leases.owned))
+        self.assertEqual(sorted(m.id for m in dequeued_1 + dequeued_2), sorted(m.id for m in messages))
+        self.assertEqual(Statman.gauge('fqa.lock-check.exists.failed-lock.FileNotFoundError').value, lock_failures)
+
+    def test_idle_consumer_steals_work(self):
+        base_path = get_unique_base_path('fqa-lease')
+        consumer_1 = self.consumer_factory(base_path)
+        consumer_1.partition_leases.rebalance()
+        consumer_2 = self.consumer_factory(base_path)
+        consumer_2.partition_leases.rebalance()
+        self.assertEqual(consumer_2.partition_leases.owned, [])
+
+        m1 = consumer_1.enqueue(Message(payload='hello world'))
+        self.assertEqual(consumer_2.dequeue().id, m1.id)
+
+    def test_partitions_rebalanced_when_consumer_dies(self):
+        base_path = get_unique_base_path('fqa-lease')
+        consumer_1 = self.consumer_factory(base_path, {'partition_lease_duration': 0.3, 'disable_work_stealing': True})
+        consumer_2 = self.consumer_factory(base_path, {'partition_lease_duration': 0.3, 'disable_work_stealing': True})
+        consumer_1.partition_leases.rebalance()
+        consumer_2.partition_leases.rebalance()
+        consumer_1.partition_leases.rebalance()
+        consumer_2.partition_leases.rebalance()
+        self.assertEqual(len(consumer_2.partition_leases.owned), 2)
+
+        # consumer_1 stops renewing its leases
+        messages = consumer_1.enqueue_batch([Message(payload=f'hello {i}') for i in range(20)])
+        time.sleep(0.4)
+        dequeued = consumer_2.dequeue_batch(max_messages=20)
+        self.assertEqual(consumer_2.partition_leases.owned, consumer_2._layout.shard_names)
+        self.assertEqual(sorted(m.id for m in dequeued), sorted(m.id for m in messages))
+        self.assertTrue(os.path.exists(consumer_2.config.lease_path))
+
+
+class TestFqaPartitionLeasesCompliance(test_fqa.TestFqaCompliance):
+
+    def queue_adapter_factory(self) -> FileQueueAdapter:
+        # order is kept within a shard only; the compliance tests expect first in first out
+        return TestFqaPartitionLeases.consumer_factory(get_unique_base_path('fqa-lease-compliance'), {'shard_count': 1})
@@ -0,0 +1,103 @@
+import multiprocessing
+import os
+import time
+import unittest
+from pulpo_messaging.rate_limiter import RequestTypeLimiter, TokenBucket
+from .unittest_helper import get_unique_base_path
+
+
+def acquire_tokens(path: str, count: int, acquired):
+    bucket = TokenBucket(rate=0.001, burst=10, path=path)
+    for _ in range(count):
+        if not bucket.try_acquire():
+            with acquired.get_lock():
+                acquired.value += 1
+    bucket.close()
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=10, burst=3)
+        for _ in range(3):
+            self.assertEqual(bucket.try_acquire(), 0)
+        wait = bucket.try_acquire()
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.1)
+
+        time.sleep(wait)
+        self.assertEqual(bucket.try_acquire(), 0)
+
+    def test_refund(self):
+        bucket = TokenBucket(rate=0.001, burst=2)
+        self.assertEqual(bucket.try_acquire(), 0)
+        bucket.refund()
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertGreater(bucket.try_acquire(), 0)
+
+        # a refund does not fill the bucket over burst
+        for _ in range(3):
+            bucket.refund()
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertGreater(bucket.try_acquire(), 0)
+
+    def test_burst_defaults_to_rate(self):
+        self.assertEqual(TokenBucket(rate=5).burst, 5)
+        self.assertEqual(TokenBucket(rate=0.5).burst, 1)
+
+    def test_invalid_rate(self):
+        with self.assertRaises(Exception):
+            TokenBucket(rate=0)
+
+    def test_file_bucket_shared_across_processes(self):
+        base_path = get_unique_base_path('rate-limiter')
+        os.makedirs(base_path)
+        path = os.path.join(base_path, 'sample.bucket')
+        acquired = multiprocessing.Value('i', 0)
+        processes = [multiprocessing.Process(target=acquire_tokens, args=(path, 5, acquired)) for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        # 20 attempts against one bucket of 10 tokens
+        self.assertEqual(acquired.value, 10)
+        bucket = TokenBucket(rate=0.001, burst=10, path=path)
+        self.assertGreater(bucket.try_acquire(), 0)
+        bucket.close()
+
+
+class TestRequestTypeLimiter(unittest.TestCase):
+
+    def test_concurrency_cap(self):
+        limiter = RequestTypeLimiter(request_type='sample', max_concurrency=2)
+        self.assertEqual(limiter.acquire(), 0)
+        self.assertEqual(limiter.acquire(), 0)
+        self.assertEqual(limiter.acquire(), RequestTypeLimiter.CONCURRENCY_HOLD_DURATION)
+
+        limiter.release()
+        self.assertEqual(limiter.acquire(), 0)
+
+    def test_capped_message_does_not_take_a_token(self):
+        limiter = RequestTypeLimiter(request_type='sample', rate_limit=0.001, burst=1, max_concurrency=1)
+        self.assertEqual(limiter.acquire(), 0)
+        self.assertEqual(limiter.acquire(), RequestTypeLimiter.CONCURRENCY_HOLD_DURATION)
+
+        limiter.release()
+        # the token was taken by the first message only
+        self.assertGreater(limiter.acquire(), 1)
+
+    def test_refund(self):
+        directory = get_unique_base_path('rate-limiter')
+        limiter = RequestTypeLimiter(request_type='sample', rate_limit=0.001, burst=1, max_concurrency=1, directory=directory)
+        self.assertEqual(limiter.acquire(), 0)
+        limiter.refund()
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(limiter.acquire(), 0)
+
+    def test_bucket_file_in_directory(self):
+        directory = get_unique_base_path('rate-limiter')
+        RequestTypeLimiter(request_type='api/call', rate_limit=1, directory=directory)
+        self.assertEqual(os.listdir(directory), ['api%2Fcall.bucket'])
@@ -0,0 +1,70 @@
+import unittest
+from pulpo_messaging.ready_index import ReadyIndex, ReadyIndexEntry
+
+
+class TestReadyIndex(unittest.TestCase):
+
+    def test_pop_empty(self):
+        index = ReadyIndex()
+        self.assertIsNone(index.pop(now=100))
+
+    def test_pop_priority_then_available_at(self):
+        index = ReadyIndex()
+        index.push(ReadyIndexEntry(priority=5, available_at=1, message_id='a', file_name='a.message'), now=100)
+        index.push(ReadyIndexEntry(priority=1, available_at=2, message_id='b', file_name='b.message'), now=100)
+        index.push(ReadyIndexEntry(priority=1, available_at=1, message_id='c', file_name='c.message'), now=100)
+
+        self.assertEqual(index.pop(now=100).message_id, 'c')
+        self.assertEqual(index.pop(now=100).message_id, 'b')
+        self.assertEqual(index.pop(now=100).message_id, 'a')
+        self.assertIsNone(index.pop(now=100))
+
+    def test_priority_aging(self):
+        index = ReadyIndex(priority_aging_interval=10)
+        index.push(ReadyIndexEntry(priority=5, available_at=95, message_id='a', file_name='a.message'), now=100)
+        index.push(ReadyIndexEntry(priority=7, available_at=60, message_id='b', file_name='b.message'), now=100)
+        index.push(ReadyIndexEntry(priority=7, available_at=99, message_id='c', file_name='c.message'), now=100)
+
+        # ranks: a = 145, b = 130, c = 169
+        self.assertEqual(index.pop(now=100).message_id, 'b')
+        self.assertEqual(index.pop(now=100).message_id, 'a')
+        self.assertEqual(index.pop(now=100).message_id, 'c')
+
+    def test_delayed_entry_promoted_when_due(self):
+        index = ReadyIndex()
+        index.push(ReadyIndexEntry(priority=1, available_at=200, message_id='a', file_name='a.message'), now=100)
+
+        self.assertIsNone(index.pop(now=100))
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.pop(now=200).message_id, 'a')
+
+    def test_known_file_names(self):
+        index = ReadyIndex()
+        index.push(ReadyIndexEntry(priority=1, available_at=0, message_id='a', file_name='a.message'), now=100)
+        index.push(ReadyIndexEntry(priority=1, available_at=0, message_id='b', file_name='b.message'), now=100)
+        self.assertTrue(index.is_known('a.message'))
+
+        index.retain({'b.message'})
+        self.assertFalse(index.is_known('a.message'))
+        self.assertTrue(index.is_known('b.message'))
+
+        index.pop(now=100)
+        index.pop(now=100)
+        self.assertFalse(index.is_known('b.message'))
+
+    def test_file_name_by_id(self):
+        index = ReadyIndex()
+        index.push(ReadyIndexEntry(priority=1, available_at=0, message_id='a', file_name='1-a.message'), now=100)
+        index.push(ReadyIndexEntry(priority=1, available_at=0, message_id='b', file_name='1-b.message'), now=100)
+        self.assertEqual(index.get_file_name('a'), '1-a.message')
+        self.assertIsNone(index.get_file_name('c'))
+
+        # pushed again under another file name, then the first entry is popped
+        index.push(ReadyIndexEntry(priority=2, available_at=0, message_id='a', file_name='2-a.message'), now=100)
+        self.assertEqual(index.pop(now=100).file_name, '1-a.message')
+        self.assertEqual(index.get_file_name('a'), '2-a.message')
+
+        index.discard('1-b.message')
+        self.assertIsNone(index.get_file_name('b'))
+        index.retain({'2-a.message'})
+        self.assertEqual(index.get_file_name('a'), '2-a.message')
@@ -0,0 +1,41 @@
+import unittest
+from pulpo_messaging.retry_policy import RetryPolicies, RetryPolicy
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_exponential_backoff_capped(self):
+        policy = RetryPolicy({'initial_delay': 1, 'multiplier': 2, 'max_delay': 10, 'jitter': 'none'})
+        self.assertEqual([policy.get_delay(attempts) for attempts in range(6)], [1, 2, 4, 8, 10, 10])
+        self.assertEqual(policy.get_delay(attempts=10000), 10)
+
+    def test_full_jitter(self):
+        policy = RetryPolicy({'initial_delay': 4, 'jitter': 'full'})
+        delays = [policy.get_delay(attempts=1) for _ in range(100)]
+        self.assertTrue(all(0 <= delay <= 8 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_equal_jitter(self):
+        policy = RetryPolicy({'initial_delay': 4, 'jitter': 'equal'})
+        self.assertTrue(all(4 <= policy.get_delay(attempts=1) <= 8 for _ in range(100)))
+
+    def test_invalid_jitter(self):
+        with self.assertRaises(Exception):
+            RetryPolicy({'jitter': 'some'})
+
+
+class TestRetryPolicies(unittest.TestCase):
+
+    def test_policy_of_request_type_then_default(self):
+        policies = RetryPolicies(policies={'email': {'initial_delay': 5, 'jitter': 'none'}}, default_policy={'initial_delay': 1, 'jitter': 'none'})
+        self.assertEqual(policies.get_delay(request_type='email', attempts=0), 5)
+        self.assertEqual(policies.get_delay(request_type='print', attempts=0), 1)
+
+    def test_no_policy(self):
+        policies = RetryPolicies(policies={'email': {'initial_delay': 5}})
+        self.assertIsNone(policies.get_delay(request_type='print', attempts=3))
+
+    def test_retry_after_given_by_handler(self):
+        policies = RetryPolicies(default_policy={'initial_delay': 1})
+        self.assertEqual(policies.get_delay(request_type='print', attempts=0, retry_after=42), 42)
+        self.assertEqual(RetryPolicies().get_delay(request_type='print', attempts=0, retry_after=42), 42)
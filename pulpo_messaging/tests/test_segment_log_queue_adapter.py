@@ -0,0 +1,182 @@
+import os
+import time
+import datetime
+import unittest
+from pulpo_messaging.kessel import Config
+from pulpo_messaging.kessel import Message
+from pulpo_messaging.kessel import Pulpo
+from pulpo_messaging.kessel import QueueAdapter
+from pulpo_messaging.segment_log import INDEX_ENTRY
+from pulpo_messaging.segment_log_queue_adapter import SegmentLogQueueAdapter
+from . import test_fqa
+from .unittest_helper import get_unique_base_path
+
+
+class TestSlqaCompliance(test_fqa.TestFqaCompliance):
+
+    def queue_adapter_factory(self) -> QueueAdapter:
+        return SegmentLogQueueAdapter(options={'base_path': get_unique_base_path('slqa-compliance')})
+
+
+class TestSlqa(unittest.TestCase):
+
+    @staticmethod
+    def segment_log_queue_adapter_factory(base_path: str = None, additional_options: dict = None) -> SegmentLogQueueAdapter:
+        options = {'base_path': base_path or get_unique_base_path('slqa')}
+        options.update(additional_options or {})
+        return SegmentLogQueueAdapter(options=options)
+
+    def test_initialize_from_pulpo_config(self):
+        config = Config()
+        config.set('queue_adapter_type', 'segment_log_queue_adapter')
+        config.set('segment_log_queue_adapter', {'base_path': get_unique_base_path('slqa-pulpo')})
+        pulpo = Pulpo(config)
+        self.assertIsInstance(pulpo.initialize_queue_adapter(), SegmentLogQueueAdapter)
+
+    def test_second_adapter_on_same_log_fails(self):
+        qa = self.segment_log_queue_adapter_factory()
+        with self.assertRaises(Exception):
+            self.segment_log_queue_adapter_factory(base_path=qa.config.base_path)
+
+    def test_invalid_fsync_policy(self):
+        with self.assertRaises(Exception):
+            self.segment_log_queue_adapter_factory(additional_options={'fsync_policy': 'sometimes'})
+
+    def test_dequeue_in_priority_order(self):
+        qa = self.segment_log_queue_adapter_factory()
+        low = qa.enqueue(Message(payload='low', priority=10))
+        high = qa.enqueue(Message(payload='high', priority=1))
+        self.assertEqual([m.id for m in qa.dequeue_batch(max_messages=2)], [high.id, low.id])
+
+    def test_delay(self):
+        qa = self.segment_log_queue_adapter_factory()
+        m1 = qa.enqueue(Message(payload='hello world', delay=datetime.datetime.now() + datetime.timedelta(seconds=0.5)))
+        self.assertIsNone(qa.dequeue())
+        self.assertTrue(qa.wait_for_message(timeout=5))
+        self.assertEqual(qa.dequeue().id, m1.id)
+
+    def test_skip_expired_message(self):
+        qa = self.segment_log_queue_adapter_factory()
+        m1 = qa.enqueue(Message(payload='hello world', expiration=datetime.datetime.now() - datetime.timedelta(seconds=1)))
+        self.assertIsNone(qa.dequeue())
+        self.assertIsNone(qa.peek(m1.id))
+
+    def test_message_exceeds_attempts_unavailable(self):
+        qa = self.segment_log_queue_adapter_factory(additional_options={'max_number_of_attempts': 2})
+        m1 = qa.enqueue(Message(payload='hello world'))
+        qa.rollback(qa.dequeue())
+        dq = qa.dequeue()
+        self.assertEqual(dq.attempts, 1)
+        qa.rollback(dq)
+        self.assertIsNone(qa.dequeue())
+        self.assertIsNone(qa.peek(m1.id))
+
+    def test_delete(self):
+        qa = self.segment_log_queue_adapter_factory()
+        m1 = qa.enqueue(Message(payload='hello world'))
+        qa.delete(m1.id)
+        self.assertIsNone(qa.peek(m1.id))
+        self.assertIsNone(qa.dequeue())
+
+    def test_state_recovered_after_restart(self):
+        qa = self.segment_log_queue_adapter_factory()
+        messages = qa.enqueue_batch([Message(payload=f'hello {i}') for i in range(4)])
+        qa.commit(qa.dequeue())
+        qa.rollback(qa.dequeue())
+        # locked when the process stops
+        locked = qa.dequeue()
+        self.assertEqual(locked.attempts, 1)
+        qa.close()
+
+        qa = self.segment_log_queue_adapter_factory(base_path=qa.config.base_path)
+        self.assertIsNone(qa.peek(messages[0].id))
+        dequeued = qa.dequeue_batch(max_messages=4)
+        self.assertEqual([m.id for m in dequeued], [m.id for m in messages[1:]])
+        self.assertEqual(dequeued[0].id, locked.id)
+        self.assertEqual(dequeued[0].attempts, 2)
+        self.assertEqual(dequeued[1].attempts, 0)
+
+        m5 = qa.enqueue(Message(payload='hello 5'))
+        self.assertGreater(int(m5.id), int(messages[-1].id))
+
+    def test_segments_rolled(self):
+        qa = self.segment_log_queue_adapter_factory(additional_options={'segment_max_bytes': 256})
+        messages = qa.enqueue_batch([Message(payload=f'hello {i}') for i in range(10)])
+        self.assertGreater(len(os.listdir(qa.config.segments_path)), 2)
+        for m in messages:
+            self.assertEqual(qa.peek(m.id).payload, m.payload)
+        self.assertEqual([m.id for m in qa.dequeue_batch(max_messages=10)], [m.id for m in messages])
+
+    def test_compaction(self):
+        qa = self.segment_log_queue_adapter_factory(additional_options={'segment_max_bytes': 256})
+        messages = qa.enqueue_batch([Message(payload=f'hello {i}') for i in range(20)])
+        segment_count = len(qa._segments)
+        for m in qa.dequeue_batch(max_messages=15):
+            qa.commit(m)
+
+        self.assertGreater(qa.compact(), 0)
+        self.assertLess(len(qa._segments), segment_count)
+        self.assertEqual([m.id for m in qa.dequeue_batch(max_messages=20)], [m.id for m in messages[15:]])
+        qa.close()
+
+        qa = self.segment_log_queue_adapter_factory(base_path=qa.config.base_path)
+        self.assertEqual(len(qa.dequeue_batch(max_messages=20)), 5)
+
+    def test_partially_live_segment_rewritten(self):
+        qa = self.segment_log_queue_adapter_factory(additional_options={'segment_max_bytes': 1024})
+        messages = qa.enqueue_batch([Message(payload=f'hello {i}') for i in range(10)])
+        qa.enqueue(Message(payload='x' * 1024))
+        first_segment = qa._segments[0]
+        size = first_segment.size
+        for m in qa.dequeue_batch(max_messages=9):
+            qa.commit(m)
+
+        self.assertEqual(qa.compact(), 1)
+        self.assertLess(first_segment.size, size)
+        self.assertEqual(qa.peek(messages[9].id).payload, 'hello 9')
+        self.assertEqual(qa.dequeue().id, messages[9].id)
+
+    def test_torn_writes_recovered(self):
+        qa = self.segment_log_queue_adapter_factory()
+        messages = qa.enqueue_batch([Message(payload=f'hello {i}') for i in range(3)])
+        qa.close()
+        segment_path = qa._segments[-1].log_path
+        index_path = qa._segments[-1].index_path
+        # the last index entry was not written, and a record was torn
+        os.truncate(index_path, os.path.getsize(index_path) - INDEX_ENTRY.size)
+        with open(segment_path, 'ab') as f:
+            f.write(b'\x00\x00\x00\x10torn')
+
+        qa = self.segment_log_queue_adapter_factory(base_path=qa.config.base_path)
+        self.assertEqual([m.id for m in qa.dequeue_batch(max_messages=5)], [m.id for m in messages])
+        m4 = qa.enqueue(Message(payload='hello 4'))
+        self.assertEqual(qa.peek(m4.id).payload, 'hello 4')
+
+    def test_fsync_policy_always(self):
+        qa = self.segment_log_queue_adapter_factory(additional_options={'fsync_policy': 'always'})
+        m1 = qa.enqueue(Message(payload='hello world'))
+        qa.commit(qa.dequeue())
+        self.assertIsNone(qa.peek(m1.id))
+
+    def test_background_maintenance(self):
+        qa = self.segment_log_queue_adapter_factory(additional_options={'fsync_policy': 'interval', 'fsync_interval': 0.1, 'compaction_interval': 0.1, 'segment_max_bytes': 128})
+        qa.enqueue_batch([Message(payload=f'hello {i}') for i in range(5)])
+        for m in qa.dequeue_batch(max_messages=5):
+            qa.commit(m)
+        time.sleep(0.5)
+        qa.close()
+        self.assertEqual(len(qa._segments), 1)
+
+    def test_disable_compaction(self):
+        qa = self.segment_log_queue_adapter_factory(additional_options={'disable_compaction': True, 'segment_max_bytes': 128})
+        self.assertIsNone(qa._maintenance_thread)
+        messages = qa.enqueue_batch([Message(payload=f'hello {i}') for i in range(5)])
+        self.assertGreater(len(qa._segments), 2)
+        for m in qa.dequeue_batch(max_messages=4):
+            qa.commit(m)
+
+        # only an explicit compact reclaims the done segments; the segment of each live message is still found
+        self.assertEqual(qa.peek(messages[4].id).payload, 'hello 4')
+        self.assertGreater(qa.compact(), 0)
+        self.assertEqual(qa.peek(messages[4].id).payload, 'hello 4')
+        qa.close()
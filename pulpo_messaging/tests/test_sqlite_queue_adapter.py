@@ -0,0 +1,130 @@
+import time
+import datetime
+import threading
+import unittest
+from pulpo_messaging.kessel import Config
+from pulpo_messaging.kessel import Message
+from pulpo_messaging.kessel import Pulpo
+from pulpo_messaging.kessel import QueueAdapter
+from pulpo_messaging.sqlite_queue_adapter import SqliteQueueAdapter
+from . import test_fqa
+from .unittest_helper import get_unique_base_path
+
+
+class TestSqliteQaCompliance(test_fqa.TestFqaCompliance):
+
+    def queue_adapter_factory(self) -> QueueAdapter:
+        return SqliteQueueAdapter(options={'base_path': get_unique_base_path('sqliteqa-compliance')})
+
+
+class TestSqliteQa(unittest.TestCase):
+
+    @staticmethod
+    def sqlite_queue_adapter_factory(base_path: str = None, additional_options: dict = None) -> SqliteQueueAdapter:
+        options = {'base_path': base_path or get_unique_base_path('sqliteqa')}
+        options.update(additional_options or {})
+        return SqliteQueueAdapter(options=options)
+
+    def test_initialize_from_pulpo_config(self):
+        config = Config()
+        config.set('queue_adapter_type', 'sqlite_queue_adapter')
+        config.set('sqlite_queue_adapter', {'base_path': get_unique_base_path('sqliteqa-pulpo')})
+        pulpo = Pulpo(config)
+        self.assertIsInstance(pulpo.initialize_queue_adapter(), SqliteQueueAdapter)
+
+    def test_wal_mode(self):
+        qa = self.sqlite_queue_adapter_factory()
+        self.assertEqual(qa._get_connection().execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+    def test_dequeue_uses_index(self):
+        qa = self.sqlite_queue_adapter_factory()
+        plan = qa._get_connection().execute('EXPLAIN QUERY PLAN ' + qa.SELECT_READY, (time.time(), 1)).fetchall()
+        self.assertIn('message_dequeue', str(plan))
+        self.assertNotIn('TEMP B-TREE', str(plan))
+
+    def test_dequeue_in_priority_order(self):
+        qa = self.sqlite_queue_adapter_factory()
+        low = qa.enqueue(Message(payload='low', priority=10))
+        high = qa.enqueue(Message(payload='high', priority=1))
+        self.assertEqual([m.id for m in qa.dequeue_batch(max_messages=2)], [high.id, low.id])
+
+    def test_enqueue_batch(self):
+        qa = self.sqlite_queue_adapter_factory()
+        messages = qa.enqueue_batch([Message(payload=f'hello {i}') for i in range(10)])
+        self.assertEqual([m.id for m in qa.dequeue_batch(max_messages=20)], [m.id for m in messages])
+
+    def test_delay(self):
+        qa = self.sqlite_queue_adapter_factory()
+        m1 = qa.enqueue(Message(payload='hello world', delay=datetime.datetime.now() + datetime.timedelta(seconds=0.5)))
+        self.assertIsNone(qa.dequeue())
+        self.assertTrue(qa.wait_for_message(timeout=5))
+        self.assertEqual(qa.dequeue().id, m1.id)
+
+    def test_skip_expired_message(self):
+        qa = self.sqlite_queue_adapter_factory()
+        m1 = qa.enqueue(Message(payload='hello world', expiration=datetime.datetime.now() - datetime.timedelta(seconds=1)))
+        self.assertIsNone(qa.dequeue())
+        self.assertEqual(qa.lookup_message_state(m1.id), 'unknown')
+
+    def test_message_exceeds_attempts_unavailable(self):
+        qa = self.sqlite_queue_adapter_factory(additional_options={'max_number_of_attempts': 2})
+        m1 = qa.enqueue(Message(payload='hello world'))
+        for attempts in range(2):
+            dq = qa.dequeue()
+            self.assertEqual(dq.attempts, attempts)
+            qa.rollback(dq)
+        self.assertIsNone(qa.dequeue())
+        self.assertEqual(qa.lookup_message_state(m1.id), 'unknown')
+
+    def test_lookup_message_state(self):
+        qa = self.sqlite_queue_adapter_factory(additional_options={'enable_archive': True})
+        m1 = qa.enqueue(Message(payload='hello 1'))
+        m2 = qa.enqueue(Message(payload='hello 2'))
+        self.assertEqual(qa.lookup_message_state(m1.id), 'queue')
+        dq = qa.dequeue()
+        self.assertEqual(qa.lookup_message_state(m1.id), 'lock')
+        qa.commit(dq)
+        self.assertEqual(qa.lookup_message_state(m1.id), 'complete.success')
+        qa.delete(m2.id)
+        self.assertEqual(qa.lookup_message_state(m2.id), 'complete.fail')
+        self.assertEqual(qa.lookup_message_state('no-such-message'), 'unknown')
+
+    def test_drop_archive_partitions(self):
+        qa = self.sqlite_queue_adapter_factory(additional_options={'enable_archive': True})
+        qa.enqueue(Message(payload='hello world'))
+        qa.commit(qa.dequeue())
+        self.assertEqual(qa.drop_archive_partitions(older_than=datetime.datetime.now()), 0)
+        self.assertEqual(qa.drop_archive_partitions(older_than=datetime.datetime.now() + datetime.timedelta(days=1)), 1)
+
+    def test_expired_lease_reclaimed(self):
+        base_path = get_unique_base_path('sqliteqa-lease')
+        consumer_1 = self.sqlite_queue_adapter_factory(base_path=base_path, additional_options={'lease_duration': 0.2})
+        consumer_2 = self.sqlite_queue_adapter_factory(base_path=base_path)
+        m1 = consumer_1.enqueue(Message(payload='hello world'))
+        dq_1 = consumer_1.dequeue()
+        self.assertIsNone(consumer_2.dequeue())
+
+        time.sleep(0.3)
+        dq_2 = consumer_2.dequeue()
+        self.assertEqual(dq_2.id, m1.id)
+        self.assertEqual(dq_2.attempts, 1)
+        with self.assertRaises(Exception):
+            consumer_1.commit(dq_1)
+        consumer_2.commit(dq_2)
+
+    def test_concurrent_consumers_claim_each_message_once(self):
+        base_path = get_unique_base_path('sqliteqa-concurrent')
+        messages = self.sqlite_queue_adapter_factory(base_path=base_path).enqueue_batch([Message(payload=f'hello {i}') for i in range(100)])
+        dequeued = []
+
+        def consume():
+            qa = self.sqlite_queue_adapter_factory(base_path=base_path)
+            while batch := qa.dequeue_batch(max_messages=3):
+                dequeued.extend(batch)
+
+        threads = [threading.Thread(target=consume) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(m.id for m in dequeued), sorted(m.id for m in messages))
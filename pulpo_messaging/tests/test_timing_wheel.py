@@ -0,0 +1,73 @@
+import random
+import unittest
+from pulpo_messaging.timing_wheel import TimingWheel
+
+
+class TestTimingWheel(unittest.TestCase):
+
+    def test_advance_empty(self):
+        wheel = TimingWheel()
+        self.assertEqual(wheel.advance(now=100), [])
+        self.assertIsNone(wheel.next_deadline)
+
+    def test_item_due_at_deadline(self):
+        wheel = TimingWheel()
+        wheel.add('a', deadline=100.005, now=100)
+        self.assertEqual(wheel.advance(now=100.004), [])
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(now=100.005), ['a'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_items_cascade_from_upper_levels(self):
+        wheel = TimingWheel()
+        deadlines = {'a': 100.2, 'b': 130, 'c': 100 + 3600, 'd': 100 + 86400 * 10}
+        for (item, deadline) in deadlines.items():
+            wheel.add(item, deadline=deadline, now=100)
+
+        for (item, deadline) in sorted(deadlines.items(), key=lambda d: d[1]):
+            self.assertEqual(wheel.advance(now=deadline - 0.002), [])
+            self.assertEqual(wheel.advance(now=deadline), [item])
+
+    def test_advance_over_idle_time(self):
+        wheel = TimingWheel()
+        wheel.add('a', deadline=150.25, now=100)
+        wheel.add('b', deadline=160, now=100)
+        self.assertEqual(wheel.advance(now=1000), ['a', 'b'])
+
+    def test_items_never_early_and_never_lost(self):
+        wheel = TimingWheel()
+        rng = random.Random(7)
+        deadlines = {i: 100 + rng.uniform(0, 300) for i in range(500)}
+        for (item, deadline) in deadlines.items():
+            wheel.add(item, deadline=deadline, now=100)
+
+        now = 100
+        due = set()
+        while now < 401:
+            now += rng.uniform(0, 2)
+            for item in wheel.advance(now=now):
+                self.assertLessEqual(deadlines[item], now)
+                due.add(item)
+            self.assertEqual(due, {item for (item, deadline) in deadlines.items() if deadline <= now})
+
+    def test_next_deadline(self):
+        wheel = TimingWheel()
+        wheel.add('a', deadline=100.05, now=100)
+        self.assertAlmostEqual(wheel.next_deadline, 100.05)
+
+        wheel = TimingWheel()
+        wheel.add('b', deadline=200, now=100)
+        # a lower bound for an item in an upper level: where it cascades
+        self.assertLessEqual(wheel.next_deadline, 200)
+        while wheel.next_deadline < 200:
+            self.assertEqual(wheel.advance(now=wheel.next_deadline), [])
+        self.assertEqual(wheel.advance(now=200), ['b'])
+
+    def test_deadline_already_passed_by_the_wheel(self):
+        wheel = TimingWheel()
+        wheel.add('a', deadline=200, now=100)
+        wheel.advance(now=150)
+        # the clock of the caller went back
+        wheel.add('b', deadline=140, now=130)
+        self.assertEqual(wheel.advance(now=135), [])
+        self.assertEqual(wheel.advance(now=140), ['b'])
@@ -0,0 +1,43 @@
+import unittest
+from pulpo_messaging.tube_scheduler import DeficitRoundRobin
+
+
+class TestDeficitRoundRobin(unittest.TestCase):
+
+    @staticmethod
+    def select_many(scheduler: DeficitRoundRobin, count: int, ready: set) -> list:
+        return [scheduler.select(lambda tube: tube in ready) for _ in range(count)]
+
+    def test_equal_weights_alternate(self):
+        scheduler = DeficitRoundRobin({'a': 1, 'b': 1})
+        self.assertEqual(TestDeficitRoundRobin.select_many(scheduler, 4, {'a', 'b'}), ['b', 'a', 'b', 'a'])
+
+    def test_weighted_share(self):
+        scheduler = DeficitRoundRobin({'bulk': 1, 'interactive': 3})
+        selected = TestDeficitRoundRobin.select_many(scheduler, 40, {'bulk', 'interactive'})
+        self.assertEqual(selected.count('interactive'), 30)
+        self.assertEqual(selected.count('bulk'), 10)
+
+    def test_fractional_weight(self):
+        scheduler = DeficitRoundRobin({'a': 1, 'b': 0.5})
+        selected = TestDeficitRoundRobin.select_many(scheduler, 30, {'a', 'b'})
+        self.assertEqual(selected.count('a'), 20)
+        self.assertEqual(selected.count('b'), 10)
+
+    def test_idle_tube_skipped(self):
+        scheduler = DeficitRoundRobin({'a': 1, 'b': 5})
+        self.assertEqual(TestDeficitRoundRobin.select_many(scheduler, 3, {'a'}), ['a', 'a', 'a'])
+
+    def test_no_tube_ready(self):
+        scheduler = DeficitRoundRobin({'a': 1, 'b': 1})
+        self.assertIsNone(scheduler.select(lambda tube: False))
+
+    def test_is_ready_called_once_per_tube(self):
+        scheduler = DeficitRoundRobin({'a': 1, 'b': 0.1})
+        calls = []
+        scheduler.select(lambda tube: calls.append(tube) or tube == 'b')
+        self.assertEqual(sorted(calls), ['a', 'b'])
+
+    def test_invalid_weight(self):
+        with self.assertRaises(Exception):
+            DeficitRoundRobin({'a': 0})
@@ -0,0 +1,122 @@
+import heapq
+import itertools
+import math
+
+
+class TimingWheel():
+    '''
+    Hierarchical timing wheel of items due at a deadline (epoch seconds), with a resolution of tick seconds (1 millisecond by default).
+    Level 0 has wheel_size slots of one tick; each level above has wheel_size slots, each spanning a whole turn of the level below, and levels are added as far deadlines need them.
+    An item is added to the lowest level whose current turn holds its deadline, in O(1).  When the wheel reaches the start of a slot of an upper level,
+    the items of the slot cascade to the levels below, so an item is moved at most once per level.
+    advance steps one tick at a time only while level 0 holds items; otherwise it jumps to the next occupied slot start, so its cost does not grow with the time elapsed.
+    Items are not removed: the caller drops items it no longer wants when they come due.
+    The wheel is held in memory only; an adapter rebuilds it from its store at startup.
+    '''
+
+    _tick = None
+    _wheel_size = None
+    _levels = None
+    _level_counts = None
+    # current time in ticks: every item held in the levels is due after it
+    _current = None
+    # items added with a deadline the wheel has already passed, which the clock of the caller has not (the clock went back): (deadline tick, order, item)
+    _overdue = None
+    _order = None
+
+    def __init__(self, tick: float = 0.001, wheel_size: int = 256):
+        self._tick = tick
+        self._wheel_size = wheel_size
+        self._levels = []
+        self._level_counts = []
+        self._overdue = []
+        self._order = itertools.count()
+
+    def __len__(self):
+        return sum(self._level_counts) + len(self._overdue)
+
+    @property
+    def next_deadline(self) -> float:
+        '''
+        Earliest time (epoch seconds) at which advance may return an item, or None if the wheel is empty.
+        This is the next deadline when level 0 holds items, and otherwise the start of the next occupied slot of the lowest occupied level, where its items cascade.
+        '''
+        candidates = []
+        if self._overdue:
+            candidates.append(self._overdue[0][0])
+        level = self._get_lowest_occupied_level()
+        if level is not None:
+            span = self._wheel_size**level
+            turn = self._current // span // self._wheel_size
+            slot_number = self._current // span + 1
+            while slot_number // self._wheel_size == turn:
+                if self._levels[level][slot_number % self._wheel_size]:
+                    candidates.append(slot_number * span)
+                    break
+                slot_number += 1
+        return min(candidates) * self._tick if candidates else None
+
+    def add(self, item, deadline: float, now: float):
+        deadline_tick = math.ceil(deadline / self._tick)
+        if len(self) == 0:
+            # nothing to cascade: restart from now rather than step over the idle time
+            self._current = math.floor(now / self._tick)
+        if deadline_tick <= self._current:
+            heapq.heappush(self._overdue, (deadline_tick, next(self._order), item))
+        else:
+            self._insert(deadline_tick, item)
+
+    def advance(self, now: float) -> list:
+        '''Moves the wheel to now, and returns the items due by now, in no particular order.'''
+        target = math.floor(now / self._tick)
+        due = []
+        while self._overdue and self._overdue[0][0] <= target:
+            due.append(heapq.heappop(self._overdue)[2])
+        while self._current is not None and self._current < target:
+            level = self._get_lowest_occupied_level()
+            if level is None:
+                self._current = target
+                break
+            span = self._wheel_size**level
+            next_tick = (self._current // span + 1) * span
+            if next_tick > target:
+                self._current = target
+                break
+            self._current = next_tick
+            self._cascade()
+            slot = self._levels[0][self._current % self._wheel_size]
+            if slot:
+                due.extend(item for (_, item) in slot)
+                self._level_counts[0] -= len(slot)
+                self._levels[0][self._current % self._wheel_size] = []
+        return due
+
+    def _get_lowest_occupied_level(self) -> int:
+        return next((level for (level, count) in enumerate(self._level_counts) if count), None)
+
+    def _insert(self, deadline_tick: int, item):
+        level = 0
+        span = 1
+        while deadline_tick // (span * self._wheel_size) != self._current // (span * self._wheel_size):
+            level += 1
+            span *= self._wheel_size
+        while len(self._levels) <= level:
+            self._levels.append([[] for _ in range(self._wheel_size)])
+            self._level_counts.append(0)
+        self._levels[level][(deadline_tick // span) % self._wheel_size].append((deadline_tick, item))
+        self._level_counts[level] += 1
+
+    def _cascade(self):
+        '''Moves down the items of the upper level slots starting at the current tick, highest level first.'''
+        for level in range(len(self._levels) - 1, 0, -1):
+            span = self._wheel_size**level
+            if self._current % span:
+                continue
+            slot_index = (self._current // span) % self._wheel_size
+            slot = self._levels[level][slot_index]
+            if not slot:
+                continue
+            self._levels[level][slot_index] = []
+            self._level_counts[level] -= len(slot)
+            for (deadline_tick, item) in slot:
+                self._insert(deadline_tick, item)
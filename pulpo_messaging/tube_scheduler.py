@@ -0,0 +1,55 @@
+from collections.abc import Callable
+
+
+class DeficitRoundRobin():
+    '''
+    Deficit round robin over a set of tubes, with a cost of one per message.
+    Each time the round visits a tube, the tube's deficit grows by its weight; the tube is then served while its deficit covers a message.
+    Over time each busy tube is served in proportion to its weight, and a tube with nothing ready gives up its deficit (it cannot bank credit while idle).
+    Weights may be fractional (e.g. 0.5 serves a tube on every other round), but must be positive.
+    '''
+
+    _weights = None
+    _tubes = None
+    _deficits = None
+    _position = None
+
+    def __init__(self, weights: dict):
+        if not weights:
+            raise Exception('deficit round robin requires at least one tube')
+        for tube, weight in weights.items():
+            if not weight or float(weight) <= 0:
+                raise Exception(f'invalid tube weight [{tube=}][{weight=}]')
+        self._weights = {tube: float(weight) for tube, weight in weights.items()}
+        self._tubes = list(self._weights)
+        self._deficits = {tube: 0.0 for tube in self._tubes}
+        self._position = 0
+
+    @property
+    def tubes(self) -> list:
+        return list(self._tubes)
+
+    def select(self, is_ready: Callable[[str], bool]) -> str:
+        '''
+        Returns the next tube to serve, or None when no tube is ready.
+        is_ready is called at most once per tube per selection.
+        '''
+        readiness = {}
+
+        def check(tube: str) -> bool:
+            if tube not in readiness:
+                readiness[tube] = is_ready(tube)
+            return readiness[tube]
+
+        while True:
+            tube = self._tubes[self._position]
+            if not check(tube):
+                self._deficits[tube] = 0.0
+            elif self._deficits[tube] >= 1:
+                self._deficits[tube] -= 1
+                return tube
+
+            if len(readiness) == len(self._tubes) and not any(readiness.values()):
+                return None
+            self._position = (self._position + 1) % len(self._tubes)
+            self._deficits[self._tubes[self._position]] += self._weights[self._tubes[self._position]]
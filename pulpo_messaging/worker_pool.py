@@ -0,0 +1,84 @@
+import concurrent.futures
+from loguru import logger
+from .message import Message
+from .payload_handler import PayloadHandler, RequestResult
+
+WORKER_POOL_MODE_THREAD = 'thread'
+WORKER_POOL_MODE_PROCESS = 'process'
+
+
+def invoke_handler(handler: PayloadHandler, payload) -> RequestResult:
+    '''Module level so that it can be pickled for the process pool.'''
+    return handler.handle(payload=payload)
+
+
+class WorkerPool():
+    '''
+    Runs payload handlers on a `concurrent.futures` pool.
+    Only the handler invocation runs on the pool; the dispatcher (Pulpo.start) keeps ownership of the queue adapter and commits or rolls back each message as its future completes.
+    In `process` mode the handler and payload must be picklable.
+    '''
+
+    _executor = None
+    _in_flight = None
+    _size = None
+    _capacity = None
+
+    def __init__(self, mode: str, size: int, prefetch: int = 0):
+        if mode == WORKER_POOL_MODE_THREAD:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=size, thread_name_prefix='pulpo-worker')
+        elif mode == WORKER_POOL_MODE_PROCESS:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=size)
+        else:
+            raise Exception(f'invalid worker pool mode [{mode}]')
+        self._size = size
+        self._capacity = size + max(prefetch, 0)
+        self._in_flight = {}
+        logger.debug(f'worker pool started [{mode=}][{size=}][{prefetch=}]')
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def in_flight_count(self) -> int:
+        return len(self._in_flight)
+
+    @property
+    def available_capacity(self) -> int:
+        '''Number of messages that may be submitted before the pool is saturated (workers + prefetch).'''
+        return max(self._capacity - len(self._in_flight), 0)
+
+    def submit(self, message: Message, handler: PayloadHandler):
+        future = self._executor.submit(invoke_handler, handler, message.payload)
+        self._in_flight[future] = message
+
+    def wait_for_completed(self, timeout: float = None) -> list:
+        '''
+        Waits until at least one in-flight message completes (or timeout), and returns a list of (message, result) for every completed message.
+        A handler that raises is reported as a transient failure, so the message is rolled back rather than lost.
+        '''
+        if not self._in_flight:
+            return []
+        done, _ = concurrent.futures.wait(self._in_flight.keys(), timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+        completed = []
+        for future in done:
+            message = self._in_flight.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.warning(f'handler raised exception [id={message.id}][type={message.request_type}][{e=}]')
+                result = RequestResult.transient_factory(error=str(e))
+            completed.append((message, result))
+        return completed
+
+    def drain(self) -> list:
+        '''Waits for all in-flight messages, returning a list of (message, result).'''
+        completed = []
+        while self._in_flight:
+            completed.extend(self.wait_for_completed())
+        return completed
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+        logger.debug('worker pool shutdown')